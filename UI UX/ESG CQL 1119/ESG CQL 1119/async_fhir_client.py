@@ -0,0 +1,323 @@
+"""
+Async SMART on FHIR Client Module
+以 asyncio + httpx 連線池（HTTP/2、keep-alive）擷取FHIR資料
+介面與 fhir_client.FHIRClient 相同，但所有 getter 皆為 coroutine
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, Optional, AsyncIterator
+from urllib.parse import urljoin
+
+from fhir_client import FHIRClient, MultiServerFHIRClient
+import shared_path  # noqa: F401
+from fhir_shared.json_decoder import get_decoder
+from fhir_shared.fhir_scheduler import RequestScheduler, FHIRRequestError, get_scheduler
+
+try:
+    import httpx
+except ImportError:  # 選用套件：僅在 fetch.transport = async 時需要
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+
+def _http2_available() -> bool:
+    """HTTP/2 需要額外安裝 h2 套件 (pip install httpx[http2])"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class AsyncFHIRClient:
+    """Async FHIR Client - 使用共用連線池，可同時進行多個請求"""
+    
+    CQL_RESOURCE_TYPES = FHIRClient.CQL_RESOURCE_TYPES
+    
+    def __init__(self, base_url: str, name: str = "FHIR Server", auth_token: Optional[str] = None,
+                 page_size: int = 100, max_pages: Optional[int] = None, max_concurrency: int = 4,
+                 timeout: float = 30.0, connect_timeout: float = 10.0,
+                 max_keepalive: Optional[int] = None, http2: bool = True,
+                 json_decoder: str = 'auto', scheduler: Optional[RequestScheduler] = None,
+                 resource_types: Optional[List[str]] = None):
+        """
+        初始化非同步FHIR客戶端
+        
+        Args:
+            base_url: FHIR伺服器基礎URL
+            name: 伺服器名稱
+            auth_token: OAuth認證token (如需要)
+            page_size: 每頁資源筆數 (搜尋參數 _count)
+            max_pages: 每次搜尋最多擷取頁數 (None = 不限制)
+            max_concurrency: 連線池最大連線數（同時請求上限）
+            timeout: 每個請求的預設逾時秒數（讀取/寫入/取得連線）
+            connect_timeout: 建立連線的逾時秒數
+            max_keepalive: 保持 keep-alive 的閒置連線數（預設同 max_concurrency）
+            http2: 是否啟用 HTTP/2（未安裝 h2 時自動退回 HTTP/1.1）
+            json_decoder: Bundle 解碼後端 (auto / orjson / json)；stream 在此以整頁解碼處理
+            scheduler: 請求排程器（與同步客戶端共用速率限制與重試），None = 行程共用排程器
+            resource_types: 擷取的資源類型（依擷取順序），None = CQL_RESOURCE_TYPES
+        """
+        if httpx is None:
+            raise ImportError("AsyncFHIRClient 需要 httpx 套件，請執行: pip install httpx[http2]")
+        
+        self.base_url = base_url.rstrip('/')
+        self.name = name
+        self.auth_token = auth_token
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self.decoder = get_decoder(json_decoder)
+        self.scheduler = scheduler or get_scheduler()
+        self.resource_types = list(resource_types or self.CQL_RESOURCE_TYPES)
+        
+        if http2 and not _http2_available():
+            logger.warning(f"{name}: 未安裝 h2 套件，改用 HTTP/1.1 keep-alive 連線")
+            http2 = False
+        
+        headers = {
+            'Accept': 'application/fhir+json',
+            'Content-Type': 'application/fhir+json'
+        }
+        if auth_token:
+            headers['Authorization'] = f'Bearer {auth_token}'
+        
+        self.client = httpx.AsyncClient(
+            headers=headers,
+            http2=http2,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_concurrency,
+                max_keepalive_connections=max_keepalive or self.max_concurrency
+            )
+        )
+    
+    async def __aenter__(self) -> 'AsyncFHIRClient':
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+    
+    async def aclose(self):
+        """關閉連線池"""
+        await self.client.aclose()
+    
+    async def _get_bundle(self, url: str, params: Optional[Dict], resource_type: str,
+                          timeout: Optional[float] = None) -> Dict:
+        """
+        以GET取得單一Bundle頁面
+        
+        暫時性錯誤由排程器重試；重試用盡後拋出 FHIRRequestError（與同步版相同）。
+        asyncio.CancelledError 不會被攔截，呼叫端取消 task 時請求會立即中止並釋放連線。
+        """
+        try:
+            response = await self.scheduler.arequest(
+                self.client, 'GET', url, params=params,
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+            )
+            response.raise_for_status()
+            
+            data = self.decoder.loads(response.content)
+            logger.info(f"成功從 {self.name} 取得 {resource_type} 資料 ({response.http_version})")
+            return data
+        
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error(f"從 {self.name} 請求 {resource_type} 失敗: {e}")
+            raise FHIRRequestError(f"從 {self.name} 請求 {resource_type} 失敗: {e}") from e
+    
+    def _get_next_link(self, bundle: Dict) -> Optional[str]:
+        """從 Bundle.link 中提取 relation=next 的下一頁連結"""
+        for link in bundle.get('link', []):
+            if link.get('relation') == 'next':
+                next_url = link.get('url')
+                if next_url:
+                    return urljoin(self.base_url + '/', next_url)
+        return None
+    
+    async def iter_pages(self, resource_type: str, params: Optional[Dict] = None,
+                         timeout: Optional[float] = None) -> AsyncIterator[Dict]:
+        """逐頁產生搜尋結果Bundle（跟隨 Bundle.link[relation=next]）"""
+        search_params = dict(params or {})
+        search_params.setdefault('_count', self.page_size)
+        
+        url = urljoin(self.base_url + '/', resource_type)
+        logger.info(f"請求 {self.name}: {resource_type} (_count={search_params['_count']})")
+        bundle = await self._get_bundle(url, search_params, resource_type, timeout)
+        page_count = 1
+        
+        while True:
+            yield bundle
+            
+            next_link = self._get_next_link(bundle)
+            if not next_link:
+                break
+            if self.max_pages is not None and page_count >= self.max_pages:
+                logger.warning(f"{self.name} {resource_type} 已達頁數上限 {self.max_pages}，停止分頁")
+                break
+            
+            bundle = await self._get_bundle(next_link, None, resource_type, timeout)
+            page_count += 1
+            logger.info(f"取得 {resource_type} 第 {page_count} 頁: {len(bundle.get('entry', []))} 筆")
+    
+    async def iter_resources(self, resource_type: str, params: Optional[Dict] = None,
+                             timeout: Optional[float] = None) -> AsyncIterator[Dict]:
+        """以 async generator 逐頁產生資源"""
+        async for bundle in self.iter_pages(resource_type, params, timeout):
+            for entry in bundle.get('entry', []):
+                if 'resource' in entry:
+                    yield entry['resource']
+    
+    async def search(self, resource_type: str, params: Optional[Dict] = None,
+                     timeout: Optional[float] = None) -> List[Dict]:
+        """取得某資源類型的所有分頁結果"""
+        return [resource async for resource in self.iter_resources(resource_type, params, timeout)]
+    
+    async def get_patients(self, params: Optional[Dict] = None, timeout: Optional[float] = None) -> List[Dict]:
+        """取得Patient資源列表"""
+        return await self.search('Patient', params, timeout)
+    
+    async def get_encounters(self, params: Optional[Dict] = None, timeout: Optional[float] = None) -> List[Dict]:
+        """取得Encounter資源列表"""
+        return await self.search('Encounter', params, timeout)
+    
+    async def get_medication_requests(self, params: Optional[Dict] = None,
+                                      timeout: Optional[float] = None) -> List[Dict]:
+        """取得MedicationRequest資源列表"""
+        return await self.search('MedicationRequest', params, timeout)
+    
+    async def get_medication_administrations(self, params: Optional[Dict] = None,
+                                             timeout: Optional[float] = None) -> List[Dict]:
+        """取得MedicationAdministration資源列表"""
+        return await self.search('MedicationAdministration', params, timeout)
+    
+    async def get_observations(self, params: Optional[Dict] = None, timeout: Optional[float] = None) -> List[Dict]:
+        """取得Observation資源列表"""
+        return await self.search('Observation', params, timeout)
+    
+    async def get_procedures(self, params: Optional[Dict] = None, timeout: Optional[float] = None) -> List[Dict]:
+        """取得Procedure資源列表"""
+        return await self.search('Procedure', params, timeout)
+    
+    async def get_document_references(self, params: Optional[Dict] = None,
+                                      timeout: Optional[float] = None) -> List[Dict]:
+        """取得DocumentReference資源列表"""
+        return await self.search('DocumentReference', params, timeout)
+    
+    async def get_diagnostic_reports(self, params: Optional[Dict] = None,
+                                     timeout: Optional[float] = None) -> List[Dict]:
+        """取得DiagnosticReport資源列表"""
+        return await self.search('DiagnosticReport', params, timeout)
+    
+    async def get_all_resources_for_cql(self, date_range: Optional[tuple] = None,
+                                        search_plan: Optional[Dict[str, Dict]] = None) -> Dict[str, List[Dict]]:
+        """
+        並行取得CQL執行所需的所有資源（同一連線池，受 max_concurrency 限制）
+        
+        Args:
+            date_range: (start_date, end_date) 日期範圍
+            search_plan: QueryPlanner 產生的 {資源類型: 搜尋參數}
+        
+        Returns:
+            包含所有資源類型的字典
+        """
+        params = {}
+        if date_range:
+            start_date, end_date = date_range
+            params['_lastUpdated'] = f'ge{start_date.isoformat()}'
+        
+        logger.info(f"開始從 {self.name} 非同步擷取所有CQL所需資源...")
+        
+        async def fetch(resource_type: str) -> List[Dict]:
+            type_params = FHIRClient.plan_params(resource_type, search_plan)
+            if type_params is None:
+                return []
+            return await self.search(resource_type, {**type_params, **params})
+        
+        results = await asyncio.gather(*(fetch(resource_type) for resource_type in self.resource_types))
+        resources = dict(zip(self.resource_types, results))
+        
+        total_count = sum(len(r) for r in resources.values())
+        logger.info(f"從 {self.name} 共取得 {total_count} 筆資源")
+        
+        for resource_type, resource_list in resources.items():
+            logger.info(f"  - {resource_type}: {len(resource_list)} 筆")
+        
+        return resources
+
+
+class AsyncMultiServerFHIRClient(MultiServerFHIRClient):
+    """管理多個非同步FHIR伺服器客戶端（合併邏輯沿用 MultiServerFHIRClient）"""
+    
+    def __init__(self, server_configs: List[Dict], fetch_config: Optional[Dict] = None,
+                 resource_types: Optional[List[str]] = None):
+        """
+        初始化多伺服器非同步客戶端
+        
+        Args:
+            server_configs: 伺服器配置列表
+            fetch_config: 擷取模式設定 (來自config.yaml的fetch)
+                per_server_concurrency: 每個伺服器的連線池大小
+                request_timeout: 每個請求的逾時秒數
+                total_timeout: 整體擷取逾時秒數，逾時即取消所有請求 (None = 不限制)
+                http2: 是否啟用 HTTP/2
+            resource_types: 擷取的資源類型，None = FHIRClient.CQL_RESOURCE_TYPES
+        """
+        fetch_config = fetch_config or {}
+        self.resource_types = list(resource_types or FHIRClient.CQL_RESOURCE_TYPES)
+        per_server_concurrency = fetch_config.get('per_server_concurrency', 4)
+        self.total_timeout = fetch_config.get('total_timeout')
+        self.dedupe = fetch_config.get('dedupe', 'server')
+        self.scheduler = self._setup_scheduler(server_configs, fetch_config)
+        
+        # httpx 連線池綁定於建立它的 event loop，因此只保存參數，
+        # 每次擷取時在該次的 event loop 內建立並關閉客戶端
+        self.client_kwargs = []
+        
+        for config in server_configs:
+            if config.get('enabled', True):
+                if config.get('bulk_export', False):
+                    raise ValueError(f"{config.get('name', 'FHIR Server')}: 非同步傳輸不支援 bulk_export，"
+                                     f"請移除 bulk_export 或改用 transport: sync")
+                self.client_kwargs.append({
+                    'base_url': config['base_url'],
+                    'name': config.get('name', 'FHIR Server'),
+                    'auth_token': config.get('auth_token'),
+                    'page_size': config.get('page_size', 100),
+                    'max_pages': config.get('max_pages'),
+                    'max_concurrency': config.get('max_concurrency', per_server_concurrency),
+                    'timeout': fetch_config.get('request_timeout', 30.0),
+                    'http2': fetch_config.get('http2', True),
+                    'json_decoder': fetch_config.get('json_decoder', 'auto'),
+                    'scheduler': self.scheduler,
+                    'resource_types': self.resource_types
+                })
+        
+        logger.info(f"已初始化 {len(self.client_kwargs)} 個非同步FHIR伺服器連線設定")
+    
+    async def fetch_all_servers(self, date_range: Optional[tuple] = None,
+                                search_plan: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict[str, List[Dict]]]:
+        """
+        同時從所有伺服器擷取資源；超過 total_timeout 時取消所有進行中的請求
+        
+        Returns:
+            {'server1': {'Patient': [...], ...}, 'server2': {...}}
+        """
+        clients = [AsyncFHIRClient(**kwargs) for kwargs in self.client_kwargs]
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(*(client.get_all_resources_for_cql(date_range, search_plan) for client in clients)),
+                timeout=self.total_timeout
+            )
+        finally:
+            await asyncio.gather(*(client.aclose() for client in clients))
+        
+        return {f"server{idx}": data for idx, data in enumerate(results, 1)}
+    
+    def get_all_resources_from_all_servers(self, date_range: Optional[tuple] = None,
+                                           concurrent: Optional[bool] = None,
+                                           search_plan: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict[str, List[Dict]]]:
+        """同步呼叫介面，供 main.py 以相同流程使用（concurrent 參數僅為相容保留）"""
+        return asyncio.run(self.fetch_all_servers(date_range, search_plan))
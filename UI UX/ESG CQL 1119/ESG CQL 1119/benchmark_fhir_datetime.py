@@ -0,0 +1,119 @@
+"""
+FHIR 日期解析效能測試 - DataFilter 的時間範圍過濾
+
+比較原本 DataFilter._parse_fhir_datetime 逐一嘗試五種 strptime 格式的寫法（legacy_parse，只保留在此）
+與 fhir_datetime.parse_fhir_datetime（單次正規表示式解析 + LRU 快取），
+並以 DataFilter.filter_fhir_data 測量整體過濾時間
+
+用法:
+    python benchmark_fhir_datetime.py              # 預設 10 萬、50 萬筆資源
+    python benchmark_fhir_datetime.py 1000000      # 指定資源筆數
+"""
+
+import sys
+import time
+import random
+from datetime import datetime
+
+from data_filter import DataFilter
+from fhir_datetime import parse_fhir_datetime
+
+DEFAULT_SIZES = [100_000, 500_000]
+REPEAT = 3
+
+
+def legacy_parse(date_str: str) -> datetime:
+    """原本的寫法：移除時區後逐一嘗試 strptime 格式，全部失敗回傳目前時間"""
+    date_str = date_str.replace('Z', '+00:00')
+    formats = [
+        '%Y-%m-%dT%H:%M:%S.%f%z',
+        '%Y-%m-%dT%H:%M:%S%z',
+        '%Y-%m-%dT%H:%M:%S.%f',
+        '%Y-%m-%dT%H:%M:%S',
+        '%Y-%m-%d'
+    ]
+    for fmt in formats:
+        try:
+            clean_str = date_str.split('+')[0].split('-', 3)
+            if len(clean_str) >= 3:
+                clean_str = '-'.join(clean_str[:3])
+            else:
+                clean_str = date_str.split('+')[0]
+            return datetime.strptime(clean_str, fmt.split('%z')[0].strip())
+        except:
+            continue
+    return datetime.now()
+
+
+def build_dates(size: int) -> list:
+    """產生測試日期字串：dateTime（含 +08:00、Z 與毫秒）、date 與部分日期混合，日期約兩年內"""
+    rng = random.Random(size)
+    dates = []
+    for _ in range(size):
+        day = f"{rng.choice((2024, 2025))}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        kind = rng.random()
+        if kind < 0.5:
+            dates.append(f"{day}T{rng.randint(8, 17):02d}:{rng.choice((0, 30)):02d}:00+08:00")
+        elif kind < 0.7:
+            dates.append(f"{day}T{rng.randint(0, 23):02d}:00:00.000Z")
+        elif kind < 0.95:
+            dates.append(day)
+        else:
+            dates.append(day[:7])
+    return dates
+
+
+def build_data(dates: list) -> dict:
+    """日期字串 → Encounter / Observation / MedicationRequest 資源"""
+    data = {'Encounter': [], 'Observation': [], 'MedicationRequest': []}
+    for index, date in enumerate(dates):
+        kind = index % 3
+        if kind == 0:
+            data['Encounter'].append({'resourceType': 'Encounter', 'id': str(index), 'period': {'start': date}})
+        elif kind == 1:
+            data['Observation'].append({'resourceType': 'Observation', 'id': str(index), 'effectiveDateTime': date})
+        else:
+            data['MedicationRequest'].append({'resourceType': 'MedicationRequest', 'id': str(index),
+                                              'authoredOn': date})
+    return data
+
+
+def best_of(func, repeat=REPEAT):
+    """重複執行取最短時間（秒）"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def cold_parse(dates: list):
+    """清空 LRU 快取後解析（每個不同字串解析一次）"""
+    parse_fhir_datetime.cache_clear()
+    for date in dates:
+        parse_fhir_datetime(date)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    data_filter = DataFilter({'time_range': {'years': 2}})
+    
+    legacy_failures = sum(1 for date in ('2024-03', '2024') if legacy_parse(date).date() == datetime.now().date())
+    print(f"原本的解析: 部分日期 ('2024-03', '2024') 有 {legacy_failures} 個被當作目前時間")
+    print(f"FHIR 日期解析效能測試 (每項取 {REPEAT} 次最短時間)")
+    print(f"{'筆數':>10} {'strptime':>10} {'單次解析':>10} {'LRU 命中':>10} {'filter_fhir_data':>18} {'倍數':>7}")
+    for size in sizes:
+        dates = build_dates(size)
+        data = build_data(dates)
+        
+        legacy = best_of(lambda: [legacy_parse(date) for date in dates])
+        cold = best_of(lambda: cold_parse(dates))
+        warm = best_of(lambda: [parse_fhir_datetime(date) for date in dates])
+        filtering = best_of(lambda: data_filter.filter_fhir_data(data))
+        print(f"{size:>10,} {legacy * 1000:>8.0f}ms {cold * 1000:>8.0f}ms {warm * 1000:>8.0f}ms "
+              f"{filtering * 1000:>16.0f}ms {legacy / warm:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
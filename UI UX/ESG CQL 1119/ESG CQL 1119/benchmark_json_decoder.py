@@ -0,0 +1,99 @@
+"""
+JSON 解碼效能測試 - 比較 json / orjson / stream 解析大型 FHIR Bundle
+
+用法:
+    python benchmark_json_decoder.py                # 使用專案內的大型測試 Bundle
+    python benchmark_json_decoder.py a.json b.json  # 指定檔案
+"""
+
+import sys
+import time
+from pathlib import Path
+
+import shared_path  # noqa: F401
+from fhir_shared.json_decoder import get_decoder, orjson
+
+# 專案內的大型測試 Bundle（相對於 UI UX 目錄）
+UI_DIR = Path(__file__).resolve().parents[2]
+DEFAULT_BUNDLES = [
+    UI_DIR / 'FHIR-Dashboard-App' / 'Dementia_Hospice_19_Patients.json',
+    UI_DIR / 'HAPI-FHIR-Samples' / 'CGMH_test_data_outpatient_quality_53_bundle.json',
+    UI_DIR / 'HAPI-FHIR-Samples' / 'CGMH_test_data_quality_50_bundle.json',
+    UI_DIR / 'HAPI-FHIR-Samples' / 'CGMH_test_data_same_hospital_overlap_42_bundle.json',
+    UI_DIR / 'HAPI-FHIR-Samples' / 'CGMH_test_data_antibiotic_49_bundle.json',
+    UI_DIR / 'HAPI-FHIR-Samples' / 'CGMH_test_data_taiwan_100_bundle.json',
+]
+
+CHUNK_SIZE = 65536  # 與 FHIRClient 串流下載的 chunk 大小相同
+REPEAT = 20
+
+
+def best_of(func, repeat=REPEAT):
+    """重複執行取最短時間（秒）"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_file(path: Path):
+    """測試單一 Bundle 檔案"""
+    raw = path.read_bytes()
+    if raw.startswith(b'\xef\xbb\xbf'):
+        # 伺服器回應不含 BOM；orjson 不接受 BOM
+        raw = raw[3:]
+    chunks = [raw[i:i + CHUNK_SIZE] for i in range(0, len(raw), CHUNK_SIZE)]
+    
+    print(f"\n{path.name} ({len(raw) / 1024:.0f} KB)")
+    
+    results = {}
+    for name in ('json', 'orjson'):
+        if name == 'orjson' and orjson is None:
+            print("  orjson : 未安裝 (pip install orjson)")
+            continue
+        decoder = get_decoder(name)
+        entries = len(decoder.loads(raw).get('entry', []))
+        results[name] = best_of(lambda: decoder.loads(raw))
+        print(f"  {name:<7}: {results[name] * 1000:8.2f} ms  ({entries} entries)")
+    
+    stream = get_decoder('stream')
+    
+    def consume():
+        for _ in stream.iter_entries(chunks):
+            pass
+    
+    def first_entry():
+        next(iter(stream.iter_entries(chunks)), None)
+    
+    results['stream'] = best_of(consume)
+    print(f"  stream : {results['stream'] * 1000:8.2f} ms  "
+          f"(第一筆資源: {best_of(first_entry) * 1000:.2f} ms)")
+    
+    baseline = results['json']
+    for name, elapsed in results.items():
+        if name != 'json':
+            print(f"  {name} / json = {elapsed / baseline:.2f}x")
+    return results
+
+
+def main():
+    paths = [Path(p) for p in sys.argv[1:]] or [p for p in DEFAULT_BUNDLES if p.exists()]
+    if not paths:
+        print("找不到測試 Bundle 檔案")
+        return
+    
+    print(f"JSON 解碼效能測試 (每項取 {REPEAT} 次最短時間, chunk={CHUNK_SIZE} bytes)")
+    totals = {}
+    for path in paths:
+        for name, elapsed in benchmark_file(path).items():
+            totals[name] = totals.get(name, 0) + elapsed
+    
+    print("\n合計:")
+    for name, elapsed in totals.items():
+        print(f"  {name:<7}: {elapsed * 1000:8.2f} ms  ({totals['json'] / elapsed:.2f}x vs json)")
+
+
+if __name__ == '__main__':
+    main()
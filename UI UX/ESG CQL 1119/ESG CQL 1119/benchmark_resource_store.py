@@ -0,0 +1,81 @@
+"""
+FHIRStore 索引效能測試 - EHR 採用率的「就醫 × 文件」join
+
+比較原本逐一就醫掃描所有 DocumentReference 的巢狀迴圈（O(E×D)）
+與 FHIRStore.by_encounter 雜湊索引（O(E+D)，含建立索引的時間）
+
+用法:
+    python benchmark_resource_store.py              # 預設規模 500 ~ 8000 次就醫
+    python benchmark_resource_store.py 1000 20000   # 指定就醫次數
+"""
+
+import sys
+import time
+import random
+from datetime import datetime
+
+from cql_engine import FHIRStore
+from cql_processor import CQLProcessor
+
+DEFAULT_SIZES = [500, 1000, 2000, 4000, 8000]
+DOCUMENTS_PER_ENCOUNTER = 0.8
+REPEAT = 3
+EHR_CQL = 'EHR_Adoption_Rate.cql'
+
+
+def build_data(num_encounters: int) -> dict:
+    """產生測試資料：每次就醫約 0.8 份文件，文件以 context 參照隨機的就醫"""
+    rng = random.Random(num_encounters)
+    encounters = [{'resourceType': 'Encounter', 'id': f'enc-{i}', 'subject': {'reference': f'Patient/p-{i % 100}'}}
+                  for i in range(num_encounters)]
+    documents = [{'resourceType': 'DocumentReference', 'id': f'doc-{i}',
+                  'context': {'reference': f'Encounter/enc-{rng.randrange(num_encounters)}'}}
+                 for i in range(int(num_encounters * DOCUMENTS_PER_ENCOUNTER))]
+    patients = [{'resourceType': 'Patient', 'id': f'p-{i}'} for i in range(100)]
+    return {'Patient': patients, 'Encounter': encounters, 'DocumentReference': documents}
+
+
+def nested_join(data: dict) -> int:
+    """原本的寫法：每次就醫掃描所有文件"""
+    documents = data['DocumentReference']
+    return len([e for e in data['Encounter']
+                if any(d.get('context', {}).get('reference', '').endswith(e.get('id', ''))
+                       for d in documents)])
+
+
+def indexed_join(data: dict) -> int:
+    """FHIRStore 索引（每次重新建立 store，計入建立索引的時間）"""
+    store = FHIRStore(data)
+    return len([e for e in data['Encounter']
+                if store.by_encounter(f"Encounter/{e['id']}", 'DocumentReference')])
+
+
+def best_of(func, repeat=REPEAT):
+    """重複執行取最短時間（秒）"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    processor = CQLProcessor(EHR_CQL)
+    period = (datetime(2025, 1, 1), datetime(2025, 12, 31, 23, 59, 59))
+    
+    print(f"EHR 採用率 join 效能測試 (每項取 {REPEAT} 次最短時間, 每次就醫 {DOCUMENTS_PER_ENCOUNTER} 份文件)")
+    print(f"{'就醫次數':>8} {'巢狀迴圈':>12} {'索引 join':>12} {'_execute_ehr_adoption':>22} {'倍數':>8}")
+    for size in sizes:
+        data = build_data(size)
+        assert nested_join(data) == indexed_join(data)
+        nested = best_of(lambda: nested_join(data))
+        indexed = best_of(lambda: indexed_join(data))
+        adoption = best_of(lambda: processor._execute_ehr_adoption(FHIRStore(data), period))
+        print(f"{size:>8} {nested * 1000:>10.1f}ms {indexed * 1000:>10.2f}ms {adoption * 1000:>20.2f}ms "
+              f"{nested / indexed:>7.0f}x")
+
+
+if __name__ == '__main__':
+    main()
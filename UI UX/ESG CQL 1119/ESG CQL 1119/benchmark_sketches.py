@@ -0,0 +1,82 @@
+"""
+近似統計效能測試 - 不重複病人數與年齡分位數
+
+比較精確計算（Python set、保留全部年齡後排序）與 sketches 的 HyperLogLog / QuantileSketch：
+分批加入（模擬逐頁擷取的資源），輸出耗時、累計時的記憶體峰值（tracemalloc）與估計誤差
+
+用法:
+    python benchmark_sketches.py                 # 預設 1、4 百萬筆紀錄
+    python benchmark_sketches.py 10000000        # 指定紀錄筆數
+"""
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import shared_path  # noqa: F401
+from fhir_shared.sketches import HyperLogLog, QuantileSketch
+
+DEFAULT_SIZES = [1_000_000, 4_000_000]
+BATCH = 100_000
+
+
+def build_batches(size: int):
+    """產生測試紀錄：病人 ID（約一半不重複）與年齡，每批 BATCH 筆"""
+    rng = np.random.default_rng(size)
+    for start in range(0, size, BATCH):
+        count = min(BATCH, size - start)
+        ids = rng.integers(0, size // 2, count)
+        yield [f"Patient/{value}" for value in ids.tolist()], rng.gamma(6.0, 8.0, count).round()
+
+
+def exact(size: int):
+    """精確計算：病人 ID 放入 set，年齡全部保留後取分位數"""
+    patients, ages = set(), []
+    for ids, batch_ages in build_batches(size):
+        patients.update(ids)
+        ages.extend(batch_ages.tolist())
+    return len(patients), np.percentile(ages, [50, 90], method='lower')
+
+
+def approximate(size: int):
+    """sketch：HyperLogLog + QuantileSketch（記憶體固定）"""
+    patients, ages = HyperLogLog(), QuantileSketch()
+    for ids, batch_ages in build_batches(size):
+        patients.update(ids)
+        ages.update(batch_ages)
+    summary = ages.summary()['quantiles']
+    return patients.summary(), [summary['p50']['value'], summary['p90']['value']]
+
+
+def measure(func, size: int):
+    """(結果, 秒數, 記憶體峰值 MB)；tracemalloc 會拖慢執行，耗時與記憶體分兩次測量"""
+    start = time.perf_counter()
+    result = func(size)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func(size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 1024 / 1024
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    
+    print(f"近似統計效能測試 (每批 {BATCH:,} 筆)")
+    print(f"{'紀錄筆數':>12} {'方式':>6} {'不重複病人':>22} {'年齡 p50 / p90':>16} {'耗時':>8} {'記憶體峰值':>10}")
+    for size in sizes:
+        (count, quantiles), seconds, peak = measure(exact, size)
+        print(f"{size:>12,} {'精確':>6} {count:>22,} {quantiles[0]:>7.1f} / {quantiles[1]:<6.1f} "
+              f"{seconds:>7.2f}s {peak:>8.1f}MB")
+        (bounds, estimates), seconds, peak = measure(approximate, size)
+        estimate = f"{bounds['estimate']:,} ({(bounds['estimate'] - count) / count:+.2%})"
+        print(f"{'':>12} {'sketch':>6} {estimate:>22} {estimates[0]:>7.1f} / {estimates[1]:<6.1f} "
+              f"{seconds:>7.2f}s {peak:>8.1f}MB")
+        print(f"{'':>12} {'':>6} 95% 信賴區間 {bounds['lower']:,}–{bounds['upper']:,}")
+
+
+if __name__ == '__main__':
+    main()
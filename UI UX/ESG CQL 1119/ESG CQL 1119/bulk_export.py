@@ -0,0 +1,200 @@
+"""
+FHIR Bulk Data Export Module
+以 FHIR Bulk Data Access ($export) 大量擷取資源：
+kick-off → 輪詢 Content-Location → 並行下載 NDJSON → 逐行解析
+"""
+
+import json
+import time
+import logging
+import threading
+from typing import Dict, List, Optional, Any, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import requests
+
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class BulkExportError(Exception):
+    """Bulk export 無法完成（伺服器不支援、逾時或匯出失敗）"""
+
+
+class BulkDataExporter:
+    """FHIR Bulk Data $export 客戶端（系統層級匯出）"""
+    
+    def __init__(self, session: requests.Session, base_url: str, name: str = "FHIR Server",
+                 poll_interval: float = 5.0, max_wait: float = 3600.0, download_workers: int = 4,
+                 decoder=None, scheduler=None):
+        """
+        初始化Bulk Data匯出器
+        
+        Args:
+            session: 已設定認證 headers 的 requests.Session（與 FHIRClient 共用）
+            base_url: FHIR伺服器基礎URL
+            name: 伺服器名稱
+            poll_interval: 伺服器未提供 Retry-After 時的輪詢間隔秒數
+            max_wait: 等待匯出完成的最長秒數
+            download_workers: 同時下載 NDJSON 檔案的數量
+            decoder: json_decoder 解碼後端（None = 標準 json），用於解析每一行
+            scheduler: 請求排程器（None = 行程共用排程器）
+        """
+        self.session = session
+        self.base_url = base_url.rstrip('/')
+        self.name = name
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.download_workers = max(1, download_workers)
+        self.loads = decoder.loads if decoder is not None else json.loads
+        self.scheduler = scheduler or get_scheduler()
+        # 各資源類型下載量 {resource_type: {'resources': n, 'bytes': b}}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self._stats_lock = threading.Lock()
+    
+    def kick_off(self, resource_types: List[str], since: Optional[str] = None) -> str:
+        """
+        送出 $export 請求
+        
+        Args:
+            resource_types: 要匯出的資源類型 (_type)
+            since: 只匯出此時間後更新的資源 (_since, ISO 8601)
+        
+        Returns:
+            匯出狀態URL（Content-Location）
+        """
+        url = urljoin(self.base_url + '/', '$export')
+        params = {
+            '_type': ','.join(resource_types),
+            '_outputFormat': 'application/fhir+ndjson'
+        }
+        if since:
+            params['_since'] = since
+        
+        headers = {'Accept': 'application/fhir+json', 'Prefer': 'respond-async'}
+        
+        try:
+            response = self.scheduler.get(url, session=self.session, params=params, headers=headers, timeout=30)
+        except requests.exceptions.RequestException as e:
+            raise BulkExportError(f"{self.name} $export kick-off 失敗: {e}")
+        
+        if response.status_code != 202 or 'Content-Location' not in response.headers:
+            raise BulkExportError(
+                f"{self.name} 不支援 $export (HTTP {response.status_code})"
+            )
+        
+        status_url = response.headers['Content-Location']
+        logger.info(f"{self.name} $export 已受理，狀態URL: {status_url}")
+        return status_url
+    
+    def wait_for_manifest(self, status_url: str) -> Dict[str, Any]:
+        """
+        輪詢匯出狀態直到完成
+        
+        Returns:
+            匯出 manifest {'output': [{'type': ..., 'url': ...}], 'error': [...]}
+        """
+        deadline = time.monotonic() + self.max_wait
+        
+        while True:
+            try:
+                response = self.scheduler.get(status_url, session=self.session,
+                                              headers={'Accept': 'application/json'}, timeout=30)
+            except requests.exceptions.RequestException as e:
+                raise BulkExportError(f"{self.name} 查詢匯出狀態失敗: {e}")
+            
+            if response.status_code == 200:
+                manifest = response.json()
+                logger.info(f"{self.name} 匯出完成，共 {len(manifest.get('output', []))} 個檔案")
+                return manifest
+            
+            if response.status_code != 202:
+                raise BulkExportError(f"{self.name} 匯出失敗 (HTTP {response.status_code}): {response.text[:200]}")
+            
+            progress = response.headers.get('X-Progress')
+            if progress:
+                logger.info(f"{self.name} 匯出進度: {progress}")
+            
+            wait = self._retry_after(response.headers.get('Retry-After'))
+            if time.monotonic() + wait > deadline:
+                raise BulkExportError(f"{self.name} 匯出超過 {self.max_wait} 秒未完成")
+            time.sleep(wait)
+    
+    def _retry_after(self, value: Optional[str]) -> float:
+        """解析 Retry-After（秒數）；無法解析時使用預設輪詢間隔"""
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                pass
+        return self.poll_interval
+    
+    def iter_ndjson(self, file_url: str, resource_type: Optional[str] = None) -> Iterator[Dict]:
+        """串流下載單一 NDJSON 檔案，逐行解析為資源（不會將整個檔案載入記憶體）"""
+        headers = {'Accept': 'application/fhir+ndjson'}
+        num_resources = num_bytes = 0
+        response = self.scheduler.get(file_url, session=self.session, headers=headers, stream=True, timeout=300)
+        with response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                num_bytes += len(line) + 1
+                num_resources += 1
+                yield self.loads(line)
+        
+        if resource_type:
+            with self._stats_lock:
+                stats = self.stats.setdefault(resource_type, {'resources': 0, 'bytes': 0})
+                stats['resources'] += num_resources
+                stats['bytes'] += num_bytes
+    
+    def download(self, manifest: Dict[str, Any], resource_types: List[str]) -> Dict[str, List[Dict]]:
+        """
+        並行下載 manifest 中的所有 NDJSON 檔案
+        
+        Returns:
+            {'Patient': [...], 'Encounter': [...], ...}（包含所有 resource_types）
+        """
+        outputs = [o for o in manifest.get('output', []) if o.get('type') in resource_types]
+        for error in manifest.get('error', []):
+            logger.warning(f"{self.name} 匯出錯誤檔案: {error.get('url')}")
+        
+        def fetch(output: Dict) -> List[Dict]:
+            resources = list(self.iter_ndjson(output['url'], output['type']))
+            logger.info(f"已下載 {output['type']}: {len(resources)} 筆")
+            return resources
+        
+        resources: Dict[str, List[Dict]] = {resource_type: [] for resource_type in resource_types}
+        with ThreadPoolExecutor(max_workers=self.download_workers, thread_name_prefix='bulk-ndjson') as executor:
+            # 依 manifest 順序合併，結果與下載完成順序無關
+            for output, file_resources in zip(outputs, executor.map(fetch, outputs)):
+                resources[output['type']].extend(file_resources)
+        
+        return resources
+    
+    def export(self, resource_types: List[str], since: Optional[str] = None) -> Dict[str, List[Dict]]:
+        """
+        執行完整的 Bulk export 流程
+        
+        Args:
+            resource_types: 要匯出的資源類型
+            since: _since 參數
+        
+        Returns:
+            與 FHIRClient.get_all_resources_for_cql 相同結構的資源字典
+        """
+        status_url = self.kick_off(resource_types, since)
+        manifest = self.wait_for_manifest(status_url)
+        resources = self.download(manifest, resource_types)
+        
+        # 通知伺服器可清除匯出檔案
+        try:
+            self.scheduler.delete(status_url, session=self.session, timeout=30)
+        except requests.exceptions.RequestException:
+            pass
+        
+        return resources
@@ -0,0 +1,1629 @@
+"""
+CQL Engine Module
+在記憶體中的 FHIR 資料上執行 cql_parser 產生的 AST：
+retrieve、query（where / let / with / return / sort）、exists、Count 等彙總、
+Interval 與日期運算，以及 library 內的 define function
+
+說明:
+- 日期時間一律以 naive datetime 表示（FHIR 字串的時區直接捨去，保留當地時間）
+- 值集只能展開本專案 CQL 以 code 名稱列舉的值集；外部 URL 值集無法展開，視為不含任何代碼
+- 本專案 CQL 的 where 條件可能是清單（例如 where P.code.coding C where ...），非空清單視為成立
+"""
+
+import re
+import json
+import math
+import zlib
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from functools import cmp_to_key
+from typing import Dict, List, Any, Optional, Callable, Iterable, Tuple
+
+from fhir_datetime import parse_fhir_datetime, to_wall_time
+
+logger = logging.getLogger(__name__)
+
+
+class CQLEvaluationError(Exception):
+    """CQL 運算式無法執行（未定義的識別字、型別不符或不支援的運算）"""
+
+
+# 字串比較時判斷兩邊是否都是日期（至少到日）
+_DATE_PREFIX_RE = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+# [Type: "Terminology"] 未指定 codePath 時使用的屬性
+DEFAULT_CODE_PATHS = {
+    'Encounter': 'type',
+    'MedicationRequest': 'medication',
+    'MedicationAdministration': 'medication',
+    'MedicationDispense': 'medication',
+    'MedicationStatement': 'medication',
+    'Immunization': 'vaccineCode',
+    'DocumentReference': 'type',
+    'ServiceRequest': 'code',
+    'AllergyIntolerance': 'code',
+}
+
+# Patient compartment：以這些欄位參照病人的資源屬於該病人
+PATIENT_REFERENCE_FIELDS = ('subject', 'patient', 'beneficiary', 'individual')
+
+# Extension.value[x] 可用的全部型別
+_ANY_TYPE = ('Base64Binary', 'Boolean', 'Canonical', 'Code', 'Date', 'DateTime', 'Decimal', 'Id', 'Instant',
+             'Integer', 'Markdown', 'Oid', 'PositiveInt', 'String', 'Time', 'UnsignedInt', 'Uri', 'Url', 'Uuid',
+             'Address', 'Age', 'Annotation', 'Attachment', 'CodeableConcept', 'Coding', 'ContactPoint', 'Count',
+             'Distance', 'Duration', 'HumanName', 'Identifier', 'Money', 'Period', 'Quantity', 'Range', 'Ratio',
+             'Reference', 'SampledData', 'Signature', 'Timing', 'ContactDetail', 'Contributor',
+             'DataRequirement', 'Expression', 'ParameterDefinition', 'RelatedArtifact', 'TriggerDefinition',
+             'UsageContext', 'Dosage', 'Meta')
+
+# FHIR R4 choice 型別元素 [x] 及其允許的型別（CQL 以元素名稱存取：effective → effectiveDateTime）
+CHOICE_TYPES = {
+    'value': _ANY_TYPE,
+    'effective': ('DateTime', 'Period', 'Timing', 'Instant'),
+    'onset': ('DateTime', 'Age', 'Period', 'Range', 'String'),
+    'abatement': ('DateTime', 'Age', 'Period', 'Range', 'String'),
+    'performed': ('DateTime', 'Period', 'String', 'Age', 'Range'),
+    'occurrence': ('DateTime', 'Period', 'Timing', 'String'),
+    'medication': ('CodeableConcept', 'Reference'),
+    'reported': ('Boolean', 'Reference'),
+    'deceased': ('Boolean', 'DateTime'),
+    'multipleBirth': ('Boolean', 'Integer'),
+    'asNeeded': ('Boolean', 'CodeableConcept'),
+    'dose': ('Range', 'Quantity'),
+    'rate': ('Ratio', 'Range', 'Quantity'),
+    'bounds': ('Duration', 'Range', 'Period'),
+    'serviced': ('Date', 'Period'),
+    'timing': ('Timing', 'Period', 'DateTime'),
+    'product': ('CodeableConcept', 'Reference'),
+    'scheduled': ('Timing', 'Period', 'String'),
+    'doseNumber': ('PositiveInt', 'String'),
+    'seriesDoses': ('PositiveInt', 'String'),
+}
+
+_UNIT_SECONDS = {'week': 604800, 'day': 86400, 'hour': 3600, 'minute': 60, 'second': 1, 'millisecond': 0.001}
+
+
+class Code:
+    """CQL Code（system 已解析為代碼系統 URL）"""
+    
+    __slots__ = ('code', 'system', 'display')
+    
+    def __init__(self, code: str, system: Optional[str] = None, display: Optional[str] = None):
+        self.code = code
+        self.system = system
+        self.display = display
+    
+    def __eq__(self, other):
+        return isinstance(other, Code) and (self.code, self.system) == (other.code, other.system)
+    
+    def __hash__(self):
+        return hash((self.code, self.system))
+    
+    def __repr__(self):
+        return f"Code({self.code!r}, {self.system!r})"
+
+
+class Concept:
+    """CQL Concept（多個 Code 代表同一概念）"""
+    
+    __slots__ = ('codes', 'display')
+    
+    def __init__(self, codes: List[Code], display: Optional[str] = None):
+        self.codes = codes
+        self.display = display
+
+
+class ValueSet:
+    """值集；codes 為 None 表示無法展開（外部 URL）"""
+    
+    __slots__ = ('name', 'id', 'codes')
+    
+    def __init__(self, name: str, id: Optional[str], codes: Optional[List[Code]]):
+        self.name = name
+        self.id = id
+        self.codes = codes
+
+
+class Quantity:
+    """數量（時間數量的 unit 為單數形式的時間單位，例如 day）"""
+    
+    __slots__ = ('value', 'unit')
+    
+    def __init__(self, value, unit: Optional[str]):
+        self.value = value
+        self.unit = unit
+    
+    def __eq__(self, other):
+        return isinstance(other, Quantity) and (self.value, self.unit) == (other.value, other.unit)
+    
+    def __hash__(self):
+        return hash((self.value, self.unit))
+
+
+class Interval:
+    """區間（low/high 為 None 時視為無限）"""
+    
+    __slots__ = ('low', 'high', 'low_closed', 'high_closed')
+    
+    def __init__(self, low, high, low_closed: bool = True, high_closed: bool = True):
+        self.low = low
+        self.high = high
+        self.low_closed = low_closed
+        self.high_closed = high_closed
+    
+    def contains(self, point) -> Optional[bool]:
+        if point is None:
+            return None
+        if self.low is not None:
+            order = compare(point, self.low)
+            if order < 0 or (order == 0 and not self.low_closed):
+                return False
+        if self.high is not None:
+            order = compare(point, self.high)
+            if order > 0 or (order == 0 and not self.high_closed):
+                return False
+        return True
+    
+    def __eq__(self, other):
+        return isinstance(other, Interval) and (self.low, self.high, self.low_closed, self.high_closed) == \
+            (other.low, other.high, other.low_closed, other.high_closed)
+    
+    def __hash__(self):
+        return hash((self.low, self.high))
+
+
+class FHIRStore:
+    """
+    記憶體中的 FHIR 資源（依類型存放；以 Type/id 建立參照索引供 resolve() 使用）
+    
+    retrieve_cache 保存帶代碼條件的 retrieve 結果，同一個 store 上執行的所有 Library 共用。
+    雜湊索引（id、病人、就醫、代碼）在第一次查詢時建立，之後的 join 與查找皆為 O(1)。
+    """
+    
+    def __init__(self, fhir_data: Dict[str, List[Dict]], _references: Optional[Dict[str, Dict]] = None):
+        self.resources = fhir_data
+        self._references = _references
+        self._partitions: Optional[Dict[str, 'FHIRStore']] = None
+        self._patient_index: Optional[Dict[str, Dict[str, List[Dict]]]] = None
+        self._encounter_index: Optional[Dict[str, Dict[str, List[Dict]]]] = None
+        # {(resourceType, path): {code: [資源位置]}}
+        self._code_indexes: Dict[Tuple[str, str], Dict[str, List[int]]] = {}
+        self.retrieve_cache: Dict[tuple, List[Dict]] = {}
+        # 由同一份資料衍生、執行期間共用的結構（例如 fhir_frames.FHIRFrames）
+        self.derived: Dict[str, Any] = {}
+    
+    def retrieve(self, resource_type: str) -> List[Dict]:
+        return self.resources.get(resource_type) or []
+    
+    def resolve(self, reference: Optional[str]) -> Optional[Dict]:
+        """Encounter/123 或 http://server/fhir/Encounter/123 → 資源"""
+        if not reference:
+            return None
+        return self._reference_index().get(normalize_reference(reference))
+    
+    def get(self, resource_type: str, resource_id: str) -> Optional[Dict]:
+        """依 id 取得資源"""
+        return self._reference_index().get(f"{resource_type}/{resource_id}")
+    
+    def by_patient(self, patient_reference: str, resource_type: str) -> List[Dict]:
+        """參照此病人（subject / patient / ...）的 resource_type 資源"""
+        if self._patient_index is None:
+            self._patient_index = self._index_references(lambda resource: [_references_patient(resource)])
+        return self._patient_index.get(normalize_reference(patient_reference), {}).get(resource_type, [])
+    
+    def by_encounter(self, encounter_reference: str, resource_type: str) -> List[Dict]:
+        """參照此就醫（encounter / context）的 resource_type 資源"""
+        if self._encounter_index is None:
+            self._encounter_index = self._index_references(_references_encounters)
+        return self._encounter_index.get(normalize_reference(encounter_reference), {}).get(resource_type, [])
+    
+    def by_code(self, resource_type: str, code: str, system: Optional[str] = None,
+                path: Optional[str] = None) -> List[Dict]:
+        """path（預設為該類型的代碼欄位）含此代碼的資源；system 為 None 時不比對 system"""
+        path = path or DEFAULT_CODE_PATHS.get(resource_type, 'code')
+        return [resource for resource in self.by_codes(resource_type, path, [code])
+                if _code_match(resource_path(resource, path), Code(code, system))]
+    
+    def by_codes(self, resource_type: str, path: str, codes: Iterable[str]) -> List[Dict]:
+        """path 上含任一代碼值（不比對 system）的資源，保持原本順序"""
+        index = self._code_indexes.get((resource_type, path))
+        if index is None:
+            index = {}
+            for position, resource in enumerate(self.retrieve(resource_type)):
+                for _, code in _codings(resource_path(resource, path)):
+                    positions = index.setdefault(code, [])
+                    if not positions or positions[-1] != position:
+                        positions.append(position)
+            self._code_indexes[(resource_type, path)] = index
+        resources = self.retrieve(resource_type)
+        positions = sorted({position for code in codes for position in index.get(code, ())})
+        return [resources[position] for position in positions]
+    
+    def _index_references(self, references_of: Callable[[Dict], Iterable[Optional[str]]]) -> Dict[str, Dict[str, List[Dict]]]:
+        index: Dict[str, Dict[str, List[Dict]]] = {}
+        for resource_type, resources in self.resources.items():
+            for resource in resources:
+                for reference in set(references_of(resource)):
+                    if reference:
+                        index.setdefault(reference, {}).setdefault(resource_type, []).append(resource)
+        return index
+    
+    def build_indexes(self, partition: bool = False):
+        """預先建立參照索引（partition=True 時一併分割病人 compartment），例如在 fork 子行程前"""
+        self._reference_index()
+        if partition:
+            self.partition_by_patient()
+    
+    def _reference_index(self) -> Dict[str, Dict]:
+        if self._references is None:
+            self._references = {}
+            for resource_type, resources in self.resources.items():
+                for resource in resources:
+                    if resource.get('id'):
+                        self._references[f"{resource_type}/{resource['id']}"] = resource
+        return self._references
+    
+    def partition_by_patient(self) -> Dict[str, 'FHIRStore']:
+        """
+        依 Patient compartment 分割資源 {patient_id: FHIRStore}
+        
+        不屬於任何病人的資源（例如 Organization、Medication）每個病人都看得到；
+        參照索引與整體資料共用，resolve() 仍可找到其他 compartment 的資源。
+        分割結果會保留，多個 Patient context Library 共用同一組 compartment（及其 retrieve 快取）。
+        """
+        if self._partitions is not None:
+            return self._partitions
+        references = self._reference_index()
+        compartments: Dict[str, Dict[str, List[Dict]]] = {
+            patient['id']: {'Patient': [patient]} for patient in self.retrieve('Patient') if patient.get('id')
+        }
+        self._distribute(compartments, lambda patient_id: patient_id)
+        self._partitions = {patient_id: FHIRStore(compartment, references)
+                            for patient_id, compartment in compartments.items()}
+        return self._partitions
+    
+    def shard(self, count: int) -> List['FHIRStore']:
+        """
+        依病人將資源分為 count 個 shard（病人 id 的 CRC32 決定所屬 shard，跨執行與機器皆一致）
+        
+        每個 shard 包含所屬病人的所有資源，以及不屬於任何病人的資源；
+        參照索引各自建立，只涵蓋該 shard 的資源。
+        """
+        shards: List[Dict[str, List[Dict]]] = [{'Patient': []} for _ in range(count)]
+        for patient in self.retrieve('Patient'):
+            shards[shard_of(patient.get('id') or '', count)]['Patient'].append(patient)
+        self._distribute(dict(enumerate(shards)), lambda patient_id: shard_of(patient_id, count))
+        return [FHIRStore(resources) for resources in shards]
+    
+    def snapshot_version(self) -> str:
+        """整份資料的版本指紋（所有資源的版本鍵；與資源順序無關）"""
+        return _digest([resource_version(resource_type, resource)
+                        for resource_type, resources in self.resources.items() for resource in resources])
+    
+    def patient_versions(self) -> Tuple[Dict[str, str], str]:
+        """
+        各病人 compartment 的版本指紋 {patient_id: 指紋}，以及不屬於任何病人之資源的指紋
+        
+        指紋由 compartment 內每筆資源的 Type/id 與 meta.versionId / meta.lastUpdated 組成
+        （兩者皆無時以資源內容雜湊代替）；與上次執行的指紋比較即可得知哪些病人有新增、更新或刪除的資源。
+        """
+        keys: Dict[str, List[str]] = {patient['id']: [] for patient in self.retrieve('Patient') if patient.get('id')}
+        shared: List[str] = []
+        for resource_type, resources in self.resources.items():
+            for resource in resources:
+                if resource_type == 'Patient':
+                    patient_id = resource.get('id')
+                else:
+                    patient_reference = _references_patient(resource)
+                    patient_id = patient_reference[len('Patient/'):] if patient_reference else None
+                if patient_id is None:
+                    shared.append(resource_version(resource_type, resource))
+                elif patient_id in keys:
+                    keys[patient_id].append(resource_version(resource_type, resource))
+        return {patient_id: _digest(versions) for patient_id, versions in keys.items()}, _digest(shared)
+    
+    def _distribute(self, compartments: Dict[Any, Dict[str, List[Dict]]], key_of: Callable[[str], Any]):
+        """將非 Patient 資源放入所屬病人的 compartment（key_of: 病人 id → compartment key），共用資源放入每一個"""
+        for resource_type, resources in self.resources.items():
+            if resource_type == 'Patient':
+                continue
+            shared = []
+            for resource in resources:
+                patient_reference = _references_patient(resource)
+                if patient_reference is None:
+                    shared.append(resource)
+                    continue
+                compartment = compartments.get(key_of(patient_reference[len('Patient/'):]))
+                if compartment is not None:
+                    compartment.setdefault(resource_type, []).append(resource)
+            if shared:
+                for compartment in compartments.values():
+                    compartment.setdefault(resource_type, []).extend(shared)
+
+
+def shard_of(patient_id: str, count: int) -> int:
+    """病人所屬的 shard 編號"""
+    return zlib.crc32(patient_id.encode('utf-8')) % count
+
+
+def resource_version(resource_type: str, resource: Dict) -> str:
+    """資源的版本鍵：Type/id 加上 meta.versionId 與 meta.lastUpdated；兩者皆無時為內容雜湊"""
+    meta = resource.get('meta') or {}
+    if meta.get('versionId') or meta.get('lastUpdated'):
+        version = f"{meta.get('versionId')}|{meta.get('lastUpdated')}"
+    else:
+        content = json.dumps(resource, sort_keys=True, ensure_ascii=False, default=str)
+        version = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    return f"{resource_type}/{resource.get('id')}|{version}"
+
+
+def _digest(keys: List[str]) -> str:
+    """版本鍵清單的指紋（與順序無關）"""
+    return hashlib.sha1('\n'.join(sorted(keys)).encode('utf-8')).hexdigest()
+
+
+def normalize_reference(reference: str) -> str:
+    """參照字串統一為 Type/id（去除伺服器網址與 _history）"""
+    reference = reference.split('/_history/')[0]
+    return '/'.join(reference.rstrip('/').split('/')[-2:])
+
+
+def _references_encounters(resource: Dict) -> List[str]:
+    """資源參照的就醫（Encounter/id）：encounter、context（STU3）或 context.encounter（R4 DocumentReference）"""
+    references = []
+    for field in ('encounter', 'context'):
+        value = resource.get(field)
+        if not isinstance(value, dict):
+            continue
+        for item in [value] + _as_list(value.get('encounter')):
+            reference = item.get('reference') if isinstance(item, dict) else None
+            if reference and reference.split('/_history/')[0].split('/')[-2:-1] == ['Encounter']:
+                references.append(normalize_reference(reference))
+    return references
+
+
+def resource_path(resource: Dict, path: str) -> List[Any]:
+    """沿 a.b.c 取得資源欄位值，清單逐層攤平（與 CQL 屬性存取相同，choice 型別見 CHOICE_TYPES）"""
+    values = [resource]
+    for name in path.split('.'):
+        next_values = []
+        for value in values:
+            item = _field(value, name) if isinstance(value, dict) else None
+            if isinstance(item, list):
+                next_values.extend(item)
+            elif item is not None:
+                next_values.append(item)
+        values = next_values
+    return values
+
+
+def _field(value: Dict, name: str):
+    if name in value:
+        return value[name]
+    # choice 型別：value → valueQuantity、onset → onsetDateTime（只比對宣告的型別，period 不會取到 periodUnit）
+    for type_name in CHOICE_TYPES.get(name, ()):
+        item = value.get(name + type_name)
+        if item is not None:
+            return item
+    return None
+
+
+def _references_patient(resource: Dict) -> Optional[str]:
+    """資源參照的病人（Patient/id）；不屬於病人 compartment 時回傳 None"""
+    for field in PATIENT_REFERENCE_FIELDS:
+        value = resource.get(field)
+        if isinstance(value, dict) and value.get('reference', '').split('/')[-2:-1] == ['Patient']:
+            return '/'.join(value['reference'].rstrip('/').split('/')[-2:])
+    return None
+
+
+# 值的轉換與比較
+
+def parse_datetime(value: str) -> Optional[datetime]:
+    """FHIR / CQL 日期時間字串 → datetime（精確度不足時補最小值，時區捨去）"""
+    return to_wall_time(parse_fhir_datetime(value))
+
+
+def to_datetime(value) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        parsed = parse_datetime(value)
+        if parsed is not None:
+            return parsed
+    raise CQLEvaluationError(f"無法轉換為日期時間: {value!r}")
+
+
+def to_interval(value) -> Optional[Interval]:
+    """Interval 或 FHIR Period → Interval；dateTime（例如 effective[x] 為時間點）視為單點區間"""
+    if value is None or isinstance(value, Interval):
+        return value
+    if isinstance(value, dict) and ('start' in value or 'end' in value):
+        return Interval(to_datetime(value.get('start')), to_datetime(value.get('end')))
+    if isinstance(value, datetime) or isinstance(value, str) and parse_datetime(value) is not None:
+        point = to_datetime(value)
+        return Interval(point, point)
+    raise CQLEvaluationError(f"無法轉換為區間: {type(value).__name__}")
+
+
+def _comparable(a, b) -> Tuple[Any, Any]:
+    if isinstance(a, datetime) and isinstance(b, str):
+        return a, to_datetime(b)
+    if isinstance(b, datetime) and isinstance(a, str):
+        return to_datetime(a), b
+    if isinstance(a, str) and isinstance(b, str) and _DATE_PREFIX_RE.match(a) and _DATE_PREFIX_RE.match(b):
+        parsed_a, parsed_b = parse_datetime(a), parse_datetime(b)
+        if parsed_a is not None and parsed_b is not None:
+            return parsed_a, parsed_b
+    if isinstance(a, Quantity) and isinstance(b, Quantity):
+        return a.value, b.value
+    if isinstance(a, dict) and isinstance(b, (int, float)) and 'value' in a:
+        return a['value'], b
+    if isinstance(b, dict) and isinstance(a, (int, float)) and 'value' in b:
+        return a, b['value']
+    return a, b
+
+
+def compare(a, b) -> Optional[int]:
+    """-1 / 0 / 1；任一邊為 null 時回傳 None"""
+    if a is None or b is None:
+        return None
+    a, b = _comparable(a, b)
+    try:
+        return (a > b) - (a < b)
+    except TypeError:
+        raise CQLEvaluationError(f"無法比較 {type(a).__name__} 與 {type(b).__name__}")
+
+
+def _codings(value) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Code / Concept / CodeableConcept / Coding / 代碼字串 → [(system, code)]"""
+    if value is None:
+        return []
+    if isinstance(value, Code):
+        return [(value.system, value.code)]
+    if isinstance(value, Concept):
+        return [(code.system, code.code) for code in value.codes]
+    if isinstance(value, str):
+        return [(None, value)]
+    if isinstance(value, list):
+        return [coding for item in value for coding in _codings(item)]
+    if isinstance(value, dict):
+        if 'coding' in value:
+            return _codings(value['coding'])
+        if 'code' in value:
+            return [(value.get('system'), value['code'])]
+    return []
+
+
+def _code_match(left, right) -> bool:
+    """任一代碼相同（system 任一邊未提供時只比對 code）"""
+    right_codes = _codings(right)
+    for system, code in _codings(left):
+        for other_system, other_code in right_codes:
+            if code == other_code and (system is None or other_system is None or system == other_system):
+                return True
+    return False
+
+
+def _is_terminology(value) -> bool:
+    return isinstance(value, (Code, Concept))
+
+
+def _index_codes(value) -> Optional[List[str]]:
+    """可用代碼索引查詢的 retrieve 條件所含的代碼值；不是代碼條件時回傳 None"""
+    if isinstance(value, ValueSet):
+        return [code for _, code in _codings(value.codes)]
+    if _is_terminology(value) or isinstance(value, list) and value and all(map(_is_terminology, value)):
+        return [code for _, code in _codings(value)]
+    return None
+
+
+def _filter_key(value) -> Optional[tuple]:
+    """retrieve 代碼條件的可雜湊表示（供 retrieve 快取使用）；無法表示時回傳 None，不快取"""
+    if isinstance(value, Code):
+        return ('code', value.code, value.system)
+    if isinstance(value, (Concept, ValueSet, list)):
+        codes = value if isinstance(value, list) else value.codes
+        keys = None if codes is None else tuple(_filter_key(code) for code in codes)
+        if keys is not None and None in keys:
+            return None
+        if isinstance(value, ValueSet):
+            return ('valueset', value.id or value.name, keys)
+        return ('concept' if isinstance(value, Concept) else 'list', keys)
+    if isinstance(value, (str, int, float)):
+        return ('value', type(value).__name__, value)
+    return None
+
+
+def equal(a, b) -> Optional[bool]:
+    if a is None or b is None:
+        return None
+    if _is_terminology(a) or _is_terminology(b):
+        return _code_match(a, b)
+    if isinstance(a, list) and isinstance(b, list):
+        if len(a) != len(b):
+            return False
+        results = [equal(x, y) for x, y in zip(a, b)]
+        return None if None in results else all(results)
+    a, b = _comparable(a, b)
+    return a == b
+
+
+def equivalent(a, b) -> bool:
+    if a is None or b is None:
+        return a is None and b is None
+    if _is_terminology(a) or _is_terminology(b) or isinstance(a, dict) and 'coding' in a:
+        return _code_match(a, b)
+    if isinstance(a, str) and isinstance(b, str):
+        return ' '.join(a.lower().split()) == ' '.join(b.lower().split())
+    return bool(equal(a, b))
+
+
+def truth(value) -> Optional[bool]:
+    """CQL 布林值；本專案 CQL 以清單作為條件時，非空清單視為成立"""
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, list):
+        return len(value) > 0
+    raise CQLEvaluationError(f"條件必須是布林值: {type(value).__name__}")
+
+
+def add_quantity(value: datetime, quantity: Quantity, sign: int = 1) -> datetime:
+    """日期時間 ± 時間數量（年、月依日曆計算，月底自動調整）"""
+    amount = quantity.value * sign
+    unit = quantity.unit
+    if unit in ('year', 'month'):
+        months = int(amount) * (12 if unit == 'year' else 1)
+        month_index = value.year * 12 + value.month - 1 + months
+        year, month = divmod(month_index, 12)
+        month += 1
+        days_in_month = (datetime(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)).day
+        return value.replace(year=year, month=month, day=min(value.day, days_in_month))
+    if unit not in _UNIT_SECONDS:
+        raise CQLEvaluationError(f"不支援的時間單位: {unit}")
+    return value + timedelta(seconds=amount * _UNIT_SECONDS[unit])
+
+
+def truncate(value: datetime, precision: Optional[str]) -> datetime:
+    """依精確度截斷（day: 捨去時分秒）"""
+    if precision is None or precision in ('second', 'millisecond'):
+        return value
+    fields = ('year', 'month', 'day', 'hour', 'minute')
+    if precision == 'week':
+        precision = 'day'
+    keep = fields.index(precision) + 1
+    defaults = {'month': 1, 'day': 1, 'hour': 0, 'minute': 0}
+    return value.replace(second=0, microsecond=0,
+                         **{field: defaults[field] for field in fields[keep:]})
+
+
+def duration_between(low: datetime, high: datetime, precision: str) -> int:
+    """完整經過的時間單位數（years between、days between）"""
+    if precision in ('year', 'month'):
+        months = (high.year - low.year) * 12 + high.month - low.month
+        if (high.day, high.time()) < (low.day, low.time()) and months > 0:
+            months -= 1
+        elif (high.day, high.time()) > (low.day, low.time()) and months < 0:
+            months += 1
+        return int(months / 12) if precision == 'year' else months
+    seconds = (high - low).total_seconds()
+    return int(seconds / _UNIT_SECONDS[precision])
+
+
+def difference_between(low: datetime, high: datetime, precision: str) -> int:
+    """跨越的時間邊界數（difference in days between）"""
+    if precision == 'year':
+        return high.year - low.year
+    if precision == 'month':
+        return (high.year - low.year) * 12 + high.month - low.month
+    return duration_between(truncate(low, precision), truncate(high, precision), precision)
+
+
+def _hash_key(value):
+    """distinct / union 去重用的鍵（資源以 Type/id 比對）"""
+    if isinstance(value, dict):
+        if 'resourceType' in value and 'id' in value:
+            return ('resource', value['resourceType'], value['id'])
+        return ('tuple',) + tuple(sorted((key, _hash_key(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return ('list',) + tuple(_hash_key(item) for item in value)
+    if isinstance(value, (Concept, ValueSet)):
+        return id(value)
+    return value
+
+
+def distinct(values: Iterable) -> List:
+    seen = set()
+    result = []
+    for value in values:
+        key = _hash_key(value)
+        if key not in seen:
+            seen.add(key)
+            result.append(value)
+    return result
+
+
+def _as_list(value) -> List:
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _round(value, precision: int = 0):
+    if value is None:
+        return None
+    factor = 10 ** precision
+    return math.floor(value * factor + 0.5) / factor
+
+
+def _type_matches(value, type_name: str) -> bool:
+    """is / as 的型別判斷（FHIR 型別名稱不分大小寫）"""
+    name = type_name.split('.')[-1]
+    lowered = name.lower()
+    if lowered in ('datetime', 'date', 'instant'):
+        return isinstance(value, datetime) or isinstance(value, str) and parse_datetime(value) is not None
+    if lowered in ('string', 'code', 'uri', 'url', 'id', 'markdown'):
+        return isinstance(value, str)
+    if lowered in ('integer', 'positiveint', 'unsignedint'):
+        return isinstance(value, int) and not isinstance(value, bool)
+    if lowered == 'decimal':
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if lowered == 'boolean':
+        return isinstance(value, bool)
+    if lowered in ('quantity', 'age', 'duration', 'simplequantity'):
+        return isinstance(value, Quantity) or isinstance(value, dict) and 'value' in value
+    if lowered == 'period':
+        return isinstance(value, Interval) or isinstance(value, dict) and ('start' in value or 'end' in value)
+    if lowered in ('codeableconcept', 'concept'):
+        return isinstance(value, Concept) or isinstance(value, dict) and ('coding' in value or 'text' in value)
+    if lowered in ('coding',):
+        return isinstance(value, Code) or isinstance(value, dict) and 'code' in value
+    if lowered == 'reference':
+        return isinstance(value, dict) and 'reference' in value
+    if isinstance(value, dict) and 'resourceType' in value:
+        return value['resourceType'] == name
+    return True
+
+
+def to_json_value(value):
+    """執行結果 → 可序列化為 JSON 的值（資源以 Type/id 表示）"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, list):
+        return [to_json_value(item) for item in value]
+    if isinstance(value, dict):
+        if 'resourceType' in value and 'id' in value:
+            return f"{value['resourceType']}/{value['id']}"
+        return {key: to_json_value(item) for key, item in value.items()}
+    if isinstance(value, Code):
+        return {'code': value.code, 'system': value.system, 'display': value.display}
+    if isinstance(value, Concept):
+        return {'codes': [to_json_value(code) for code in value.codes], 'display': value.display}
+    if isinstance(value, Quantity):
+        return {'value': value.value, 'unit': value.unit}
+    if isinstance(value, Interval):
+        return {'low': to_json_value(value.low), 'high': to_json_value(value.high),
+                'lowClosed': value.low_closed, 'highClosed': value.high_closed}
+    if isinstance(value, ValueSet):
+        return {'valueset': value.id or value.name}
+    return str(value)
+
+
+class _LibraryAlias:
+    """include ... called FHIRHelpers 的別名（FHIRHelpers.ToDate(x) 等呼叫對應內建函式）"""
+    
+    def __init__(self, name: str):
+        self.name = name
+
+
+class CQLEvaluator:
+    """
+    CQL 直譯器：在 FHIRStore 上執行 library 的 define（結果依名稱快取）
+    
+    用法:
+        evaluator = CQLEvaluator(ast, FHIRStore(fhir_data), {'Measurement Period': Interval(start, end)})
+        value = evaluator.evaluate_definition('numerator_count')
+    """
+    
+    def __init__(self, library: Dict[str, Any], store: FHIRStore, parameters: Optional[Dict[str, Any]] = None,
+                 patient: Optional[Dict] = None, now: Optional[datetime] = None):
+        """
+        Args:
+            library: cql_parser.parse_cql 的結果
+            store: FHIR 資源（Patient context 時為該病人的 compartment）
+            parameters: 覆寫 parameter 預設值 {名稱: 值}
+            patient: Patient context 的病人資源（None = Population）
+            now: Now() / Today() 的時間（同一次執行內固定）
+        """
+        self.library = library
+        self.store = store
+        self.patient = patient
+        self.now = now or datetime.now()
+        self.definitions = library.get('definitions', {})
+        self.warnings: List[str] = []
+        # 本 evaluator 的 retrieve 快取命中 / 未命中次數
+        self.retrieve_hits = 0
+        self.retrieve_misses = 0
+        self._parameter_overrides = parameters or {}
+        self._values: Dict[str, Any] = {}
+        self._evaluating: List[str] = []
+        self._terminology: Dict[str, Any] = {}
+    
+    # define 與識別字
+    
+    def evaluate_definition(self, name: str) -> Any:
+        if name in self._values:
+            return self._values[name]
+        definition = self.definitions.get(name)
+        if definition is None or definition['kind'] != 'expression':
+            raise CQLEvaluationError(f"未定義的 define: {name}")
+        if definition.get('expression') is None:
+            raise CQLEvaluationError(definition.get('error') or f"define {name} 無法解析")
+        if name in self._evaluating:
+            raise CQLEvaluationError(f"define 循環參照: {' → '.join(self._evaluating + [name])}")
+        
+        self._evaluating.append(name)
+        try:
+            value = self.evaluate(definition['expression'], {})
+        finally:
+            self._evaluating.pop()
+        self._values[name] = value
+        return value
+    
+    def _parameter(self, name: str) -> Any:
+        key = ('parameter', name)
+        if key not in self._terminology:
+            if name in self._parameter_overrides:
+                value = self._parameter_overrides[name]
+            else:
+                default = self.library['parameters'][name].get('default')
+                value = None if default is None else self.evaluate(default, {})
+            self._terminology[key] = value
+        return self._terminology[key]
+    
+    def _code(self, name: str) -> Code:
+        code = self.library['codes'][name]
+        system = self.library['codesystems'].get(code['system'], {}).get('id') or code['system']
+        return Code(code['code'], system, code.get('display'))
+    
+    def _valueset(self, name: str) -> ValueSet:
+        key = ('valueset', name)
+        if key not in self._terminology:
+            valueset = self.library['valuesets'][name]
+            codes = None
+            if 'codes' in valueset:
+                codes = [self._code(code) for code in valueset['codes'] if code in self.library['codes']]
+            else:
+                self.warnings.append(f"值集 {name} 無法展開（{valueset.get('id')}），視為不含任何代碼")
+            self._terminology[key] = ValueSet(name, valueset.get('id'), codes)
+        return self._terminology[key]
+    
+    def _reference(self, name: str, scope: Dict[str, Any]) -> Any:
+        if name in scope:
+            return scope[name]
+        if name in self.definitions and self.definitions[name]['kind'] == 'expression':
+            return self.evaluate_definition(name)
+        library = self.library
+        if name in library['parameters']:
+            return self._parameter(name)
+        if name in library['codes']:
+            return self._code(name)
+        if name in library['concepts']:
+            concept = library['concepts'][name]
+            return Concept([self._code(code) for code in concept['codes']], concept.get('display'))
+        if name in library['valuesets']:
+            return self._valueset(name)
+        if name in library['codesystems']:
+            return library['codesystems'][name]['id']
+        if name in library['includes']:
+            return _LibraryAlias(name)
+        if name == library.get('context') == 'Patient':
+            if self.patient is None:
+                raise CQLEvaluationError("Population 執行時無法參照 Patient")
+            return self.patient
+        this = scope.get('$this')
+        if isinstance(this, dict) and name in this:
+            # sort by 欄位名稱 / FHIRPath 無 lambda 參數的 where(code = 'x')
+            return this[name]
+        raise CQLEvaluationError(f"未定義的識別字: {name}")
+    
+    # 運算式
+    
+    def evaluate(self, node: Dict[str, Any], scope: Dict[str, Any]) -> Any:
+        handler = getattr(self, '_eval_' + node['kind'], None)
+        if handler is None:
+            raise CQLEvaluationError(f"不支援的運算式: {node['kind']}")
+        return handler(node, scope)
+    
+    def _eval_literal(self, node, scope):
+        if node['type'] in ('DateTime', 'Date'):
+            return to_datetime(node['value'])
+        return node['value']
+    
+    def _eval_ref(self, node, scope):
+        return self._reference(node['name'], scope)
+    
+    def _eval_paren(self, node, scope):
+        return self.evaluate(node['expression'], scope)
+    
+    def _eval_quantity(self, node, scope):
+        value = node['value']
+        if isinstance(value, dict):
+            value = self.evaluate(value, scope)
+            if value is None:
+                return None
+        return Quantity(value, node['unit'])
+    
+    def _eval_list(self, node, scope):
+        return [self.evaluate(element, scope) for element in node['elements']]
+    
+    def _eval_tuple(self, node, scope):
+        return {element['name']: self.evaluate(element['value'], scope) for element in node['elements']}
+    
+    def _eval_instance(self, node, scope):
+        elements = self._eval_tuple(node, scope)
+        if node['type'] == 'Code':
+            return Code(elements.get('code'), elements.get('system'), elements.get('display'))
+        if node['type'] == 'Quantity':
+            return Quantity(elements.get('value'), elements.get('unit'))
+        return elements
+    
+    def _eval_interval(self, node, scope):
+        return Interval(self.evaluate(node['low'], scope), self.evaluate(node['high'], scope),
+                        node['lowClosed'], node['highClosed'])
+    
+    def _eval_if(self, node, scope):
+        if truth(self.evaluate(node['condition'], scope)):
+            return self.evaluate(node['then'], scope)
+        return self.evaluate(node['else'], scope)
+    
+    def _eval_case(self, node, scope):
+        if node['comparand'] is not None:
+            comparand = self.evaluate(node['comparand'], scope)
+            for item in node['items']:
+                if equal(comparand, self.evaluate(item['when'], scope)):
+                    return self.evaluate(item['then'], scope)
+        else:
+            for item in node['items']:
+                if truth(self.evaluate(item['when'], scope)):
+                    return self.evaluate(item['then'], scope)
+        return self.evaluate(node['else'], scope)
+    
+    def _eval_let(self, node, scope):
+        scope = dict(scope)
+        for binding in node['let']:
+            scope[binding['name']] = self.evaluate(binding['expression'], scope)
+        return self.evaluate(node['expression'], scope)
+    
+    def _eval_property(self, node, scope):
+        return self._property(self.evaluate(node['source'], scope), node['path'])
+    
+    def _property(self, value, path: str):
+        if value is None:
+            return None
+        if isinstance(value, list):
+            # FHIRPath：清單的屬性為各元素屬性攤平
+            result = []
+            for item in value:
+                item_value = self._property(item, path)
+                if isinstance(item_value, list):
+                    result.extend(item_value)
+                elif item_value is not None:
+                    result.append(item_value)
+            return result
+        if isinstance(value, dict):
+            return _field(value, path)
+        if isinstance(value, Interval):
+            return {'low': value.low, 'high': value.high, 'start': value.low, 'end': value.high,
+                    'lowClosed': value.low_closed, 'highClosed': value.high_closed}.get(path)
+        if isinstance(value, (Code, Concept, Quantity)):
+            return getattr(value, path, None)
+        if path == 'value':
+            # FHIR primitive 的 .value（E.status.value）
+            return value
+        return None
+    
+    def _eval_index(self, node, scope):
+        source = self.evaluate(node['source'], scope)
+        index = self.evaluate(node['index'], scope)
+        if source is None or index is None:
+            return None
+        try:
+            return source[index]
+        except (IndexError, TypeError, KeyError):
+            return None
+    
+    def _eval_is(self, node, scope):
+        value = self.evaluate(node['operand'], scope)
+        return value is not None and _type_matches(value, node['type'])
+    
+    def _eval_as(self, node, scope):
+        value = self.evaluate(node['operand'], scope)
+        if value is None:
+            return None
+        if node['type'].split('.')[-1].lower() in ('datetime', 'date') and isinstance(value, str):
+            return to_datetime(value) if parse_datetime(value) else None
+        return value if _type_matches(value, node['type']) else None
+    
+    def _eval_between(self, node, scope):
+        value = self.evaluate(node['operand'], scope)
+        low = compare(value, self.evaluate(node['low'], scope))
+        high = compare(value, self.evaluate(node['high'], scope))
+        if low is None or high is None:
+            return None
+        if node['properly']:
+            return low > 0 and high < 0
+        return low >= 0 and high <= 0
+    
+    def _eval_component(self, node, scope):
+        value = to_datetime(self.evaluate(node['operand'], scope))
+        if value is None:
+            return None
+        component = node['component']
+        if component == 'date':
+            return truncate(value, 'day')
+        if component == 'time':
+            return value.time().isoformat()
+        return getattr(value, component, None)
+    
+    def _eval_duration(self, node, scope):
+        return self._between(node, scope, duration_between)
+    
+    def _eval_difference(self, node, scope):
+        return self._between(node, scope, difference_between)
+    
+    def _between(self, node, scope, function: Callable) -> Optional[int]:
+        if 'operand' in node:
+            interval = to_interval(self.evaluate(node['operand'], scope))
+            low, high = (interval.low, interval.high) if interval else (None, None)
+        else:
+            low = self.evaluate(node['low'], scope)
+            high = self.evaluate(node['high'], scope)
+        low, high = to_datetime(low), to_datetime(high)
+        if low is None or high is None:
+            return None
+        return function(low, high, node['precision'])
+    
+    def _eval_minimum(self, node, scope):
+        raise CQLEvaluationError(f"不支援 minimum {node['type']}")
+    
+    def _eval_maximum(self, node, scope):
+        raise CQLEvaluationError(f"不支援 maximum {node['type']}")
+    
+    def _eval_convert(self, node, scope):
+        raise CQLEvaluationError(f"不支援單位轉換: {node['unit']}")
+    
+    def _eval_lambda(self, node, scope):
+        raise CQLEvaluationError("lambda 只能作為 FHIRPath 函式的參數")
+    
+    # 一元與二元運算
+    
+    def _eval_unary(self, node, scope):
+        op = node['op']
+        value = self.evaluate(node['operand'], scope)
+        
+        if op == 'not':
+            value = truth(value)
+            return None if value is None else not value
+        if op == 'exists':
+            return any(item is not None for item in value) if isinstance(value, list) else value is not None
+        if op == 'is null':
+            return value is None
+        if op == 'is not null':
+            return value is not None
+        if op in ('is true', 'is false'):
+            return value is (op == 'is true')
+        if value is None:
+            return None
+        if op == 'negate':
+            if isinstance(value, Quantity):
+                return Quantity(-value.value, value.unit)
+            return -value
+        if op in ('start of', 'end of'):
+            interval = to_interval(value)
+            return interval.low if op == 'start of' else interval.high
+        if op == 'width of':
+            interval = to_interval(value)
+            return None if interval.low is None or interval.high is None else interval.high - interval.low
+        if op == 'distinct':
+            return distinct(value)
+        if op == 'flatten':
+            return [item for sub in value for item in _as_list(sub)]
+        if op in ('singleton from', 'point from'):
+            if isinstance(value, Interval):
+                return value.low
+            if len(value) > 1:
+                raise CQLEvaluationError("singleton from 的清單含多個元素")
+            return value[0] if value else None
+        raise CQLEvaluationError(f"不支援的運算: {op}")
+    
+    def _eval_binary(self, node, scope):
+        op = node['op']
+        if op in ('and', 'or', 'implies'):
+            return self._logical(op, node, scope)
+        left = self.evaluate(node['left'], scope)
+        right = self.evaluate(node['right'], scope)
+        
+        if op in ('union', '|'):
+            if left is None and right is None:
+                return None
+            return distinct(_as_list(left) + _as_list(right))
+        if op == 'intersect':
+            keys = {_hash_key(item) for item in _as_list(right)}
+            return distinct(item for item in _as_list(left) if _hash_key(item) in keys)
+        if op == 'except':
+            keys = {_hash_key(item) for item in _as_list(right)}
+            return distinct(item for item in _as_list(left) if _hash_key(item) not in keys)
+        if op == '=':
+            return equal(left, right)
+        if op == '!=':
+            result = equal(left, right)
+            return None if result is None else not result
+        if op == '~':
+            return equivalent(left, right)
+        if op == '!~':
+            return not equivalent(left, right)
+        if op == 'in':
+            return self._membership(left, right)
+        if op == 'contains':
+            if isinstance(left, str) and isinstance(right, str):
+                return right in left
+            return self._membership(right, left)
+        if op == '&':
+            return ('' if left is None else str(left)) + ('' if right is None else str(right))
+        if op == 'xor':
+            left, right = truth(left), truth(right)
+            return None if left is None or right is None else left != right
+        
+        if left is None or right is None:
+            return None
+        if op in ('<', '<=', '>', '>='):
+            order = compare(left, right)
+            return {'<': order < 0, '<=': order <= 0, '>': order > 0, '>=': order >= 0}[op]
+        if op in ('+', '-', '*', '/', 'div', 'mod', '^'):
+            return self._arithmetic(op, left, right)
+        if op in ('starts with', 'ends with'):
+            return str(left).startswith(right) if op == 'starts with' else str(left).endswith(right)
+        return self._timing(node, left, right)
+    
+    def _logical(self, op: str, node, scope) -> Optional[bool]:
+        left = truth(self.evaluate(node['left'], scope))
+        if op == 'and' and left is False:
+            return False
+        if op == 'or' and left is True:
+            return True
+        if op == 'implies' and left is False:
+            return True
+        right = truth(self.evaluate(node['right'], scope))
+        if op == 'and':
+            return False if right is False else (None if None in (left, right) else True)
+        if op == 'or':
+            return True if right is True else (None if None in (left, right) else False)
+        return True if right is True else (None if None in (left, right) else False)
+    
+    def _membership(self, element, container) -> Optional[bool]:
+        if container is None:
+            return False
+        if isinstance(container, ValueSet):
+            return element is not None and container.codes is not None and _code_match(element, container.codes)
+        if isinstance(container, (Interval, dict)) and not isinstance(element, (list, Interval)):
+            return to_interval(container).contains(element)
+        if element is None:
+            return None
+        if isinstance(container, str):
+            return element in container
+        if _is_terminology(element) or isinstance(element, dict) and 'coding' in element:
+            return any(_code_match(element, item) for item in container)
+        return any(equal(element, item) for item in container)
+    
+    def _arithmetic(self, op: str, left, right):
+        if isinstance(right, Quantity) and not isinstance(left, Quantity) and op in ('+', '-'):
+            return add_quantity(to_datetime(left), right, 1 if op == '+' else -1)
+        if op == '+' and isinstance(left, str) and isinstance(right, str):
+            return left + right
+        if isinstance(left, Quantity) or isinstance(right, Quantity):
+            left_value = left.value if isinstance(left, Quantity) else left
+            right_value = right.value if isinstance(right, Quantity) else right
+            unit = left.unit if isinstance(left, Quantity) else right.unit
+            return Quantity(self._arithmetic(op, left_value, right_value), unit)
+        if isinstance(left, dict) and 'value' in left:
+            left = left['value']
+        if isinstance(right, dict) and 'value' in right:
+            right = right['value']
+        if op == '+':
+            return left + right
+        if op == '-':
+            return left - right
+        if op == '*':
+            return left * right
+        if op == '^':
+            return left ** right
+        if right == 0:
+            return None
+        if op == '/':
+            return left / right
+        if op == 'div':
+            return int(left / right)
+        return math.fmod(left, right) if isinstance(left, float) or isinstance(right, float) else \
+            int(math.fmod(left, right))
+    
+    def _timing(self, node, left, right) -> Optional[bool]:
+        op = node['op']
+        precision = node.get('precision')
+        
+        if op in ('during', 'included in', 'includes'):
+            container, contained = (right, left) if op != 'includes' else (left, right)
+            interval = to_interval(container)
+            if isinstance(contained, (Interval, dict)):
+                contained = to_interval(contained)
+                return self._in_interval(contained.low, interval, precision) and \
+                    self._in_interval(contained.high, interval, precision)
+            return self._in_interval(contained, interval, precision)
+        
+        if op == 'overlaps':
+            left, right = to_interval(left), to_interval(right)
+            starts_before_end = right.high is None or left.low is None or compare(left.low, right.high) <= 0
+            ends_after_start = right.low is None or left.high is None or compare(left.high, right.low) >= 0
+            return starts_before_end and ends_after_start
+        
+        # 時間點運算：依 boundary（starts/ends）與 target_boundary（start of/end of）取區間端點
+        before = op.endswith('before')
+        left = self._boundary(left, node.get('boundary'), 'end' if before else 'start')
+        right = self._boundary(right, node.get('target_boundary'), 'start' if before else 'end')
+        left, right = to_datetime(left), to_datetime(right)
+        if left is None or right is None:
+            return None
+        
+        if op in ('starts', 'ends', 'same as'):
+            return compare(truncate(left, precision), truncate(right, precision)) == 0
+        if op.startswith('same or'):
+            order = compare(truncate(left, precision), truncate(right, precision))
+            return order <= 0 if op.endswith('before') else order >= 0
+        if op == 'within':
+            quantity = self.evaluate(node['quantity'], {})
+            return add_quantity(right, quantity, -1) <= left <= add_quantity(right, quantity)
+        
+        if op not in ('before', 'after'):
+            raise CQLEvaluationError(f"不支援的時間運算: {op}")
+        quantity = self.evaluate(node['quantity'], {}) if node.get('quantity') else None
+        if quantity is None:
+            order = compare(truncate(left, precision), truncate(right, precision))
+            return order < 0 if op == 'before' else order > 0
+        
+        # A 3 days [or less / or more] after B：以數量的精確度比較
+        unit = quantity.unit if quantity.unit in ('year', 'month', 'week', 'day', 'hour', 'minute') else None
+        target = add_quantity(right, quantity, -1 if op == 'before' else 1)
+        left, right, target = truncate(left, unit), truncate(right, unit), truncate(target, unit)
+        offset = node.get('offset')
+        if offset is None:
+            return left == target
+        if op == 'after':
+            return right < left <= target if offset == 'less' else left >= target
+        return target <= left < right if offset == 'less' else left <= target
+    
+    @staticmethod
+    def _in_interval(point, interval: Optional[Interval], precision: Optional[str]) -> Optional[bool]:
+        if interval is None or point is None:
+            return None
+        point = to_datetime(point) if isinstance(point, str) else point
+        if precision and isinstance(point, datetime):
+            low = truncate(interval.low, precision) if isinstance(interval.low, datetime) else interval.low
+            high = truncate(interval.high, precision) if isinstance(interval.high, datetime) else interval.high
+            interval = Interval(low, high, interval.low_closed, interval.high_closed)
+            point = truncate(point, precision)
+        return interval.contains(point)
+    
+    @staticmethod
+    def _boundary(value, boundary: Optional[str], default: str):
+        if isinstance(value, (Interval, dict)) and not (isinstance(value, dict) and 'start' not in value
+                                                         and 'end' not in value):
+            interval = to_interval(value)
+            side = {'starts': 'start', 'ends': 'end'}.get(boundary, boundary) or default
+            return interval.low if side == 'start' else interval.high
+        return value
+    
+    # retrieve 與 query
+    
+    def _eval_retrieve(self, node, scope):
+        resource_type = node['resourceType']
+        resources = self.store.retrieve(resource_type)
+        if node['codes'] is None:
+            return list(resources)
+        
+        try:
+            target = self.evaluate(node['codes'], scope)
+        except CQLEvaluationError:
+            if node['codes']['kind'] != 'ref':
+                raise
+            # 本專案 CQL 的 [Encounter: class = "IMP"]：未宣告的代碼名稱直接當作代碼值
+            target = node['codes']['name']
+        path = node['codePath'] or DEFAULT_CODE_PATHS.get(resource_type, 'code')
+        comparator = node['codeComparator'] or 'in'
+        target_key = _filter_key(target)
+        key = None if target_key is None else (resource_type, path, comparator, target_key)
+        if key is not None:
+            cached = self.store.retrieve_cache.get(key)
+            if cached is not None:
+                self.retrieve_hits += 1
+                return list(cached)
+            self.retrieve_misses += 1
+        
+        codes = _index_codes(target) if comparator in ('in', '=', '~') else None
+        if codes is not None:
+            # 以代碼索引取得候選資源，再以完整條件（含 system）過濾
+            resources = self.store.by_codes(resource_type, path, codes)
+        matched = [resource for resource in resources
+                   if self._retrieve_filter(self._path(resource, path), comparator, target)]
+        if key is not None:
+            self.store.retrieve_cache[key] = matched
+        return list(matched)
+    
+    def _path(self, resource: Dict, path: str):
+        value = resource
+        for part in path.split('.'):
+            value = self._property(value, part)
+        return value
+    
+    def _retrieve_filter(self, value, comparator: str, target) -> bool:
+        if value is None:
+            return False
+        if comparator == 'in':
+            if isinstance(target, (Code, Concept)):
+                return _code_match(value, target)
+            if isinstance(target, list) and not any(_is_terminology(item) for item in target):
+                return any(equal(item, element) for item in _as_list(value) for element in target)
+            return bool(self._membership(value, target if isinstance(target, (ValueSet, list)) else [target]))
+        if comparator in ('=', '~', '!='):
+            if _is_terminology(target) or isinstance(value, dict) and 'coding' in value:
+                matched = _code_match(value, target)
+            else:
+                matched = any(equal(item, target) for item in _as_list(value))
+            return matched if comparator != '!=' else not matched
+        if comparator == 'contains':
+            return bool(self._membership(target, value))
+        raise CQLEvaluationError(f"不支援的 retrieve 條件: {comparator}")
+    
+    def _eval_query(self, node, scope):
+        sources = node['sources']
+        singleton = False
+        if len(sources) == 1:
+            source = self.evaluate(sources[0]['expression'], scope)
+            singleton = source is not None and not isinstance(source, list)
+            alias = sources[0]['alias']
+            rows = [{alias: item} for item in _as_list(source)]
+        else:
+            rows = [{}]
+            for source in sources:
+                items = _as_list(self.evaluate(source['expression'], scope))
+                rows = [dict(row, **{source['alias']: item}) for row in rows for item in items]
+        
+        matched = []
+        for row in rows:
+            row_scope = dict(scope, **row)
+            for binding in node['let']:
+                row_scope[binding['name']] = self.evaluate(binding['expression'], row_scope)
+            if not all(self._relationship(relationship, row_scope) for relationship in node['relationships']):
+                continue
+            if node['where'] is not None and not truth(self.evaluate(node['where'], row_scope)):
+                continue
+            matched.append((row, row_scope))
+        
+        if node['aggregate'] is not None:
+            return self._aggregate(node['aggregate'], matched, scope)
+        
+        if node['return'] is not None:
+            results = [self.evaluate(node['return']['expression'], row_scope) for _, row_scope in matched]
+            if node['return']['distinct']:
+                results = distinct(results)
+        elif len(sources) == 1:
+            results = [row[sources[0]['alias']] for row, _ in matched]
+        else:
+            results = [row for row, _ in matched]
+        
+        if node['sort'] is not None:
+            # 沒有 return 時結果即為來源，排序鍵可用 alias 限定（sort by E.id）
+            aliases = [source['alias'] for source in sources] if node['return'] is None else []
+            results = self._sort(results, node['sort'], scope, aliases)
+        if singleton:
+            return results[0] if results else None
+        return results
+    
+    def _relationship(self, relationship, scope) -> bool:
+        alias = relationship['alias']
+        related = _as_list(self.evaluate(relationship['expression'], scope))
+        found = any(truth(self.evaluate(relationship['suchThat'], dict(scope, **{alias: item})))
+                    for item in related)
+        return found if relationship['type'] == 'with' else not found
+    
+    def _aggregate(self, aggregate, matched, scope):
+        accumulator = aggregate['name']
+        value = self.evaluate(aggregate['starting'], scope) if aggregate['starting'] is not None else None
+        if aggregate['distinct']:
+            seen = set()
+            unique = []
+            for row, row_scope in matched:
+                key = _hash_key(row)
+                if key not in seen:
+                    seen.add(key)
+                    unique.append((row, row_scope))
+            matched = unique
+        for _, row_scope in matched:
+            value = self.evaluate(aggregate['expression'], dict(row_scope, **{accumulator: value}))
+        return value
+    
+    def _sort(self, results: List, sort: Dict[str, Any], scope, aliases: Optional[List[str]] = None) -> List:
+        def compare_values(a, b) -> int:
+            # null 排在最前（asc）
+            if a is None or b is None:
+                return (a is not None) - (b is not None)
+            return compare(a, b)
+        
+        if not sort['by']:
+            ordered = sorted(results, key=cmp_to_key(compare_values))
+            return ordered[::-1] if sort.get('direction') == 'desc' else ordered
+        
+        def row_scope(row):
+            bound = dict(scope, **{'$this': row})
+            if aliases and len(aliases) == 1:
+                bound[aliases[0]] = row
+            elif aliases:
+                # 多個來源的結果為 {alias: 項目}
+                bound.update(row)
+            return bound
+        
+        ordered = list(results)
+        # 由最後一個排序鍵開始做穩定排序
+        for item in reversed(sort['by']):
+            keys = {id(row): self.evaluate(item['expression'], row_scope(row)) for row in ordered}
+            ordered.sort(key=cmp_to_key(lambda a, b: compare_values(keys[id(a)], keys[id(b)])),
+                         reverse=item['direction'] == 'desc')
+        return ordered
+    
+    # 函式呼叫
+    
+    def _eval_call(self, node, scope):
+        name = node['name']
+        definition = self.definitions.get(name)
+        if definition is not None and definition['kind'] == 'function':
+            return self._call_function(definition, [self.evaluate(arg, scope) for arg in node['args']])
+        return self._builtin(name, node['args'], scope)
+    
+    def _call_function(self, definition: Dict[str, Any], args: List[Any]):
+        if definition.get('expression') is None:
+            raise CQLEvaluationError(definition.get('error') or f"函式 {definition['name']} 無法執行（external）")
+        params = definition['params']
+        if len(args) != len(params):
+            raise CQLEvaluationError(f"函式 {definition['name']} 需要 {len(params)} 個參數，但傳入 {len(args)} 個")
+        # 函式內只看得到參數（不含呼叫端的 alias）
+        return self.evaluate(definition['expression'], {param['name']: arg for param, arg in zip(params, args)})
+    
+    def _eval_method(self, node, scope):
+        source_node = node['source']
+        name = node['name']
+        if source_node['kind'] == 'ref' and source_node['name'] in self.library['includes'] \
+                and source_node['name'] not in scope:
+            # FHIRHelpers.ToDate(x) → 內建函式
+            return self._builtin(name, node['args'], scope)
+        
+        source = self.evaluate(source_node, scope)
+        definition = self.definitions.get(name)
+        if definition is not None and definition['kind'] == 'function' and definition.get('fluent'):
+            return self._call_function(definition, [source] + [self.evaluate(arg, scope) for arg in node['args']])
+        return self._fhirpath(name, source, node['args'], scope)
+    
+    def _lambda(self, node: Dict[str, Any], scope: Dict[str, Any]) -> Callable[[Any], Any]:
+        """FHIRPath 函式參數 → 對每個元素求值的函式（c: c.code = 'x' 或以 $this 欄位求值）"""
+        if node['kind'] == 'lambda':
+            return lambda item: self.evaluate(node['body'], dict(scope, **{node['param']: item}))
+        return lambda item: self.evaluate(node, dict(scope, **{'$this': item}))
+    
+    def _fhirpath(self, name: str, source, args: List[Dict[str, Any]], scope):
+        items = _as_list(source)
+        if name == 'resolve':
+            resolved = [self.store.resolve(item.get('reference') if isinstance(item, dict) else item)
+                        for item in items]
+            resolved = [resource for resource in resolved if resource is not None]
+            return resolved if isinstance(source, list) else (resolved[0] if resolved else None)
+        if name in ('exists', 'where', 'all', 'select'):
+            if not args:
+                return bool(items) if name == 'exists' else items
+            function = self._lambda(args[0], scope)
+            if name == 'select':
+                return [value for item in items for value in _as_list(function(item))]
+            matches = [item for item in items if truth(function(item))]
+            if name == 'exists':
+                return bool(matches)
+            if name == 'all':
+                return len(matches) == len(items)
+            return matches
+        if name in ('empty', 'count', 'first', 'last', 'distinct'):
+            return {'empty': lambda: not items, 'count': lambda: len(items),
+                    'first': lambda: items[0] if items else None, 'last': lambda: items[-1] if items else None,
+                    'distinct': lambda: distinct(items)}[name]()
+        values = [self.evaluate(arg, scope) for arg in args]
+        if name == 'substring':
+            return self._substring(source, *values)
+        if name == 'length':
+            return None if source is None else len(source)
+        if name in ('startsWith', 'endsWith', 'contains'):
+            if source is None or values[0] is None:
+                return None
+            return {'startsWith': str.startswith, 'endsWith': str.endswith,
+                    'contains': str.__contains__}[name](source, values[0])
+        return self._builtin_value(name, [source] + values)
+    
+    # 內建函式
+    
+    def _builtin(self, name: str, args: List[Dict[str, Any]], scope):
+        return self._builtin_value(name, [self.evaluate(arg, scope) for arg in args])
+    
+    def _builtin_value(self, name: str, values: List[Any]):
+        function = BUILTIN_FUNCTIONS.get(name) or BUILTIN_FUNCTIONS.get(name[:1].upper() + name[1:])
+        if function is not None:
+            return function(*values)
+        if name in ('AgeInYears', 'AgeInYearsAt', 'AgeInMonths', 'AgeInMonthsAt'):
+            if self.patient is None:
+                raise CQLEvaluationError(f"{name} 需要 Patient context")
+            as_of = values[0] if values else self.now
+            precision = 'year' if 'Years' in name else 'month'
+            return _age(self.patient.get('birthDate'), as_of, precision)
+        if name == 'Now':
+            return self.now
+        if name == 'Today':
+            return truncate(self.now, 'day')
+        if name in ('substring', 'Substring'):
+            return self._substring(*values)
+        raise CQLEvaluationError(f"未定義的函式: {name}")
+    
+    @staticmethod
+    def _substring(value, start, length=None):
+        if value is None or start is None:
+            return None
+        if start < 0 or start >= len(value):
+            return None
+        return value[start:] if length is None else value[start:start + length]
+
+
+def _age(birth_date, as_of, precision: str = 'year') -> Optional[int]:
+    birth_date, as_of = to_datetime(birth_date), to_datetime(as_of)
+    if birth_date is None or as_of is None:
+        return None
+    return duration_between(truncate(birth_date, 'day'), truncate(as_of, 'day'), precision)
+
+
+def _aggregate_values(values) -> List:
+    return [value for value in _as_list(values) if value is not None]
+
+
+def _sum(values):
+    values = _aggregate_values(values)
+    return sum(values) if values else None
+
+
+def _avg(values):
+    values = _aggregate_values(values)
+    return sum(values) / len(values) if values else None
+
+
+def _min(values):
+    values = _aggregate_values(values)
+    return min(values, key=cmp_to_key(compare)) if values else None
+
+
+def _max(values):
+    values = _aggregate_values(values)
+    return max(values, key=cmp_to_key(compare)) if values else None
+
+
+def _coalesce(*values):
+    if len(values) == 1 and isinstance(values[0], list):
+        values = values[0]
+    return next((value for value in values if value is not None), None)
+
+
+def _to_string(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        return str(value)
+    if isinstance(value, Quantity):
+        return f"{value.value} '{value.unit}'"
+    return str(value)
+
+
+def _to_decimal(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_integer(value):
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_date(value):
+    value = to_datetime(value) if not isinstance(value, dict) else None
+    return None if value is None else truncate(value, 'day')
+
+
+def _to_concept(value):
+    if value is None or isinstance(value, Concept):
+        return value
+    codings = value.get('coding', []) if isinstance(value, dict) else []
+    return Concept([Code(c.get('code'), c.get('system'), c.get('display')) for c in codings],
+                   value.get('text') if isinstance(value, dict) else None)
+
+
+def _to_quantity(value):
+    if value is None or isinstance(value, Quantity):
+        return value
+    return Quantity(value.get('value'), value.get('code') or value.get('unit'))
+
+
+def _datetime(year, month=1, day=1, hour=0, minute=0, second=0, millisecond=0):
+    if year is None:
+        return None
+    return datetime(year, month or 1, day or 1, hour or 0, minute or 0, second or 0, (millisecond or 0) * 1000)
+
+
+BUILTIN_FUNCTIONS: Dict[str, Callable] = {
+    'Count': lambda values: len(_aggregate_values(values)),
+    'Sum': _sum,
+    'Avg': _avg,
+    'Min': _min,
+    'Max': _max,
+    'Coalesce': _coalesce,
+    'First': lambda values: _as_list(values)[0] if _as_list(values) else None,
+    'Last': lambda values: _as_list(values)[-1] if _as_list(values) else None,
+    'Exists': lambda values: any(value is not None for value in _as_list(values)),
+    'IsNull': lambda value: value is None,
+    'Distinct': lambda values: distinct(_as_list(values)),
+    'Flatten': lambda values: [item for sub in _as_list(values) for item in _as_list(sub)],
+    'AllTrue': lambda values: all(value is True for value in _aggregate_values(values)),
+    'AnyTrue': lambda values: any(value is True for value in _aggregate_values(values)),
+    'Round': lambda value, precision=0: _round(value, precision or 0),
+    'Abs': lambda value: None if value is None else abs(value),
+    'Floor': lambda value: None if value is None else math.floor(value),
+    'Ceiling': lambda value: None if value is None else math.ceil(value),
+    'Truncate': lambda value: None if value is None else int(value),
+    'Length': lambda value: None if value is None else len(value),
+    'Upper': lambda value: None if value is None else value.upper(),
+    'Lower': lambda value: None if value is None else value.lower(),
+    'ToUpper': lambda value: None if value is None else value.upper(),
+    'ToLower': lambda value: None if value is None else value.lower(),
+    'StartsWith': lambda value, prefix: None if value is None or prefix is None else value.startswith(prefix),
+    'EndsWith': lambda value, suffix: None if value is None or suffix is None else value.endswith(suffix),
+    'Split': lambda value, separator: None if value is None else value.split(separator),
+    'Combine': lambda values, separator='': separator.join(_aggregate_values(values)),
+    'Concatenate': lambda *values: None if None in values else ''.join(values),
+    'ToString': _to_string,
+    'ToDecimal': _to_decimal,
+    'ToInteger': _to_integer,
+    'ToBoolean': lambda value: value if value is None or isinstance(value, bool) else str(value).lower() == 'true',
+    'ToDate': _to_date,
+    'ToDateTime': lambda value: to_datetime(value),
+    'ToInterval': to_interval,
+    'ToConcept': _to_concept,
+    'ToCode': lambda value: None if value is None else Code(value.get('code'), value.get('system'),
+                                                             value.get('display')),
+    'ToQuantity': _to_quantity,
+    'DateTime': _datetime,
+    'Date': lambda year, month=1, day=1: _datetime(year, month, day),
+    'CalculateAgeInYearsAt': lambda birth_date, as_of: _age(birth_date, as_of, 'year'),
+    'CalculateAgeInMonthsAt': lambda birth_date, as_of: _age(birth_date, as_of, 'month'),
+}
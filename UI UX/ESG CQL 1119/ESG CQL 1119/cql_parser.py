@@ -0,0 +1,1308 @@
+"""
+CQL Parser Module
+將CQL Library解析為可序列化的AST（dict 結構），並依檔案內容雜湊快取於磁碟
+
+支援的宣告: library / using / include / codesystem / valueset / code / concept /
+            parameter / context / define（含 define function）
+運算式: retrieve、query（alias / let / with / without / where / return / sort）、
+        邏輯與比較運算、timing 運算（during、before/after、included in ...）、
+        日期時間/數量字面值、Interval / List / Tuple / 型別實例、if / case、函式呼叫
+
+cql/ 目錄中部分檔案附有 SQL 範例或缺少開頭 /* 的註解區塊；這些無法解析的內容
+不會中斷解析，而是略過並記錄於 AST 的 diagnostics（含行號）。
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Any, Optional, Tuple
+from pathlib import Path
+
+import shared_path  # noqa: F401
+from fhir_shared.json_decoder import get_decoder
+
+logger = logging.getLogger(__name__)
+
+# AST 結構變更時遞增，使舊的磁碟快取自動失效
+PARSER_VERSION = '2'
+
+STATEMENT_KEYWORDS = {
+    'library', 'using', 'include', 'codesystem', 'valueset', 'code', 'concept',
+    'parameter', 'context', 'define', 'private', 'public'
+}
+
+# 不可作為 query alias 的保留字（比對時不分大小寫）
+RESERVED_WORDS = {
+    'after', 'aggregate', 'all', 'and', 'as', 'asc', 'ascending', 'before', 'between', 'by',
+    'case', 'cast', 'collapse', 'contains', 'convert', 'day', 'days',
+    'define', 'desc', 'descending', 'difference', 'distinct', 'div', 'duration',
+    'during', 'else', 'end', 'ends', 'except', 'exists', 'expand', 'false', 'flatten', 'from',
+    'hour', 'hours', 'if', 'implies', 'in', 'included', 'includes', 'intersect', 'is', 'let',
+    'meets', 'millisecond', 'milliseconds', 'minute', 'minutes', 'mod', 'month', 'months',
+    'not', 'null', 'occurs', 'of', 'on', 'or', 'overlaps', 'point', 'predecessor', 'properly',
+    'return', 'same', 'second', 'seconds', 'singleton', 'sort', 'start', 'starting', 'starts',
+    'successor', 'such', 'that', 'then', 'to', 'true', 'union', 'week', 'weeks',
+    'when', 'where', 'width', 'with', 'within', 'without', 'xor', 'year', 'years'
+}
+
+TEMPORAL_UNITS = {
+    'year': 'year', 'years': 'year', 'month': 'month', 'months': 'month',
+    'week': 'week', 'weeks': 'week', 'day': 'day', 'days': 'day',
+    'hour': 'hour', 'hours': 'hour', 'minute': 'minute', 'minutes': 'minute',
+    'second': 'second', 'seconds': 'second', 'millisecond': 'millisecond', 'milliseconds': 'millisecond'
+}
+
+DATETIME_COMPONENTS = {'date', 'time', 'timezoneoffset', 'year', 'month', 'week', 'day',
+                       'hour', 'minute', 'second', 'millisecond'}
+
+_DATETIME_RE = re.compile(
+    r'@(?:T\d{2}(?::\d{2}(?::\d{2}(?:\.\d+)?)?)?'
+    r'|\d{4}(?:-\d{2}(?:-\d{2})?)?(?:T(?:\d{2}(?::\d{2}(?::\d{2}(?:\.\d+)?)?)?)?(?:Z|[+-]\d{2}:\d{2})?)?)'
+)
+_NUMBER_RE = re.compile(r'\d+(?:\.\d+)?')
+_OPERATORS = ('<=', '>=', '!=', '!~', '->')
+
+
+class CQLParseError(Exception):
+    """CQL語法錯誤（含行號）"""
+    
+    def __init__(self, message: str, line: int = 0):
+        super().__init__(f"第 {line} 行: {message}" if line else message)
+        self.line = line
+
+
+class Token:
+    """詞法單元: kind 為 ident / qident / string / number / datetime / op"""
+    
+    __slots__ = ('kind', 'value', 'line', 'col')
+    
+    def __init__(self, kind: str, value: str, line: int, col: int):
+        self.kind = kind
+        self.value = value
+        self.line = line
+        self.col = col
+    
+    def __repr__(self):
+        return f"Token({self.kind}, {self.value!r}, {self.line}:{self.col})"
+
+
+def tokenize(text: str) -> Tuple[List[Token], List[Dict]]:
+    """
+    將CQL原始碼切分為詞法單元
+    
+    註解（// 、-- 與 /* */）直接略過。
+    
+    Returns:
+        (tokens, diagnostics)
+    """
+    tokens: List[Token] = []
+    diagnostics: List[Dict] = []
+    text = text.lstrip('﻿')
+    length = len(text)
+    pos = 0
+    line = 1
+    line_start = 0
+    
+    while pos < length:
+        char = text[pos]
+        
+        if char == '\n':
+            line += 1
+            pos += 1
+            line_start = pos
+            continue
+        if char in ' \t\r\f\v　':
+            pos += 1
+            continue
+        
+        if text.startswith('//', pos) or text.startswith('--', pos):
+            end = text.find('\n', pos)
+            pos = length if end < 0 else end
+            continue
+        
+        if text.startswith('/*', pos):
+            end = text.find('*/', pos + 2)
+            if end < 0:
+                diagnostics.append({'line': line, 'message': '區塊註解未結束，已略過至檔案結尾'})
+                end = length
+            comment = text[pos:end]
+            newlines = comment.count('\n')
+            if newlines:
+                line += newlines
+                line_start = pos + comment.rfind('\n') + 1
+            pos = min(end + 2, length)
+            continue
+        
+        col = pos - line_start
+        
+        if char in '"`\'':
+            value, end = _read_quoted(text, pos, char)
+            if value is None:
+                # 未結束的引號（常見於未標記的註解文字）：視為單一符號
+                tokens.append(Token('op', char, line, col))
+                pos += 1
+            else:
+                tokens.append(Token('string' if char == "'" else 'qident', value, line, col))
+                pos = end
+            continue
+        
+        if char == '@':
+            match = _DATETIME_RE.match(text, pos)
+            if match and len(match.group()) > 1:
+                tokens.append(Token('datetime', match.group()[1:], line, col))
+                pos = match.end()
+                continue
+        
+        if char.isdigit():
+            match = _NUMBER_RE.match(text, pos)
+            tokens.append(Token('number', match.group(), line, col))
+            pos = match.end()
+            continue
+        
+        if char == '_' or char == '$' or char.isalpha():
+            end = pos + 1
+            while end < length and (text[end] == '_' or text[end].isalnum()):
+                end += 1
+            tokens.append(Token('ident', text[pos:end], line, col))
+            pos = end
+            continue
+        
+        for operator in _OPERATORS:
+            if text.startswith(operator, pos):
+                tokens.append(Token('op', operator, line, col))
+                pos += len(operator)
+                break
+        else:
+            tokens.append(Token('op', char, line, col))
+            pos += 1
+    
+    return tokens, diagnostics
+
+
+def _read_quoted(text: str, pos: int, quote: str) -> Tuple[Optional[str], int]:
+    """讀取單行引號字串（支援反斜線跳脫），回傳 (內容, 結束位置)；同一行未結束時內容為 None"""
+    chars = []
+    end = pos + 1
+    length = len(text)
+    escapes = {'n': '\n', 't': '\t', 'r': '\r', 'f': '\f'}
+    
+    while end < length:
+        char = text[end]
+        if char == '\\' and end + 1 < length:
+            following = text[end + 1]
+            if following == 'u' and end + 5 < length:
+                try:
+                    chars.append(chr(int(text[end + 2:end + 6], 16)))
+                    end += 6
+                    continue
+                except ValueError:
+                    pass
+            chars.append(escapes.get(following, following))
+            end += 2
+            continue
+        if char == quote:
+            return ''.join(chars), end + 1
+        if char == '\n':
+            break
+        chars.append(char)
+        end += 1
+    
+    return None, end
+
+
+def split_statements(tokens: List[Token]) -> List[Tuple[str, List[Token]]]:
+    """
+    依最上層宣告切分詞法單元
+    
+    宣告以位於行首（第 0 欄）的宣告關鍵字開始；其後縮排的內容與行首的右括號屬於
+    同一宣告。行首出現的其他內容（SQL、未標記的註解文字）為 'unparsed' 區段。
+    
+    Returns:
+        [(kind, tokens)]，kind 為 'statement' 或 'unparsed'
+    """
+    segments: List[Tuple[str, List[Token]]] = []
+    current: List[Token] = []
+    kind = 'unparsed'
+    
+    for token in tokens:
+        if token.col == 0:
+            starts_statement = token.kind == 'ident' and token.value in STATEMENT_KEYWORDS
+            continues = token.kind == 'op' and token.value in ')]}'
+            if starts_statement or not continues:
+                if current:
+                    segments.append((kind, current))
+                current = []
+                kind = 'statement' if starts_statement else 'unparsed'
+        current.append(token)
+    
+    if current:
+        segments.append((kind, current))
+    return segments
+
+
+class CQLParser:
+    """CQL遞迴下降解析器，處理單一宣告的詞法單元序列"""
+    
+    def __init__(self, tokens: List[Token]):
+        self.tokens = tokens
+        self.pos = 0
+        # let ... in <expr> 的繫結中，'in' 不視為成員運算子（括號內恢復）
+        self.allow_in = True
+        # query 子句的最小欄位：let 項目內的子查詢不可吃掉與 let 對齊（或更左）的外層子句
+        self.clause_column = -1
+    
+    # 基本操作
+    
+    def peek(self, offset: int = 0) -> Optional[Token]:
+        index = self.pos + offset
+        return self.tokens[index] if index < len(self.tokens) else None
+    
+    def at_end(self) -> bool:
+        return self.pos >= len(self.tokens)
+    
+    def next(self) -> Token:
+        token = self.peek()
+        if token is None:
+            raise CQLParseError("宣告不完整", self._last_line())
+        self.pos += 1
+        return token
+    
+    def _last_line(self) -> int:
+        return self.tokens[-1].line if self.tokens else 0
+    
+    def check(self, *values: str, offset: int = 0) -> bool:
+        """下一個詞法單元是否為指定的關鍵字或符號（不含引號識別字）"""
+        token = self.peek(offset)
+        return token is not None and token.kind in ('ident', 'op') and token.value in values
+    
+    def accept(self, *values: str) -> Optional[Token]:
+        if self.check(*values):
+            return self.next()
+        return None
+    
+    def expect(self, *values: str) -> Token:
+        token = self.peek()
+        if not self.check(*values):
+            found = repr(token.value) if token else '宣告結尾'
+            raise CQLParseError(f"預期 {' / '.join(values)}，但遇到 {found}",
+                                token.line if token else self._last_line())
+        return self.next()
+    
+    def identifier(self) -> str:
+        """讀取識別字或引號識別字"""
+        token = self.peek()
+        if token is None or token.kind not in ('ident', 'qident'):
+            found = repr(token.value) if token else '宣告結尾'
+            raise CQLParseError(f"預期識別字，但遇到 {found}", token.line if token else self._last_line())
+        self.pos += 1
+        return token.value
+    
+    def string(self) -> str:
+        token = self.peek()
+        if token is None or token.kind != 'string':
+            found = repr(token.value) if token else '宣告結尾'
+            raise CQLParseError(f"預期字串，但遇到 {found}", token.line if token else self._last_line())
+        self.pos += 1
+        return token.value
+    
+    def _is_alias(self, token: Optional[Token]) -> bool:
+        return (token is not None and token.kind in ('ident', 'qident')
+                and (token.kind == 'qident' or token.value.lower() not in RESERVED_WORDS))
+    
+    # 宣告
+    
+    def parse_statement(self, library: Dict[str, Any]):
+        """解析一個最上層宣告並寫入 library"""
+        start = self.peek()
+        access = None
+        if self.check('private', 'public'):
+            access = self.next().value
+        
+        keyword = self.expect(*(STATEMENT_KEYWORDS - {'private', 'public'})).value
+        
+        if keyword == 'library':
+            library['name'] = self.identifier()
+            library['version'] = self.string() if self.accept('version') else None
+        
+        elif keyword == 'using':
+            model = self.identifier()
+            library['usings'].append({
+                'model': model,
+                'version': self.string() if self.accept('version') else None
+            })
+            if self.accept('called'):
+                self.identifier()
+        
+        elif keyword == 'include':
+            path = self.identifier()
+            while self.accept('.'):
+                path += '.' + self.identifier()
+            version = self.string() if self.accept('version') else None
+            alias = self.identifier() if self.accept('called') else path
+            library['includes'][alias] = {'library': path, 'version': version}
+        
+        elif keyword == 'codesystem':
+            name = self.identifier()
+            self.expect(':')
+            library['codesystems'][name] = {
+                'id': self.string(),
+                'version': self.string() if self.accept('version') else None
+            }
+        
+        elif keyword == 'valueset':
+            name = self.identifier()
+            self.expect(':')
+            if self.accept('{'):
+                # 本專案 CQL 以 code 名稱列舉的值集: valueset "X": { "Code A", "Code B" }
+                library['valuesets'][name] = {'id': None, 'version': None, 'codes': self._name_list('}')}
+                return
+            valueset = {'id': self.string(), 'version': self.string() if self.accept('version') else None}
+            if self.accept('codesystems'):
+                self.expect('{')
+                valueset['codesystems'] = self._name_list('}')
+            library['valuesets'][name] = valueset
+        
+        elif keyword == 'code':
+            name = self.identifier()
+            self.expect(':')
+            code = {'code': self.string()}
+            self.expect('from')
+            code['system'] = self.identifier()
+            code['display'] = self.string() if self.accept('display') else None
+            library['codes'][name] = code
+        
+        elif keyword == 'concept':
+            name = self.identifier()
+            self.expect(':')
+            self.expect('{')
+            concept = {'codes': self._name_list('}')}
+            concept['display'] = self.string() if self.accept('display') else None
+            library['concepts'][name] = concept
+        
+        elif keyword == 'parameter':
+            name = self.identifier()
+            parameter = {'type': None, 'default': None}
+            if not self.at_end() and not self.check('default'):
+                parameter['type'] = self.type_specifier()
+            if self.accept('default'):
+                parameter['default'] = self.expression()
+            library['parameters'][name] = parameter
+        
+        elif keyword == 'context':
+            library['context'] = self.identifier()
+        
+        elif keyword == 'define':
+            definition = self._definition(access, start.line)
+            library['definitions'][definition['name']] = definition
+    
+    def _name_list(self, closing: str) -> List[str]:
+        names = []
+        while not self.accept(closing):
+            names.append(self.identifier())
+            self.accept(',')
+        return names
+    
+    def _definition(self, access: Optional[str], line: int) -> Dict[str, Any]:
+        """define "Name": <expr> / define Name AS (<expr>) / define [fluent] function F(...): <expr>"""
+        fluent = bool(self.accept('fluent'))
+        if self.check('function') and self.peek(1) is not None and self.peek(1).kind in ('ident', 'qident'):
+            self.next()
+            name = self.identifier()
+            self.expect('(')
+            params = []
+            while not self.accept(')'):
+                param_name = self.identifier()
+                param_type = None if self.check(',', ')') else self.type_specifier()
+                params.append({'name': param_name, 'type': param_type})
+                self.accept(',')
+            returns = self.type_specifier() if self.accept('returns') else None
+            self.expect(':', 'AS', 'as')
+            external = bool(self.accept('external'))
+            return {
+                'name': name, 'kind': 'function', 'access': access, 'fluent': fluent,
+                'params': params, 'returns': returns, 'line': line,
+                'expression': None if external else self.expression(), 'external': external
+            }
+        
+        name = self.identifier()
+        self.expect(':', 'AS', 'as')
+        first = self.peek(1) if self.check('(') else self.peek()
+        if first is not None and first.kind == 'ident' and first.value in ('SELECT', 'WITH'):
+            raise CQLParseError("define 內容為 SQL 查詢，非 CQL 運算式", first.line)
+        return {'name': name, 'kind': 'expression', 'access': access, 'line': line,
+                'expression': self.expression()}
+    
+    def type_specifier(self) -> str:
+        """型別（以字串表示）: Integer、FHIR.Encounter、List<Code>、Interval<DateTime>、Tuple { a Integer }"""
+        if self.accept('List', 'Interval', 'Choice'):
+            kind = self.tokens[self.pos - 1].value
+            self.expect('<')
+            types = [self.type_specifier()]
+            while self.accept(','):
+                types.append(self.type_specifier())
+            self.expect('>')
+            return f"{kind}<{', '.join(types)}>"
+        if self.accept('Tuple'):
+            self.expect('{')
+            elements = []
+            while not self.accept('}'):
+                element = self.identifier()
+                self.accept(':')
+                elements.append(f"{element} {self.type_specifier()}")
+                self.accept(',')
+            return f"Tuple {{ {', '.join(elements)} }}"
+        name = self.identifier()
+        while self.check('.') and self.peek(1) is not None and self.peek(1).kind in ('ident', 'qident'):
+            self.next()
+            name += '.' + self.identifier()
+        return name
+    
+    # 運算式（由低至高優先序）
+    
+    def expression(self) -> Dict[str, Any]:
+        left = self._implies()
+        while self.check('|', 'union', 'intersect', 'except'):
+            op = self.next().value
+            left = _binary('union' if op == '|' else op, left, self._implies())
+        return left
+    
+    def _implies(self) -> Dict[str, Any]:
+        left = self._or()
+        while self.accept('implies'):
+            left = _binary('implies', left, self._or())
+        return left
+    
+    def _or(self) -> Dict[str, Any]:
+        left = self._and()
+        while self.check('or', 'xor'):
+            op = self.next().value
+            left = _binary(op, left, self._and())
+        return left
+    
+    def _and(self) -> Dict[str, Any]:
+        left = self._membership()
+        while self.accept('and'):
+            left = _binary('and', left, self._membership())
+        return left
+    
+    def _membership(self) -> Dict[str, Any]:
+        left = self._equality()
+        while (self.check('in', 'contains') or self.check('not') and self.check('in', offset=1)) \
+                and (self.allow_in or not self.check('in')):
+            negated = bool(self.accept('not'))
+            op = self.next().value
+            precision = self._precision_of()
+            node = _binary(op, left, self._equality())
+            if precision:
+                node['precision'] = precision
+            # X not in Y（本專案 CQL 的寫法）等同 not (X in Y)
+            left = {'kind': 'unary', 'op': 'not', 'operand': node} if negated else node
+        return left
+    
+    def _equality(self) -> Dict[str, Any]:
+        left = self._timing()
+        while self.check('=', '!=', '~', '!~'):
+            op = self.next().value
+            left = _binary(op, left, self._timing())
+        return left
+    
+    def _timing(self) -> Dict[str, Any]:
+        left = self._inequality()
+        while True:
+            phrase = self._timing_phrase()
+            if phrase is None:
+                return left
+            node = _binary(phrase.pop('op'), left, self._inequality())
+            node.update(phrase)
+            left = node
+    
+    def _precision_of(self) -> Optional[str]:
+        """dateTimePrecision 'of'（例如 day of）"""
+        token = self.peek()
+        if (token is not None and token.kind == 'ident' and token.value in TEMPORAL_UNITS
+                and self.check('of', offset=1)):
+            self.pos += 2
+            return TEMPORAL_UNITS[token.value]
+        return None
+    
+    def _timing_phrase(self) -> Optional[Dict[str, Any]]:
+        """
+        解析 timing 運算片語，回傳 {'op': ..., 'precision', 'quantity', 'properly', 'boundary'}
+        不是 timing 運算時不移動位置並回傳 None
+        """
+        start = self.pos
+        phrase: Dict[str, Any] = {}
+        
+        if self.check('starts', 'ends') and self.check('with', offset=1):
+            # 本專案 CQL 使用的字串運算: X starts with 'O80'
+            op = self.next().value
+            self.next()
+            return {'op': 'starts with' if op == 'starts' else 'ends with'}
+        
+        if self.check('starts', 'ends', 'occurs'):
+            phrase['boundary'] = self.next().value
+        
+        if self.accept('properly'):
+            phrase['properly'] = True
+        
+        if self.accept('during'):
+            phrase['op'] = 'during'
+        elif self.check('included') and self.check('in', offset=1):
+            self.pos += 2
+            phrase['op'] = 'included in'
+        elif self.accept('includes'):
+            phrase['op'] = 'includes'
+        elif self.accept('overlaps'):
+            phrase['op'] = 'overlaps'
+            if self.check('before', 'after'):
+                phrase['op'] = 'overlaps ' + self.next().value
+        elif self.accept('meets'):
+            phrase['op'] = 'meets'
+            if self.check('before', 'after'):
+                phrase['op'] = 'meets ' + self.next().value
+        elif self.accept('same'):
+            precision = self._precision_token()
+            if self.accept('as'):
+                phrase['op'] = 'same as'
+            elif self.accept('or'):
+                phrase['op'] = 'same or ' + self.expect('before', 'after').value
+            else:
+                self.pos = start
+                return None
+            if precision:
+                phrase['precision'] = precision
+        elif self.check('on') and self.check('or', offset=1):
+            self.pos += 2
+            phrase['op'] = 'same or ' + self.expect('before', 'after').value
+        elif self.accept('within'):
+            phrase['quantity'] = self._quantity_literal()
+            self.expect('of')
+            phrase['op'] = 'within'
+        elif self.check('before', 'after'):
+            phrase['op'] = self.next().value
+        else:
+            quantity = None
+            if self.peek() is not None and self.peek().kind == 'number':
+                saved = self.pos
+                try:
+                    quantity = self._quantity_literal()
+                except CQLParseError:
+                    self.pos = saved
+                    quantity = None
+            if quantity is not None:
+                phrase['quantity'] = quantity
+                if self.accept('or'):
+                    phrase['offset'] = self.expect('less', 'more').value
+                if self.check('before', 'after'):
+                    phrase['op'] = self.next().value
+            if 'op' not in phrase:
+                if phrase.get('boundary') in ('starts', 'ends') and len(phrase) == 1:
+                    # X starts Y / X ends Y（區間起訖相同）
+                    phrase['op'] = phrase.pop('boundary')
+                    return phrase
+                self.pos = start
+                return None
+        
+        if phrase['op'] in ('before', 'after') or phrase['op'].startswith('same or'):
+            precision = self._precision_token()
+            if precision:
+                phrase['precision'] = precision
+            if self.check('start', 'end') and self.check('of', offset=1):
+                phrase['target_boundary'] = self.next().value
+                self.next()
+        elif phrase['op'] in ('during', 'included in', 'includes'):
+            precision = self._precision_token()
+            if precision:
+                phrase['precision'] = precision
+        return phrase
+    
+    def _precision_token(self) -> Optional[str]:
+        token = self.peek()
+        if token is not None and token.kind == 'ident' and token.value in TEMPORAL_UNITS:
+            if self.check('of', offset=1):
+                self.pos += 2
+            else:
+                self.pos += 1
+            return TEMPORAL_UNITS[token.value]
+        return None
+    
+    def _quantity_literal(self) -> Dict[str, Any]:
+        token = self.next()
+        if token.kind != 'number':
+            raise CQLParseError(f"預期數量，但遇到 {token.value!r}", token.line)
+        unit_token = self.peek()
+        if unit_token is None or not (unit_token.kind == 'string' or
+                                      (unit_token.kind == 'ident' and unit_token.value in TEMPORAL_UNITS)):
+            raise CQLParseError("數量缺少單位", token.line)
+        self.pos += 1
+        unit = TEMPORAL_UNITS.get(unit_token.value, unit_token.value)
+        return {'kind': 'quantity', 'value': _number(token.value), 'unit': unit}
+    
+    def _inequality(self) -> Dict[str, Any]:
+        left = self._type_expression()
+        while self.check('<=', '<', '>', '>='):
+            op = self.next().value
+            left = _binary(op, left, self._type_expression())
+        return left
+    
+    def _type_expression(self) -> Dict[str, Any]:
+        operand = self._prefix()
+        while True:
+            if self.check('is'):
+                self.next()
+                negated = bool(self.accept('not'))
+                if self.check('null', 'true', 'false'):
+                    test = self.next().value
+                    operand = {'kind': 'unary', 'op': f"is {'not ' if negated else ''}{test}", 'operand': operand}
+                else:
+                    operand = {'kind': 'is', 'operand': operand, 'type': self.type_specifier()}
+                    if negated:
+                        operand = {'kind': 'unary', 'op': 'not', 'operand': operand}
+            elif self.check('as') and self.peek(1) is not None and self.peek(1).kind in ('ident', 'qident'):
+                self.next()
+                operand = {'kind': 'as', 'operand': operand, 'type': self.type_specifier()}
+            elif self.check('properly', 'between') and (self.check('between') or self.check('between', offset=1)):
+                properly = bool(self.accept('properly'))
+                self.expect('between')
+                low = self.term()
+                self.expect('and')
+                high = self.term()
+                operand = {'kind': 'between', 'operand': operand, 'low': low, 'high': high, 'properly': properly}
+            else:
+                return operand
+    
+    def _prefix(self) -> Dict[str, Any]:
+        token = self.peek()
+        if token is None:
+            raise CQLParseError("運算式不完整", self._last_line())
+        
+        if self.accept('not'):
+            return {'kind': 'unary', 'op': 'not', 'operand': self._type_expression()}
+        if self.accept('exists'):
+            return {'kind': 'unary', 'op': 'exists', 'operand': self._type_expression()}
+        if self.accept('cast'):
+            operand = self.expression()
+            self.expect('as')
+            return {'kind': 'as', 'operand': operand, 'type': self.type_specifier(), 'strict': True}
+        
+        # years between A and B / duration in days between A and B / difference in days between A and B
+        if token.kind == 'ident' and token.value in ('duration', 'difference') and self.check('in', offset=1):
+            self.pos += 2
+            precision = TEMPORAL_UNITS[self.expect(*TEMPORAL_UNITS).value]
+            if self.accept('of'):
+                return {'kind': token.value, 'precision': precision, 'operand': self.term()}
+            self.expect('between')
+            low = self.term()
+            self.expect('and')
+            return {'kind': token.value, 'precision': precision, 'low': low, 'high': self.term()}
+        if token.kind == 'ident' and token.value in TEMPORAL_UNITS and self.check('between', offset=1):
+            self.pos += 2
+            low = self.term()
+            self.expect('and')
+            return {'kind': 'duration', 'precision': TEMPORAL_UNITS[token.value], 'low': low, 'high': self.term()}
+        
+        return self.term()
+    
+    def term(self) -> Dict[str, Any]:
+        left = self._multiplicative()
+        while self.check('+', '-', '&'):
+            op = self.next().value
+            left = _binary(op, left, self._multiplicative())
+        return left
+    
+    def _multiplicative(self) -> Dict[str, Any]:
+        left = self._power()
+        while self.check('*', '/', 'div', 'mod'):
+            op = self.next().value
+            left = _binary(op, left, self._power())
+        return left
+    
+    def _power(self) -> Dict[str, Any]:
+        left = self._unary()
+        while self.accept('^'):
+            left = _binary('^', left, self._unary())
+        return left
+    
+    def _unary(self) -> Dict[str, Any]:
+        token = self.peek()
+        if token is None:
+            raise CQLParseError("運算式不完整", self._last_line())
+        
+        if self.check('-', '+'):
+            op = self.next().value
+            operand = self._unary()
+            if op == '-' and operand.get('kind') in ('literal', 'quantity') and isinstance(operand.get('value'), (int, float)):
+                operand['value'] = -operand['value']
+                return operand
+            return operand if op == '+' else {'kind': 'unary', 'op': 'negate', 'operand': operand}
+        
+        if token.kind == 'ident':
+            following = self.peek(1)
+            value = token.value
+            if value in ('start', 'end') and self.check('of', offset=1):
+                self.pos += 2
+                return {'kind': 'unary', 'op': f'{value} of', 'operand': self._unary()}
+            if value in ('width', 'successor', 'predecessor') and self.check('of', offset=1):
+                self.pos += 2
+                return {'kind': 'unary', 'op': f'{value} of', 'operand': self._unary()}
+            if value in ('singleton', 'point') and self.check('from', offset=1):
+                self.pos += 2
+                return {'kind': 'unary', 'op': f'{value} from', 'operand': self._unary()}
+            if value.lower() in DATETIME_COMPONENTS and self.check('from', offset=1):
+                self.pos += 2
+                return {'kind': 'component', 'component': value.lower(), 'operand': self._unary()}
+            if value in ('distinct', 'flatten', 'expand', 'collapse') and following is not None \
+                    and not self.check(',', ')', offset=1):
+                # distinct X 與 distinct(X) 相同
+                self.pos += 1
+                return {'kind': 'unary', 'op': value, 'operand': self._type_expression()}
+            if value in ('minimum', 'maximum') and following is not None and following.kind in ('ident', 'qident'):
+                self.pos += 1
+                return {'kind': value, 'type': self.type_specifier()}
+            if value == 'convert':
+                self.pos += 1
+                operand = self.expression()
+                self.expect('to')
+                if self.peek() is not None and self.peek().kind == 'string':
+                    return {'kind': 'convert', 'operand': operand, 'unit': self.string()}
+                return {'kind': 'as', 'operand': operand, 'type': self.type_specifier()}
+            if value == 'if':
+                self.pos += 1
+                condition = self.expression()
+                self.expect('then')
+                then = self.expression()
+                self.expect('else')
+                return {'kind': 'if', 'condition': condition, 'then': then, 'else': self.expression()}
+            if value == 'case':
+                return self._case()
+            if value == 'let':
+                # let a: X, b: Y in <expr> 或連續多行 let a := X（本專案 CQL 在函式中使用的寫法）
+                bindings = []
+                while self.accept('let'):
+                    allow_in, self.allow_in = self.allow_in, False
+                    try:
+                        bindings.extend(self._let_items())
+                    finally:
+                        self.allow_in = allow_in
+                    self.accept('in')
+                return {'kind': 'let', 'let': bindings, 'expression': self.expression()}
+        
+        return self._postfix()
+    
+    def _case(self) -> Dict[str, Any]:
+        self.expect('case')
+        comparand = None if self.check('when') else self.expression()
+        items = []
+        while self.accept('when'):
+            when = self.expression()
+            self.expect('then')
+            items.append({'when': when, 'then': self.expression()})
+        self.expect('else')
+        default = self.expression()
+        self.expect('end')
+        return {'kind': 'case', 'comparand': comparand, 'items': items, 'else': default}
+    
+    def _postfix(self) -> Dict[str, Any]:
+        if self.check('from'):
+            return self._query(None)
+        
+        node = self._primary()
+        while True:
+            if self.check('.') and self.peek(1) is not None and self.peek(1).kind in ('ident', 'qident'):
+                self.next()
+                name = self.identifier()
+                if self.accept('('):
+                    node = {'kind': 'method', 'source': node, 'name': name, 'args': self._arguments()}
+                else:
+                    node = {'kind': 'property', 'source': node, 'path': name}
+            elif self.check('[') and node.get('kind') != 'retrieve':
+                self.next()
+                index = self.expression()
+                self.expect(']')
+                node = {'kind': 'index', 'source': node, 'index': index}
+            else:
+                break
+        
+        unit = self.peek()
+        if unit is not None and unit.kind == 'ident' and unit.value in TEMPORAL_UNITS \
+                and not self.check('of', 'between', offset=1) and node.get('kind') not in ('literal', 'quantity'):
+            # "Lookback Days" days：以運算式的值建立時間數量
+            self.pos += 1
+            return {'kind': 'quantity', 'value': node, 'unit': TEMPORAL_UNITS[unit.value]}
+        
+        if node.get('kind') in ('ref', 'property', 'method', 'retrieve', 'call', 'paren', 'list', 'index') \
+                and self._is_alias(self.peek()):
+            return self._query(node)
+        if node.get('kind') == 'paren':
+            return node['expression']
+        return node
+    
+    def _primary(self) -> Dict[str, Any]:
+        token = self.next()
+        
+        if token.kind == 'string':
+            return {'kind': 'literal', 'type': 'String', 'value': token.value}
+        if token.kind == 'number':
+            unit = self.peek()
+            if unit is not None and (unit.kind == 'string' or
+                                     (unit.kind == 'ident' and unit.value in TEMPORAL_UNITS
+                                      and not self.check('of', offset=1) and not self.check('between', offset=1))):
+                self.pos += 1
+                return {'kind': 'quantity', 'value': _number(token.value),
+                        'unit': TEMPORAL_UNITS.get(unit.value, unit.value)}
+            value = _number(token.value)
+            return {'kind': 'literal', 'type': 'Integer' if isinstance(value, int) else 'Decimal', 'value': value}
+        if token.kind == 'datetime':
+            value = token.value
+            value_type = 'Time' if value.startswith('T') else ('DateTime' if 'T' in value else 'Date')
+            return {'kind': 'literal', 'type': value_type, 'value': value}
+        if token.kind == 'qident':
+            return self._reference(token.value)
+        
+        if token.kind == 'op':
+            if token.value == '(':
+                allow_in, self.allow_in = self.allow_in, True
+                try:
+                    expression = self.expression()
+                finally:
+                    self.allow_in = allow_in
+                self.expect(')')
+                return {'kind': 'paren', 'expression': expression}
+            if token.value == '[':
+                return self._retrieve()
+            if token.value == '{':
+                return self._braces()
+            raise CQLParseError(f"非預期的符號 {token.value!r}", token.line)
+        
+        value = token.value
+        if value in ('true', 'false'):
+            return {'kind': 'literal', 'type': 'Boolean', 'value': value == 'true'}
+        if value == 'null':
+            return {'kind': 'literal', 'type': 'Null', 'value': None}
+        if value == 'Interval' and self.check('[', '('):
+            low_closed = self.next().value == '['
+            low = self.expression()
+            self.expect(',')
+            high = self.expression()
+            high_closed = self.expect(']', ')').value == ']'
+            return {'kind': 'interval', 'low': low, 'high': high,
+                    'lowClosed': low_closed, 'highClosed': high_closed}
+        if value == 'List' and self.check('<', '{'):
+            element_type = None
+            if self.accept('<'):
+                element_type = self.type_specifier()
+                self.expect('>')
+            self.expect('{')
+            node = self._braces()
+            if element_type:
+                node['elementType'] = element_type
+            return node
+        if value == 'Tuple' and self.check('{'):
+            self.next()
+            return self._braces(tuple_only=True)
+        if value[:1].isupper() and self.check('{') and self._looks_like_instance():
+            self.next()
+            node = self._braces(tuple_only=True)
+            return {'kind': 'instance', 'type': value, 'elements': node['elements']}
+        if value.lower() in RESERVED_WORDS and value not in ('day', 'days', 'year', 'years', 'month', 'months'):
+            if not self.check('('):
+                raise CQLParseError(f"非預期的關鍵字 {value!r}", token.line)
+        return self._reference(value)
+    
+    def _looks_like_instance(self) -> bool:
+        """Code { code: ... } 之類的型別實例（大括號內為 name: value）"""
+        first = self.peek(1)
+        return (first is not None and (first.kind in ('ident', 'qident') and self.check(':', offset=2)
+                                       or first.kind == 'op' and first.value == '}'))
+    
+    def _reference(self, name: str) -> Dict[str, Any]:
+        if self.accept('('):
+            return {'kind': 'call', 'name': name, 'args': self._arguments()}
+        return {'kind': 'ref', 'name': name}
+    
+    def _arguments(self) -> List[Dict[str, Any]]:
+        args = []
+        allow_in, self.allow_in = self.allow_in, True
+        try:
+            while not self.accept(')'):
+                token = self.peek()
+                if token is not None and token.kind == 'ident' and self.check(':', offset=1):
+                    # FHIRPath 風格的 lambda: coding.exists(c: c.code = 'drg')
+                    self.pos += 2
+                    args.append({'kind': 'lambda', 'param': token.value, 'body': self.expression()})
+                else:
+                    args.append(self.expression())
+                if not self.check(')'):
+                    self.expect(',')
+        finally:
+            self.allow_in = allow_in
+        return args
+    
+    def _braces(self, tuple_only: bool = False) -> Dict[str, Any]:
+        """{ ... } 之後的內容：List 或 Tuple（name: value）"""
+        first = self.peek()
+        is_tuple = tuple_only or (first is not None and first.kind in ('ident', 'qident', 'string')
+                                  and self.check(':', offset=1)) or self.check(':')
+        if is_tuple:
+            elements = []
+            if self.accept(':'):
+                self.expect('}')
+                return {'kind': 'tuple', 'elements': elements}
+            while not self.accept('}'):
+                name = self.string() if self.peek() is not None and self.peek().kind == 'string' else self.identifier()
+                self.expect(':')
+                elements.append({'name': name, 'value': self.expression()})
+                if not self.check('}'):
+                    self.expect(',')
+            return {'kind': 'tuple', 'elements': elements}
+        
+        elements = []
+        while not self.accept('}'):
+            elements.append(self.expression())
+            if not self.check('}'):
+                self.expect(',')
+        return {'kind': 'list', 'elements': elements}
+    
+    def _retrieve(self) -> Dict[str, Any]:
+        """[Type] / [Type: "Terminology"] / [Type: path in|=|~ <expr>]"""
+        resource_type = self.identifier()
+        while self.check('.') and self.peek(1) is not None and self.peek(1).kind in ('ident', 'qident'):
+            self.next()
+            resource_type = self.identifier()
+        
+        node = {'kind': 'retrieve', 'resourceType': resource_type,
+                'codePath': None, 'codeComparator': None, 'codes': None}
+        if self.accept(':'):
+            filter_expression = self.expression()
+            path = _dotted_path(filter_expression.get('left')) if filter_expression.get('kind') == 'binary' else None
+            if path and filter_expression['op'] in ('in', '=', '~', '!=', 'contains'):
+                node['codePath'] = path
+                node['codeComparator'] = filter_expression['op']
+                node['codes'] = filter_expression['right']
+            else:
+                node['codes'] = filter_expression
+        self.expect(']')
+        return node
+    
+    def _clause(self, *keywords: str) -> bool:
+        token = self.peek()
+        return self.check(*keywords) and token.col > self.clause_column
+    
+    def _query(self, source: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """query: source alias [, ...] [let] [with/without] [where] [return/aggregate] [sort]"""
+        sources = []
+        multi_source = source is None
+        if multi_source:
+            self.expect('from')
+            source = self._query_source()
+        while True:
+            sources.append({'expression': source, 'alias': self.identifier()})
+            # 多個來源僅限 from 開頭的 query，避免吃掉函式參數間的逗號
+            if not (multi_source and self.accept(',')):
+                break
+            source = self._query_source()
+        
+        query: Dict[str, Any] = {'kind': 'query', 'sources': sources, 'let': [], 'relationships': [],
+                                 'where': None, 'return': None, 'aggregate': None, 'sort': None}
+        
+        # 本專案 CQL 的 let / where 可交錯出現；多個 where 以 and 合併
+        while self._clause('let', 'with', 'without', 'where'):
+            clause = self.next()
+            if clause.value == 'let':
+                clause_column, self.clause_column = self.clause_column, clause.col
+                try:
+                    query['let'].extend(self._let_items())
+                finally:
+                    self.clause_column = clause_column
+            elif clause.value == 'where':
+                condition = self.expression()
+                query['where'] = condition if query['where'] is None else _binary('and', query['where'], condition)
+            else:
+                related = self._query_source()
+                alias = self.identifier()
+                self.expect('such')
+                self.expect('that')
+                query['relationships'].append({'type': clause.value, 'expression': related, 'alias': alias,
+                                               'suchThat': self.expression()})
+        
+        if self._clause('return'):
+            self.next()
+            distinct = True
+            if self.check('all', 'distinct'):
+                distinct = self.next().value == 'distinct'
+            query['return'] = {'expression': self.expression(), 'distinct': distinct}
+        elif self._clause('aggregate'):
+            self.next()
+            distinct = False
+            if self.check('all', 'distinct'):
+                distinct = self.next().value == 'distinct'
+            name = self.identifier()
+            starting = self._unary() if self.accept('starting') else None
+            self.expect(':')
+            query['aggregate'] = {'name': name, 'distinct': distinct, 'starting': starting,
+                                  'expression': self.expression()}
+        
+        if self._clause('sort'):
+            self.next()
+            if self.accept('by'):
+                items = []
+                while True:
+                    item = {'expression': self.expression(), 'direction': 'asc'}
+                    if self.check('asc', 'ascending', 'desc', 'descending'):
+                        item['direction'] = 'desc' if self.next().value.startswith('desc') else 'asc'
+                    items.append(item)
+                    if not self.accept(','):
+                        break
+                query['sort'] = {'by': items}
+            else:
+                direction = self.expect('asc', 'ascending', 'desc', 'descending').value
+                query['sort'] = {'by': [], 'direction': 'desc' if direction.startswith('desc') else 'asc'}
+        
+        return query
+    
+    def _let_items(self) -> List[Dict[str, Any]]:
+        """name: expr [, name: expr]*（亦接受 name := expr 與 name = expr）"""
+        items = []
+        while True:
+            name = self.identifier()
+            if self.expect(':', '=').value == ':':
+                self.accept('=')
+            items.append({'name': name, 'expression': self.expression()})
+            if not (self.check(',') and self.peek(1) is not None and self.peek(1).kind in ('ident', 'qident')
+                    and self.check(':', '=', offset=2)):
+                return items
+            self.next()
+    
+    def _query_source(self) -> Dict[str, Any]:
+        node = self._primary()
+        while self.check('.') and self.peek(1) is not None and self.peek(1).kind in ('ident', 'qident'):
+            self.next()
+            name = self.identifier()
+            if self.accept('('):
+                node = {'kind': 'method', 'source': node, 'name': name, 'args': self._arguments()}
+            else:
+                node = {'kind': 'property', 'source': node, 'path': name}
+        return node['expression'] if node.get('kind') == 'paren' else node
+
+
+def _binary(op: str, left: Dict[str, Any], right: Dict[str, Any]) -> Dict[str, Any]:
+    return {'kind': 'binary', 'op': op, 'left': left, 'right': right}
+
+
+def _number(text: str):
+    return float(text) if '.' in text else int(text)
+
+
+def _dotted_path(node: Optional[Dict[str, Any]]) -> Optional[str]:
+    """ref / property 串接為 'a.b.c'；含呼叫或其他運算時回傳 None"""
+    if node is None:
+        return None
+    if node.get('kind') == 'ref':
+        return node['name']
+    if node.get('kind') == 'property':
+        parent = _dotted_path(node['source'])
+        return f"{parent}.{node['path']}" if parent else None
+    return None
+
+
+def walk(node: Any):
+    """深度優先走訪AST中所有運算式節點"""
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, dict):
+            if 'kind' in current:
+                yield current
+            # 反向推入堆疊，使走訪順序與原始碼順序一致
+            stack.extend(value for value in reversed(list(current.values())) if isinstance(value, (dict, list)))
+        elif isinstance(current, list):
+            stack.extend(reversed(current))
+
+
+def _annotate(definition: Dict[str, Any], definitions: Dict[str, Any]):
+    """記錄定義中使用的 retrieve 與參照的其他定義（供相依分析與查詢規劃）"""
+    retrieves = []
+    references = set()
+    for node in walk(definition.get('expression')):
+        kind = node['kind']
+        if kind == 'retrieve':
+            retrieves.append({
+                'resourceType': node['resourceType'],
+                'codePath': node['codePath'],
+                'codeComparator': node['codeComparator'],
+                'terminology': node['codes']['name'] if (node['codes'] or {}).get('kind') == 'ref' else None
+            })
+        elif kind in ('ref', 'call'):
+            references.add(node['name'])
+    definition['retrieves'] = retrieves
+    definition['references'] = sorted(name for name in references if name in definitions)
+
+
+def new_library() -> Dict[str, Any]:
+    return {
+        'name': None, 'version': None, 'usings': [], 'includes': {},
+        'codesystems': {}, 'valuesets': {}, 'codes': {}, 'concepts': {},
+        'parameters': {}, 'context': None, 'definitions': {}, 'diagnostics': []
+    }
+
+
+def parse_cql(text: str) -> Dict[str, Any]:
+    """
+    解析CQL原始碼
+    
+    Returns:
+        library AST:
+        {
+            'name', 'version', 'usings', 'includes', 'codesystems', 'valuesets', 'codes',
+            'concepts', 'parameters', 'context',
+            'definitions': {name: {'kind', 'expression', 'retrieves', 'references', 'line', ...}},
+            'diagnostics': [{'line', 'end_line', 'message'}]
+        }
+        無法解析的 define 仍會列於 definitions，其 expression 為 None 並附 'error'。
+    """
+    tokens, diagnostics = tokenize(text)
+    library = new_library()
+    library['diagnostics'].extend(diagnostics)
+    
+    for kind, segment in split_statements(tokens):
+        start_line, end_line = segment[0].line, segment[-1].line
+        if kind == 'unparsed':
+            library['diagnostics'].append({'line': start_line, 'end_line': end_line,
+                                           'message': '非CQL宣告，已略過'})
+            continue
+        
+        parser = CQLParser(segment)
+        try:
+            parser.parse_statement(library)
+        except CQLParseError as e:
+            library['diagnostics'].append({'line': e.line or start_line, 'end_line': end_line,
+                                           'message': str(e)})
+            _record_failed_definition(library, segment, str(e))
+            continue
+        
+        if not parser.at_end():
+            library['diagnostics'].append({'line': parser.peek().line, 'end_line': end_line,
+                                           'message': '宣告後有無法解析的內容，已略過'})
+    
+    for definition in library['definitions'].values():
+        _annotate(definition, library['definitions'])
+    return library
+
+
+def _record_failed_definition(library: Dict[str, Any], segment: List[Token], error: str):
+    """define 解析失敗時仍登錄名稱，執行時可回報明確錯誤"""
+    values = [token for token in segment[:4] if token.kind in ('ident', 'qident')]
+    names = [token.value for token in values]
+    if 'define' not in names:
+        return
+    index = names.index('define') + 1
+    if index < len(values) and values[index].value in ('function', 'fluent') and index + 1 < len(values):
+        index += 1
+    if index < len(values):
+        name = values[index].value
+        library['definitions'].setdefault(name, {
+            'name': name, 'kind': 'expression', 'access': None, 'line': segment[0].line,
+            'expression': None, 'error': error
+        })
+
+
+class CQLASTCache:
+    """
+    CQL AST 磁碟快取
+    
+    以檔案內容的 SHA-256（含 PARSER_VERSION）為鍵，內容未變更時直接載入 AST，
+    完全略過詞法分析與解析。
+    
+    目錄結構：
+        <cache_dir>/<內容雜湊>.json   {'parser_version': ..., 'source': 檔名, 'ast': {...}}
+    """
+    
+    def __init__(self, cache_dir: str = '.cql_cache'):
+        """
+        初始化AST快取
+        
+        Args:
+            cache_dir: 快取目錄
+        """
+        self.cache_dir = Path(cache_dir)
+        self.decoder = get_decoder()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+    
+    @staticmethod
+    def content_key(content: bytes) -> str:
+        digest = hashlib.sha256(PARSER_VERSION.encode('ascii') + b'\0' + content)
+        return digest.hexdigest()[:32]
+    
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self.cache_dir / f"{key}.json"
+        try:
+            with open(path, 'rb') as f:
+                entry = self.decoder.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"AST快取檔案損毀，將重新解析: {path} ({e})")
+            return None
+        if entry.get('parser_version') != PARSER_VERSION:
+            return None
+        return entry.get('ast')
+    
+    def save(self, key: str, source: str, ast: Dict[str, Any]):
+        """以暫存檔 + os.replace 原子寫入"""
+        path = self.cache_dir / f"{key}.json"
+        tmp_path = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'parser_version': PARSER_VERSION, 'source': source, 'ast': ast},
+                          f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"無法寫入AST快取: {path} ({e})")
+    
+    def get_or_parse(self, content: bytes, source: str = '') -> Dict[str, Any]:
+        """
+        取得CQL內容的AST（快取命中時不解析）
+        
+        Args:
+            content: CQL檔案原始位元組
+            source: 檔名（僅記錄用）
+        """
+        key = self.content_key(content)
+        ast = self.load(key)
+        with self._lock:
+            if ast is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if ast is not None:
+            return ast
+        
+        ast = parse_cql(content.decode('utf-8-sig'))
+        self.save(key, source, ast)
+        return ast
+    
+    def clear(self):
+        for path in self.cache_dir.glob('*.json'):
+            path.unlink()
+
+
+def load_library(path: str, cache: Optional[CQLASTCache] = None) -> Dict[str, Any]:
+    """
+    讀取並解析CQL檔案
+    
+    Args:
+        path: CQL檔案路徑
+        cache: AST快取（None = 每次重新解析）
+    """
+    path = Path(path)
+    content = path.read_bytes()
+    if cache is not None:
+        return cache.get_or_parse(content, path.name)
+    return parse_cql(content.decode('utf-8-sig'))
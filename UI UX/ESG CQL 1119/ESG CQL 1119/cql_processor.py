@@ -1,81 +1,262 @@
 """
 CQL Processor Module
-處理CQL檔案解析和模擬執行
-注意: 由於Python缺乏完整的CQL引擎，此模組提供模擬執行功能
+處理CQL檔案解析和執行
+所有 define 由 cql_engine 直譯執行；ESG 三個 Library 另外附加顯示用的彙總欄位（估算值）
 """
 
-import re
+import gc
+import os
 import logging
-from typing import Dict, List, Any, Optional
-from datetime import datetime, timedelta
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Any, Optional, Callable
+from datetime import date, datetime
 from pathlib import Path
 
+from cql_parser import CQLASTCache, parse_cql, walk
+from cql_engine import CQLEvaluator, FHIRStore, Interval, to_json_value
+import shared_path  # noqa: F401
+from fhir_shared.fhir_frames import FHIRFrames
+from measure_state import MeasureState
+from result_cache import CQLResultCache
+from fhir_shared.sketches import HyperLogLog, QuantileSketch
+
 logger = logging.getLogger(__name__)
 
+# 結果依執行當下時間而定的函式（AgeInYears 等未指定日期時也以 Today() 計算）
+CLOCK_FUNCTIONS = ('Now', 'Today', 'TimeOfDay')
+
+# ESG Library 顯示用的彙總欄位（main.py 與 data_filter 依這些欄位顯示）
+ESG_SUMMARIES = {
+    "Antibiotic_Utilization": "_execute_antibiotic_utilization",
+    "EHR_Adoption_Rate": "_execute_ehr_adoption",
+    "Waste": "_execute_waste",
+}
+
 
 class CQLProcessor:
     """CQL處理器 - 解析CQL並基於FHIR資料進行計算"""
     
-    def __init__(self, cql_file_path: str):
+    def __init__(self, cql_file_path: str, ast_cache: Optional[CQLASTCache] = None,
+                 approximate: Optional[Dict] = None):
         """
         初始化CQL處理器
         
         Args:
             cql_file_path: CQL檔案路徑
+            ast_cache: AST磁碟快取（None = 每次重新解析）
+            approximate: 近似統計參數（sketches.sketch_options；None = 精確計算）
         """
         self.cql_file_path = Path(cql_file_path)
+        self.ast_cache = ast_cache
+        self.approximate = approximate
         self.cql_content = ""
         self.library_name = ""
         self.version = ""
+        self.ast: Dict[str, Any] = {}
         self.definitions = {}
+        # 沒有可執行內容時略過的原因（例如只有 SQL 的指標檔）
+        self.skip_reason: Optional[str] = None
+        self._patient_level: Optional[bool] = None
+        self._uses_clock: Optional[bool] = None
         
         self._load_cql()
-        self._parse_metadata()
+        self._parse_library()
     
     def _load_cql(self):
         """載入CQL檔案內容"""
         try:
-            with open(self.cql_file_path, 'r', encoding='utf-8') as f:
-                self.cql_content = f.read()
+            with open(self.cql_file_path, 'rb') as f:
+                self._raw_content = f.read()
+            self.cql_content = self._raw_content.decode('utf-8-sig')
             logger.info(f"已載入CQL檔案: {self.cql_file_path.name}")
         except Exception as e:
             logger.error(f"載入CQL檔案失敗: {e}")
             raise
     
-    def _parse_metadata(self):
-        """解析CQL metadata"""
-        # 提取library名稱和版本
-        library_match = re.search(r'library\s+(\w+)\s+version\s+[\'"]([^\'\"]+)[\'"]', self.cql_content)
-        if library_match:
-            self.library_name = library_match.group(1)
-            self.version = library_match.group(2)
-            logger.info(f"CQL Library: {self.library_name} v{self.version}")
+    def _parse_library(self):
+        """解析CQL為AST（內容未變更時由快取載入）"""
+        if self.ast_cache is not None:
+            self.ast = self.ast_cache.get_or_parse(self._raw_content, self.cql_file_path.name)
+        else:
+            self.ast = parse_cql(self.cql_content)
+        
+        self.library_name = self.ast.get('name') or self.cql_file_path.stem
+        self.version = self.ast.get('version') or ""
+        self.definitions = self.ast.get('definitions', {})
+        logger.info(f"CQL Library: {self.library_name} v{self.version} ({len(self.definitions)} 個 define)")
+        
+        for diagnostic in self.ast.get('diagnostics', []):
+            logger.debug(f"{self.cql_file_path.name} 第 {diagnostic['line']} 行: {diagnostic['message']}")
+        
+        expressions = [name for name, definition in self.definitions.items() if definition['kind'] == 'expression']
+        if not expressions and self.library_name not in ESG_SUMMARIES:
+            self.skip_reason = (f"沒有可執行的 CQL define（{len(self.ast.get('diagnostics', []))} 段"
+                                f"非 CQL 內容，例如 SQL 查詢）")
+            logger.debug(f"{self.cql_file_path.name}: {self.skip_reason}，執行時將略過")
     
-    def execute(self, fhir_data: Dict[str, List[Dict]], measurement_period: tuple) -> Dict[str, Any]:
+    def execute(self, fhir_data: Dict[str, List[Dict]], measurement_period: tuple,
+                store: Optional[FHIRStore] = None) -> Dict[str, Any]:
         """
-        執行CQL邏輯（模擬）
+        執行CQL邏輯
         
         Args:
             fhir_data: FHIR資源數據 {'Patient': [...], 'Encounter': [...]}
             measurement_period: (start_date, end_date) 測量期間
-            
+            store: 由 fhir_data 建立的 FHIRStore（多個 Library 共用 retrieve 快取；None = 自行建立）
+        
         Returns:
-            執行結果字典
+            執行結果字典（definitions 為各 define 的值，definition_errors 為無法執行的 define；
+            沒有可執行內容的 Library 只有 skipped 說明原因）
         """
+        results = {
+            "library": self.library_name,
+            "version": self.version,
+            "measurement_period": {
+                "start": measurement_period[0].isoformat(),
+                "end": measurement_period[1].isoformat()
+            }
+        }
+        if self.skip_reason:
+            logger.warning(f"略過 {self.library_name}: {self.skip_reason}")
+            results['skipped'] = self.skip_reason
+            return results
+        
         logger.info(f"開始執行CQL: {self.library_name}")
+        store = store or FHIRStore(fhir_data)
+        results.update(self._evaluate_definitions(store, measurement_period))
+        results['data_status'] = 'FHIR 資料已載入' if fhir_data.get('Patient') else 'FHIR 無資料記載'
         
-        # 根據不同的CQL library執行不同的邏輯
-        if self.library_name == "Antibiotic_Utilization":
-            return self._execute_antibiotic_utilization(fhir_data, measurement_period)
-        elif self.library_name == "EHR_Adoption_Rate":
-            return self._execute_ehr_adoption(fhir_data, measurement_period)
-        elif self.library_name == "Waste":
-            return self._execute_waste(fhir_data, measurement_period)
+        summary = ESG_SUMMARIES.get(self.library_name)
+        if summary:
+            results.update(getattr(self, summary)(store, measurement_period))
+        
+        return results
+    
+    def _parameters(self, measurement_period: tuple) -> Dict[str, Any]:
+        """以執行的測量期間覆寫 Library 的測量期間參數（各檔案命名不一）"""
+        start, end = measurement_period
+        parameters = {}
+        for name in self.ast.get('parameters', {}):
+            key = name.lower().replace(' ', '').replace('_', '')
+            if key == 'measurementperiod':
+                parameters[name] = Interval(start, end)
+            elif key in ('measurementperiodstart', 'measurementstartdate'):
+                parameters[name] = start
+            elif key in ('measurementperiodend', 'measurementenddate'):
+                parameters[name] = end
+        return parameters
+    
+    def uses_clock(self) -> bool:
+        """是否有 define 或函式呼叫 Now() / Today()（或未指定日期的 AgeInYears 等），結果隨執行日期變動"""
+        if self._uses_clock is None:
+            self._uses_clock = any(
+                node['kind'] == 'call' and (node['name'] in CLOCK_FUNCTIONS or
+                                            (node['name'].startswith('AgeIn') and not node['args']))
+                for definition in self.definitions.values()
+                for node in walk(definition.get('expression'))
+            )
+        return self._uses_clock
+    
+    def included_contents(self) -> List[bytes]:
+        """
+        include 的 Library 原始內容（遞迴）
+        
+        依序尋找與此檔同目錄的 <名稱>-<版本>.cql、<名稱>.cql；找不到的 Library（例如 FHIRHelpers 由引擎內建）略過
+        """
+        contents = []
+        seen = set()
+        pending = list(self.ast.get('includes', {}).values())
+        while pending:
+            include = pending.pop(0)
+            name = include['library'].split('.')[-1]
+            if name in seen:
+                continue
+            seen.add(name)
+            candidates = [f"{name}-{include['version']}.cql"] if include.get('version') else []
+            for candidate in candidates + [f"{name}.cql"]:
+                path = self.cql_file_path.parent / candidate
+                if not path.is_file():
+                    continue
+                raw = path.read_bytes()
+                contents.append(raw)
+                ast = (self.ast_cache.get_or_parse(raw, path.name) if self.ast_cache is not None
+                       else parse_cql(raw.decode('utf-8-sig')))
+                pending.extend(ast.get('includes', {}).values())
+                break
+        return contents
+    
+    def _is_patient_level(self) -> bool:
+        """context Patient 且運算式參照 Patient 的 Library 需逐一病人執行"""
+        if self._patient_level is None:
+            self._patient_level = self.ast.get('context') == 'Patient' and any(
+                node['kind'] == 'ref' and node['name'] == 'Patient'
+                for definition in self.definitions.values()
+                for node in walk(definition.get('expression')))
+        return self._patient_level
+    
+    def _evaluate_definitions(self, store: FHIRStore, measurement_period: tuple,
+                              verbose: bool = True) -> Dict[str, Any]:
+        """
+        執行所有 define（單一 define 失敗不影響其他 define）
+        
+        Population：所有資料執行一次。Patient：每個病人以其 compartment 執行後彙總，
+        清單合併、數值加總、布林值為符合的病人數，其他值依病人列出。
+        verbose=False 時不記錄完成訊息與警告（逐一病人執行時使用，警告仍放在結果中）。
+        """
+        names = [name for name, definition in self.definitions.items() if definition['kind'] == 'expression']
+        parameters = self._parameters(measurement_period)
+        now = datetime.now()
+        errors: Dict[str, str] = {}
+        warnings: List[str] = []
+        retrieve_cache = {'hits': 0, 'misses': 0}
+        
+        def evaluate_all(evaluator: CQLEvaluator, label: str = '') -> Dict[str, Any]:
+            values = {}
+            for name in names:
+                if name in errors:
+                    continue
+                try:
+                    values[name] = evaluator.evaluate_definition(name)
+                except Exception as e:
+                    errors[name] = f"{label}{e}"
+                    logger.debug(f"{self.library_name}.{name} 執行失敗: {label}{e}")
+            for warning in evaluator.warnings:
+                if warning not in warnings:
+                    warnings.append(warning)
+            retrieve_cache['hits'] += evaluator.retrieve_hits
+            retrieve_cache['misses'] += evaluator.retrieve_misses
+            return values
+        
+        if self._is_patient_level():
+            context = 'Patient'
+            per_patient: Dict[str, Dict[str, Any]] = {name: {} for name in names}
+            for patient_id, patient_store in store.partition_by_patient().items():
+                evaluator = CQLEvaluator(self.ast, patient_store, parameters,
+                                         patient=patient_store.retrieve('Patient')[0], now=now)
+                for name, value in evaluate_all(evaluator, f"Patient/{patient_id}: ").items():
+                    per_patient[name][patient_id] = value
+            values = {name: _combine_patient_values(per_patient[name]) for name in names if name not in errors}
         else:
-            logger.warning(f"未知的CQL library: {self.library_name}")
-            return {"error": "Unknown CQL library"}
+            context = 'Population'
+            values = evaluate_all(CQLEvaluator(self.ast, store, parameters, now=now))
+        
+        if verbose:
+            logger.info(f"{self.library_name}: {len(values)}/{len(names)} 個 define 執行完成（{context}）")
+            for warning in warnings:
+                logger.warning(f"{self.library_name}: {warning}")
+        
+        results = {
+            'context': context,
+            'definitions': {name: to_json_value(value) for name, value in values.items()},
+            'definition_errors': errors,
+            'retrieve_cache': retrieve_cache,
+        }
+        if warnings:
+            results['warnings'] = warnings
+        return results
     
-    def _execute_antibiotic_utilization(self, fhir_data: Dict, measurement_period: tuple) -> Dict:
+    def _execute_antibiotic_utilization(self, store: FHIRStore, measurement_period: tuple) -> Dict:
         """執行抗生素使用率計算"""
         results = {
             "library": self.library_name,
@@ -86,11 +267,12 @@ class CQLProcessor:
             }
         }
         
-        # 取得資源
-        patients = fhir_data.get('Patient', [])
-        encounters = fhir_data.get('Encounter', [])
-        med_requests = fhir_data.get('MedicationRequest', [])
-        med_admins = fhir_data.get('MedicationAdministration', [])
+        # 取得資源（欄式 frame）
+        frames = _frames(store)
+        patients = frames['Patient']
+        encounters = frames['Encounter']
+        med_requests = frames['MedicationRequest']
+        med_admins = frames['MedicationAdministration']
         
         # 基礎計數
         results['total_patients'] = len(patients)
@@ -102,28 +284,41 @@ class CQLProcessor:
         if len(encounters) == 0:
             results['data_warning'] = '⚠️ 2年內無就醫記錄，部分指標無法計算'
         
-        # 使用抗生素的病人數（模擬）
-        antibiotic_patients = set()
-        for med in med_admins:
-            if 'subject' in med and 'reference' in med['subject']:
-                antibiotic_patients.add(med['subject']['reference'])
+        # 使用抗生素的病人數（近似模式：HyperLogLog 估計，附 95% 信賴區間）
+        if self.approximate:
+            sketch = HyperLogLog(self.approximate['precision'])
+            sketch.update(med_admins['patient_id'])
+            bounds = sketch.summary()
+            antibiotic_patients = bounds['estimate']
+            results['antibiotic_use_patient_count_error_bounds'] = bounds
+        else:
+            antibiotic_patients = int(med_admins['patient_id'].nunique())
         
-        results['antibiotic_use_patient_count'] = len(antibiotic_patients)
+        results['antibiotic_use_patient_count'] = antibiotic_patients
         
         # 計算使用率
         if len(patients) > 0:
             results['antibiotic_use_rate_percent'] = round(
-                (len(antibiotic_patients) / len(patients)) * 100, 2
+                (antibiotic_patients / len(patients)) * 100, 2
             )
+            if self.approximate:
+                results['antibiotic_use_rate_percent_error_bounds'] = {
+                    'lower': round(bounds['lower'] / len(patients) * 100, 2),
+                    'upper': round(bounds['upper'] / len(patients) * 100, 2),
+                }
         else:
             results['antibiotic_use_rate_percent'] = 0
         
-        # 住院日數（簡化計算）
-        total_bed_days = 0
-        for encounter in encounters:
-            if encounter.get('class', {}).get('code') in ['IMP', 'ACUTE']:
-                # 簡化：假設每次住院3天
-                total_bed_days += 3
+        # 住院日數（簡化計算：假設每次住院3天）
+        inpatient = encounters['class'].isin(['IMP', 'ACUTE'])
+        total_bed_days = int(inpatient.sum()) * 3
+        
+        # 近似模式：住院日數分布（有起訖時間的住院，分位數 sketch 附相對誤差範圍）
+        if self.approximate:
+            stays = encounters[inpatient]
+            length_of_stay = QuantileSketch(self.approximate['relative_accuracy'])
+            length_of_stay.update((stays['end'] - stays['start']).dt.total_seconds() / 86400)
+            results['length_of_stay_days'] = length_of_stay.summary()
         
         results['total_bed_days'] = total_bed_days
         results['data_scope'] = 'CQL計算範圍：全部FHIR資料（無時間限制）'
@@ -144,7 +339,7 @@ class CQLProcessor:
         logger.info(f"抗生素使用率計算完成: {results['antibiotic_use_rate_percent']}%")
         return results
     
-    def _execute_ehr_adoption(self, fhir_data: Dict, measurement_period: tuple) -> Dict:
+    def _execute_ehr_adoption(self, store: FHIRStore, measurement_period: tuple) -> Dict:
         """執行電子病歷採用率計算"""
         results = {
             "library": self.library_name,
@@ -155,31 +350,28 @@ class CQLProcessor:
             }
         }
         
-        # 取得資源
-        patients = fhir_data.get('Patient', [])
-        encounters = fhir_data.get('Encounter', [])
-        documents = fhir_data.get('DocumentReference', [])
-        observations = fhir_data.get('Observation', [])
-        procedures = fhir_data.get('Procedure', [])
-        med_requests = fhir_data.get('MedicationRequest', [])
+        # 取得資源（欄式 frame）
+        frames = _frames(store)
+        patients = frames['Patient']
+        encounters = frames['Encounter']
+        documents = frames['DocumentReference']
+        observations = frames['Observation']
+        procedures = frames['Procedure']
+        med_requests = frames['MedicationRequest']
         
         # 基礎計數
         results['total_patients'] = len(patients)
         results['total_encounters'] = len(encounters)
         results['total_ehr_documents'] = len(documents)
         results['total_electronic_prescriptions'] = len(med_requests)
-        results['total_electronic_lab_results'] = len([o for o in observations 
-                                                        if any(c.get('code') == 'laboratory' 
-                                                              for c in o.get('category', [{}]))])
+        results['total_electronic_lab_results'] = int(observations['is_laboratory'].sum())
         results['total_electronic_procedures'] = len(procedures)
         results['data_scope'] = 'CQL計算範圍：全部FHIR資料（無時間限制）'
         
         # 計算採用率
         if len(encounters) > 0:
             # 有電子記錄的就醫次數
-            encounters_with_ehr = len([e for e in encounters 
-                                       if any(d.get('context', {}).get('reference', '').endswith(e.get('id', '')) 
-                                             for d in documents)])
+            encounters_with_ehr = int(encounters['id'].isin(documents['encounter_id'].dropna()).sum())
             
             results['ehr_adoption_rate_encounter_percent'] = round(
                 (encounters_with_ehr / len(encounters)) * 100, 2
@@ -218,7 +410,7 @@ class CQLProcessor:
         logger.info(f"EHR採用率計算完成: {results['ehr_adoption_rate_encounter_percent']}%")
         return results
     
-    def _execute_waste(self, fhir_data: Dict, measurement_period: tuple) -> Dict:
+    def _execute_waste(self, store: FHIRStore, measurement_period: tuple) -> Dict:
         """執行廢棄物管理計算"""
         results = {
             "library": self.library_name,
@@ -229,20 +421,21 @@ class CQLProcessor:
             }
         }
         
-        # 取得資源
-        patients = fhir_data.get('Patient', [])
-        encounters = fhir_data.get('Encounter', [])
-        observations = fhir_data.get('Observation', [])
+        # 取得資源（欄式 frame）
+        frames = _frames(store)
+        patients = frames['Patient']
+        encounters = frames['Encounter']
+        observations = frames['Observation']
         
         # 基礎計數
         results['total_patients'] = len(patients)
         results['total_encounters'] = len(encounters)
         
         # 廢棄物相關觀察記錄（模擬）
-        waste_observations = [o for o in observations 
-                             if 'waste' in str(o.get('code', {})).lower()]
+        waste_observations = observations['coding_text'].str.contains('waste', regex=False) | \
+            observations['text'].fillna('').str.lower().str.contains('waste', regex=False)
         
-        results['total_waste_records'] = len(waste_observations)
+        results['total_waste_records'] = int(waste_observations.sum())
         
         # 模擬廢棄物量（kg）- 說明：FHIR無標準廢棄物資源，此為估算
         results['total_waste_kg'] = len(encounters) * 2.5  # 每次就醫平均2.5kg
@@ -276,18 +469,26 @@ class CQLProcessor:
 class CQLExecutor:
     """CQL執行器 - 管理多個CQL檔案的執行"""
     
-    def __init__(self, cql_files: List[str]):
+    def __init__(self, cql_files: List[str], ast_cache: Optional[CQLASTCache] = None, workers: int = 1,
+                 result_cache: Optional[CQLResultCache] = None, approximate: Optional[Dict] = None):
         """
         初始化CQL執行器
         
         Args:
             cql_files: CQL檔案路徑列表
+            ast_cache: AST磁碟快取（None = 每次重新解析）
+            workers: 平行執行的行程數（1 = 依序執行；0 = CPU 核心數）
+            result_cache: execute_all 的結果磁碟快取（None = 每次重新執行）
+            approximate: 近似統計參數（sketches.sketch_options；None = 精確計算）
         """
         self.processors = []
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.result_cache = result_cache
+        self.approximate = approximate
         
         for cql_file in cql_files:
             if Path(cql_file).exists():
-                processor = CQLProcessor(cql_file)
+                processor = CQLProcessor(cql_file, ast_cache, approximate)
                 self.processors.append(processor)
             else:
                 logger.warning(f"CQL檔案不存在: {cql_file}")
@@ -305,14 +506,328 @@ class CQLExecutor:
                 'Waste': {...}
             }
         """
+        # 同一次執行共用一個 store：相同的 retrieve（資源類型 + 代碼條件）只計算一次
+        store = FHIRStore(fhir_data)
+        
+        # 結果快取：CQL 內容、資料快照與測量期間皆相同的 Library 直接取回上次的結果
+        # （使用 Now() / Today() 的 Library 另以執行日期區分）
+        cached: Dict[str, Dict[str, Any]] = {}
+        keys: Dict[str, str] = {}
+        if self.result_cache is not None:
+            snapshot = store.snapshot_version()
+            today = date.today().isoformat()
+            for processor in self.processors:
+                keys[processor.library_name] = self.result_cache.key(
+                    processor._raw_content, snapshot, measurement_period, self.approximate,
+                    today if processor.uses_clock() else None, processor.included_contents())
+                result = self.result_cache.get(keys[processor.library_name])
+                if result is not None:
+                    cached[processor.library_name] = result
+            logger.info(f"結果快取: 命中 {len(cached)} 個、需執行 {len(self.processors) - len(cached)} 個 Library")
+        pending = [processor for processor in self.processors if processor.library_name not in cached]
+        
+        workers = self._workers(len(pending))
+        if workers > 1:
+            # 參照索引與病人 compartment 先在主行程建立，子行程直接共用
+            store.build_indexes(partition=any(processor._is_patient_level() for processor in pending))
+        executed = dict(zip(
+            (processor.library_name for processor in pending),
+            self._map(lambda index: _execute_library(pending[index], store, measurement_period),
+                      len(pending), workers)
+        ))
+        if self.result_cache is not None:
+            for library_name, result in executed.items():
+                if 'error' not in result:
+                    self.result_cache.put(keys[library_name], library_name, result)
+        results = {processor.library_name: cached.get(processor.library_name) or executed[processor.library_name]
+                   for processor in self.processors}
+        skipped = [library_name for library_name, result in results.items() if 'skipped' in result]
+        if skipped:
+            logger.warning(f"{len(skipped)} 個 Library 沒有可執行的 CQL，已略過: {', '.join(skipped)}")
+        
+        hits = misses = 0
+        for library_name, result in executed.items():
+            stats = result.get('retrieve_cache')
+            if stats is None:
+                continue
+            hits += stats['hits']
+            misses += stats['misses']
+            logger.info(f"{library_name}: retrieve 快取命中 {stats['hits']} 次，未命中 {stats['misses']} 次")
+        
+        if hits + misses:
+            logger.info(f"retrieve 快取合計: 命中 {hits} / {hits + misses} ({hits / (hits + misses):.0%})")
+        return results
+    
+    def execute_sharded(self, fhir_data: Dict[str, List[Dict]], measurement_period: tuple,
+                        shards: int) -> Dict[str, Any]:
+        """
+        依病人分成 shards 個 shard 各自執行所有CQL，再合併各 shard 的族群人數
+        
+        每個 shard 只含所屬病人的資源（及共用資源），可分散到多個行程（之後亦可分散到多台機器）；
+        shard 只回傳 population_counts 與錯誤，不回傳 define 的完整結果。
+        族群人數以 define 名稱辨識（Initial Population / Denominator / Numerator），
+        各 shard 相加即為全體人數，因此這些 define 必須是以病人為單位可加總的計數。
+        
+        Returns:
+            {
+                'Indicator_01_...': {
+                    'library': ..., 'version': ..., 'measurement_period': {...}, 'shards': N,
+                    'population_counts': {'initial_population': n, 'denominator': n, 'numerator': n},
+                    'definition_errors': {...}
+                }
+            }
+        """
+        shard_stores = FHIRStore(fhir_data).shard(shards)
+        logger.info(f"依病人分為 {shards} 個 shard: " +
+                    ", ".join(str(len(shard_store.retrieve('Patient'))) for shard_store in shard_stores))
+        
+        def execute_shard(index: int) -> Dict[str, Any]:
+            partials = {}
+            for processor in self.processors:
+                if processor.skip_reason:
+                    continue
+                result = _execute_library(processor, shard_stores[index], measurement_period)
+                partial = {key: result[key] for key in ('error', 'definition_errors') if key in result}
+                partial['population_counts'] = population_counts(result.get('definitions', {}))
+                partials[processor.library_name] = partial
+            return partials
+        
+        shard_results = self._map(execute_shard, shards, self._workers(shards))
+        
         results = {}
+        for processor in self.processors:
+            merged = {
+                "library": processor.library_name,
+                "version": processor.version,
+                "measurement_period": {
+                    "start": measurement_period[0].isoformat(),
+                    "end": measurement_period[1].isoformat()
+                },
+                "shards": shards,
+                "population_counts": {},
+                "definition_errors": {},
+            }
+            if processor.skip_reason:
+                merged['skipped'] = processor.skip_reason
+                results[processor.library_name] = merged
+                continue
+            for index, shard_result in enumerate(shard_results):
+                partial = shard_result[processor.library_name]
+                if 'error' in partial:
+                    merged.setdefault('error', f"shard {index}: {partial['error']}")
+                for role, count in partial['population_counts'].items():
+                    merged['population_counts'][role] = merged['population_counts'].get(role, 0) + count
+                for name, message in partial.get('definition_errors', {}).items():
+                    merged['definition_errors'].setdefault(name, f"shard {index}: {message}")
+            results[processor.library_name] = merged
+            if merged['population_counts']:
+                logger.info(f"{processor.library_name}: {merged['population_counts']}")
+        
+        return results
+    
+    def execute_incremental(self, fhir_data: Dict[str, List[Dict]], measurement_period: tuple,
+                            state: MeasureState) -> Dict[str, Any]:
+        """
+        增量執行所有CQL：只重新計算資源有變動的病人，以差額修正族群人數
+        
+        FHIRStore.patient_versions() 的指紋（meta.versionId / meta.lastUpdated）與上次狀態比較，
+        新增或變動的病人以其 compartment 重新執行，刪除的病人扣除上次的貢獻；
+        CQL 內容變更的 Library、測量期間或共用資源（不屬於任何病人）變更時全部重新計算。
+        與 execute_sharded 相同，族群 define 必須是以病人為單位可加總的計數，結果也只含族群人數。
         
+        Returns:
+            {
+                'Indicator_01_...': {
+                    'library': ..., 'version': ..., 'measurement_period': {...},
+                    'population_counts': {...}, 'definition_errors': {...},
+                    'incremental': {'patients': N, 'evaluated': n, 'removed': n}
+                }
+            }
+        """
+        store = FHIRStore(fhir_data)
+        versions, shared = store.patient_versions()
+        period = {"start": measurement_period[0].isoformat(), "end": measurement_period[1].isoformat()}
+        if state.reset(period, shared):
+            logger.info("測量期間或共用資源已變更（或無上次狀態），全部病人重新計算")
+        changed = state.changed_patients(versions)
+        removed = state.removed_patients(versions)
+        
+        # 各 Library 需要重新計算的病人（CQL 內容變更的 Library 重新計算全部病人）
+        libraries = {}
+        targets: Dict[str, List[CQLProcessor]] = {patient_id: [] for patient_id in versions}
         for processor in self.processors:
-            try:
-                result = processor.execute(fhir_data, measurement_period)
-                results[processor.library_name] = result
-            except Exception as e:
-                logger.error(f"執行 {processor.library_name} 失敗: {e}")
-                results[processor.library_name] = {"error": str(e)}
+            fingerprint = CQLASTCache.content_key(processor._raw_content)
+            fresh = state.libraries.get(processor.library_name, {}).get('fingerprint') != fingerprint
+            library = state.library(processor.library_name, fingerprint)
+            libraries[processor.library_name] = library
+            if processor.skip_reason:
+                continue
+            for patient_id in (versions if fresh else changed):
+                targets[patient_id].append(processor)
+            for patient_id in removed:
+                MeasureState.update(library, patient_id, None)
+        patient_ids = [patient_id for patient_id, processors in targets.items() if processors]
+        logger.info(f"增量執行: {len(versions)} 位病人中 {len(patient_ids)} 位需重新計算，{len(removed)} 位已刪除")
+        
+        compartments = store.partition_by_patient() if patient_ids else {}
+        
+        def execute_patient(index: int) -> Dict[str, Any]:
+            patient_id = patient_ids[index]
+            return {processor.library_name: _patient_contribution(processor, compartments[patient_id],
+                                                                  measurement_period)
+                    for processor in targets[patient_id]}
+        
+        workers = self._workers(len(patient_ids))
+        if workers > 1:
+            store.build_indexes()
+        for patient_id, contributions in zip(patient_ids, self._map(execute_patient, len(patient_ids), workers)):
+            for library_name, (counts, errors) in contributions.items():
+                MeasureState.update(libraries[library_name], patient_id, counts, errors)
+        
+        state.patients = versions
+        state.save()
+        
+        results = {}
+        for processor in self.processors:
+            library = libraries[processor.library_name]
+            errors = {}
+            for patient_id, patient_errors in library['errors'].items():
+                for name, message in patient_errors.items():
+                    errors.setdefault(name, f"Patient/{patient_id}: {message}")
+            results[processor.library_name] = {
+                "library": processor.library_name,
+                "version": processor.version,
+                "measurement_period": period,
+                "population_counts": dict(library['totals']),
+                "definition_errors": errors,
+                "incremental": {
+                    "patients": len(versions),
+                    "evaluated": sum(1 for patient_id in patient_ids if processor in targets[patient_id]),
+                    "removed": len(removed),
+                },
+            }
+            if processor.skip_reason:
+                results[processor.library_name]['skipped'] = processor.skip_reason
+            if library['totals']:
+                logger.info(f"{processor.library_name}: {library['totals']}")
         
         return results
+    
+    def _workers(self, tasks: int) -> int:
+        """實際使用的行程數（不支援 fork 的平台一律依序執行）"""
+        workers = min(self.workers, tasks)
+        if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            logger.warning("此平台不支援 fork，CQL 改為依序執行")
+            return 1
+        return workers
+    
+    def _map(self, task: Callable[[int], Any], count: int, workers: int) -> List[Any]:
+        """
+        依序取得 task(0) ... task(count - 1)；workers > 1 時以 fork 行程池平行執行
+        
+        task 及其參照的 FHIR 資料在 fork 前放入模組變數，子行程以 copy-on-write 共用，不需逐一 pickle；
+        只有 task 的回傳值傳回主行程。
+        """
+        if workers <= 1:
+            return [task(index) for index in range(count)]
+        
+        global _shared_task
+        _shared_task = task
+        # 凍結現有物件，避免子行程的 GC 走訪觸發 copy-on-write 複製整份資料
+        gc.freeze()
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                logger.info(f"以 {workers} 個行程平行執行 {count} 個工作")
+                return list(executor.map(_run_shared_task, range(count)))
+        finally:
+            gc.unfreeze()
+            _shared_task = None
+
+
+# 平行執行時 fork 前設定的工作（子行程繼承，不經 pickle）
+_shared_task: Optional[Callable[[int], Any]] = None
+
+
+def _run_shared_task(index: int) -> Any:
+    return _shared_task(index)
+
+
+def _frames(store: FHIRStore) -> FHIRFrames:
+    """store 的欄式 frame（同一個 store 上的 Library 共用，各資源類型只攤平一次）"""
+    if 'frames' not in store.derived:
+        store.derived['frames'] = FHIRFrames(store.resources)
+    return store.derived['frames']
+
+
+def _patient_contribution(processor: CQLProcessor, store: FHIRStore, measurement_period: tuple):
+    """單一病人 compartment 的族群人數貢獻 (counts, define 錯誤)；執行失敗時 counts 為空"""
+    try:
+        result = processor._evaluate_definitions(store, measurement_period, verbose=False)
+    except Exception as e:
+        logger.debug(f"{processor.library_name} 執行失敗: {e}")
+        return {}, {processor.library_name: str(e)}
+    return population_counts(result['definitions']), result['definition_errors']
+
+
+def _execute_library(processor: CQLProcessor, store: FHIRStore, measurement_period: tuple) -> Dict[str, Any]:
+    """執行單一 Library；失敗時回傳 {"error": 訊息}"""
+    try:
+        return processor.execute(store.resources, measurement_period, store)
+    except Exception as e:
+        logger.error(f"執行 {processor.library_name} 失敗: {e}")
+        return {"error": str(e)}
+
+
+# 族群 define 名稱（小寫、去除空白與底線）→ population_counts 的欄位
+POPULATION_ROLES = {
+    "initialpopulation": "initial_population",
+    "denominator": "denominator",
+    "numerator": "numerator",
+}
+
+
+def population_counts(definitions: Dict[str, Any]) -> Dict[str, int]:
+    """由 define 值取得族群人數：數值直接使用，清單取筆數，布林值為 0/1"""
+    counts = {}
+    for name, value in definitions.items():
+        role = POPULATION_ROLES.get(name.lower().replace(' ', '').replace('_', ''))
+        if role is None:
+            continue
+        if isinstance(value, bool):
+            counts[role] = int(value)
+        elif isinstance(value, (int, float)):
+            counts[role] = value
+        elif isinstance(value, list):
+            counts[role] = len(value)
+        elif value is None:
+            counts[role] = 0
+    return counts
+
+
+def _combine_patient_values(values: Dict[str, Any]) -> Any:
+    """彙總 Patient context 各病人的 define 值"""
+    present = [value for value in values.values() if value is not None]
+    if not present:
+        return None
+    if all(isinstance(value, list) for value in present):
+        return [item for value in present for item in value]
+    if all(isinstance(value, bool) for value in present):
+        return sum(1 for value in present if value)
+    if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+        return sum(present)
+    if all(isinstance(value, dict) for value in present) and _numeric_fields(present):
+        # 各病人的計數 tuple（如 {"男性": 1, "女性": 0}）逐欄位加總
+        return {key: sum(value.get(key) or 0 for value in present) for key in present[0]}
+    return {patient_id: value for patient_id, value in values.items() if value is not None}
+
+
+def _numeric_fields(values: List[Dict]) -> bool:
+    """所有 tuple 欄位相同且皆為數值（None 視為 0）"""
+    keys = set(values[0])
+    for value in values:
+        if set(value) != keys:
+            return False
+        for field in value.values():
+            if field is not None and (isinstance(field, bool) or not isinstance(field, (int, float))):
+                return False
+    return True
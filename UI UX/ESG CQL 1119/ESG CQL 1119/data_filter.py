@@ -5,9 +5,15 @@ Data Filter and Display Module
 """
 
 import logging
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Iterator, Optional, Tuple
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
 from collections import Counter
+from itertools import islice
+
+from fhir_datetime import parse_fhir_datetime, parse_local_datetime
+import shared_path  # noqa: F401
+from fhir_shared.sketches import QuantileSketch
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +30,7 @@ class DataFilter:
         """
         self.filter_config = filter_config
         self.time_range = self._calculate_time_range()
+        self._index: Optional[TimeIndex] = None
     
     def _calculate_time_range(self) -> tuple:
         """計算時間範圍（預設2年內）"""
@@ -34,140 +41,281 @@ class DataFilter:
         logger.info(f"時間範圍: {start_date.date()} 至 {end_date.date()} ({years}年)")
         return (start_date, end_date)
     
-    def filter_fhir_data(self, fhir_data: Dict[str, List[Dict]]) -> Dict[str, List[Dict]]:
+    def filter_fhir_data(self, fhir_data: Dict[str, List[Dict]],
+                         time_range: Optional[Tuple[datetime, datetime]] = None) -> Dict[str, List[Dict]]:
         """
         過濾FHIR資料（依時間範圍）
         
+        同一份資料第一次過濾時建立 TimeIndex，之後不同的時間範圍（2年、1年、季、月）皆以 bisect 切片，
+        不再逐筆走訪與解析日期。日期無法解析的資源視為不在範圍內（不再當作目前時間計入）。
+        
         Args:
             fhir_data: 原始FHIR資料
-            
+            time_range: (start_date, end_date)，None = config 的時間範圍
+        
         Returns:
             過濾後的FHIR資料
         """
-        filtered_data = {}
-        start_date, end_date = self.time_range
+        start_date, end_date = time_range or self.time_range
+        filtered_data = self.time_index(fhir_data).window(start_date, end_date)
         
         for resource_type, resources in fhir_data.items():
-            filtered_resources = []
-            
-            for resource in resources:
-                # 根據不同資源類型檢查日期
-                if self._is_within_time_range(resource, start_date, end_date):
-                    filtered_resources.append(resource)
-            
-            filtered_data[resource_type] = filtered_resources
-            
-            if len(filtered_resources) != len(resources):
-                logger.info(f"{resource_type}: {len(resources)} -> {len(filtered_resources)} 筆（已過濾）")
+            if len(filtered_data[resource_type]) != len(resources):
+                logger.info(f"{resource_type}: {len(resources)} -> {len(filtered_data[resource_type])} 筆（已過濾）")
         
         return filtered_data
     
-    def _is_within_time_range(self, resource: Dict, start_date: datetime, end_date: datetime) -> bool:
-        """檢查資源是否在時間範圍內"""
-        resource_type = resource.get('resourceType')
+    def time_index(self, fhir_data: Dict[str, List[Dict]]) -> 'TimeIndex':
+        """fhir_data 的時間索引（同一份資料只建立一次）"""
+        if self._index is None or self._index.fhir_data is not fhir_data:
+            self._index = TimeIndex(fhir_data)
+        return self._index
+
+
+class TimeIndex:
+    """
+    各資源類型依臨床日期排序的索引
+    
+    建立時每筆資源只解析一次日期（O(n log n)），之後每個時間範圍以 bisect 找出起訖位置，
+    取出範圍內的 k 筆並依原本順序排列（O(log n + k log k)），不需再走訪全部資源。
+    無日期欄位的資源（含 Patient）每個範圍都保留；日期無法解析的資源一律排除。
+    """
+    
+    def __init__(self, fhir_data: Dict[str, List[Dict]]):
+        self.fhir_data = fhir_data
+        # {resourceType: 排序後的日期}、{resourceType: [(原本位置, 資源)]}（與日期同順序）
+        self._dates: Dict[str, List[datetime]] = {}
+        self._dated: Dict[str, List[Tuple[int, Dict]]] = {}
+        # {resourceType: [(原本位置, 資源)]} 無日期欄位、每個範圍都保留的資源
+        self._undated: Dict[str, List[Tuple[int, Dict]]] = {}
         
-        try:
-            # 依資源類型取得相關日期欄位
-            if resource_type == 'Patient':
-                # Patient資源不過濾（保留所有病人）
-                return True
-            
-            elif resource_type == 'Encounter':
-                period = resource.get('period', {})
-                start_str = period.get('start')
-                if start_str:
-                    resource_date = self._parse_fhir_datetime(start_str)
-                    return start_date <= resource_date <= end_date
-            
-            elif resource_type == 'MedicationRequest':
-                authored_on = resource.get('authoredOn')
-                if authored_on:
-                    resource_date = self._parse_fhir_datetime(authored_on)
-                    return start_date <= resource_date <= end_date
-            
-            elif resource_type == 'MedicationAdministration':
-                effective = resource.get('effectiveDateTime') or resource.get('effectivePeriod', {}).get('start')
-                if effective:
-                    resource_date = self._parse_fhir_datetime(effective)
-                    return start_date <= resource_date <= end_date
-            
-            elif resource_type == 'Observation':
-                effective = resource.get('effectiveDateTime') or resource.get('effectivePeriod', {}).get('start')
-                if effective:
-                    resource_date = self._parse_fhir_datetime(effective)
-                    return start_date <= resource_date <= end_date
-            
-            elif resource_type == 'Procedure':
-                performed = resource.get('performedDateTime') or resource.get('performedPeriod', {}).get('start')
-                if performed:
-                    resource_date = self._parse_fhir_datetime(performed)
-                    return start_date <= resource_date <= end_date
-            
-            elif resource_type == 'DocumentReference':
-                date = resource.get('date')
-                if date:
-                    resource_date = self._parse_fhir_datetime(date)
-                    return start_date <= resource_date <= end_date
-            
-            elif resource_type == 'DiagnosticReport':
-                effective = resource.get('effectiveDateTime') or resource.get('effectivePeriod', {}).get('start')
-                if effective:
-                    resource_date = self._parse_fhir_datetime(effective)
-                    return start_date <= resource_date <= end_date
-            
-            # 如果無法判斷日期，預設保留
-            return True
+        for resource_type, resources in fhir_data.items():
+            dated = []
+            undated = []
+            invalid_dates = 0
+            for position, resource in enumerate(resources):
+                date_str = resource_date(resource)
+                if not date_str:
+                    undated.append((position, resource))
+                    continue
+                resource_datetime = parse_local_datetime(date_str) if isinstance(date_str, str) else None
+                if resource_datetime is None:
+                    invalid_dates += 1
+                    logger.debug(f"日期解析失敗: {resource_type}/{resource.get('id')} {date_str!r}")
+                    continue
+                dated.append((resource_datetime, position, resource))
             
-        except Exception as e:
-            logger.debug(f"日期解析失敗: {e}")
-            return True
+            dated.sort(key=lambda item: (item[0], item[1]))
+            self._dates[resource_type] = [item[0] for item in dated]
+            self._dated[resource_type] = [(position, resource) for _, position, resource in dated]
+            self._undated[resource_type] = undated
+            if invalid_dates:
+                logger.warning(f"{resource_type}: {invalid_dates} 筆日期格式無法解析，已排除")
+    
+    def window(self, start_date: datetime, end_date: datetime) -> Dict[str, List[Dict]]:
+        """start_date <= 日期 <= end_date 的資源（加上無日期欄位的資源），保持原本順序"""
+        filtered_data = {}
+        for resource_type, dates in self._dates.items():
+            low = bisect_left(dates, start_date)
+            high = bisect_right(dates, end_date)
+            selected = self._dated[resource_type][low:high]
+            undated = self._undated[resource_type]
+            if undated:
+                selected = selected + undated
+            selected.sort(key=lambda item: item[0])
+            filtered_data[resource_type] = [resource for _, resource in selected]
+        return filtered_data
+
+
+def resource_date(resource: Dict) -> Optional[str]:
+    """
+    資源的臨床日期字串（Encounter period.start、authoredOn、effective[x]、performed[x]、date）
+    Patient 與未列出的資源類型回傳 None（不依時間過濾）
+    """
+    resource_type = resource.get('resourceType')
+    
+    if resource_type == 'Encounter':
+        return (resource.get('period') or {}).get('start')
+    
+    elif resource_type == 'MedicationRequest':
+        return resource.get('authoredOn')
+    
+    elif resource_type in ('MedicationAdministration', 'Observation', 'DiagnosticReport'):
+        return resource.get('effectiveDateTime') or (resource.get('effectivePeriod') or {}).get('start')
+    
+    elif resource_type == 'Procedure':
+        return resource.get('performedDateTime') or (resource.get('performedPeriod') or {}).get('start')
+    
+    elif resource_type == 'DocumentReference':
+        return resource.get('date')
+    
+    return None
+
+
+# 年齡分組（上限含）；超過最後一組上限為「66歲以上」
+AGE_GROUPS = [(17, '0-17歲'), (30, '18-30歲'), (50, '31-50歲'), (65, '51-65歲')]
+OLDEST_AGE_GROUP = '66歲以上'
+TOP_LOCATIONS = 10
+
+
+class DemographicsAggregator:
+    """
+    病患基本資料的單次走訪彙總
     
-    def _parse_fhir_datetime(self, date_str: str) -> datetime:
-        """解析FHIR datetime字串"""
-        # 移除時區資訊並解析
-        date_str = date_str.replace('Z', '+00:00')
+    add(patient) 逐筆累計年齡分組、性別、居住地計數與年齡的總和 / 最小 / 最大值，
+    不保留中間清單；merge(other) 合併另一個彙總器（各伺服器或 shard 分別彙總後合併，不需重新走訪）。
+    指定 age_sketch 時另以分位數 sketch 估計年齡中位數等分位數（近似模式）。
+    """
+    
+    def __init__(self, display_config: Optional[Dict] = None, today: Optional[datetime] = None,
+                 age_sketch: Optional[QuantileSketch] = None):
+        """
+        Args:
+            display_config: 顯示配置（patient_age / patient_gender / patient_location 為 False 時不統計）
+            today: 計算年齡的基準日（None = 現在）
+            age_sketch: 年齡分位數 sketch（None = 不估計分位數）
+        """
+        display_config = display_config or {}
+        self.count_age = display_config.get('patient_age', True)
+        self.count_gender = display_config.get('patient_gender', True)
+        self.count_location = display_config.get('patient_location', True)
+        self.today = today or datetime.now()
+        
+        self.patient_count = 0
+        self.age_groups: Dict[str, int] = {label: 0 for _, label in AGE_GROUPS}
+        self.age_groups[OLDEST_AGE_GROUP] = 0
+        self.age_count = 0
+        self.age_sum = 0
+        self.age_min: Optional[int] = None
+        self.age_max: Optional[int] = None
+        self.age_sketch = age_sketch
+        self.genders: Counter = Counter()
+        self.locations: Counter = Counter()
+    
+    def add(self, patient: Dict):
+        """累計一位病患"""
+        self.patient_count += 1
+        
+        birth_date = patient.get('birthDate')
+        if birth_date and self.count_age:
+            age = calculate_age(birth_date, self.today)
+            if age is not None:
+                self.age_groups[age_group(age)] += 1
+                self.age_count += 1
+                self.age_sum += age
+                self.age_min = age if self.age_min is None else min(self.age_min, age)
+                self.age_max = age if self.age_max is None else max(self.age_max, age)
+                if self.age_sketch is not None:
+                    self.age_sketch.add(age)
+        
+        gender = patient.get('gender')
+        if gender and self.count_gender:
+            self.genders[gender] += 1
+        
+        if self.count_location:
+            location = extract_location(patient.get('address', []))
+            if location:
+                self.locations[location] += 1
+    
+    def merge(self, other: 'DemographicsAggregator') -> 'DemographicsAggregator':
+        """併入另一個彙總器的計數（回傳自己）"""
+        self.patient_count += other.patient_count
+        for label, count in other.age_groups.items():
+            self.age_groups[label] += count
+        self.age_count += other.age_count
+        self.age_sum += other.age_sum
+        for value in (other.age_min, other.age_max):
+            if value is not None:
+                self.age_min = value if self.age_min is None else min(self.age_min, value)
+                self.age_max = value if self.age_max is None else max(self.age_max, value)
+        if self.age_sketch is not None and other.age_sketch is not None:
+            self.age_sketch.merge(other.age_sketch)
+        self.genders.update(other.genders)
+        self.locations.update(other.locations)
+        return self
+    
+    def result(self) -> Dict[str, Any]:
+        """彙總結果（欄位與 DataDisplay.extract_patient_demographics 相同）"""
+        demographics = {
+            'total_patient_count': self.patient_count,
+            'age_distribution': {},
+            'gender_distribution': {},
+            'location_distribution': {},
+        }
+        
+        if self.age_count:
+            demographics['age_distribution'] = dict(self.age_groups)
+            demographics['average_age'] = round(self.age_sum / self.age_count, 1)
+            demographics['age_range'] = {'min': self.age_min, 'max': self.age_max}
+            if self.age_sketch is not None:
+                demographics['age_quantiles'] = self.age_sketch.summary()['quantiles']
+                demographics['age_quantiles_relative_accuracy'] = self.age_sketch.relative_accuracy
         
-        # 嘗試多種格式
-        formats = [
-            '%Y-%m-%dT%H:%M:%S.%f%z',
-            '%Y-%m-%dT%H:%M:%S%z',
-            '%Y-%m-%dT%H:%M:%S.%f',
-            '%Y-%m-%dT%H:%M:%S',
-            '%Y-%m-%d'
-        ]
+        if self.genders:
+            total = sum(self.genders.values())
+            demographics['gender_distribution'] = dict(self.genders)
+            demographics['gender_percentages'] = {
+                k: round(v / total * 100, 1)
+                for k, v in self.genders.items()
+            }
         
-        for fmt in formats:
-            try:
-                # 移除時區後解析
-                clean_str = date_str.split('+')[0].split('-', 3)
-                if len(clean_str) >= 3:
-                    clean_str = '-'.join(clean_str[:3])
-                else:
-                    clean_str = date_str.split('+')[0]
-                
-                return datetime.strptime(clean_str, fmt.split('%z')[0].strip())
-            except:
-                continue
+        if self.locations:
+            demographics['location_distribution'] = dict(self.locations)
+            demographics['top_locations'] = sorted(
+                self.locations.items(),
+                key=lambda x: x[1],
+                reverse=True
+            )[:TOP_LOCATIONS]
         
-        # 如果都失敗，回傳當前時間
-        return datetime.now()
+        return demographics
+
+
+def age_group(age: int) -> str:
+    """年齡所屬的分組標籤"""
+    for upper, label in AGE_GROUPS:
+        if age <= upper:
+            return label
+    return OLDEST_AGE_GROUP
+
+
+def calculate_age(birth_date_str: str, today: Optional[datetime] = None) -> Optional[int]:
+    """計算年齡（birthDate 可為 2000、2000-05 等部分日期；無法解析時回傳 None）"""
+    birth_date = parse_fhir_datetime(birth_date_str) if isinstance(birth_date_str, str) else None
+    if birth_date is None:
+        return None
+    today = today or datetime.now()
+    age = today.year - birth_date.year
+    if (today.month, today.day) < (birth_date.month, birth_date.day):
+        age -= 1
+    return age
+
+
+def extract_location(address_list: List[Dict]) -> Optional[str]:
+    """提取居住地（第一筆地址，優先順序: city > state > country）"""
+    if not address_list:
+        return None
+    
+    address = address_list[0]
+    return address.get('city') or address.get('state') or address.get('country')
 
 
 class DataDisplay:
     """資料顯示處理器 - 提取和顯示指定欄位"""
     
-    def __init__(self, display_config: Dict):
+    def __init__(self, display_config: Dict, approximate: Optional[Dict] = None):
         """
         初始化資料顯示處理器
         
         Args:
             display_config: 顯示配置 (來自config.yaml的data_filters.display_fields)
+            approximate: 近似統計參數（sketches.sketch_options；None = 不估計年齡分位數）
         """
         self.display_config = display_config
+        self.approximate = approximate
     
     def extract_patient_demographics(self, fhir_data: Dict[str, List[Dict]]) -> Dict[str, Any]:
         """
-        提取病患基本資料統計
+        提取病患基本資料統計（單次走訪，見 DemographicsAggregator）
         
         Returns:
             {
@@ -177,107 +325,37 @@ class DataDisplay:
                 'location_distribution': {...}
             }
         """
-        patients = fhir_data.get('Patient', [])
-        
-        demographics = {
-            'total_patient_count': len(patients),
-            'age_distribution': {},
-            'gender_distribution': {},
-            'location_distribution': {},
-            'patient_details': []
-        }
+        aggregator = self.aggregator()
+        for patient in fhir_data.get('Patient', []):
+            aggregator.add(patient)
         
-        ages = []
-        genders = []
-        locations = []
+        logger.info(f"已提取 {aggregator.patient_count} 位病患的基本資料")
+        return aggregator.result()
+    
+    def aggregator(self) -> 'DemographicsAggregator':
+        """依顯示設定建立空的彙總器（例如各伺服器或 shard 各自彙總後 merge）"""
+        age_sketch = QuantileSketch(self.approximate['relative_accuracy']) if self.approximate else None
+        return DemographicsAggregator(self.display_config, age_sketch=age_sketch)
+    
+    def patient_details(self, fhir_data: Dict[str, List[Dict]], offset: int = 0,
+                        limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        病患詳細資料（逐筆產生，需要時才計算；offset / limit 分頁）
         
-        for patient in patients:
-            # 提取年齡
+        Yields:
+            {'id': ..., 'name': ..., 'age': ..., 'gender': ..., 'location': ...}
+        """
+        today = datetime.now()
+        stop = offset + limit if limit is not None else None
+        for patient in islice(fhir_data.get('Patient', []), offset, stop):
             birth_date = patient.get('birthDate')
-            if birth_date and self.display_config.get('patient_age', True):
-                age = self._calculate_age(birth_date)
-                ages.append(age)
-            
-            # 提取性別
-            gender = patient.get('gender')
-            if gender and self.display_config.get('patient_gender', True):
-                genders.append(gender)
-            
-            # 提取居住地
-            address = patient.get('address', [])
-            if address and self.display_config.get('patient_location', True):
-                location = self._extract_location(address)
-                if location:
-                    locations.append(location)
-            
-            # 病患詳細資料
-            demographics['patient_details'].append({
+            yield {
                 'id': patient.get('id'),
                 'name': self._extract_name(patient.get('name', [])),
-                'age': self._calculate_age(birth_date) if birth_date else None,
-                'gender': gender,
-                'location': self._extract_location(address) if address else None
-            })
-        
-        # 統計分布
-        if ages:
-            demographics['age_distribution'] = self._create_age_distribution(ages)
-            demographics['average_age'] = round(sum(ages) / len(ages), 1)
-            demographics['age_range'] = {'min': min(ages), 'max': max(ages)}
-        
-        if genders:
-            demographics['gender_distribution'] = dict(Counter(genders))
-            demographics['gender_percentages'] = {
-                k: round(v / len(genders) * 100, 1) 
-                for k, v in demographics['gender_distribution'].items()
+                'age': calculate_age(birth_date, today) if birth_date else None,
+                'gender': patient.get('gender'),
+                'location': extract_location(patient.get('address', []))
             }
-        
-        if locations:
-            demographics['location_distribution'] = dict(Counter(locations))
-            demographics['top_locations'] = sorted(
-                demographics['location_distribution'].items(), 
-                key=lambda x: x[1], 
-                reverse=True
-            )[:10]
-        
-        logger.info(f"已提取 {len(patients)} 位病患的基本資料")
-        return demographics
-    
-    def _calculate_age(self, birth_date_str: str) -> int:
-        """計算年齡"""
-        try:
-            birth_date = datetime.strptime(birth_date_str, '%Y-%m-%d')
-            today = datetime.now()
-            age = today.year - birth_date.year
-            if (today.month, today.day) < (birth_date.month, birth_date.day):
-                age -= 1
-            return age
-        except:
-            return 0
-    
-    def _create_age_distribution(self, ages: List[int]) -> Dict[str, int]:
-        """建立年齡分布"""
-        distribution = {
-            '0-17歲': 0,
-            '18-30歲': 0,
-            '31-50歲': 0,
-            '51-65歲': 0,
-            '66歲以上': 0
-        }
-        
-        for age in ages:
-            if age < 18:
-                distribution['0-17歲'] += 1
-            elif age <= 30:
-                distribution['18-30歲'] += 1
-            elif age <= 50:
-                distribution['31-50歲'] += 1
-            elif age <= 65:
-                distribution['51-65歲'] += 1
-            else:
-                distribution['66歲以上'] += 1
-        
-        return distribution
     
     def _extract_name(self, name_list: List[Dict]) -> str:
         """提取姓名"""
@@ -290,17 +368,6 @@ class DataDisplay:
         
         return f"{family} {given}".strip() or "Unknown"
     
-    def _extract_location(self, address_list: List[Dict]) -> Optional[str]:
-        """提取居住地"""
-        if not address_list:
-            return None
-        
-        address = address_list[0]
-        
-        # 優先順序: city > state > country
-        location = address.get('city') or address.get('state') or address.get('country')
-        return location
-    
     def format_results_for_display(self, cql_results: Dict, demographics: Dict) -> Dict[str, Any]:
         """
         格式化結果供顯示
@@ -308,7 +375,7 @@ class DataDisplay:
         Args:
             cql_results: CQL執行結果
             demographics: 病患基本資料統計
-            
+        
         Returns:
             格式化後的結果
         """
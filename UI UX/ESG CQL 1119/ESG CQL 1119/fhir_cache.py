@@ -0,0 +1,219 @@
+"""
+FHIR Resource Cache Module
+本機磁碟快取：依伺服器與資源類型保存FHIR資源，支援 _lastUpdated 增量同步
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional, Iterable, Callable, Union
+from datetime import datetime, timezone
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class FHIRResourceCache:
+    """
+    FHIR資源磁碟快取
+    
+    目錄結構：
+        <cache_dir>/<伺服器URL雜湊>/<ResourceType>.json
+        {
+            "base_url": "...",
+            "resource_type": "Encounter",
+            "last_sync": "2025-11-19T08:00:00+00:00",
+            "resources": {"<id>": {...resource...}}
+        }
+    
+    每個資源以 id 為鍵，meta.versionId 不同時以新版本取代。
+    快取總大小超過 max_size_mb 時，依最近使用時間淘汰最舊的資源類型檔案。
+    """
+    
+    def __init__(self, cache_dir: str = '.fhir_cache', max_size_mb: float = 500):
+        """
+        初始化快取
+        
+        Args:
+            cache_dir: 快取目錄
+            max_size_mb: 快取大小上限 (MB)
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+    
+    def _server_dir(self, base_url: str) -> Path:
+        """依伺服器URL取得快取子目錄"""
+        server_hash = hashlib.sha1(base_url.rstrip('/').encode('utf-8')).hexdigest()[:16]
+        return self.cache_dir / server_hash
+    
+    def _entry_path(self, base_url: str, resource_type: str, query_key: Optional[str] = None) -> Path:
+        if query_key:
+            return self._server_dir(base_url) / f"{resource_type}.{query_key}.json"
+        return self._server_dir(base_url) / f"{resource_type}.json"
+
+    @staticmethod
+    def query_key(params: Optional[Dict]) -> Optional[str]:
+        """搜尋條件的穩定雜湊；無條件時回傳 None"""
+        if not params:
+            return None
+        canonical = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:12]
+
+    def load(self, base_url: str, resource_type: str, query_key: Optional[str] = None) -> Optional[Dict]:
+        """
+        讀取某伺服器某資源類型的快取
+        
+        Returns:
+            {'last_sync': str, 'resources': {id: resource}}，無快取時回傳 None
+        """
+        path = self._entry_path(base_url, resource_type, query_key)
+        if not path.exists():
+            return None
+        
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            # 更新存取時間，供 LRU 淘汰使用
+            os.utime(path, None)
+            return entry
+        except (OSError, ValueError) as e:
+            logger.warning(f"快取檔案損毀，將重新完整擷取: {path} ({e})")
+            return None
+    
+    def get_last_sync(self, base_url: str, resource_type: str, query_key: Optional[str] = None) -> Optional[str]:
+        """取得上次同步時間（ISO 8601）"""
+        entry = self.load(base_url, resource_type, query_key)
+        return entry.get('last_sync') if entry else None
+    
+    def merge(self, base_url: str, resource_type: str, resources: Iterable[Dict],
+              sync_time: Union[str, Callable[[], str]], replace: bool = False,
+              query_key: Optional[str] = None, updated_ids: Optional[Iterable[str]] = None) -> Dict[str, Dict]:
+        """
+        合併新擷取的資源並寫回快取
+        
+        Args:
+            base_url: 伺服器URL
+            resource_type: 資源類型
+            resources: 本次擷取的資源（可為 generator）
+            sync_time: 本次同步時間，下次以 _lastUpdated=gt<sync_time> 增量擷取；
+                       可為函式，於資源全部取完後才呼叫（同步時間取自伺服器回應時使用）
+            replace: True 時捨棄舊快取（完整重新擷取）
+            query_key: 搜尋條件雜湊，不同條件的結果分開保存
+            updated_ids: 同一期間伺服器上更新過的所有資源 id（不套用搜尋條件）；
+                         不在 resources 中者已不符合搜尋條件，自快取移除
+        
+        Returns:
+            合併後的 {id: resource}
+        """
+        entry = None if replace else self.load(base_url, resource_type, query_key)
+        cached = entry.get('resources', {}) if entry else {}
+        
+        added = updated = removed = 0
+        received = set()
+        for resource in resources:
+            resource_id = resource.get('id')
+            if not resource_id:
+                continue
+            received.add(resource_id)
+            
+            previous = cached.get(resource_id)
+            if previous is None:
+                added += 1
+            else:
+                version = self._version_of(resource)
+                if version is not None and version == self._version_of(previous):
+                    continue
+                updated += 1
+            cached[resource_id] = resource
+        
+        if updated_ids is not None:
+            for resource_id in set(updated_ids) - received:
+                if cached.pop(resource_id, None) is not None:
+                    removed += 1
+        
+        if callable(sync_time):
+            sync_time = sync_time()
+        self._write(self._entry_path(base_url, resource_type, query_key), {
+            'base_url': base_url,
+            'resource_type': resource_type,
+            'last_sync': sync_time,
+            'resources': cached
+        })
+        
+        logger.info(f"快取 {resource_type}: 新增 {added} 筆、更新 {updated} 筆、移除 {removed} 筆，共 {len(cached)} 筆")
+        return cached
+    
+    def _version_of(self, resource: Dict) -> Optional[str]:
+        return resource.get('meta', {}).get('versionId')
+    
+    def _write(self, path: Path, entry: Dict):
+        """以暫存檔 + os.replace 原子寫入，再檢查大小上限"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        
+        tmp_path = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        
+        self._evict(keep=path)
+    
+    def size_bytes(self) -> int:
+        """目前快取總大小"""
+        return sum(p.stat().st_size for p in self.cache_dir.glob('*/*.json'))
+    
+    def _evict(self, keep: Optional[Path] = None):
+        """超過大小上限時，依最近使用時間由舊至新刪除快取檔案"""
+        with self._lock:
+            files = [(p, p.stat()) for p in self.cache_dir.glob('*/*.json')]
+            total = sum(st.st_size for _, st in files)
+            if total <= self.max_size_bytes:
+                return
+            
+            for path, st in sorted(files, key=lambda item: item[1].st_mtime):
+                if total <= self.max_size_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    path.unlink()
+                    total -= st.st_size
+                    logger.info(f"快取超過上限，已淘汰: {path.parent.name}/{path.name}")
+                except OSError:
+                    continue
+    
+    def clear(self, base_url: Optional[str] = None):
+        """清除快取（指定伺服器或全部）"""
+        target = self._server_dir(base_url) if base_url else self.cache_dir
+        for path in target.glob('**/*.json'):
+            path.unlink()
+    
+    @staticmethod
+    def now() -> str:
+        """目前UTC時間（ISO 8601），作為同步時間點"""
+        return datetime.now(timezone.utc).isoformat(timespec='seconds')
+    
+    @staticmethod
+    def filter_updated_since(resources: Iterable[Dict], since: datetime) -> List[Dict]:
+        """依 meta.lastUpdated 篩選（模擬伺服器端 _lastUpdated=ge 行為）"""
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        
+        selected = []
+        for resource in resources:
+            last_updated = resource.get('meta', {}).get('lastUpdated')
+            if not last_updated:
+                continue
+            try:
+                updated_at = datetime.fromisoformat(last_updated.replace('Z', '+00:00'))
+            except ValueError:
+                continue
+            if updated_at.tzinfo is None:
+                updated_at = updated_at.replace(tzinfo=timezone.utc)
+            if updated_at >= since:
+                selected.append(resource)
+        return selected
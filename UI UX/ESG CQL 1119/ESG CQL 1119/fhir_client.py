@@ -4,18 +4,46 @@ SMART on FHIR Client Module
 """
 
 import requests
+import json
+import hashlib
 import logging
-from typing import Dict, List, Optional, Any
-from datetime import datetime, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Optional, Any, Iterable, Iterator, Generator, Tuple
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from urllib.parse import urljoin
 
+from fhir_cache import FHIRResourceCache
+from bulk_export import BulkDataExporter, BulkExportError
+import shared_path  # noqa: F401
+from fhir_shared.json_decoder import get_decoder
+from fhir_shared.fhir_scheduler import RequestScheduler, FHIRRequestError, get_scheduler, configure_scheduler
+
 logger = logging.getLogger(__name__)
 
+# 增量同步時間點往前重疊的時間：容忍伺服器寫入延遲與多節點時鐘差異（重複取得的資源依 versionId 略過）
+SYNC_OVERLAP = timedelta(minutes=2)
+# 只影響回傳內容、不影響哪些資源符合條件的搜尋參數
+RESULT_PARAMS = ('_elements', '_count', '_summary')
+
 
 class FHIRClient:
     """FHIR Client for connecting to SMART on FHIR servers"""
     
-    def __init__(self, base_url: str, name: str = "FHIR Server", auth_token: Optional[str] = None):
+    # ESG 摘要與顯示流程所需的資源類型（依擷取順序）；各Library retrieve 的其他類型由 resource_types 加入
+    CQL_RESOURCE_TYPES = [
+        'Patient', 'Encounter', 'MedicationRequest', 'MedicationAdministration',
+        'Observation', 'Procedure', 'DocumentReference', 'DiagnosticReport'
+    ]
+    
+    def __init__(self, base_url: str, name: str = "FHIR Server", auth_token: Optional[str] = None,
+                 page_size: int = 100, max_pages: Optional[int] = None, max_concurrency: int = 4,
+                 cache: Optional[FHIRResourceCache] = None, refresh: bool = False,
+                 bulk_export: bool = False, bulk_config: Optional[Dict] = None,
+                 json_decoder: str = 'auto', scheduler: Optional[RequestScheduler] = None,
+                 resource_types: Optional[List[str]] = None):
         """
         初始化FHIR客戶端
         
@@ -23,12 +51,40 @@ class FHIRClient:
             base_url: FHIR伺服器基礎URL
             name: 伺服器名稱
             auth_token: OAuth認證token (如需要)
+            page_size: 每頁資源筆數 (搜尋參數 _count)
+            max_pages: 每次搜尋最多擷取頁數 (None = 不限制，跟隨所有 next 連結)
+            max_concurrency: 對此伺服器同時進行的請求上限（並行擷取模式使用）
+            cache: 本機磁碟快取；設定後僅以 _lastUpdated=gt<上次同步> 擷取增量
+            refresh: True 時忽略既有快取，完整重新擷取並覆寫
+            bulk_export: True 時以 Bulk Data $export 擷取（伺服器不支援時退回分頁搜尋）
+            bulk_config: Bulk export 設定 (poll_interval, max_wait, download_workers)
+            json_decoder: Bundle 解碼後端 (auto / orjson / json / stream)，
+                          stream 為增量解析，下載中即逐筆產生資源
+            scheduler: 請求排程器（速率限制、重試、退避），None = 行程共用排程器
+            resource_types: 擷取的資源類型（依擷取順序），None = CQL_RESOURCE_TYPES
         """
         self.base_url = base_url.rstrip('/')
         self.name = name
         self.auth_token = auth_token
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.max_concurrency = max(1, max_concurrency)
+        self.cache = cache
+        self.refresh = refresh
+        self.bulk_export = bulk_export
+        self.bulk_config = bulk_config or {}
+        self.decoder = get_decoder(json_decoder)
+        self.scheduler = scheduler or get_scheduler()
+        self.resource_types = list(resource_types or self.CQL_RESOURCE_TYPES)
+        # 各資源類型實際下載量 {resource_type: {'resources': n, 'bytes': b}}
+        self.fetch_stats: Dict[str, Dict[str, int]] = {}
         self.session = requests.Session()
         
+        # 連線池大小與並行上限一致，避免並行模式下連線被丟棄重建
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
         # 設定headers
         self.session.headers.update({
             'Accept': 'application/fhir+json',
@@ -42,7 +98,7 @@ class FHIRClient:
     
     def _make_request(self, resource_type: str, params: Optional[Dict] = None) -> Dict:
         """
-        執行FHIR API請求
+        執行FHIR API請求（僅取得第一頁）
         
         Args:
             resource_type: FHIR資源類型 (Patient, Encounter, etc.)
@@ -52,120 +108,477 @@ class FHIRClient:
             FHIR Bundle資源
         """
         url = urljoin(self.base_url + '/', resource_type)
+        logger.info(f"請求 {self.name}: {resource_type}")
+        return self._get_bundle(url, params, resource_type)
+    
+    def _get_bundle(self, url: str, params: Optional[Dict], resource_type: str,
+                    page_info: Optional[Dict] = None) -> Dict:
+        """
+        以GET取得單一Bundle頁面
         
+        Args:
+            url: 搜尋URL或Bundle中的 next 連結
+            params: 查詢參數（next 連結已含參數時為 None）
+            resource_type: 資源類型（僅用於日誌）
+            page_info: 指定時記錄回應的伺服器時間（page_info['server_time']）
+            
+        Returns:
+            FHIR Bundle資源
+            
+        Raises:
+            FHIRRequestError: 排程器重試用盡後仍失敗（不回傳空Bundle，避免指標被默默算成 0）
+        """
         try:
-            logger.info(f"請求 {self.name}: {resource_type}")
-            response = self.session.get(url, params=params, timeout=30)
+            response = self.scheduler.get(url, session=self.session, params=params, timeout=30)
             response.raise_for_status()
             
-            data = response.json()
+            data = self.decoder.loads(response.content)
+            num_resources = sum(1 for entry in data.get('entry', []) if 'resource' in entry)
+            self._record_fetch(resource_type, num_resources, len(response.content))
+            if page_info is not None:
+                page_info['server_time'] = self._server_time(data, response.headers)
             logger.info(f"成功從 {self.name} 取得 {resource_type} 資料")
             return data
             
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"從 {self.name} 請求 {resource_type} 失敗: {e}")
+            raise FHIRRequestError(f"從 {self.name} 請求 {resource_type} 失敗: {e}") from e
+    
+    def _stream_bundle(self, url: str, params: Optional[Dict], resource_type: str,
+                       page_info: Optional[Dict] = None) -> Generator[Dict, None, Dict]:
+        """
+        以增量解碼取得單一Bundle頁面，下載過程中逐筆產生資源
+        
+        Returns:
+            (generator 回傳值) entry 以外的Bundle欄位（link、total）
+            
+        Raises:
+            FHIRRequestError: 重試用盡後仍失敗，或下載途中中斷
+        """
+        num_resources = num_bytes = 0
+        try:
+            response = self.scheduler.get(url, session=self.session, params=params, timeout=30, stream=True)
+            with response:
+                response.raise_for_status()
+                parser = self.decoder.iter_entries(response.iter_content(chunk_size=65536))
+                try:
+                    for entry in parser:
+                        if 'resource' in entry:
+                            num_resources += 1
+                            yield entry['resource']
+                finally:
+                    num_bytes = parser.bytes_read
+                bundle = parser.bundle
+                if page_info is not None:
+                    page_info['server_time'] = self._server_time(bundle, response.headers)
+            logger.info(f"成功從 {self.name} 取得 {resource_type} 資料")
+        except (requests.exceptions.RequestException, ValueError) as e:
             logger.error(f"從 {self.name} 請求 {resource_type} 失敗: {e}")
-            return {'resourceType': 'Bundle', 'entry': []}
+            raise FHIRRequestError(f"從 {self.name} 請求 {resource_type} 失敗: {e}") from e
+        finally:
+            self._record_fetch(resource_type, num_resources, num_bytes)
+        return bundle
+    
+    @staticmethod
+    def _server_time(bundle: Dict, headers) -> Optional[datetime]:
+        """伺服器產生回應的時間：Bundle.meta.lastUpdated，沒有時改用 HTTP Date 標頭（UTC）"""
+        candidates = [(bundle.get('meta') or {}).get('lastUpdated'), headers.get('Date')]
+        for parse, value in zip((datetime.fromisoformat, parsedate_to_datetime), candidates):
+            if not value:
+                continue
+            try:
+                moment = parse(value)
+            except (TypeError, ValueError):
+                continue
+            if moment.tzinfo is None:
+                moment = moment.replace(tzinfo=timezone.utc)
+            return moment.astimezone(timezone.utc)
+        return None
+    
+    def _record_fetch(self, resource_type: str, num_resources: int, num_bytes: int):
+        """累計下載的資源筆數與位元組數（供查詢下推統計）"""
+        stats = self.fetch_stats.setdefault(resource_type, {'resources': 0, 'bytes': 0})
+        stats['resources'] += num_resources
+        stats['bytes'] += num_bytes
+    
+    def count_resources(self, resource_type: str, params: Optional[Dict] = None) -> Optional[int]:
+        """
+        以 _summary=count 查詢符合條件的資源總數（不下載資源內容）
+        
+        Returns:
+            Bundle.total，伺服器未提供時回傳 None
+        """
+        count_params = dict(params or {})
+        count_params['_summary'] = 'count'
+        url = urljoin(self.base_url + '/', resource_type)
+        
+        try:
+            response = self.scheduler.get(url, session=self.session, params=count_params, timeout=30)
+            response.raise_for_status()
+            return self.decoder.loads(response.content).get('total')
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning(f"無法取得 {self.name} {resource_type} 總數: {e}")
+            return None
+    
+    def sample_payload(self, resource_type: str, params: Optional[Dict] = None,
+                       sample_size: int = 20) -> Optional[Dict[str, int]]:
+        """
+        取一頁樣本量測每筆資源的平均大小（不計入 fetch_stats）
+        
+        Returns:
+            {'resources': n, 'bytes': b}，請求失敗時回傳 None
+        """
+        sample_params = dict(params or {})
+        sample_params['_count'] = sample_size
+        url = urljoin(self.base_url + '/', resource_type)
+        
+        try:
+            response = self.scheduler.get(url, session=self.session, params=sample_params, timeout=30)
+            response.raise_for_status()
+            bundle = self.decoder.loads(response.content)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning(f"無法取得 {self.name} {resource_type} 樣本: {e}")
+            return None
+        
+        resources = sum(1 for entry in bundle.get('entry', []) if 'resource' in entry)
+        return {'resources': resources, 'bytes': len(response.content)}
+    
+    def _get_next_link(self, bundle: Dict) -> Optional[str]:
+        """從 Bundle.link 中提取 relation=next 的下一頁連結"""
+        for link in bundle.get('link', []):
+            if link.get('relation') == 'next':
+                next_url = link.get('url')
+                if next_url:
+                    # 部分伺服器回傳相對路徑
+                    return urljoin(self.base_url + '/', next_url)
+        return None
+    
+    def iter_pages(self, resource_type: str, params: Optional[Dict] = None,
+                   page_info: Optional[Dict] = None) -> Iterator[Dict]:
+        """
+        逐頁產生搜尋結果Bundle（跟隨 Bundle.link[relation=next]）
+        
+        Args:
+            resource_type: FHIR資源類型
+            params: 查詢參數，未指定 _count 時使用 page_size
+            page_info: 指定時記錄第一頁回應的伺服器時間（page_info['server_time']）
+            
+        Yields:
+            每一頁的FHIR Bundle
+        """
+        url, search_params = self._search_request(resource_type, params)
+        bundle = self._get_bundle(url, search_params, resource_type, page_info)
+        page_count = 1
+        
+        while True:
+            yield bundle
+            
+            next_link = self._next_page_link(bundle, resource_type, page_count)
+            if not next_link:
+                break
+            
+            # next 連結已包含完整查詢參數
+            bundle = self._get_bundle(next_link, None, resource_type)
+            page_count += 1
+            logger.info(f"取得 {resource_type} 第 {page_count} 頁: {len(bundle.get('entry', []))} 筆")
+    
+    def _search_request(self, resource_type: str, params: Optional[Dict]) -> tuple:
+        """建立搜尋URL與參數（未指定 _count 時使用 page_size）"""
+        search_params = dict(params or {})
+        search_params.setdefault('_count', self.page_size)
+        
+        url = urljoin(self.base_url + '/', resource_type)
+        logger.info(f"請求 {self.name}: {resource_type} (_count={search_params['_count']})")
+        return url, search_params
+    
+    def _next_page_link(self, bundle: Dict, resource_type: str, page_count: int) -> Optional[str]:
+        """取得下一頁連結；無下一頁或已達 max_pages 時回傳 None"""
+        next_link = self._get_next_link(bundle)
+        if next_link and self.max_pages is not None and page_count >= self.max_pages:
+            logger.warning(f"{self.name} {resource_type} 已達頁數上限 {self.max_pages}，停止分頁")
+            return None
+        return next_link
+    
+    def iter_resources(self, resource_type: str, params: Optional[Dict] = None,
+                       page_info: Optional[Dict] = None) -> Iterator[Dict]:
+        """
+        以generator逐頁產生資源，記憶體中一次只保留一頁
+        
+        Args:
+            resource_type: FHIR資源類型
+            params: 查詢參數
+            page_info: 指定時記錄第一頁回應的伺服器時間（page_info['server_time']，供增量同步使用）
+            
+        Yields:
+            Bundle.entry[].resource
+        """
+        if not self.decoder.incremental:
+            for bundle in self.iter_pages(resource_type, params, page_info):
+                yield from self._iter_bundle_resources(bundle)
+            return
+        
+        # 增量解碼：每頁邊下載邊產生資源，該頁結束後才取得 next 連結
+        url, search_params = self._search_request(resource_type, params)
+        bundle = yield from self._stream_bundle(url, search_params, resource_type, page_info)
+        page_count = 1
+        
+        while True:
+            next_link = self._next_page_link(bundle, resource_type, page_count)
+            if not next_link:
+                break
+            bundle = yield from self._stream_bundle(next_link, None, resource_type)
+            page_count += 1
     
     def get_patients(self, params: Optional[Dict] = None) -> List[Dict]:
         """取得Patient資源列表"""
-        bundle = self._make_request('Patient', params)
-        return self._extract_resources(bundle)
+        return list(self.iter_resources('Patient', params))
     
     def get_encounters(self, params: Optional[Dict] = None) -> List[Dict]:
         """取得Encounter資源列表"""
-        bundle = self._make_request('Encounter', params)
-        return self._extract_resources(bundle)
+        return list(self.iter_resources('Encounter', params))
     
     def get_medication_requests(self, params: Optional[Dict] = None) -> List[Dict]:
         """取得MedicationRequest資源列表"""
-        bundle = self._make_request('MedicationRequest', params)
-        return self._extract_resources(bundle)
+        return list(self.iter_resources('MedicationRequest', params))
     
     def get_medication_administrations(self, params: Optional[Dict] = None) -> List[Dict]:
         """取得MedicationAdministration資源列表"""
-        bundle = self._make_request('MedicationAdministration', params)
-        return self._extract_resources(bundle)
+        return list(self.iter_resources('MedicationAdministration', params))
     
     def get_observations(self, params: Optional[Dict] = None) -> List[Dict]:
         """取得Observation資源列表"""
-        bundle = self._make_request('Observation', params)
-        return self._extract_resources(bundle)
+        return list(self.iter_resources('Observation', params))
     
     def get_procedures(self, params: Optional[Dict] = None) -> List[Dict]:
         """取得Procedure資源列表"""
-        bundle = self._make_request('Procedure', params)
-        return self._extract_resources(bundle)
+        return list(self.iter_resources('Procedure', params))
     
     def get_document_references(self, params: Optional[Dict] = None) -> List[Dict]:
         """取得DocumentReference資源列表"""
-        bundle = self._make_request('DocumentReference', params)
-        return self._extract_resources(bundle)
+        return list(self.iter_resources('DocumentReference', params))
     
     def get_diagnostic_reports(self, params: Optional[Dict] = None) -> List[Dict]:
         """取得DiagnosticReport資源列表"""
-        bundle = self._make_request('DiagnosticReport', params)
-        return self._extract_resources(bundle)
+        return list(self.iter_resources('DiagnosticReport', params))
     
     def _extract_resources(self, bundle: Dict) -> List[Dict]:
         """從Bundle中提取資源"""
-        if 'entry' not in bundle:
-            return []
-        
-        resources = []
+        return list(self._iter_bundle_resources(bundle))
+    
+    def _iter_bundle_resources(self, bundle: Dict) -> Iterator[Dict]:
+        """逐筆產生Bundle中的資源"""
         for entry in bundle.get('entry', []):
             if 'resource' in entry:
-                resources.append(entry['resource'])
-        
-        return resources
+                yield entry['resource']
     
-    def get_all_resources_for_cql(self, date_range: Optional[tuple] = None) -> Dict[str, List[Dict]]:
+    def get_all_resources_for_cql(self, date_range: Optional[tuple] = None,
+                                  stream: bool = False,
+                                  search_plan: Optional[Dict[str, Dict]] = None) -> Dict[str, Any]:
         """
         取得CQL執行所需的所有資源
         
         Args:
             date_range: (start_date, end_date) 日期範圍
+            stream: True 時回傳 {資源類型: generator}，由呼叫端逐頁消費，
+                    不會先將所有分頁載入記憶體
+            search_plan: QueryPlanner 產生的 {資源類型: 搜尋參數}；
+                         指定時只擷取計畫中的資源類型，其餘回傳空列表
+            
+        Returns:
+            包含所有資源類型的字典
+        """
+        if stream:
+            logger.info(f"以串流模式從 {self.name} 擷取所有CQL所需資源...")
+            streams = {}
+            for resource_type in self.resource_types:
+                params = self.plan_params(resource_type, search_plan)
+                if params is None:
+                    streams[resource_type] = iter(())
+                elif self.cache is not None:
+                    # 快取模式需先合併增量，再由快取內容產生
+                    streams[resource_type] = iter(self.fetch_resources(resource_type, date_range, params))
+                else:
+                    params.update(self._build_search_params(date_range))
+                    streams[resource_type] = self.iter_resources(resource_type, params)
+            return streams
+        
+        logger.info(f"開始從 {self.name} 擷取所有CQL所需資源...")
+        
+        resources = {}
+        for resource_type in self.resource_types:
+            params = self.plan_params(resource_type, search_plan)
+            resources[resource_type] = [] if params is None else self.fetch_resources(resource_type, date_range, params)
+        
+        self._log_resource_counts(resources)
+        return resources
+    
+    def get_all_resources_bulk(self, date_range: Optional[tuple] = None,
+                               search_plan: Optional[Dict[str, Dict]] = None) -> Dict[str, List[Dict]]:
+        """
+        以 FHIR Bulk Data $export 取得CQL執行所需的所有資源
+        
+        一次匯出所有資源類型，並行下載 NDJSON 檔案並逐行解析，回傳結構與
+        get_all_resources_for_cql 相同。搜尋計畫只用於決定 _type，其餘條件
+        由CQL執行時判斷。伺服器不支援 $export 時退回分頁搜尋。
+        
+        Args:
+            date_range: (start_date, end_date) 日期範圍，以 _since 篩選
+            search_plan: QueryPlanner 產生的搜尋計畫
             
         Returns:
             包含所有資源類型的字典
         """
+        resource_types = [
+            resource_type for resource_type in self.resource_types
+            if self.plan_params(resource_type, search_plan) is not None
+        ]
+        since = date_range[0].isoformat() if date_range else None
+        
+        exporter = BulkDataExporter(
+            self.session, self.base_url, self.name,
+            poll_interval=self.bulk_config.get('poll_interval', 5.0),
+            max_wait=self.bulk_config.get('max_wait', 3600.0),
+            download_workers=self.bulk_config.get('download_workers', self.max_concurrency),
+            decoder=self.decoder,
+            scheduler=self.scheduler
+        )
+        
+        logger.info(f"以 Bulk Data $export 從 {self.name} 擷取所有CQL所需資源...")
+        try:
+            exported = exporter.export(resource_types, since)
+        except (BulkExportError, requests.exceptions.RequestException, ValueError) as e:
+            logger.warning(f"{e}，改用分頁搜尋擷取")
+            return self.get_all_resources_for_cql(date_range, search_plan=search_plan)
+        
+        self.fetch_stats.update(exporter.stats)
+        resources = {resource_type: exported.get(resource_type, []) for resource_type in self.resource_types}
+        self._log_resource_counts(resources)
+        return resources
+    
+    @staticmethod
+    def plan_params(resource_type: str, search_plan: Optional[Dict[str, Dict]]) -> Optional[Dict]:
+        """取得搜尋計畫中某資源類型的參數；不在計畫中（不需擷取）時回傳 None"""
+        if not search_plan:
+            return {}
+        if resource_type not in search_plan:
+            return None
+        return dict(search_plan[resource_type])
+    
+    def fetch_resources(self, resource_type: str, date_range: Optional[tuple] = None,
+                        params: Optional[Dict] = None) -> List[Dict]:
+        """
+        取得某資源類型的所有資源（有設定快取時走增量同步）
+        
+        Args:
+            resource_type: FHIR資源類型
+            date_range: (start_date, end_date) 日期範圍，以 _lastUpdated 篩選
+            params: 額外的搜尋參數（例如查詢規劃下推的條件）
+            
+        Returns:
+            資源列表
+        """
+        params = dict(params or {})
+        if self.cache is None:
+            params.update(self._build_search_params(date_range))
+            return list(self.iter_resources(resource_type, params))
+        
+        # 不同搜尋條件的結果分開快取
+        query_key = FHIRResourceCache.query_key(params)
+        last_sync = None if self.refresh else self.cache.get_last_sync(self.base_url, resource_type, query_key)
+        # 同步時間點以伺服器時鐘為準（第一頁回應的時間），本機時鐘只在回應沒有時間時使用，
+        # 且取在請求送出之前，避免遺漏請求期間更新的資源
+        page_info: Dict[str, Any] = {}
+        local_time = datetime.now(timezone.utc)
+        
+        def sync_time() -> str:
+            return self._sync_point(page_info.get('server_time') or local_time)
+        
+        if last_sync:
+            logger.info(f"{self.name} {resource_type}: 增量同步 (_lastUpdated=gt{last_sync})")
+            updated_ids = None
+            if any(key not in RESULT_PARAMS for key in params):
+                # 帶下推條件的增量結果不含改為不符合條件（例如 status 改變）的資源，
+                # 先以不帶條件的查詢取得期間內更新過的 id，合併時自快取移除
+                updated_ids = self._updated_ids(resource_type, last_sync)
+            delta = self.iter_resources(resource_type, {**params, '_lastUpdated': f'gt{last_sync}'}, page_info)
+            cached = self.cache.merge(self.base_url, resource_type, delta, sync_time, query_key=query_key,
+                                      updated_ids=updated_ids)
+        else:
+            # 首次同步（或 --refresh）不帶 _lastUpdated 條件，讓快取保有完整資料，
+            # 日期範圍改於本機以 meta.lastUpdated 篩選
+            logger.info(f"{self.name} {resource_type}: 完整同步並建立快取")
+            full = self.iter_resources(resource_type, params, page_info)
+            cached = self.cache.merge(self.base_url, resource_type, full, sync_time,
+                                      replace=True, query_key=query_key)
+        
+        resources = list(cached.values())
+        if date_range:
+            resources = FHIRResourceCache.filter_updated_since(resources, date_range[0])
+        return resources
+    
+    def _updated_ids(self, resource_type: str, since: str) -> List[str]:
+        """since 之後更新過的所有資源 id（不套用搜尋條件，只下載 id）"""
+        return [resource['id'] for resource in
+                self.iter_resources(resource_type, {'_lastUpdated': f'gt{since}', '_elements': 'id'})
+                if resource.get('id')]
+    
+    @staticmethod
+    def _sync_point(moment: datetime) -> str:
+        """下次增量同步的 _lastUpdated 起點：往前重疊 SYNC_OVERLAP（ISO 8601，UTC）"""
+        return (moment - SYNC_OVERLAP).astimezone(timezone.utc).isoformat(timespec='seconds')
+    
+    def _build_search_params(self, date_range: Optional[tuple] = None) -> Dict:
+        """依日期範圍建立共用搜尋參數"""
         params = {}
         if date_range:
             start_date, end_date = date_range
             params['_lastUpdated'] = f'ge{start_date.isoformat()}'
-        
-        logger.info(f"開始從 {self.name} 擷取所有CQL所需資源...")
-        
-        resources = {
-            'Patient': self.get_patients(params),
-            'Encounter': self.get_encounters(params),
-            'MedicationRequest': self.get_medication_requests(params),
-            'MedicationAdministration': self.get_medication_administrations(params),
-            'Observation': self.get_observations(params),
-            'Procedure': self.get_procedures(params),
-            'DocumentReference': self.get_document_references(params),
-            'DiagnosticReport': self.get_diagnostic_reports(params),
-        }
-        
-        # 統計資料量
+        return params
+    
+    def _log_resource_counts(self, resources: Dict[str, List[Dict]]):
+        """記錄各資源類型的擷取筆數"""
         total_count = sum(len(r) for r in resources.values())
         logger.info(f"從 {self.name} 共取得 {total_count} 筆資源")
         
         for resource_type, resource_list in resources.items():
             logger.info(f"  - {resource_type}: {len(resource_list)} 筆")
-        
-        return resources
 
 
 class MultiServerFHIRClient:
     """管理多個FHIR伺服器的客戶端"""
     
-    def __init__(self, server_configs: List[Dict]):
+    def __init__(self, server_configs: List[Dict], fetch_config: Optional[Dict] = None,
+                 cache: Optional[FHIRResourceCache] = None, refresh: bool = False,
+                 resource_types: Optional[List[str]] = None):
         """
         初始化多伺服器客戶端
         
         Args:
             server_configs: 伺服器配置列表
+            fetch_config: 擷取模式設定 (來自config.yaml的fetch)
+                concurrent: 是否並行擷取（跨伺服器、跨資源類型）
+                max_workers: 執行緒池大小（全域同時請求上限）
+                per_server_concurrency: 每個伺服器預設的同時請求上限
+                bulk: Bulk Data $export 設定（伺服器設定 bulk_export: true 時使用）
+                json_decoder: Bundle JSON 解碼後端 (auto / orjson / json / stream)
+                dedupe: 合併去重鍵 (server = resourceType+id+伺服器；content = 內容雜湊)
+                rate_limit: 請求排程器設定（requests_per_second、max_in_flight、max_retries...）
+            cache: 本機磁碟快取（所有伺服器共用，依伺服器URL分目錄）
+            refresh: True 時忽略既有快取，完整重新擷取
+            resource_types: 擷取的資源類型（CQL_RESOURCE_TYPES 加上各Library retrieve 的類型），
+                            None = FHIRClient.CQL_RESOURCE_TYPES
         """
+        fetch_config = fetch_config or {}
+        self.resource_types = list(resource_types or FHIRClient.CQL_RESOURCE_TYPES)
+        self.concurrent = fetch_config.get('concurrent', False)
+        self.max_workers = max(1, fetch_config.get('max_workers', 8))
+        per_server_concurrency = fetch_config.get('per_server_concurrency', 4)
+        bulk_config = fetch_config.get('bulk', {})
+        self.dedupe = fetch_config.get('dedupe', 'server')
+        if self.dedupe not in ('server', 'content'):
+            raise ValueError(f"未知的去重方式: {self.dedupe}（可用: server, content）")
+        self.scheduler = self._setup_scheduler(server_configs, fetch_config)
+        
         self.clients = []
         
         for config in server_configs:
@@ -173,22 +586,59 @@ class MultiServerFHIRClient:
                 client = FHIRClient(
                     base_url=config['base_url'],
                     name=config.get('name', 'FHIR Server'),
-                    auth_token=config.get('auth_token')
+                    auth_token=config.get('auth_token'),
+                    page_size=config.get('page_size', 100),
+                    max_pages=config.get('max_pages'),
+                    max_concurrency=config.get('max_concurrency', per_server_concurrency),
+                    cache=cache,
+                    refresh=refresh,
+                    bulk_export=config.get('bulk_export', False),
+                    bulk_config=bulk_config,
+                    json_decoder=fetch_config.get('json_decoder', 'auto'),
+                    scheduler=self.scheduler,
+                    resource_types=self.resource_types
                 )
                 self.clients.append(client)
         
         logger.info(f"已初始化 {len(self.clients)} 個FHIR伺服器連線")
     
-    def get_all_resources_from_all_servers(self, date_range: Optional[tuple] = None) -> Dict[str, Dict[str, List[Dict]]]:
+    @staticmethod
+    def _setup_scheduler(server_configs: List[Dict], fetch_config: Dict) -> RequestScheduler:
+        """建立共用請求排程器；伺服器設定 requests_per_second 時覆寫該伺服器速率"""
+        rate_config = fetch_config.get('rate_limit')
+        scheduler = configure_scheduler(rate_config) if rate_config is not None else get_scheduler()
+        for config in server_configs:
+            if config.get('enabled', True) and 'requests_per_second' in config:
+                scheduler.set_rate(config['base_url'], config['requests_per_second'], config.get('burst'))
+        return scheduler
+    
+    def get_scheduler_stats(self) -> Dict[str, Any]:
+        """請求排程器統計（重試次數、限流等待秒數）"""
+        return self.scheduler.get_stats()
+    
+    def get_all_resources_from_all_servers(self, date_range: Optional[tuple] = None,
+                                           concurrent: Optional[bool] = None,
+                                           search_plan: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict[str, List[Dict]]]:
         """
         從所有伺服器取得資源
         
+        Args:
+            date_range: (start_date, end_date) 日期範圍
+            concurrent: 是否並行擷取（None = 依 fetch_config 設定）
+            search_plan: QueryPlanner 產生的搜尋計畫（伺服器端過濾條件）
+        
         Returns:
             {
                 'server1': {'Patient': [...], 'Encounter': [...]},
                 'server2': {'Patient': [...], 'Encounter': [...]}
             }
         """
+        if concurrent is None:
+            concurrent = self.concurrent
+        
+        if concurrent:
+            return self._get_all_resources_concurrently(date_range, search_plan)
+        
         all_data = {}
         
         for idx, client in enumerate(self.clients, 1):
@@ -197,10 +647,93 @@ class MultiServerFHIRClient:
             logger.info(f"正在從 {client.name} 擷取資料...")
             logger.info(f"{'='*60}")
             
-            all_data[server_key] = client.get_all_resources_for_cql(date_range)
+            if client.bulk_export:
+                all_data[server_key] = client.get_all_resources_bulk(date_range, search_plan=search_plan)
+            else:
+                all_data[server_key] = client.get_all_resources_for_cql(date_range, search_plan=search_plan)
         
         return all_data
     
+    def _get_all_resources_concurrently(self, date_range: Optional[tuple] = None,
+                                        search_plan: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict[str, List[Dict]]]:
+        """
+        以有界執行緒池並行擷取所有伺服器 × 所有資源類型
+        
+        每個伺服器以 BoundedSemaphore 限制同時請求數；結果依伺服器與
+        資源類型的原始順序組裝，因此與循序模式輸出完全相同。
+        """
+        logger.info(f"\n{'='*60}")
+        logger.info(f"並行擷取 {len(self.clients)} 個伺服器資料 (max_workers={self.max_workers})")
+        logger.info(f"{'='*60}")
+        
+        limits = [threading.BoundedSemaphore(client.max_concurrency) for client in self.clients]
+        
+        def fetch(client_idx: int, resource_type: str) -> List[Dict]:
+            client = self.clients[client_idx]
+            params = FHIRClient.plan_params(resource_type, search_plan)
+            if params is None:
+                return []
+            with limits[client_idx]:
+                return client.fetch_resources(resource_type, date_range, params)
+        
+        futures = {}
+        bulk_futures = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='fhir-fetch') as executor:
+            # Bulk export 伺服器一次匯出所有資源類型，NDJSON 下載由匯出器自行並行
+            for client_idx, client in enumerate(self.clients):
+                if client.bulk_export:
+                    bulk_futures[client_idx] = executor.submit(
+                        client.get_all_resources_bulk, date_range, search_plan
+                    )
+            
+            # 依資源類型輪流提交各伺服器的工作，讓不同伺服器的請求交錯進行，
+            # 避免單一伺服器的工作佔滿執行緒而卡在其並行上限
+            for resource_type in self.resource_types:
+                for client_idx in range(len(self.clients)):
+                    if client_idx in bulk_futures:
+                        continue
+                    futures[(client_idx, resource_type)] = executor.submit(
+                        fetch, client_idx, resource_type
+                    )
+        
+        all_data = {}
+        for client_idx, client in enumerate(self.clients):
+            if client_idx in bulk_futures:
+                all_data[f"server{client_idx + 1}"] = bulk_futures[client_idx].result()
+                continue
+            resources = {
+                resource_type: futures[(client_idx, resource_type)].result()
+                for resource_type in self.resource_types
+            }
+            client._log_resource_counts(resources)
+            all_data[f"server{client_idx + 1}"] = resources
+        
+        return all_data
+    
+    def get_fetch_stats(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """各伺服器實際下載量 {server_key: {resource_type: {'resources', 'bytes'}}}"""
+        return {f"server{idx}": dict(client.fetch_stats) for idx, client in enumerate(self.clients, 1)}
+    
+    def get_resource_streams_from_all_servers(self, date_range: Optional[tuple] = None,
+                                              search_plan: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict[str, Iterator[Dict]]]:
+        """
+        取得各伺服器各資源類型的資源 iterator（延遲擷取，消費時才逐頁下載）
+        
+        Returns:
+            {'server1': {'Patient': iterator, ...}, ...}，可直接交給 merge_resource_streams
+        """
+        streams = {}
+        for idx, client in enumerate(self.clients, 1):
+            if client.bulk_export:
+                # Bulk export 一次取得所有檔案，再以 iterator 形式交給合併流程
+                exported = client.get_all_resources_bulk(date_range, search_plan=search_plan)
+                streams[f"server{idx}"] = {rt: iter(resources) for rt, resources in exported.items()}
+            else:
+                streams[f"server{idx}"] = client.get_all_resources_for_cql(
+                    date_range, stream=True, search_plan=search_plan
+                )
+        return streams
+    
     def merge_resources(self, all_server_data: Dict[str, Dict[str, List[Dict]]]) -> Dict[str, List[Dict]]:
         """
         合併所有伺服器的資源（去重）
@@ -208,26 +741,74 @@ class MultiServerFHIRClient:
         Returns:
             {'Patient': [...], 'Encounter': [...]}
         """
-        merged = {}
-        resource_types = ['Patient', 'Encounter', 'MedicationRequest', 'MedicationAdministration',
-                         'Observation', 'Procedure', 'DocumentReference', 'DiagnosticReport']
+        return self.merge_resource_streams(all_server_data)
+    
+    def merge_resource_streams(self, server_streams: Dict[str, Dict[str, Iterable[Dict]]]) -> Dict[str, List[Dict]]:
+        """
+        串流合併各伺服器的資源
+        
+        逐筆消費各伺服器的 iterator，只保留合併結果與去重鍵，不會同時保存
+        每個伺服器的完整資料與合併後副本。
+        
+        Args:
+            server_streams: {server_key: {resource_type: iterable}}（列表或 generator 皆可）
+        
+        Returns:
+            {'Patient': [...], 'Encounter': [...]}
+        """
+        merged = {resource_type: [] for resource_type in self.resource_types}
+        duplicates = 0
         
-        for resource_type in resource_types:
-            merged[resource_type] = []
-            seen_ids = set()
-            
-            for server_data in all_server_data.values():
-                for resource in server_data.get(resource_type, []):
-                    resource_id = resource.get('id')
-                    if resource_id and resource_id not in seen_ids:
-                        merged[resource_type].append(resource)
-                        seen_ids.add(resource_id)
+        for resource_type, resource, is_new in self.iter_merged_resources(server_streams):
+            if is_new:
+                merged[resource_type].append(resource)
+            else:
+                duplicates += 1
         
         total = sum(len(r) for r in merged.values())
-        logger.info(f"\n合併後總計 {total} 筆資源（已去重）")
+        logger.info(f"\n合併後總計 {total} 筆資源（已去重 {duplicates} 筆，去重方式: {self.dedupe}）")
         
         for resource_type, resources in merged.items():
             if resources:
                 logger.info(f"  - {resource_type}: {len(resources)} 筆")
         
         return merged
+    
+    def iter_merged_resources(self, server_streams: Dict[str, Dict[str, Iterable[Dict]]]) -> Iterator[Tuple[str, Dict, bool]]:
+        """
+        依資源類型、伺服器順序逐筆產生 (resource_type, resource, is_new)
+        
+        去重鍵只保存 tuple 或 16 bytes 雜湊，記憶體用量與合併後筆數成正比。
+        is_new 為 False 表示重複資源（呼叫端可略過）。
+        """
+        for resource_type in self.resource_types:
+            seen = set()
+            
+            for server_key, server_data in server_streams.items():
+                for resource in server_data.get(resource_type, ()):
+                    key = self._dedupe_key(server_key, resource_type, resource)
+                    if key is None:
+                        continue
+                    if key in seen:
+                        yield resource_type, resource, False
+                        continue
+                    seen.add(key)
+                    yield resource_type, resource, True
+    
+    def _dedupe_key(self, server_key: str, resource_type: str, resource: Dict) -> Optional[Any]:
+        """
+        計算去重鍵
+        
+        server: (resourceType, id, 伺服器) - 不同醫院相同 id 的資源不會互相覆蓋
+        content: 內容雜湊（忽略 meta）- 跨伺服器完全相同的資源只保留一份
+        """
+        resource_id = resource.get('id')
+        if not resource_id:
+            return None
+        
+        if self.dedupe == 'content':
+            content = {k: v for k, v in resource.items() if k != 'meta'}
+            canonical = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+            return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).digest()
+        
+        return (resource.get('resourceType', resource_type), resource_id, server_key)
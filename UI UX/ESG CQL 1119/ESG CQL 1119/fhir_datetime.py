@@ -0,0 +1,68 @@
+"""
+FHIR Date/Time Parsing Module
+FHIR date / dateTime / instant 字串解析：
+單一正規表示式一次解析（含部分日期 2024、2024-03 與時區），結果以 LRU 快取（同一日期在資料中大量重複）
+
+    parse_fhir_datetime('2024-03-01T08:00:00+08:00')  → aware datetime（含 +08:00）
+    parse_fhir_datetime('2024-03')                    → datetime(2024, 3, 1)（naive，精確度不足補最小值）
+    parse_fhir_datetime('2024-02-30')                 → None（格式或日期不正確）
+"""
+
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Optional
+
+# FHIR 日期時間: 2024、2024-03、2024-03-01、2024-03-01T08:00:00.000+08:00（時間可省略秒）
+_DATETIME_RE = re.compile(
+    r'^(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2})(?::(\d{2})(?::(\d{2})(?:\.(\d+))?)?)?)?)?)?'
+    r'(Z|[+-]\d{2}:?\d{2})?$'
+)
+
+# LRU 快取的字串數
+CACHE_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_fhir_datetime(value: str) -> Optional[datetime]:
+    """
+    FHIR date / dateTime / instant → datetime
+    
+    有時區（Z 或 ±hh:mm）時回傳 aware datetime，否則為 naive；
+    精確度不足時月、日補 1，時間補 0；格式不符或日期不存在時回傳 None
+    """
+    match = _DATETIME_RE.match(value)
+    if not match:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    tzinfo = None
+    if zone == 'Z':
+        tzinfo = timezone.utc
+    elif zone:
+        offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[-2:]))
+        tzinfo = timezone(-offset if zone[0] == '-' else offset)
+    try:
+        return datetime(int(year), int(month or 1), int(day or 1), int(hour or 0), int(minute or 0),
+                        int(second or 0), int((fraction or '0')[:6].ljust(6, '0')), tzinfo)
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_local_datetime(value: str) -> Optional[datetime]:
+    """parse_fhir_datetime 後以 to_local 轉為本機時間的 naive datetime（結果快取）"""
+    return to_local(parse_fhir_datetime(value))
+
+
+def to_local(value: Optional[datetime]) -> Optional[datetime]:
+    """aware datetime 轉為本機時間的 naive datetime（naive 直接回傳），可與 datetime.now() 比較"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone().replace(tzinfo=None)
+
+
+def to_wall_time(value: Optional[datetime]) -> Optional[datetime]:
+    """捨去時區、保留字串上的當地時間（CQL 引擎的日期時間表示方式）"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.replace(tzinfo=None)
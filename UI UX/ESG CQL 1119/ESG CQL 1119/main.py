@@ -10,8 +10,8 @@ ESG CQL Testing Main Program
 """
 
 import logging
+import argparse
 import yaml
-import json
 from pathlib import Path
 from datetime import datetime
 from tabulate import tabulate
@@ -21,9 +21,17 @@ from colorama import Fore, Style, init
 init(autoreset=True)
 
 # 導入自定義模組
-from fhir_client import MultiServerFHIRClient
+from fhir_client import FHIRClient, MultiServerFHIRClient
+from fhir_cache import FHIRResourceCache
+from measure_state import MeasureState
+from query_planner import QueryPlanner, retrieved_types
 from cql_processor import CQLExecutor
+from cql_parser import CQLASTCache, load_library
+from result_cache import CQLResultCache
+from result_writer import RESOURCE_SECTION, write_results
 from data_filter import DataFilter, DataDisplay
+import shared_path  # noqa: F401
+from fhir_shared.sketches import sketch_options
 
 # 設定logging
 logging.basicConfig(
@@ -40,10 +48,20 @@ logger = logging.getLogger(__name__)
 class ESGCQLTester:
     """ESG CQL測試主類別"""
     
-    def __init__(self, config_path: str = 'config.yaml'):
-        """初始化測試器"""
+    def __init__(self, config_path: str = 'config.yaml', refresh: bool = False):
+        """
+        初始化測試器
+        
+        Args:
+            config_path: 設定檔路徑
+            refresh: True 時忽略本機FHIR快取，完整重新擷取
+        """
         self.config = self._load_config(config_path)
         self.workspace_dir = Path(__file__).parent
+        self.refresh = refresh
+        self.query_plan_report = None
+        self.scheduler_stats = None
+        self._libraries = None
         
         logger.info("="*80)
         logger.info("ESG CQL 測試系統啟動")
@@ -55,10 +73,26 @@ class ESGCQLTester:
             with open(config_path, 'r', encoding='utf-8') as f:
                 config = yaml.safe_load(f)
             logger.info(f"已載入設定檔: {config_path}")
-            return config
         except Exception as e:
             logger.error(f"載入設定檔失敗: {e}")
             raise
+        self._validate_config(config)
+        return config
+    
+    @staticmethod
+    def _validate_config(config: dict):
+        """拒絕無法同時使用的設定（而不是執行時默默忽略）"""
+        fetch_config = config.get('fetch') or {}
+        if fetch_config.get('transport', 'sync') != 'async':
+            return
+        if (config.get('cache') or {}).get('enabled', False):
+            raise ValueError("fetch.transport: async 不支援本機快取，請將 cache.enabled 設為 false 或改用 transport: sync")
+        bulk_servers = [server_config.get('name', server_key)
+                        for server_key, server_config in config['fhir_servers'].items()
+                        if server_config.get('enabled', True) and server_config.get('bulk_export', False)]
+        if bulk_servers:
+            raise ValueError(f"fetch.transport: async 不支援 bulk_export（{', '.join(bulk_servers)}），"
+                             f"請移除 bulk_export 或改用 transport: sync")
     
     def setup_fhir_clients(self) -> MultiServerFHIRClient:
         """設定FHIR客戶端連線"""
@@ -72,7 +106,67 @@ class ESGCQLTester:
                 server_configs.append(server_config)
                 logger.info(f"✓ {server_config['name']}: {server_config['base_url']}")
         
-        return MultiServerFHIRClient(server_configs)
+        fetch_config = self.config.get('fetch') or {}
+        cache = self._setup_cache()
+        resource_types = self._resource_types()
+        logger.info(f"擷取資源類型: {', '.join(resource_types)}")
+        
+        if fetch_config.get('transport', 'sync') == 'async':
+            # 選用：asyncio + httpx 連線池（需安裝 httpx[http2]）
+            from async_fhir_client import AsyncMultiServerFHIRClient
+            logger.info("使用非同步傳輸 (asyncio + HTTP/2 連線池)")
+            return AsyncMultiServerFHIRClient(server_configs, fetch_config, resource_types=resource_types)
+        
+        return MultiServerFHIRClient(server_configs, fetch_config, cache=cache, refresh=self.refresh,
+                                     resource_types=resource_types)
+    
+    def _load_libraries(self) -> dict:
+        """啟用的CQL Library AST {名稱: AST（檔案不存在為 None）}，與執行時使用同一個AST快取"""
+        if self._libraries is None:
+            ast_cache = self._setup_ast_cache()
+            self._libraries = {}
+            for cql_config in self.config['cql_libraries']:
+                if cql_config.get('enabled', True):
+                    cql_path = self.workspace_dir / cql_config['file']
+                    self._libraries[cql_config['name']] = (load_library(str(cql_path), ast_cache)
+                                                           if cql_path.exists() else None)
+        return self._libraries
+    
+    def _resource_types(self) -> list:
+        """擷取的資源類型：ESG 摘要與顯示用的類型，加上各Library retrieve 的其他類型（例如 Condition）"""
+        resource_types = list(FHIRClient.CQL_RESOURCE_TYPES)
+        for library in self._load_libraries().values():
+            if library is not None:
+                resource_types.extend(sorted(retrieved_types(library) - set(resource_types)))
+        return resource_types
+    
+    def _setup_cache(self):
+        """依config建立本機FHIR快取（cache.enabled）"""
+        cache_config = self.config.get('cache') or {}
+        if not cache_config.get('enabled', False):
+            return None
+        
+        cache_dir = self.workspace_dir / cache_config.get('directory', '.fhir_cache')
+        cache = FHIRResourceCache(str(cache_dir), cache_config.get('max_size_mb', 500))
+        
+        mode = "完整重新擷取 (--refresh)" if self.refresh else "增量同步 (_lastUpdated)"
+        logger.info(f"✓ 本機快取: {cache_dir} | {mode}")
+        return cache
+    
+    def _setup_ast_cache(self):
+        """依config建立CQL AST磁碟快取（cql_parsing.ast_cache）"""
+        parsing_config = self.config.get('cql_parsing') or {}
+        if not parsing_config.get('ast_cache', True):
+            return None
+        return CQLASTCache(str(self.workspace_dir / parsing_config.get('cache_directory', '.cql_cache')))
+    
+    def _setup_result_cache(self):
+        """依config建立CQL執行結果磁碟快取（cql_results_cache.enabled）"""
+        results_config = self.config.get('cql_results_cache') or {}
+        if not results_config.get('enabled', False):
+            return None
+        return CQLResultCache(str(self.workspace_dir / results_config.get('directory', '.cql_results')),
+                              results_config.get('max_size_mb', 200))
     
     def fetch_fhir_data(self, fhir_client: MultiServerFHIRClient) -> dict:
         """從所有伺服器擷取FHIR資料"""
@@ -80,14 +174,80 @@ class ESGCQLTester:
         logger.info("步驟 2: 從SMART on FHIR伺服器擷取資料（範圍：全部）")
         logger.info("="*80)
         
-        # 擷取所有資料（不限時間，CQL範圍開很大）
-        all_server_data = fhir_client.get_all_resources_from_all_servers(date_range=None)
+        # 查詢規劃：將CQL的測量期間與篩選條件下推為伺服器端搜尋參數
+        planner, search_plan = self._plan_queries()
         
-        # 合併資料
-        merged_data = fhir_client.merge_resources(all_server_data)
+        fetch_config = self.config.get('fetch') or {}
+        if fetch_config.get('streaming_merge', False) and hasattr(fhir_client, 'clients'):
+            # 串流合併：逐頁擷取並直接合併，不保留各伺服器的完整資料
+            server_streams = fhir_client.get_resource_streams_from_all_servers(date_range=None, search_plan=search_plan)
+            merged_data = fhir_client.merge_resource_streams(server_streams)
+        else:
+            # 擷取資料（CQL範圍開很大，未啟用查詢規劃時擷取全部）
+            all_server_data = fhir_client.get_all_resources_from_all_servers(date_range=None, search_plan=search_plan)
+            # 合併資料
+            merged_data = fhir_client.merge_resources(all_server_data)
+            del all_server_data
+        
+        # 請求排程統計（重試次數、限流等待秒數）
+        self.scheduler_stats = fhir_client.get_scheduler_stats()
+        logger.info(f"請求排程: {fhir_client.scheduler.format_stats()}")
+        
+        # 非同步客戶端沒有逐伺服器的下載統計
+        if search_plan and hasattr(fhir_client, 'clients'):
+            fetch_stats = fhir_client.get_fetch_stats()
+            self.query_plan_report = planner.measure_savings(fhir_client, search_plan, fetch_stats)
+            if planner.project_elements:
+                self.query_plan_report['projection'] = planner.measure_projection(fhir_client, search_plan, fetch_stats)
         
         return merged_data
     
+    def _measurement_period(self) -> tuple:
+        """CQL測量期間（無限大，實際過濾在VS Code控制）"""
+        return (
+            datetime(1900, 1, 1),
+            datetime(2100, 12, 31)
+        )
+    
+    def _plan_queries(self):
+        """依啟用的CQL Library建立伺服器端搜尋計畫（query_planning.enabled）"""
+        planning_config = self.config.get('query_planning') or {}
+        if not planning_config.get('enabled', False):
+            return None, None
+        
+        # 資料與欄位需求由各Library的AST推導
+        libraries = self._load_libraries()
+        
+        date_window = self._measurement_period()
+        if planning_config.get('apply_time_range', False):
+            # 一併套用顯示用時間範圍（CQL也只會看到此範圍內的資料）
+            filter_start, filter_end = DataFilter(self.config['data_filters']).time_range
+            date_window = (max(date_window[0], filter_start), min(date_window[1], filter_end))
+        
+        planner = QueryPlanner(libraries, date_window,
+                               project_elements=planning_config.get('project_elements', False),
+                               saved_types=self._saved_resource_types())
+        search_plan = planner.plan()
+        
+        logger.info("查詢規劃（伺服器端過濾條件）:")
+        for line in planner.describe(search_plan):
+            logger.info(f"  - {line}")
+        
+        return planner, search_plan
+    
+    def _saved_resource_types(self) -> list:
+        """
+        過濾後資源會逐筆寫入結果檔或顯示明細的資源類型（查詢規劃不下推這些類型的條件，也不投影欄位）
+        
+        filtered_data 包含所有擷取的類型：寫入結果檔（output.raw_resources 不為 none）或
+        顯示詳細資料（display_fields.encounter_details）時，所有類型都需完整擷取
+        """
+        output_config = self.config.get('output') or {}
+        display_fields = (self.config.get('data_filters') or {}).get('display_fields') or {}
+        if output_config.get('raw_resources', 'inline') != 'none' or display_fields.get('encounter_details', False):
+            return self._resource_types()
+        return []
+    
     def execute_cql_libraries(self, fhir_data: dict) -> dict:
         """執行所有CQL檔案"""
         logger.info("\n" + "="*80)
@@ -105,17 +265,29 @@ class ESGCQLTester:
                 else:
                     logger.warning(f"✗ CQL檔案不存在: {cql_config['file']}")
         
-        # 建立CQL執行器
-        cql_executor = CQLExecutor(cql_files)
+        # 建立CQL執行器（AST快取：內容未變更的CQL不重新解析）
+        ast_cache = self._setup_ast_cache()
+        execution_config = self.config.get('cql_execution') or {}
+        result_cache = self._setup_result_cache()
+        cql_executor = CQLExecutor(cql_files, ast_cache, workers=execution_config.get('workers', 1),
+                                   result_cache=result_cache,
+                                   approximate=sketch_options(self.config.get('approximate_statistics')))
+        if ast_cache is not None:
+            logger.info(f"CQL AST快取: 命中 {ast_cache.hits} 個、重新解析 {ast_cache.misses} 個")
         
         # 設定測量期間（無限大，實際過濾在VS Code控制）
-        measurement_period = (
-            datetime(1900, 1, 1),
-            datetime(2100, 12, 31)
-        )
-        
-        # 執行所有CQL
-        results = cql_executor.execute_all(fhir_data, measurement_period)
+        measurement_period = self._measurement_period()
+        
+        # 執行所有CQL（incremental_state：只重新計算資源有變動的病人；shards > 1：依病人分片執行，只彙總族群人數）
+        shards = execution_config.get('shards', 0)
+        state_file = execution_config.get('incremental_state')
+        if state_file:
+            state = MeasureState(str(self.workspace_dir / state_file))
+            results = cql_executor.execute_incremental(fhir_data, measurement_period, state)
+        elif shards > 1:
+            results = cql_executor.execute_sharded(fhir_data, measurement_period, shards)
+        else:
+            results = cql_executor.execute_all(fhir_data, measurement_period)
         
         logger.info(f"\n已執行 {len(results)} 個CQL Library")
         return results
@@ -131,7 +303,8 @@ class ESGCQLTester:
         filtered_fhir_data = data_filter.filter_fhir_data(fhir_data)
         
         # 建立資料顯示處理器
-        data_display = DataDisplay(self.config['data_filters']['display_fields'])
+        data_display = DataDisplay(self.config['data_filters']['display_fields'],
+                                   sketch_options(self.config.get('approximate_statistics')))
         
         # 提取病患基本資料統計
         demographics = data_display.extract_patient_demographics(filtered_fhir_data)
@@ -139,6 +312,12 @@ class ESGCQLTester:
         # 格式化顯示結果
         display_results = data_display.format_results_for_display(cql_results, demographics)
         
+        # 查詢下推節省統計
+        if self.query_plan_report:
+            display_results['summary']['query_plan'] = self.query_plan_report
+        if self.scheduler_stats:
+            display_results['summary']['request_scheduler'] = self.scheduler_stats
+        
         # 添加過濾後的資料供詳細顯示使用
         display_results['filtered_data'] = filtered_fhir_data
         
@@ -225,6 +404,9 @@ class ESGCQLTester:
                 if 'error' in library_result:
                     print(f"  {Fore.RED}錯誤: {library_result['error']}{Style.RESET_ALL}\n")
                     continue
+                if 'skipped' in library_result:
+                    print(f"  {Fore.YELLOW}已略過: {library_result['skipped']}{Style.RESET_ALL}\n")
+                    continue
                 
                 # 顯示主要指標
                 self._print_library_metrics(library_name, library_result)
@@ -273,6 +455,19 @@ class ESGCQLTester:
                 ["  資料狀態", result.get('data_status', 'Unknown')]
             ]
         
+        else:
+            # 其他 Library：顯示引擎計算的純量 define 值
+            for name, value in result.get('definitions', {}).items():
+                if isinstance(value, (int, float, str)) or value is None:
+                    metrics.append([f"  {name}", 'N/A' if value is None else value])
+                elif isinstance(value, list):
+                    metrics.append([f"  {name}", f"{len(value)} 筆"])
+            role_labels = {'initial_population': '初始族群', 'denominator': '分母', 'numerator': '分子'}
+            for role, count in result.get('population_counts', {}).items():
+                metrics.append([f"  {role_labels.get(role, role)}", count])
+            if result.get('definition_errors'):
+                metrics.append(["  執行失敗的 define", len(result['definition_errors'])])
+        
         if metrics:
             print(tabulate(metrics, tablefmt='plain'))
             
@@ -288,14 +483,27 @@ class ESGCQLTester:
                 print(f"{Fore.CYAN}   顯示過濾條件：{time_desc}（由VS Code控制）{Style.RESET_ALL}")
     
     def save_results(self, results: dict, output_path: str = 'esg_cql_results.json'):
-        """儲存結果到JSON檔案"""
+        """
+        儲存結果到JSON檔案（串流寫出：摘要與指標在前，過濾後的資源逐筆寫出）
+        
+        output.raw_resources 為 sidecar 時，資源改寫到 <檔名>.resources.ndjson.gz，結果檔只記錄檔名與筆數；
+        為 none 時不寫出資源
+        """
+        output_config = self.config.get('output') or {}
         output_file = self.workspace_dir / output_path
+        sidecar_file = None
+        raw_resources = output_config.get('raw_resources', 'inline')
+        if raw_resources == 'sidecar':
+            sidecar_file = output_file.with_suffix('.resources.ndjson.gz')
+        elif raw_resources == 'none':
+            results = {key: value for key, value in results.items() if key != RESOURCE_SECTION}
         
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(results, f, indent=2, ensure_ascii=False)
+        write_results(results, output_file, sidecar_file, indent=output_config.get('json_indent', 2))
         
         logger.info(f"結果已儲存至: {output_file}")
         print(f"\n{Fore.GREEN}✓ 結果已儲存至: {output_file}{Style.RESET_ALL}")
+        if sidecar_file is not None:
+            print(f"{Fore.GREEN}✓ 過濾後的資源已儲存至: {sidecar_file}{Style.RESET_ALL}")
     
     def print_detailed_data(self, results: dict):
         """顯示過濾後的詳細資料"""
@@ -454,7 +662,7 @@ class ESGCQLTester:
             logger.info("="*80)
             
             return display_results
-            
+        
         except Exception as e:
             logger.error(f"測試執行失敗: {e}", exc_info=True)
             print(f"\n{Fore.RED}✗ 錯誤: {e}{Style.RESET_ALL}")
@@ -477,8 +685,13 @@ def main():
 ╚═══════════════════════════════════════════════════════════════════════════════╝
 {Style.RESET_ALL}""")
     
+    parser = argparse.ArgumentParser(description='ESG CQL 測試系統')
+    parser.add_argument('--config', default='config.yaml', help='設定檔路徑')
+    parser.add_argument('--refresh', action='store_true', help='忽略本機FHIR快取，完整重新擷取所有資源')
+    args = parser.parse_args()
+    
     # 建立測試器並執行
-    tester = ESGCQLTester()
+    tester = ESGCQLTester(args.config, refresh=args.refresh)
     tester.run()
 
 
@@ -0,0 +1,134 @@
+"""
+Measure State Module
+增量重新計算用的狀態檔：記錄上次執行時各病人 compartment 的版本指紋，
+以及各 Library 每個病人對族群人數（Initial Population / Denominator / Numerator）的貢獻。
+再次執行時只需重新計算資源有變動的病人，並以差額修正總人數。
+"""
+
+import os
+import json
+import logging
+from typing import Dict, Optional, Set
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+
+
+class MeasureState:
+    """
+    族群人數的病人貢獻狀態
+    
+    檔案格式：
+        {
+            "version": 1,
+            "measurement_period": {"start": "...", "end": "..."},
+            "shared": "<不屬於任何病人之資源的指紋>",
+            "patients": {"<patient_id>": "<compartment 指紋>"},
+            "libraries": {
+                "<library>": {
+                    "fingerprint": "<CQL 內容雜湊>",
+                    "totals": {"initial_population": n, "denominator": n, "numerator": n},
+                    "contributions": {"<patient_id>": {"denominator": 1, ...}},
+                    "errors": {"<patient_id>": {"<define>": "錯誤訊息"}}
+                }
+            }
+        }
+    """
+    
+    def __init__(self, path: Optional[str] = None):
+        """
+        初始化狀態（path 存在時載入上次的狀態）
+        
+        Args:
+            path: 狀態檔路徑（None = 只保存在記憶體）
+        """
+        self.path = Path(path) if path else None
+        self.measurement_period: Optional[Dict[str, str]] = None
+        self.shared: Optional[str] = None
+        self.patients: Dict[str, str] = {}
+        self.libraries: Dict[str, Dict] = {}
+        
+        if self.path is not None:
+            self.load()
+    
+    def load(self):
+        """載入狀態檔（不存在或損毀時從空狀態開始，即全部重新計算）"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"族群人數狀態檔損毀，將全部重新計算: {self.path} ({e})")
+            return
+        if state.get('version') != STATE_VERSION:
+            return
+        self.measurement_period = state.get('measurement_period')
+        self.shared = state.get('shared')
+        self.patients = state.get('patients', {})
+        self.libraries = state.get('libraries', {})
+    
+    def save(self):
+        """以暫存檔 + os.replace 原子寫入"""
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        state = {
+            'version': STATE_VERSION,
+            'measurement_period': self.measurement_period,
+            'shared': self.shared,
+            'patients': self.patients,
+            'libraries': self.libraries,
+        }
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"無法寫入族群人數狀態檔: {self.path} ({e})")
+    
+    def reset(self, measurement_period: Dict[str, str], shared: str) -> bool:
+        """測量期間或共用資源（不屬於任何病人）有變動時清除所有貢獻；回傳是否已清除"""
+        if self.measurement_period == measurement_period and self.shared == shared:
+            return False
+        self.measurement_period = measurement_period
+        self.shared = shared
+        self.patients = {}
+        self.libraries = {}
+        return True
+    
+    def changed_patients(self, versions: Dict[str, str]) -> Set[str]:
+        """指紋與上次不同（含新增）的病人"""
+        return {patient_id for patient_id, version in versions.items() if self.patients.get(patient_id) != version}
+    
+    def removed_patients(self, versions: Dict[str, str]) -> Set[str]:
+        """上次有、這次已不存在的病人"""
+        return set(self.patients) - set(versions)
+    
+    def library(self, name: str, fingerprint: str) -> Dict:
+        """Library 的貢獻狀態（CQL 內容變更時重新開始）"""
+        library = self.libraries.get(name)
+        if library is None or library.get('fingerprint') != fingerprint:
+            library = {'fingerprint': fingerprint, 'totals': {}, 'contributions': {}, 'errors': {}}
+            self.libraries[name] = library
+        return library
+    
+    @staticmethod
+    def update(library: Dict, patient_id: str, counts: Optional[Dict[str, int]],
+               errors: Optional[Dict[str, str]] = None):
+        """以病人新的貢獻取代舊的貢獻，並以差額修正總人數（counts 為 None 表示移除此病人）"""
+        totals = library['totals']
+        previous = library['contributions'].pop(patient_id, {})
+        library['errors'].pop(patient_id, None)
+        for role, count in previous.items():
+            totals[role] = totals.get(role, 0) - count
+        if counts is None:
+            return
+        for role, count in counts.items():
+            totals[role] = totals.get(role, 0) + count
+        library['contributions'][patient_id] = counts
+        if errors:
+            library['errors'][patient_id] = errors
@@ -0,0 +1,754 @@
+"""
+Query Planner Module
+依啟用的CQL Library與測量期間，推導伺服器端FHIR搜尋參數（push-down）與
+_elements 欄位投影，並統計相較於不過濾擷取所節省的資源筆數與傳輸量
+
+各Library的 retrieve、可下推的 where 條件與讀取的資源欄位由解析後的AST推導
+（retrieve alias、define 參照與函式參數上的屬性存取），CQL 修改後不需另外同步需求表。
+"""
+
+import logging
+from typing import Dict, List, Optional, Any, Iterable, Set, Tuple
+from datetime import datetime
+
+from cql_engine import CHOICE_TYPES, DEFAULT_CODE_PATHS
+
+logger = logging.getLogger(__name__)
+
+
+# 各資源類型對應的日期搜尋參數（FHIR R4 search parameter）
+DATE_SEARCH_PARAMS = {
+    'Encounter': 'date',
+    'MedicationRequest': 'authoredon',
+    'MedicationAdministration': 'effective-time',
+    'Observation': 'date',
+    'Procedure': 'date',
+    'DocumentReference': 'date',
+    'DiagnosticReport': 'date',
+}
+
+# 日期元素為必填（FHIR R4 基數 1..1）的資源類型：只有這些類型下推 "during MeasurementPeriod"。
+# 其他類型的日期可缺值（例如 Encounter.period 0..1），伺服器端日期搜尋會排除沒有日期的資源
+DATE_ELEMENTS = {
+    'MedicationAdministration': 'effective',
+}
+
+# 可下推的屬性路徑（省略 FHIR primitive 的 .value）與對應的搜尋參數（token）
+SEARCH_PARAM_PATHS = {
+    'status': 'status',
+    'intent': 'intent',
+    'active': 'active',
+    'class.code': 'class',
+    'category.coding.code': 'category',
+}
+
+# cql_processor 的 ESG 摘要（_execute_*，經 FHIRFrames 攤平）讀取的欄位
+# 摘要計算列出類型的全部資源（不套用 CQL 條件），這些類型不下推過濾條件。
+# id、meta 為伺服器必定回傳的欄位，不需列出；空列表代表只用到筆數。
+# 修改 _execute_* 讀取的欄位時需同步更新，否則該欄位會被伺服器裁掉
+# （tests/test_query_planner.py 以投影後的資料執行摘要，與完整資料比對）。
+SUMMARY_ELEMENT_REQUIREMENTS = {
+    'Antibiotic_Utilization': {
+        'Patient': [],
+        'Encounter': ['class', 'period'],
+        'MedicationRequest': [],
+        'MedicationAdministration': ['subject'],
+    },
+    'EHR_Adoption_Rate': {
+        'Patient': [],
+        'Encounter': [],
+        'DocumentReference': ['context'],
+        'Observation': ['category'],
+        'MedicationRequest': [],
+        'Procedure': [],
+    },
+    'Waste': {
+        'Patient': [],
+        'Encounter': [],
+        'Observation': ['code'],
+    },
+}
+
+# print_results 與 DataDisplay 顯示筆數與明細的資源類型（全部資源，不套用 CQL 條件）
+DISPLAY_RESOURCE_TYPES = ('Patient', 'Encounter', 'MedicationRequest', 'Observation', 'Procedure')
+
+# DataFilter（時間範圍）、DataDisplay（病患基本資料）與 print_results（各類型前幾筆明細）讀取的欄位
+DISPLAY_ELEMENT_REQUIREMENTS = {
+    'Patient': ['name', 'gender', 'birthDate', 'address'],
+    'Encounter': ['class', 'period'],
+    'MedicationRequest': ['authoredOn', 'status'],
+    'MedicationAdministration': ['effective'],
+    'Observation': ['code', 'effective'],
+    'Procedure': ['performed'],
+    'DocumentReference': ['date'],
+    'DiagnosticReport': ['effective'],
+}
+
+# 病人 compartment 的參照欄位（未列出者為 subject）：通用 CQL 引擎依此將資源分給各病人
+# （Patient context、shard 與增量執行），投影時必須保留
+PATIENT_REFERENCE_ELEMENTS = {
+    'AllergyIntolerance': 'patient',
+    'Immunization': 'patient',
+    'Claim': 'patient',
+    'ExplanationOfBenefit': 'patient',
+    'Coverage': 'beneficiary',
+}
+
+# 讀取 Patient context 病人 birthDate 的內建函式
+_AGE_FUNCTIONS = ('AgeInYears', 'AgeInYearsAt', 'AgeInMonths', 'AgeInMonthsAt')
+
+# FHIR _elements 只支援最上層元素名稱，選擇型別以基本名稱表示（effectiveDateTime -> effective）
+_CHOICE_BASES = {base + type_name: base for base, type_names in CHOICE_TYPES.items() for type_name in type_names}
+
+# 回傳參數中的資源（或資源清單）本身、不讀取欄位的內建函式
+_PASS_THROUGH_FUNCTIONS = ('First', 'Last', 'Distinct', 'Flatten', 'Coalesce', 'SingletonFrom')
+_PASS_THROUGH_METHODS = ('first', 'last', 'distinct', 'single', 'take', 'skip', 'tail')
+# 只計算筆數或是否存在、不讀取欄位的內建函式
+_COUNTING_FUNCTIONS = ('Count', 'Exists', 'IsNull')
+_COUNTING_METHODS = ('count', 'exists', 'empty')
+
+
+def library_requirements(library: Dict[str, Any]) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    由 cql_parser 的解析結果推導 Library 的資料需求
+    
+    Returns:
+        {'retrieves': {resource_type: [{搜尋參數: 允許值}, ...]},
+         'elements': {resource_type: [最上層元素名稱...]，None = 需下載完整資源}}；
+        每個 retrieve 只列出其所有結果都符合的條件（'date' 為 True 表示以 "during MeasurementPeriod" 限制日期）。
+        Library 使用 resolve() 時，參照的資源類型無法判斷，回傳 None。
+    """
+    return _RequirementAnalyzer(library).analyze()
+
+
+def retrieved_types(library: Dict[str, Any]) -> Set[str]:
+    """Library 的 retrieve 資源類型（Patient context 另含 Patient）；使用 resolve() 時同樣適用"""
+    resource_types = {'Patient'} if library.get('context') == 'Patient' else set()
+    for definition in library.get('definitions', {}).values():
+        resource_types.update(retrieve['resourceType'] for retrieve in definition.get('retrieves', ()))
+    return resource_types
+
+
+def _declared_types(type_name: Optional[str]) -> Set[str]:
+    """函式參數的型別宣告 → 資源類型（FHIR.Encounter、List<FHIR.Encounter> → {'Encounter'}）"""
+    if not type_name:
+        return set()
+    while type_name.startswith('List<') and type_name.endswith('>'):
+        type_name = type_name[5:-1]
+    if '<' in type_name or ' ' in type_name:
+        return set()
+    return {type_name.split('.')[-1]}
+
+
+def _unwrap(node: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    while node is not None and node.get('kind') == 'paren':
+        node = node['expression']
+    return node or {}
+
+
+def _conjuncts(node: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """a and b and c → [a, b, c]"""
+    node = _unwrap(node)
+    if not node:
+        return []
+    if node['kind'] == 'binary' and node['op'] == 'and':
+        return _conjuncts(node['left']) + _conjuncts(node['right'])
+    return [node]
+
+
+def _alias_path(node: Optional[Dict[str, Any]], alias: str) -> Optional[str]:
+    """A.status.value → 'status'（省略 FHIR primitive 的 .value）；不是此 alias 的屬性時回傳 None"""
+    parts = []
+    node = _unwrap(node)
+    while node.get('kind') == 'property':
+        parts.append(node['path'])
+        node = _unwrap(node['source'])
+    if node.get('kind') != 'ref' or node['name'] != alias or not parts:
+        return None
+    parts.reverse()
+    if len(parts) > 1 and parts[-1] == 'value':
+        parts.pop()
+    return '.'.join(parts)
+
+
+def _literal_values(node: Optional[Dict[str, Any]]) -> Optional[List[str]]:
+    """'x' 或 {'x', 'y'}（字串 / 布林常值）→ 搜尋參數值；含其他運算式時回傳 None"""
+    node = _unwrap(node)
+    items = node['elements'] if node.get('kind') == 'list' else [node]
+    values = []
+    for item in items:
+        item = _unwrap(item)
+        if item.get('kind') != 'literal' or item['type'] not in ('String', 'Boolean'):
+            return None
+        value = str(item['value']).lower() if item['type'] == 'Boolean' else item['value']
+        if value not in values:
+            values.append(value)
+    return values
+
+
+class _RequirementAnalyzer:
+    """
+    走訪 Library 的 define 與函式，推導每個運算式的資源類型（retrieve、alias、define 參照、
+    型別宣告的函式參數），並記錄各資源類型被存取的屬性與各 retrieve 的過濾條件
+    
+    資源傳入無法追蹤的位置（Tuple、讀取欄位的內建函式等）時，該類型改為下載完整資源。
+    """
+    
+    def __init__(self, library: Dict[str, Any]):
+        self.library = library
+        self.definitions = library.get('definitions', {})
+        self.retrieves: Dict[str, List[Dict[str, Any]]] = {}
+        self.elements: Dict[str, Set[str]] = {}
+        self.full: Set[str] = set()
+        self.resolves = False
+        self._define_types: Dict[str, Set[str]] = {}
+        self._function_types: Dict[tuple, Set[str]] = {}
+        self._visiting: Set[tuple] = set()
+    
+    def analyze(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        if self.library.get('context') == 'Patient':
+            # Patient context 依 Patient 資源逐一執行
+            self.retrieves.setdefault('Patient', []).append({})
+            self.elements.setdefault('Patient', set())
+        for name, definition in self.definitions.items():
+            if definition['kind'] == 'expression':
+                self._define(name)
+            elif definition['kind'] == 'function':
+                self._function(definition, [set() for _ in definition['params']])
+        if self.resolves:
+            return None
+        return {
+            'retrieves': self.retrieves,
+            'elements': {resource_type: None if resource_type in self.full else sorted(elements)
+                         for resource_type, elements in self.elements.items()},
+        }
+    
+    def _define(self, name: str) -> Set[str]:
+        key = ('define', name)
+        if name not in self._define_types:
+            if key in self._visiting:
+                return set()
+            self._visiting.add(key)
+            self._define_types[name] = self._visit(self.definitions[name].get('expression'), {})
+            self._visiting.discard(key)
+        return self._define_types[name]
+    
+    def _function(self, definition: Dict[str, Any], arg_types: List[Set[str]]) -> Set[str]:
+        """依引數的資源類型分析函式本體（引數無資源類型時採用參數的型別宣告）"""
+        params = definition['params']
+        scope = {param['name']: types or _declared_types(param.get('type'))
+                 for param, types in zip(params, arg_types)}
+        key = ('function', definition['name'], tuple(tuple(sorted(scope.get(param['name'], ()))) for param in params))
+        if key not in self._function_types:
+            if key in self._visiting:
+                return set()
+            self._visiting.add(key)
+            self._function_types[key] = self._visit(definition.get('expression'), scope)
+            self._visiting.discard(key)
+        return self._function_types[key]
+    
+    def _escape(self, types: Set[str]):
+        """資源傳入無法追蹤欄位存取的位置，這些類型需下載完整資源"""
+        self.full.update(types)
+        for resource_type in types:
+            self.elements.setdefault(resource_type, set())
+    
+    # 運算式：回傳運算結果可能的資源類型（非資源時為空集合）
+    
+    def _visit(self, node: Any, scope: Dict[str, Set[str]]) -> Set[str]:
+        if not isinstance(node, dict):
+            return set()
+        handler = getattr(self, '_visit_' + node.get('kind', ''), None)
+        if handler is None:
+            self._visit_children(node, scope)
+            return set()
+        return handler(node, scope)
+    
+    def _visit_children(self, node: Any, scope: Dict[str, Set[str]]):
+        values = node.values() if isinstance(node, dict) else node
+        for value in values:
+            if isinstance(value, dict) and 'kind' in value:
+                self._visit(value, scope)
+            elif isinstance(value, (dict, list)):
+                self._visit_children(value, scope)
+    
+    def _visit_retrieve(self, node, scope, conditions: Optional[Dict[str, Any]] = None):
+        resource_type = node['resourceType']
+        conditions = dict(conditions or {})
+        code = self._code_condition(node)
+        if code is not None:
+            conditions.setdefault('code', code)
+        self.retrieves.setdefault(resource_type, []).append(conditions)
+        elements = self.elements.setdefault(resource_type, set())
+        if resource_type != 'Patient':
+            elements.add(PATIENT_REFERENCE_ELEMENTS.get(resource_type, 'subject'))
+        if node['codes'] is not None:
+            # 代碼條件（與代碼索引）讀取的欄位
+            element = (node['codePath'] or DEFAULT_CODE_PATHS.get(resource_type, 'code')).split('.')[0]
+            elements.add(_CHOICE_BASES.get(element, element))
+            self._visit(node['codes'], scope)
+        return {resource_type}
+    
+    def _visit_ref(self, node, scope):
+        name = node['name']
+        if name in scope:
+            return scope[name]
+        definition = self.definitions.get(name)
+        if definition is not None and definition['kind'] == 'expression':
+            return self._define(name)
+        if any(name in self.library.get(section, {})
+               for section in ('parameters', 'codes', 'concepts', 'valuesets', 'codesystems', 'includes')):
+            return set()
+        if name == self.library.get('context') == 'Patient':
+            self.elements.setdefault('Patient', set())
+            return {'Patient'}
+        # sort by 欄位名稱 / FHIRPath 無 lambda 參數的 where(code = 'x')：$this 的欄位
+        for resource_type in scope.get('$this', ()):
+            self.elements.setdefault(resource_type, set()).add(_CHOICE_BASES.get(name, name))
+        return set()
+    
+    def _visit_property(self, node, scope):
+        element = _CHOICE_BASES.get(node['path'], node['path'])
+        for resource_type in self._visit(node['source'], scope):
+            self.elements.setdefault(resource_type, set()).add(element)
+        return set()
+    
+    def _visit_paren(self, node, scope):
+        return self._visit(node['expression'], scope)
+    
+    def _visit_as(self, node, scope):
+        return self._visit(node['operand'], scope)
+    
+    def _visit_index(self, node, scope):
+        self._visit(node['index'], scope)
+        return self._visit(node['source'], scope)
+    
+    def _visit_list(self, node, scope):
+        types = set()
+        for element in node['elements']:
+            types |= self._visit(element, scope)
+        return types
+    
+    def _visit_tuple(self, node, scope):
+        for element in node['elements']:
+            self._escape(self._visit(element['value'], scope))
+        return set()
+    
+    def _visit_instance(self, node, scope):
+        return self._visit_tuple(node, scope)
+    
+    def _visit_if(self, node, scope):
+        self._visit(node['condition'], scope)
+        return self._visit(node['then'], scope) | self._visit(node['else'], scope)
+    
+    def _visit_case(self, node, scope):
+        self._visit(node['comparand'], scope)
+        types = self._visit(node['else'], scope)
+        for item in node['items']:
+            self._visit(item['when'], scope)
+            types |= self._visit(item['then'], scope)
+        return types
+    
+    def _visit_let(self, node, scope):
+        scope = dict(scope)
+        for binding in node['let']:
+            scope[binding['name']] = self._visit(binding['expression'], scope)
+        return self._visit(node['expression'], scope)
+    
+    def _visit_unary(self, node, scope):
+        types = self._visit(node['operand'], scope)
+        return types if node['op'] in ('distinct', 'flatten', 'singleton from') else set()
+    
+    def _visit_binary(self, node, scope):
+        types = self._visit(node['left'], scope) | self._visit(node['right'], scope)
+        return types if node['op'] in ('union', '|', 'intersect', 'except') else set()
+    
+    def _visit_query(self, node, scope):
+        query_scope = dict(scope)
+        source_types = []
+        for source in node['sources']:
+            types = self._visit_source(source['expression'], source['alias'], node['where'], scope)
+            query_scope[source['alias']] = types
+            source_types.append(types)
+        for binding in node['let']:
+            query_scope[binding['name']] = self._visit(binding['expression'], query_scope)
+        for relationship in node['relationships']:
+            related = self._visit_source(relationship['expression'], relationship['alias'],
+                                         relationship['suchThat'], query_scope)
+            self._visit(relationship['suchThat'], dict(query_scope, **{relationship['alias']: related}))
+        self._visit(node['where'], query_scope)
+        
+        if node['aggregate'] is not None:
+            aggregate = node['aggregate']
+            self._visit(aggregate['starting'], scope)
+            return self._visit(aggregate['expression'], dict(query_scope, **{aggregate['name']: set()}))
+        
+        if node['return'] is not None:
+            result = self._visit(node['return']['expression'], query_scope)
+        elif len(source_types) == 1:
+            result = source_types[0]
+        else:
+            # 多個來源的結果為 {alias: 項目}，其後的屬性存取無法追蹤
+            for types in source_types:
+                self._escape(types)
+            result = set()
+        
+        if node['sort'] is not None:
+            sort_scope = dict(scope, **{'$this': result})
+            if node['return'] is None:
+                sort_scope.update((source['alias'], types) for source, types in zip(node['sources'], source_types))
+            for item in node['sort']['by']:
+                self._visit(item['expression'], sort_scope)
+        return result
+    
+    def _visit_source(self, node: Dict[str, Any], alias: str, where: Optional[Dict[str, Any]],
+                      scope: Dict[str, Set[str]]) -> Set[str]:
+        """查詢來源；直接為 retrieve 時，where / such that 中只涉及此 alias 的條件即為該 retrieve 的條件"""
+        node = _unwrap(node)
+        if node.get('kind') != 'retrieve':
+            return self._visit(node, scope)
+        conditions = {}
+        for conjunct in _conjuncts(where):
+            condition = self._condition(conjunct, alias, node['resourceType'])
+            if condition is not None:
+                conditions.setdefault(*condition)
+        return self._visit_retrieve(node, scope, conditions)
+    
+    def _condition(self, node: Dict[str, Any], alias: str, resource_type: str) -> Optional[Tuple[str, Any]]:
+        """可轉為搜尋參數的條件 → (搜尋參數, 允許值)；不能轉換時回傳 None"""
+        node = _unwrap(node)
+        op = node.get('op') if node['kind'] == 'binary' else None
+        if op == 'or':
+            # 同一搜尋參數的 or → 允許值的聯集
+            left = self._condition(node['left'], alias, resource_type)
+            right = self._condition(node['right'], alias, resource_type)
+            if left is None or right is None or left[0] != right[0] or left[0] == 'date':
+                return None
+            return left[0], left[1] + [value for value in right[1] if value not in left[1]]
+        path = _alias_path(node.get('left'), alias) if op else None
+        if path is None:
+            return None
+        if op == 'during' and 'boundary' not in node:
+            right = _unwrap(node['right'])
+            if path.split('.')[0] == DATE_ELEMENTS.get(resource_type) and right['kind'] == 'ref' \
+                    and right['name'].lower().replace(' ', '').replace('_', '') == 'measurementperiod':
+                return 'date', True
+            return None
+        if op in ('=', 'in', 'contains') and path in SEARCH_PARAM_PATHS:
+            values = _literal_values(node['right'])
+            if values and (op != '=' or len(values) == 1):
+                return SEARCH_PARAM_PATHS[path], values
+        return None
+    
+    def _code_condition(self, node: Dict[str, Any]) -> Optional[List[str]]:
+        """[Observation: "Code"] → code 搜尋參數（只比對代碼值：CQL 在資源的 coding 未提供 system 時不比對 system）"""
+        codes = node['codes']
+        path = node['codePath'] or DEFAULT_CODE_PATHS.get(node['resourceType'], 'code')
+        if codes is None or codes['kind'] != 'ref' or path != 'code' \
+                or (node['codeComparator'] or 'in') not in ('in', '=', '~'):
+            return None
+        code = self.library.get('codes', {}).get(codes['name'])
+        return [code['code']] if code is not None else None
+    
+    def _visit_call(self, node, scope):
+        definition = self.definitions.get(node['name'])
+        arg_types = [self._visit(arg, scope) for arg in node['args']]
+        if definition is not None and definition['kind'] == 'function':
+            return self._function(definition, arg_types)
+        return self._builtin(node['name'], arg_types)
+    
+    def _builtin(self, name: str, arg_types: List[Set[str]]) -> Set[str]:
+        types = set().union(*arg_types)
+        if name in _AGE_FUNCTIONS and self.library.get('context') == 'Patient':
+            self.elements.setdefault('Patient', set()).add('birthDate')
+        name = name[:1].upper() + name[1:]
+        if name in _PASS_THROUGH_FUNCTIONS:
+            return types
+        if name not in _COUNTING_FUNCTIONS:
+            self._escape(types)
+        return set()
+    
+    def _visit_method(self, node, scope):
+        source_node = node['source']
+        name = node['name']
+        if source_node['kind'] == 'ref' and source_node['name'] in self.library.get('includes', {}) \
+                and source_node['name'] not in scope:
+            # FHIRHelpers.ToDate(x) → 內建函式
+            return self._builtin(name, [self._visit(arg, scope) for arg in node['args']])
+        
+        types = self._visit(source_node, scope)
+        definition = self.definitions.get(name)
+        if definition is not None and definition['kind'] == 'function' and definition.get('fluent'):
+            return self._function(definition, [types] + [self._visit(arg, scope) for arg in node['args']])
+        if name == 'resolve':
+            # 參照的資源類型無法由AST判斷
+            self.resolves = True
+            return set()
+        if name in ('exists', 'where', 'all', 'select') and node['args']:
+            selected = self._fhirpath_argument(node['args'][0], scope, types)
+            return {'where': types, 'select': selected}.get(name, set())
+        for arg in node['args']:
+            self._visit(arg, scope)
+        if name in _PASS_THROUGH_METHODS:
+            return types
+        if name not in _COUNTING_METHODS:
+            self._escape(types)
+        return set()
+    
+    def _fhirpath_argument(self, arg: Dict[str, Any], scope: Dict[str, Set[str]], types: Set[str]) -> Set[str]:
+        """FHIRPath 函式參數（c: c.code = 'x'，或以 $this 欄位求值）"""
+        if arg['kind'] == 'lambda':
+            return self._visit(arg['body'], dict(scope, **{arg['param']: types}))
+        return self._visit(arg, dict(scope, **{'$this': types}))
+
+
+class QueryPlanner:
+    """查詢規劃器 - 合併多個Library的資料需求為每種資源一組搜尋參數"""
+    
+    def __init__(self, libraries: Dict[str, Optional[Dict[str, Any]]], date_window: Optional[tuple] = None,
+                 project_elements: bool = False, saved_types: Iterable[str] = ()):
+        """
+        初始化查詢規劃器
+        
+        Args:
+            libraries: {啟用的CQL Library名稱: cql_parser 解析結果（None = 無法載入）}
+            date_window: (start, end) 日期範圍，通常為CQL測量期間
+            project_elements: True 時依欄位需求加上 _elements，只下載用到的欄位
+            saved_types: 過濾後資源會逐筆顯示或寫入結果檔的資源類型（不下推過濾條件、不投影）
+        """
+        self.libraries = libraries
+        self.date_window = date_window
+        self.project_elements = project_elements
+        self.saved_types = tuple(saved_types)
+    
+    def plan(self) -> Dict[str, Dict[str, Any]]:
+        """
+        產生搜尋計畫
+        
+        多個 retrieve 之間為聯集：某參數只有在同一資源類型的所有 retrieve
+        都有限制時才會下推，值取各 retrieve 的聯集；任何 retrieve 不限制即不下推。
+        ESG 摘要、顯示流程（DISPLAY_RESOURCE_TYPES）與 saved_types 讀取全部資源，視為不限制的 retrieve。
+        
+        Returns:
+            {resource_type: {search_param: value}}，未被任何Library、摘要或顯示流程使用的資源類型不會出現
+        """
+        requirements = {}
+        for library_name, library in self.libraries.items():
+            requirement = library_requirements(library) if library is not None else None
+            if requirement is None:
+                # 無法判斷所需資料（CQL 無法載入或使用 resolve()），退回完整擷取
+                logger.warning(f"{library_name} 無法由CQL推導資料需求，改為不過濾擷取")
+                return {}
+            requirements[library_name] = requirement
+        
+        retrieves_by_type: Dict[str, List[Dict]] = {}
+        for library_name, requirement in requirements.items():
+            for resource_type, retrieves in requirement['retrieves'].items():
+                retrieves_by_type.setdefault(resource_type, []).extend(retrieves)
+            # ESG 摘要計算全部資源
+            for resource_type in SUMMARY_ELEMENT_REQUIREMENTS.get(library_name, {}):
+                retrieves_by_type.setdefault(resource_type, []).append({})
+        # 顯示流程與結果檔使用全部資源（例如只啟用指標Library時，病患統計仍需 Patient）
+        for resource_type in DISPLAY_RESOURCE_TYPES + self.saved_types:
+            retrieves_by_type.setdefault(resource_type, []).append({})
+        
+        plan = {}
+        for resource_type, retrieves in retrieves_by_type.items():
+            plan[resource_type] = self._merge_retrieves(resource_type, retrieves)
+            # 寫入結果檔或顯示明細的類型需完整資源，不投影
+            if self.project_elements and resource_type not in self.saved_types:
+                elements = self._merge_elements(resource_type, requirements)
+                if elements:
+                    plan[resource_type]['_elements'] = ','.join(elements)
+        
+        return plan
+    
+    def _merge_elements(self, resource_type: str, requirements: Dict[str, Dict[str, Any]]) -> Optional[List[str]]:
+        """
+        合併各Library、ESG摘要與顯示流程對某資源類型需要的欄位
+        
+        任一Library需要完整資源時回傳 None。
+        """
+        elements = set(DISPLAY_ELEMENT_REQUIREMENTS.get(resource_type, []))
+        for library_name, requirement in requirements.items():
+            elements.update(SUMMARY_ELEMENT_REQUIREMENTS.get(library_name, {}).get(resource_type, []))
+            if resource_type not in requirement['elements']:
+                continue
+            library_elements = requirement['elements'][resource_type]
+            if library_elements is None:
+                logger.warning(f"{library_name} 的 {resource_type} 傳入無法分析的運算式，下載完整資源")
+                return None
+            elements.update(library_elements)
+        return sorted(elements)
+    
+    def _merge_retrieves(self, resource_type: str, retrieves: List[Dict]) -> Dict[str, Any]:
+        """合併同一資源類型的多個 retrieve 條件"""
+        params: Dict[str, Any] = {}
+        
+        common_keys = set(retrieves[0])
+        for retrieve in retrieves[1:]:
+            common_keys &= set(retrieve)
+        
+        for key in sorted(common_keys):
+            if key == 'date':
+                date_param = DATE_SEARCH_PARAMS.get(resource_type)
+                if date_param and self.date_window and all(r['date'] for r in retrieves):
+                    start, end = self.date_window
+                    params[date_param] = [f'ge{self._format_date(start)}', f'le{self._format_date(end)}']
+                continue
+            
+            values = []
+            for retrieve in retrieves:
+                for value in retrieve[key]:
+                    if value not in values:
+                        values.append(value)
+            # FHIR 搜尋以逗號表示 OR
+            params[key] = ','.join(values)
+        
+        return params
+    
+    def _format_date(self, value: datetime) -> str:
+        return value.strftime('%Y-%m-%d')
+    
+    def describe(self, plan: Dict[str, Dict[str, Any]]) -> List[str]:
+        """將搜尋計畫轉為可讀文字（供日誌使用）"""
+        lines = []
+        for resource_type, params in plan.items():
+            if not params:
+                lines.append(f"{resource_type}: (不過濾)")
+                continue
+            parts = []
+            for key, value in params.items():
+                if isinstance(value, list):
+                    parts.extend(f"{key}={v}" for v in value)
+                else:
+                    parts.append(f"{key}={value}")
+            lines.append(f"{resource_type}: {'&'.join(parts)}")
+        return lines
+    
+    def measure_savings(self, multi_client, plan: Dict[str, Dict[str, Any]],
+                        fetched_stats: Dict[str, Dict[str, Dict[str, int]]]) -> Dict[str, Any]:
+        """
+        統計下推過濾節省的資源筆數與位元組
+        
+        以 _summary=count 查詢不過濾時的總筆數；未過濾的位元組數以本次實際
+        下載的平均每筆大小推估。
+        
+        Args:
+            multi_client: MultiServerFHIRClient
+            plan: 搜尋計畫
+            fetched_stats: {server_key: {resource_type: {'resources': n, 'bytes': b}}}
+        
+        Returns:
+            節省統計報告
+        """
+        report = {'by_resource_type': {}, 'total': {}}
+        totals = {'fetched_resources': 0, 'fetched_bytes': 0,
+                  'unfiltered_resources': 0, 'unfiltered_bytes_estimated': 0}
+        
+        for idx, client in enumerate(multi_client.clients, 1):
+            server_stats = fetched_stats.get(f"server{idx}", {})
+            
+            for resource_type in client.resource_types:
+                stats = server_stats.get(resource_type, {'resources': 0, 'bytes': 0})
+                unfiltered = client.count_resources(resource_type)
+                if unfiltered is None:
+                    continue
+                
+                fetched_resources = stats['resources']
+                fetched_bytes = stats['bytes']
+                avg_bytes = fetched_bytes / fetched_resources if fetched_resources else 0
+                unfiltered_bytes = int(avg_bytes * unfiltered) if fetched_resources else fetched_bytes
+                
+                entry = report['by_resource_type'].setdefault(resource_type, {
+                    'fetched_resources': 0, 'fetched_bytes': 0,
+                    'unfiltered_resources': 0, 'unfiltered_bytes_estimated': 0,
+                    'pushed_down': resource_type in plan
+                })
+                entry['fetched_resources'] += fetched_resources
+                entry['fetched_bytes'] += fetched_bytes
+                entry['unfiltered_resources'] += unfiltered
+                entry['unfiltered_bytes_estimated'] += unfiltered_bytes
+                
+                totals['fetched_resources'] += fetched_resources
+                totals['fetched_bytes'] += fetched_bytes
+                totals['unfiltered_resources'] += unfiltered
+                totals['unfiltered_bytes_estimated'] += unfiltered_bytes
+        
+        totals['saved_resources'] = max(0, totals['unfiltered_resources'] - totals['fetched_resources'])
+        totals['saved_bytes_estimated'] = max(0, totals['unfiltered_bytes_estimated'] - totals['fetched_bytes'])
+        report['total'] = totals
+        
+        logger.info(f"查詢下推節省: {totals['saved_resources']} 筆資源、"
+                    f"約 {totals['saved_bytes_estimated'] / 1024:.1f} KB")
+        for resource_type, entry in report['by_resource_type'].items():
+            logger.info(f"  - {resource_type}: {entry['unfiltered_resources']} -> {entry['fetched_resources']} 筆")
+        
+        return report
+    
+    def measure_projection(self, multi_client, plan: Dict[str, Dict[str, Any]],
+                           fetched_stats: Dict[str, Dict[str, Dict[str, int]]],
+                           sample_size: int = 20) -> Dict[str, Any]:
+        """
+        統計 _elements 投影減少的傳輸量
+        
+        以相同搜尋條件各取一頁樣本（有/無 _elements），比較每筆資源的平均大小，
+        再依本次實際下載量推估完整資源的總位元組數。
+        
+        Args:
+            multi_client: MultiServerFHIRClient
+            plan: 搜尋計畫
+            fetched_stats: {server_key: {resource_type: {'resources': n, 'bytes': b}}}
+            sample_size: 樣本筆數
+        
+        Returns:
+            投影節省統計報告
+        """
+        report = {'by_resource_type': {}, 'total': {}}
+        totals = {'fetched_bytes': 0, 'full_bytes_estimated': 0}
+        
+        for idx, client in enumerate(multi_client.clients, 1):
+            server_stats = fetched_stats.get(f"server{idx}", {})
+            
+            for resource_type, params in plan.items():
+                if '_elements' not in params:
+                    continue
+                stats = server_stats.get(resource_type)
+                if not stats or not stats['resources']:
+                    continue
+                
+                full_params = {k: v for k, v in params.items() if k != '_elements'}
+                full = client.sample_payload(resource_type, full_params, sample_size)
+                projected = client.sample_payload(resource_type, params, sample_size)
+                if not full or not projected or not full['resources'] or not projected['resources']:
+                    continue
+                
+                full_avg = full['bytes'] / full['resources']
+                projected_avg = projected['bytes'] / projected['resources']
+                full_bytes = int(full_avg * stats['resources'])
+                
+                entry = report['by_resource_type'].setdefault(resource_type, {
+                    'elements': params['_elements'],
+                    'fetched_bytes': 0, 'full_bytes_estimated': 0,
+                    'full_bytes_per_resource': round(full_avg, 1),
+                    'projected_bytes_per_resource': round(projected_avg, 1)
+                })
+                entry['fetched_bytes'] += stats['bytes']
+                entry['full_bytes_estimated'] += full_bytes
+                
+                totals['fetched_bytes'] += stats['bytes']
+                totals['full_bytes_estimated'] += full_bytes
+        
+        for entry in list(report['by_resource_type'].values()) + [totals]:
+            full_bytes = entry['full_bytes_estimated']
+            entry['saved_bytes_estimated'] = max(0, full_bytes - entry['fetched_bytes'])
+            entry['reduction_percent'] = round(entry['saved_bytes_estimated'] / full_bytes * 100, 1) if full_bytes else 0
+        report['total'] = totals
+        
+        logger.info(f"_elements 投影節省: 約 {totals['saved_bytes_estimated'] / 1024:.1f} KB "
+                    f"({totals['reduction_percent']}%)")
+        for resource_type, entry in report['by_resource_type'].items():
+            logger.info(f"  - {resource_type}: {entry['full_bytes_per_resource']} -> "
+                        f"{entry['projected_bytes_per_resource']} bytes/筆")
+        
+        return report
@@ -0,0 +1,167 @@
+"""
+CQL Result Cache Module
+CQL 執行結果的磁碟快取（content-addressed）：
+以 CQL 內容雜湊、FHIR 資料快照雜湊與測量期間為鍵，相同的報表再次執行時直接取回結果
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Dict, Any, Optional, Sequence
+from pathlib import Path
+
+from cql_parser import PARSER_VERSION
+
+try:
+    import fcntl
+except ImportError:  # Windows：不鎖定，淘汰時容忍其他行程已刪除的檔案
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 執行引擎的結果格式或語意變更時遞增，使舊的快取結果失效
+RESULT_CACHE_VERSION = '1'
+
+
+class CQLResultCache:
+    """
+    CQL 執行結果磁碟快取
+    
+    目錄結構：
+        <cache_dir>/<鍵>.json   {'library': ..., 'result': {...}}
+        <cache_dir>/.lock       淘汰時的跨行程鎖（POSIX）
+    
+    鍵為 SHA-256(RESULT_CACHE_VERSION、PARSER_VERSION、CQL 內容（含 include 的 Library）、資料快照、測量期間、
+    近似統計參數、執行日期（只有使用 Now / Today 的 Library）)，任一項不同即為不同的鍵，因此不需要失效處理。
+    多個行程可同時使用：寫入以暫存檔 + os.replace 原子完成，讀取到寫入中或已淘汰的檔案視為未命中；
+    總大小超過 max_size_mb 時依最近使用時間（命中時更新 mtime）淘汰最舊的結果。
+    """
+    
+    def __init__(self, cache_dir: str = '.cql_results', max_size_mb: float = 200):
+        """
+        初始化結果快取
+        
+        Args:
+            cache_dir: 快取目錄
+            max_size_mb: 快取大小上限 (MB)
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+    
+    @staticmethod
+    def key(content: bytes, snapshot: str, measurement_period: tuple, approximate: Optional[Dict] = None,
+            evaluation_date: Optional[str] = None, includes: Sequence[bytes] = ()) -> str:
+        """
+        CQL 原始內容、資料快照（FHIRStore.snapshot_version）、測量期間與近似統計參數的鍵
+        
+        Args:
+            evaluation_date: 執行日期（YYYY-MM-DD；結果依 Now() / Today() 而定的 Library 才傳入，隔天即為不同的鍵）
+            includes: include 的 Library 原始內容
+        """
+        digest = hashlib.sha256()
+        parts = [RESULT_CACHE_VERSION, PARSER_VERSION, snapshot,
+                 measurement_period[0].isoformat(), measurement_period[1].isoformat()]
+        if approximate:
+            parts.append(json.dumps(approximate, sort_keys=True))
+        if evaluation_date:
+            parts.append(f"today={evaluation_date}")
+        for part in parts:
+            digest.update(part.encode('utf-8') + b'\0')
+        digest.update(content)
+        for included in includes:
+            digest.update(b'\0include\0' + hashlib.sha256(included).digest())
+        return digest.hexdigest()[:32]
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """取得快取的結果；未命中時回傳 None"""
+        path = self.cache_dir / f"{key}.json"
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            entry = None
+        except (OSError, ValueError) as e:
+            logger.warning(f"結果快取檔案損毀，將重新執行: {path} ({e})")
+            entry = None
+        
+        if entry is not None:
+            # 更新存取時間，供 LRU 淘汰使用（其他行程可能剛好淘汰此檔案）
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry['result'] if entry is not None else None
+    
+    def put(self, key: str, library: str, result: Dict[str, Any]):
+        """寫入結果（無法序列化或寫入失敗時只記錄警告）"""
+        path = self.cache_dir / f"{key}.json"
+        tmp_path = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'library': library, 'result': result}, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"無法寫入結果快取: {library} ({e})")
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+            return
+        
+        self._evict(keep=path)
+    
+    def size_bytes(self) -> int:
+        """目前快取總大小"""
+        return sum(size for _, _, size in self._entries())
+    
+    def _entries(self):
+        """[(path, mtime, size)]（略過列出後已被其他行程刪除的檔案）"""
+        entries = []
+        for path in self.cache_dir.glob('*.json'):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((path, st.st_mtime, st.st_size))
+        return entries
+    
+    def _evict(self, keep: Optional[Path] = None):
+        """超過大小上限時，依最近使用時間由舊至新刪除結果（以檔案鎖避免多個行程同時淘汰）"""
+        with self._lock, open(self.cache_dir / '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = self._entries()
+            total = sum(size for _, _, size in entries)
+            if total <= self.max_size_bytes:
+                return
+            
+            for path, _, size in sorted(entries, key=lambda entry: entry[1]):
+                if total <= self.max_size_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    continue
+                total -= size
+                logger.info(f"結果快取超過上限，已淘汰: {path.name}")
+    
+    def clear(self):
+        for path in self.cache_dir.glob('*.json'):
+            path.unlink(missing_ok=True)
@@ -0,0 +1,155 @@
+"""
+Result Writer Module
+ESGCQLTester 結果檔的串流寫出：
+先寫出摘要、病患統計與 CQL 指標，再逐筆寫出過濾後的 FHIR 資源（不在記憶體中組成整份 JSON 字串）；
+資源也可以改寫到另一個 gzip 壓縮的 NDJSON 檔（sidecar，每行一筆資源），結果檔只記錄檔名與筆數
+
+    write_results(results, 'esg_cql_results.json')                                       # 與 json.dump(indent=2) 相同
+    write_results(results, 'esg_cql_results.json', 'esg_cql_results.resources.ndjson.gz')  # 資源寫到 sidecar
+"""
+
+import os
+import gzip
+import json
+import logging
+from typing import Any, Dict, Iterable, Iterator, TextIO, Union
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 結果中的原始資源區段（{資源類型: [資源...]}），最後逐筆寫出
+RESOURCE_SECTION = 'filtered_data'
+# 資源改寫到 sidecar 時，結果檔中記錄 sidecar 的欄位
+SIDECAR_SECTION = 'filtered_data_sidecar'
+SIDECAR_FORMAT = 'ndjson+gzip'
+SIDECAR_COMPRESS_LEVEL = 6
+
+
+def write_results(results: Dict[str, Any], path: Union[str, Path],
+                  sidecar_path: Union[str, Path, None] = None, indent: int = 2) -> Dict[str, int]:
+    """
+    串流寫出結果檔
+    
+    Args:
+        results: 結果（RESOURCE_SECTION 的各資源類型可為 list 或任意 iterable，只走訪一次）
+        path: 結果 JSON 檔路徑
+        sidecar_path: 資源改寫到此 gzip NDJSON 檔（None = 直接寫在結果檔中）
+        indent: JSON 縮排空白數
+    
+    Returns:
+        各資源類型寫出的筆數
+    
+    兩個檔案都以暫存檔 + os.replace 原子寫入，寫入失敗時保留上次的結果檔。
+    """
+    path = Path(path)
+    sidecar_path = Path(sidecar_path) if sidecar_path else None
+    resources = results.get(RESOURCE_SECTION)
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    tmp_sidecar = sidecar_path.with_name(f'.{sidecar_path.name}.{os.getpid()}.tmp') if sidecar_path else None
+    
+    try:
+        counts: Dict[str, int] = {}
+        if sidecar_path is not None and resources is not None:
+            with gzip.open(tmp_sidecar, 'wt', encoding='utf-8', compresslevel=SIDECAR_COMPRESS_LEVEL) as f:
+                counts = _write_ndjson(f, resources)
+        
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            writer = _JSONObjectWriter(f, indent)
+            # 摘要與指標在前，資源區段最後
+            for key, value in results.items():
+                if key != RESOURCE_SECTION:
+                    writer.member(key, value)
+            if resources is not None:
+                if sidecar_path is not None:
+                    writer.member(SIDECAR_SECTION, {
+                        'path': sidecar_path.name,
+                        'format': SIDECAR_FORMAT,
+                        'resource_counts': counts,
+                    })
+                else:
+                    counts = writer.resource_section(RESOURCE_SECTION, resources)
+            writer.close()
+        
+        if tmp_sidecar is not None and tmp_sidecar.exists():
+            os.replace(tmp_sidecar, sidecar_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        for tmp in (tmp_path, tmp_sidecar):
+            if tmp is not None:
+                try:
+                    tmp.unlink()
+                except OSError:
+                    pass
+        raise
+    
+    logger.info(f"結果已寫出: {path}（資源 {sum(counts.values())} 筆"
+                f"{f'，sidecar: {sidecar_path.name}' if sidecar_path is not None and resources is not None else ''}）")
+    return counts
+
+
+def read_sidecar(path: Union[str, Path]) -> Iterator[Dict[str, Any]]:
+    """逐筆讀回 sidecar 中的資源（資源類型見各資源的 resourceType）"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _write_ndjson(f: TextIO, resources: Dict[str, Iterable[Dict]]) -> Dict[str, int]:
+    """每行一筆資源（精簡格式）；回傳各資源類型筆數"""
+    counts = {}
+    for resource_type, items in resources.items():
+        count = 0
+        for resource in items:
+            f.write(json.dumps(resource, ensure_ascii=False, separators=(',', ':')))
+            f.write('\n')
+            count += 1
+        counts[resource_type] = count
+    return counts
+
+
+class _JSONObjectWriter:
+    """
+    逐個成員寫出最外層 JSON 物件，輸出與 json.dump(obj, indent=indent, ensure_ascii=False) 相同
+    
+    一般成員整個以 json.dumps 編碼；資源區段逐筆編碼後寫出
+    """
+    
+    def __init__(self, f: TextIO, indent: int):
+        self.f = f
+        self.indent = indent
+        self.empty = True
+    
+    def _pad(self, depth: int) -> str:
+        return '\n' + ' ' * (self.indent * depth)
+    
+    def _encode(self, value: Any, depth: int) -> str:
+        """編碼值並將內部換行縮排到 depth 層（JSON 字串中的換行已跳脫，可直接取代）"""
+        return json.dumps(value, ensure_ascii=False, indent=self.indent).replace('\n', self._pad(depth))
+    
+    def _key(self, key: str):
+        self.f.write(('{' if self.empty else ',') + self._pad(1) + json.dumps(key, ensure_ascii=False) + ': ')
+        self.empty = False
+    
+    def member(self, key: str, value: Any):
+        self._key(key)
+        self.f.write(self._encode(value, 1))
+    
+    def resource_section(self, key: str, resources: Dict[str, Iterable[Dict]]) -> Dict[str, int]:
+        """{資源類型: [資源...]} 逐筆寫出；回傳各資源類型筆數"""
+        self._key(key)
+        counts = {}
+        for resource_type, items in resources.items():
+            self.f.write(('{' if not counts else ',') + self._pad(2) +
+                         json.dumps(resource_type, ensure_ascii=False) + ': ')
+            count = 0
+            for resource in items:
+                self.f.write(('[' if not count else ',') + self._pad(3) + self._encode(resource, 3))
+                count += 1
+            self.f.write(self._pad(2) + ']' if count else '[]')
+            counts[resource_type] = count
+        self.f.write(self._pad(1) + '}' if counts else '{}')
+        return counts
+    
+    def close(self):
+        self.f.write(self._pad(0) + '}' if not self.empty else '{}')
@@ -0,0 +1,14 @@
+"""
+pytest 共用設定：測試直接匯入程式目錄中的模組（與 main.py 相同的匯入方式）
+"""
+
+import sys
+import logging
+from pathlib import Path
+
+PROGRAM_DIR = Path(__file__).resolve().parent.parent
+if str(PROGRAM_DIR) not in sys.path:
+    sys.path.insert(0, str(PROGRAM_DIR))
+
+# 測試只看結果，不需要執行過程的日誌
+logging.getLogger().setLevel(logging.WARNING)
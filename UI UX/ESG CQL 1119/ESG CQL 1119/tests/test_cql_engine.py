@@ -0,0 +1,200 @@
+"""
+cql_engine 執行測試：以手工建立的小型資料驗證母體計數，
+並確認 ESG 三個 Library 的摘要與改寫前（逐筆模擬計算的 cql_processor）的數字一致。
+"""
+
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from cql_processor import CQLExecutor
+
+PROGRAM_DIR = Path(__file__).resolve().parent.parent
+CORPUS_DIR = PROGRAM_DIR.parents[2] / 'cql'
+MEASUREMENT_PERIOD = (datetime(2025, 1, 1), datetime(2025, 12, 31, 23, 59, 59))
+
+NHI_PROCEDURE = 'http://www.nhi.gov.tw/codes'
+ATC = 'http://www.whocc.no/atc'
+ACT_CODE = 'http://terminology.hl7.org/CodeSystem/v3-ActCode'
+OBSERVATION_CATEGORY = 'http://terminology.hl7.org/CodeSystem/observation-category'
+
+
+def _concept(system, code, display=None):
+    return {'coding': [{'system': system, 'code': code, 'display': display or code}]}
+
+
+def _by_type(resources):
+    fhir_data = {}
+    for resource in resources:
+        fhir_data.setdefault(resource['resourceType'], []).append(resource)
+    return fhir_data
+
+
+def _execute(path, fhir_data):
+    result = CQLExecutor([str(path)]).execute_all(fhir_data, MEASUREMENT_PERIOD)[path.stem]
+    assert not result.get('definition_errors'), result.get('definition_errors')
+    return result
+
+
+# 指標 15-2：全人工膝關節置換術後 90 日內置換物深部感染
+KNEE_ARTHROPLASTY = CORPUS_DIR / 'Indicator_15_2_Total_Knee_Arthroplasty_90Day_Deep_Infection_3249.cql'
+
+def _procedure(procedure_id, patient_id, code, performed, status='completed'):
+    return {'resourceType': 'Procedure', 'id': procedure_id, 'status': status,
+            'code': _concept(NHI_PROCEDURE, code), 'subject': {'reference': f'Patient/{patient_id}'},
+            'performedDateTime': performed}
+
+
+def _knee_bundle():
+    return _by_type([
+        # p1：術後 50 天感染手術 → 分子
+        _procedure('tka1', 'p1', '64164B', '2025-01-10T09:00:00'),
+        _procedure('inf1', 'p1', '64053B', '2025-03-01T09:00:00'),
+        # p2：術後 134 天，超過 90 天 → 不計
+        _procedure('tka2', 'p2', '97806A', '2025-02-01T09:00:00'),
+        _procedure('inf2', 'p2', '64198B', '2025-06-15T09:00:00'),
+        # p3：64164B 與 64198B 同一時間申報 → 排除
+        _procedure('tka3', 'p3', '64164B', '2025-04-01T10:00:00'),
+        _procedure('inf3', 'p3', '64198B', '2025-04-01T10:00:00'),
+        # p4：同一時間但置換術為 97806A，不適用排除 → 分子
+        _procedure('tka4', 'p4', '97806A', '2025-05-01T10:00:00'),
+        _procedure('inf4', 'p4', '64198B', '2025-05-01T10:00:00'),
+        # p5：第 90 天（區間含端點）→ 分子
+        _procedure('tka5', 'p5', '64169B', '2025-07-01T08:00:00'),
+        _procedure('inf5', 'p5', '64053B', '2025-09-29T08:00:00'),
+        # p6：未完成的置換術 → 不在分母，其感染手術也沒有對應的置換術
+        _procedure('tka6', 'p6', '64164B', '2025-08-01T08:00:00', status='in-progress'),
+        _procedure('inf6', 'p6', '64053B', '2025-08-20T08:00:00'),
+    ])
+
+
+def test_knee_arthroplasty_90_day_window_and_same_day_exclusion():
+    result = _execute(KNEE_ARTHROPLASTY, _knee_bundle())
+    definitions = result['definitions']
+    assert definitions['Denominator'] == 5
+    assert definitions['Numerator'] == 3
+    assert definitions['Infection Rate'] == pytest.approx(60.0)
+    assert sorted(definitions['Deep Infection After TKA']) == ['Procedure/inf1', 'Procedure/inf4', 'Procedure/inf5']
+
+
+def test_knee_arthroplasty_without_denominator():
+    result = _execute(KNEE_ARTHROPLASTY, {})
+    assert result['definitions']['Denominator'] == 0
+    assert result['definitions']['Infection Rate'] is None
+
+
+# ESG：與改寫前的摘要數字比對
+
+def _esg_bundle():
+    resources = [{'resourceType': 'Patient', 'id': f'p{index}', 'gender': ('male', 'female')[index % 2],
+                  'birthDate': f'19{50 + index * 10}-01-01'} for index in range(1, 5)]
+    
+    def encounter(encounter_id, patient_id, encounter_class, start, end):
+        return {'resourceType': 'Encounter', 'id': encounter_id, 'status': 'finished',
+                'class': {'system': ACT_CODE, 'code': encounter_class},
+                'subject': {'reference': f'Patient/{patient_id}'}, 'period': {'start': start, 'end': end}}
+    
+    def medication(resource_type, resource_id, patient_id, encounter_id, code, when):
+        resource = {'resourceType': resource_type, 'id': resource_id, 'medicationCodeableConcept': _concept(ATC, code),
+                    'subject': {'reference': f'Patient/{patient_id}'}}
+        if resource_type == 'MedicationRequest':
+            resource.update(status='active', intent='order', authoredOn=when,
+                            encounter={'reference': f'Encounter/{encounter_id}'})
+        else:
+            resource.update(status='completed', effectiveDateTime=when,
+                            context={'reference': f'Encounter/{encounter_id}'})
+        return resource
+    
+    def observation(observation_id, patient_id, code, category=None):
+        resource = {'resourceType': 'Observation', 'id': observation_id, 'status': 'final', 'code': code,
+                    'subject': {'reference': f'Patient/{patient_id}'}, 'effectiveDateTime': '2025-03-02T08:00:00+08:00'}
+        if category:
+            resource['category'] = [_concept(OBSERVATION_CATEGORY, category)]
+        return resource
+    
+    def document(document_id, patient_id, encounter_id, when):
+        return {'resourceType': 'DocumentReference', 'id': document_id, 'status': 'current',
+                'type': _concept('http://loinc.org', '18842-5', 'Discharge summary'),
+                'subject': {'reference': f'Patient/{patient_id}'}, 'date': when,
+                'context': {'encounter': [{'reference': f'Encounter/{encounter_id}'}]}}
+    
+    resources += [
+        encounter('e1', 'p1', 'IMP', '2025-03-01T08:00:00+08:00', '2025-03-05T10:00:00+08:00'),
+        encounter('e2', 'p2', 'AMB', '2025-04-10T09:00:00+08:00', '2025-04-10T09:30:00+08:00'),
+        encounter('e3', 'p3', 'IMP', '2025-05-10T08:00:00+08:00', '2025-05-12T08:00:00+08:00'),
+        encounter('e4', 'p4', 'EMER', '2025-06-01T20:00:00+08:00', '2025-06-01T23:00:00+08:00'),
+        encounter('e5', 'p1', 'AMB', '2025-07-01T09:00:00+08:00', '2025-07-01T09:20:00+08:00'),
+        medication('MedicationRequest', 'mr1', 'p1', 'e1', 'J01CA04', '2025-03-01'),
+        medication('MedicationRequest', 'mr2', 'p3', 'e3', 'J01DD04', '2025-05-10'),
+        medication('MedicationRequest', 'mr3', 'p2', 'e2', 'C07AB02', '2025-04-10'),
+        medication('MedicationAdministration', 'ma1', 'p1', 'e1', 'J01CA04', '2025-03-01T10:00:00+08:00'),
+        medication('MedicationAdministration', 'ma2', 'p1', 'e1', 'J01CA04', '2025-03-02T10:00:00+08:00'),
+        medication('MedicationAdministration', 'ma3', 'p3', 'e3', 'J01DD04', '2025-05-10T12:00:00+08:00'),
+        observation('o1', 'p1', _concept('http://loinc.org', '2345-7', 'Glucose'), 'laboratory'),
+        observation('o2', 'p3', _concept('http://loinc.org', '718-7', 'Hemoglobin'), 'laboratory'),
+        observation('o3', 'p2', _concept('http://loinc.org', '8867-4', 'Heart rate'), 'vital-signs'),
+        observation('o4', 'p2', _concept('http://example.org/esg', 'waste-weight', 'Medical waste weight')),
+        observation('o5', 'p4', _concept('http://example.org/esg', 'sharps', 'Sharps waste container')),
+        {'resourceType': 'Procedure', 'id': 'pr1', 'status': 'completed',
+         'code': _concept('http://snomed.info/sct', '80146002', 'Appendectomy'),
+         'subject': {'reference': 'Patient/p1'}, 'performedDateTime': '2025-03-02T13:00:00+08:00'},
+        document('d1', 'p1', 'e1', '2025-03-05T10:00:00+08:00'),
+        document('d2', 'p3', 'e3', '2025-05-12T08:00:00+08:00'),
+    ]
+    return _by_type(resources)
+
+
+# 改寫前的 cql_processor 對 _esg_bundle() 的輸出
+PRE_SERIES = {
+    'Antibiotic_Utilization': {
+        'total_patients': 4, 'total_encounters': 5, 'total_antibiotic_orders': 3,
+        'total_antibiotic_administrations': 3, 'antibiotic_use_patient_count': 2,
+        'antibiotic_use_rate_percent': 50.0, 'total_bed_days': 6, 'total_dot': 3, 'total_ddd': 4.5,
+        'ddd_per_100_bed_days': 75.0,
+    },
+    'EHR_Adoption_Rate': {
+        'total_patients': 4, 'total_encounters': 5, 'total_ehr_documents': 2,
+        'total_electronic_prescriptions': 3, 'total_electronic_lab_results': 0,
+        'total_electronic_procedures': 1, 'ehr_adoption_rate_encounter_percent': 0.0,
+        'electronic_prescription_rate_percent': 60.0, 'electronic_lab_results_rate_percent': 0.0,
+        'himss_emram_level': 2,
+    },
+    'Waste': {
+        'total_patients': 4, 'total_encounters': 5, 'total_waste_records': 2, 'total_waste_kg': 12.5,
+        'recyclable_waste_kg': 3.75, 'hazardous_waste_kg': 1.875, 'waste_per_encounter_kg': 2.5,
+        'recycling_rate_percent': 30.0,
+    },
+}
+
+# 刻意修正而與改寫前不同的欄位：改寫前檢驗數比對 category 本身的 'code'（R4 資料恆為 0），
+# 文件與就醫的連結只認 STU3 的 context.reference（R4 的 context.encounter 恆為 0%）
+CORRECTED = {
+    'EHR_Adoption_Rate': {
+        'total_electronic_lab_results': 2, 'electronic_lab_results_rate_percent': 40.0,
+        'ehr_adoption_rate_encounter_percent': 40.0, 'himss_emram_level': 3,
+    },
+}
+
+
+@pytest.mark.parametrize('name', sorted(PRE_SERIES))
+def test_esg_summary_matches_pre_series_numbers(name):
+    result = _execute(PROGRAM_DIR / f'{name}.cql', _esg_bundle())
+    expected = dict(PRE_SERIES[name], **CORRECTED.get(name, {}))
+    assert {key: result[key] for key in expected} == expected
+    assert result['data_status'] == 'FHIR 資料已載入'
+
+
+def test_esg_definitions_on_hand_built_bundle():
+    fhir_data = _esg_bundle()
+    antibiotic = _execute(PROGRAM_DIR / 'Antibiotic_Utilization.cql', fhir_data)['definitions']
+    assert antibiotic['Total Patient Count'] == 4
+    assert antibiotic['Antibiotic Use Patient Count'] == 2
+    assert antibiotic['Antibiotic Use Rate (%)'] == pytest.approx(50.0)
+    assert antibiotic['Total Bed Days'] == 6
+    
+    ehr = _execute(PROGRAM_DIR / 'EHR_Adoption_Rate.cql', fhir_data)['definitions']
+    assert ehr['Total Encounter Count'] == 5
+    assert ehr['Encounters with EHR Count'] == 2
+    assert ehr['EHR Adoption Rate - Encounter Level (%)'] == pytest.approx(40.0)
+    assert ehr['Total Electronic Lab Results'] == 2
@@ -0,0 +1,131 @@
+"""
+cql_parser 測試：專案 cql/ 目錄中的每個檔案都必須能解析並執行，否則列於下方的已知失敗清單（附原因）；
+另測試 CQLASTCache 的磁碟快取往返。已知失敗的檔案改好後 xfail(strict) 會失敗，提醒將其移出清單。
+"""
+
+import json
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from cql_parser import CQLASTCache, load_library, parse_cql
+from cql_processor import CQLExecutor
+
+PROGRAM_DIR = Path(__file__).resolve().parent.parent
+CORPUS_DIR = PROGRAM_DIR.parents[2] / 'cql'
+MEASUREMENT_PERIOD = (datetime(2025, 1, 1), datetime(2025, 12, 31, 23, 59, 59))
+
+# 只有 SQL 範例、沒有任何 CQL define 的檔案（執行時同樣略過）
+SQL_ONLY = {
+    'Indicator_03_2_Same_Hospital_Lipid_Lowering_Overlap_1711',
+    'Indicator_03_3_Same_Hospital_Antidiabetic_Overlap_1712',
+    'Indicator_03_4_Same_Hospital_Antipsychotic_Overlap_1726',
+    'Indicator_03_5_Same_Hospital_Antidepressant_Overlap_1727',
+    'Indicator_03_6_Same_Hospital_Sedative_Overlap_1728',
+    'Indicator_03_7_Same_Hospital_Antithrombotic_Overlap_3375',
+    'Indicator_03_8_Same_Hospital_Prostate_Overlap_3376',
+    'Indicator_03_9_Cross_Hospital_Antihypertensive_Overlap_1713',
+    'Indicator_03_10_Cross_Hospital_Lipid_Lowering_Overlap_1714',
+    'Indicator_03_11_Cross_Hospital_Antidiabetic_Overlap_1715',
+    'Indicator_03_12_Cross_Hospital_Antipsychotic_Overlap_1729',
+    'Indicator_03_13_Cross_Hospital_Antidepressant_Overlap_1730',
+    'Indicator_03_14_Cross_Hospital_Sedative_Overlap_1731',
+    'Indicator_03_15_Cross_Hospital_Antithrombotic_Overlap_3377',
+    'Indicator_03_16_Cross_Hospital_Prostate_Overlap_3378',
+    'Indicator_06_Pediatric_Asthma_ED_Rate_1315Q_1317Y',
+    'Indicator_08_Same_Day_Same_Disease_Revisit_Rate_1322',
+}
+
+# 部分 define 無法解析的檔案
+SQL_DEFINES = 'define 內容為 SQL 查詢（select / from），非 CQL 運算式'
+PARSE_FAILURES = {
+    'Indicator_07_Diabetes_HbA1c_Testing_Rate_109_01Q_110_01Y':
+        SQL_DEFINES + '；統計 define 使用 SQL 函式語法',
+    'Indicator_09_Unplanned_14Day_Readmission_Rate_1077_01Q_1809Y': SQL_DEFINES + '；含 join / group by',
+    'Indicator_10_Inpatient_3Day_ED_After_Discharge_108_01': SQL_DEFINES + '；含 join / group by',
+    'Indicator_11_1_Overall_Cesarean_Section_Rate_1136_01': SQL_DEFINES + '；含 join / group by',
+    'Indicator_11_2_Cesarean_Section_Rate_Patient_Requested_1137_01': SQL_DEFINES + '；含 join / group by',
+    'Indicator_11_3_Cesarean_Section_Rate_With_Indication_1138_01': SQL_DEFINES + '；含 join',
+    'Indicator_12_Clean_Surgery_Antibiotic_Over_3Days_Rate_1155': SQL_DEFINES + '；含 join',
+}
+
+# 可以解析但執行失敗的檔案
+EVALUATION_FAILURES = dict(PARSE_FAILURES, **{
+    'Indicator_13_Average_ESWL_Utilization_Times_20_01Q_1804Y':
+        "'id Patient' 不是合法的 CQL（應為 Patient.id），解析為以 id 為來源的查詢，執行時為未定義的識別字: id",
+})
+
+
+def _corpus(known_failures):
+    params = []
+    for path in sorted(CORPUS_DIR.glob('*.cql')):
+        if path.stem in SQL_ONLY:
+            marks = pytest.mark.skip(reason='只有 SQL 範例，沒有 CQL define')
+        elif path.stem in known_failures:
+            marks = pytest.mark.xfail(reason=known_failures[path.stem], strict=True)
+        else:
+            marks = ()
+        params.append(pytest.param(path, marks=marks, id=path.stem))
+    return params
+
+
+def test_corpus_is_listed():
+    names = {path.stem for path in CORPUS_DIR.glob('*.cql')}
+    assert names, CORPUS_DIR
+    # 清單中的檔案更名或刪除時一併更新清單
+    assert SQL_ONLY <= names
+    assert set(EVALUATION_FAILURES) <= names
+
+
+@pytest.mark.parametrize('path', _corpus(PARSE_FAILURES))
+def test_corpus_file_parses(path):
+    library = load_library(str(path))
+    assert library['name'] == path.stem
+    assert library['definitions']
+    failed = {name: definition['error'] for name, definition in library['definitions'].items()
+              if 'error' in definition}
+    assert not failed
+
+
+@pytest.mark.parametrize('path', _corpus(EVALUATION_FAILURES))
+def test_corpus_file_evaluates(path):
+    # 一位病人：Patient context 的 Library 也會執行每個 define
+    fhir_data = {'Patient': [{'resourceType': 'Patient', 'id': 'p1', 'gender': 'female', 'birthDate': '1980-01-01'}]}
+    result = CQLExecutor([str(path)]).execute_all(fhir_data, MEASUREMENT_PERIOD)[path.stem]
+    assert 'error' not in result
+    assert not result['definition_errors']
+
+
+def test_ast_cache_round_trip(tmp_path):
+    path = PROGRAM_DIR / 'Antibiotic_Utilization.cql'
+    content = path.read_bytes()
+    parsed = parse_cql(content.decode('utf-8-sig'))
+    
+    cache = CQLASTCache(str(tmp_path))
+    assert cache.get_or_parse(content, path.name) == parsed
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert len(list(tmp_path.glob('*.json'))) == 1
+    
+    # 新的快取物件從磁碟載入，與重新解析的 AST 相同（JSON 可表示的結構）
+    reloaded = CQLASTCache(str(tmp_path))
+    assert load_library(str(path), reloaded) == json.loads(json.dumps(parsed))
+    assert (reloaded.hits, reloaded.misses) == (1, 0)
+    
+    # 內容變更即為新的鍵
+    changed = content + b'\n// changed\n'
+    reloaded.get_or_parse(changed, path.name)
+    assert reloaded.misses == 1
+    assert len(list(tmp_path.glob('*.json'))) == 2
+
+
+def test_ast_cache_ignores_corrupt_entry(tmp_path):
+    path = PROGRAM_DIR / 'Waste.cql'
+    content = path.read_bytes()
+    cache = CQLASTCache(str(tmp_path))
+    (tmp_path / f"{cache.content_key(content)}.json").write_text('{not json', encoding='utf-8')
+    
+    assert cache.get_or_parse(content, path.name) == parse_cql(content.decode('utf-8-sig'))
+    assert cache.misses == 1
+    # 損毀的檔案已被覆寫
+    assert CQLASTCache(str(tmp_path)).load(cache.content_key(content)) is not None
@@ -0,0 +1,152 @@
+"""
+QueryPlanner 的 _elements 投影測試：以伺服器投影後的資料執行 ESG 三個 Library（CQL define 與
+_execute_* 摘要），結果必須與完整資料相同。SUMMARY_ELEMENT_REQUIREMENTS 漏列摘要讀取的欄位時此測試會失敗。
+"""
+
+import json
+from datetime import datetime
+from pathlib import Path
+
+from cql_engine import CHOICE_TYPES
+from cql_parser import load_library
+from cql_processor import CQLExecutor
+from query_planner import QueryPlanner, DISPLAY_RESOURCE_TYPES, SUMMARY_ELEMENT_REQUIREMENTS
+
+PROGRAM_DIR = Path(__file__).resolve().parent.parent
+ESG_LIBRARIES = ['Antibiotic_Utilization', 'EHR_Adoption_Rate', 'Waste']
+MEASUREMENT_PERIOD = (datetime(1900, 1, 1), datetime(2100, 12, 31))
+# 伺服器不論 _elements 都會回傳的元素
+MANDATORY_ELEMENTS = {'resourceType', 'id', 'meta'}
+# 隨執行時間變動的欄位
+VOLATILE_FIELDS = {'CalculationDate', 'execution_time_seconds', 'retrieve_cache'}
+
+
+def _concept(system, code, display=None, text=None):
+    concept = {'coding': [{'system': system, 'code': code, 'display': display or code}]}
+    if text:
+        concept['text'] = text
+    return concept
+
+
+def _fixture():
+    """兩位病人的完整資源（含摘要與CQL不使用的欄位，投影後會被裁掉）"""
+    narrative = {'status': 'generated', 'div': '<div xmlns="http://www.w3.org/1999/xhtml">...</div>'}
+    resources = []
+    for index, patient_id in enumerate(('p1', 'p2')):
+        resources.append({
+            'resourceType': 'Patient', 'id': patient_id, 'text': narrative,
+            'name': [{'family': f'Test{index}', 'given': ['A']}], 'gender': ('male', 'female')[index],
+            'birthDate': f'19{60 + index}-05-01', 'address': [{'city': 'Taipei', 'state': 'TW'}],
+            'telecom': [{'system': 'phone', 'value': '02-0000-0000'}],
+        })
+    resources += [
+        {'resourceType': 'Encounter', 'id': 'e1', 'status': 'finished', 'text': narrative,
+         'class': {'system': 'http://terminology.hl7.org/CodeSystem/v3-ActCode', 'code': 'IMP'},
+         'type': [_concept('http://snomed.info/sct', '183452005', 'Emergency hospital admission')],
+         'subject': {'reference': 'Patient/p1'},
+         'period': {'start': '2025-03-01T08:00:00+08:00', 'end': '2025-03-05T10:00:00+08:00'},
+         'serviceProvider': {'reference': 'Organization/o1'}},
+        {'resourceType': 'Encounter', 'id': 'e2', 'status': 'finished',
+         'class': {'system': 'http://terminology.hl7.org/CodeSystem/v3-ActCode', 'code': 'AMB'},
+         'subject': {'reference': 'Patient/p2'},
+         'period': {'start': '2025-04-10T09:00:00+08:00', 'end': '2025-04-10T09:30:00+08:00'}},
+        {'resourceType': 'MedicationRequest', 'id': 'mr1', 'status': 'active', 'intent': 'order',
+         'medicationCodeableConcept': _concept('http://www.whocc.no/atc', 'J01CA04', 'amoxicillin'),
+         'subject': {'reference': 'Patient/p1'}, 'encounter': {'reference': 'Encounter/e1'},
+         'authoredOn': '2025-03-01T09:00:00+08:00', 'dosageInstruction': [{'text': '500 mg TID'}]},
+        {'resourceType': 'MedicationAdministration', 'id': 'ma1', 'status': 'completed',
+         'medicationCodeableConcept': _concept('http://www.whocc.no/atc', 'J01CA04', 'amoxicillin'),
+         'subject': {'reference': 'Patient/p1'}, 'context': {'reference': 'Encounter/e1'},
+         'effectiveDateTime': '2025-03-01T10:00:00+08:00', 'dosage': {'text': '500 mg'}},
+        {'resourceType': 'Observation', 'id': 'o1', 'status': 'final',
+         'category': [_concept('http://terminology.hl7.org/CodeSystem/observation-category', 'laboratory')],
+         'code': _concept('http://loinc.org', '2345-7', 'Glucose'),
+         'subject': {'reference': 'Patient/p1'}, 'effectiveDateTime': '2025-03-02T08:00:00+08:00',
+         'valueQuantity': {'value': 98, 'unit': 'mg/dL'}},
+        {'resourceType': 'Observation', 'id': 'o2', 'status': 'final',
+         'code': _concept('http://example.org/esg', 'waste-weight', 'Medical waste weight', 'Waste weight'),
+         'subject': {'reference': 'Patient/p2'}, 'effectiveDateTime': '2025-04-10T09:10:00+08:00',
+         'valueQuantity': {'value': 2.1, 'unit': 'kg'}},
+        {'resourceType': 'Procedure', 'id': 'pr1', 'status': 'completed',
+         'code': _concept('http://snomed.info/sct', '80146002', 'Appendectomy'),
+         'subject': {'reference': 'Patient/p1'}, 'performedDateTime': '2025-03-02T13:00:00+08:00'},
+        {'resourceType': 'DocumentReference', 'id': 'd1', 'status': 'current',
+         'type': _concept('http://loinc.org', '18842-5', 'Discharge summary'),
+         'subject': {'reference': 'Patient/p1'}, 'date': '2025-03-05T10:00:00+08:00',
+         'context': {'encounter': [{'reference': 'Encounter/e1'}]},
+         'content': [{'attachment': {'contentType': 'text/plain', 'data': 'dGVzdA=='}}]},
+        {'resourceType': 'DiagnosticReport', 'id': 'dr1', 'status': 'final',
+         'category': [_concept('http://loinc.org', 'LP29684-5', 'Radiology')],
+         'code': _concept('http://loinc.org', '36643-5', 'Chest X-ray'),
+         'subject': {'reference': 'Patient/p1'}, 'effectiveDateTime': '2025-03-02T11:00:00+08:00',
+         'conclusion': 'No acute findings'},
+    ]
+    fhir_data = {}
+    for resource in resources:
+        fhir_data.setdefault(resource['resourceType'], []).append(resource)
+    return fhir_data
+
+
+def _project(resource, elements):
+    """模擬伺服器的 _elements：只保留列出的最上層元素（選擇型別以基本名稱表示）與必要元素"""
+    keep = MANDATORY_ELEMENTS | set(elements)
+    choices = {base + type_name for base in keep for type_name in CHOICE_TYPES.get(base, ())}
+    return {key: value for key, value in resource.items() if key in keep or key in choices}
+
+
+def _run(fhir_data):
+    files = [str(PROGRAM_DIR / f'{name}.cql') for name in ESG_LIBRARIES]
+    results = CQLExecutor(files).execute_all(fhir_data, MEASUREMENT_PERIOD)
+    # 以 JSON 正規化（日期、Interval 等）後比較
+    return json.loads(json.dumps(_strip(results), default=str, sort_keys=True))
+
+
+def _strip(value):
+    if isinstance(value, dict):
+        return {key: _strip(item) for key, item in value.items() if key not in VOLATILE_FIELDS}
+    if isinstance(value, list):
+        return [_strip(item) for item in value]
+    return value
+
+
+def _plan(saved_types=()):
+    libraries = {name: load_library(str(PROGRAM_DIR / f'{name}.cql')) for name in ESG_LIBRARIES}
+    return QueryPlanner(libraries, MEASUREMENT_PERIOD, project_elements=True, saved_types=saved_types).plan()
+
+
+def test_projected_fixture_gives_same_results():
+    fhir_data = _fixture()
+    plan = _plan()
+    projected = {
+        resource_type: [_project(resource, plan[resource_type]['_elements'].split(','))
+                        if '_elements' in plan.get(resource_type, {}) else resource
+                        for resource in resources]
+        for resource_type, resources in fhir_data.items()
+    }
+    # 確認投影確實裁掉了欄位，比對才有意義
+    assert projected != fhir_data
+    
+    full = _run(fhir_data)
+    assert _run(projected) == full
+    # 摘要讀取的欄位確實有值（否則兩邊都為 0 也會相等）
+    assert full['Antibiotic_Utilization']['antibiotic_use_patient_count'] == 1
+    assert full['Antibiotic_Utilization']['total_bed_days'] == 3
+    assert full['EHR_Adoption_Rate']['total_electronic_lab_results'] == 1
+    assert full['EHR_Adoption_Rate']['ehr_adoption_rate_encounter_percent'] == 50.0
+    assert full['Waste']['total_waste_records'] == 1
+
+
+def test_summary_and_display_types_are_not_filtered():
+    plan = _plan()
+    for requirements in SUMMARY_ELEMENT_REQUIREMENTS.values():
+        for resource_type in requirements:
+            assert set(plan[resource_type]) <= {'_elements'}, resource_type
+    for resource_type in DISPLAY_RESOURCE_TYPES:
+        assert set(plan[resource_type]) <= {'_elements'}, resource_type
+
+
+def test_saved_types_are_fetched_in_full():
+    plan = _plan(saved_types=['DiagnosticReport', 'Observation'])
+    assert plan['DiagnosticReport'] == {}
+    assert plan['Observation'] == {}
+    assert '_elements' in plan['Encounter']
@@ -4,8 +4,8 @@ CGMH測試資料統一上傳腳本
 """
 
 import json
-import requests
-import time
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 # FHIR伺服器設定
 FHIR_SERVER = "https://emr-smart.appx.com.tw/v/r4/fhir"
@@ -92,7 +92,7 @@ def upload_bundle(bundle_file, bundle_name):
     
     # 上傳Bundle
     try:
-        response = requests.post(
+        response = get_scheduler().post(
             FHIR_SERVER,
             json=bundle,
             headers={
@@ -146,11 +146,7 @@ def main():
             success_count += 1
         else:
             failed_bundles.append(bundle_info['name'])
-        
-        # 每次上傳後等待2秒
-        if i < len(BUNDLES):
-            print("\n等待2秒...")
-            time.sleep(2)
+        # 上傳間隔由共用排程器控制（速率限制、429/503 依 Retry-After 重試）
     
     # 總結
     print("\n" + "=" * 80)
@@ -162,6 +158,7 @@ def main():
         print("失敗清單:")
         for name in failed_bundles:
             print(f"  - {name}")
+    print(f"請求排程: {get_scheduler().format_stats()}")
     print("=" * 80)
 
 if __name__ == "__main__":
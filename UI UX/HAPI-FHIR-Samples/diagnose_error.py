@@ -5,7 +5,8 @@
 """
 
 import json
-import requests
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 FHIR_SERVER = "https://thas.mohw.gov.tw/v/r4/fhir"
 
@@ -38,7 +39,7 @@ def diagnose_resource(bundle_file, resource_index=1):
     }
     
     try:
-        response = requests.put(url, json=resource, headers=headers)
+        response = get_scheduler().put(url, json=resource, headers=headers)
         
         if response.status_code == 200 or response.status_code == 201:
             print(f"✅ 成功上傳")
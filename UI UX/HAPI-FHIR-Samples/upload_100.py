@@ -1,5 +1,7 @@
 import requests
 import json
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 print("開始上傳 100 筆台灣在地化傳染病數據到 emr-smart...")
 
@@ -21,7 +23,7 @@ print(f"\n正在上傳到: {url}")
 print("這將覆蓋現有的 TW00001-TW00100 病人資料...")
 
 try:
-    response = requests.post(url, json=bundle, headers=headers, timeout=120)
+    response = get_scheduler().post(url, json=bundle, headers=headers, timeout=120)
     
     print(f"\n上傳結果:")
     print(f"狀態碼: {response.status_code}")
@@ -1,5 +1,7 @@
 import requests
 import json
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 print("📤 開始上傳 49 筆抗生素使用數據到 emr-smart...")
 
@@ -22,7 +24,7 @@ print(f"\n正在上傳到: {url}")
 print("這將覆蓋現有的 TW00201-TW00249 資料...")
 
 try:
-    response = requests.post(url, json=bundle, headers=headers, timeout=120)
+    response = get_scheduler().post(url, json=bundle, headers=headers, timeout=120)
     
     print(f"\n上傳結果:")
     print(f"狀態碼: {response.status_code}")
@@ -2,8 +2,9 @@
 上傳3個簡單的糖尿病患者到FHIR server
 """
 
-import requests
 import json
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 FHIR_SERVER = "https://emr-smart.appx.com.tw/v/r4/fhir"
 
@@ -14,7 +15,7 @@ with open('diabetes_simple_3.json', 'r', encoding='utf-8') as f:
 print(f"📤 上傳 {len(bundle['entry'])} 個資源到FHIR server...")
 
 # 上傳
-response = requests.post(FHIR_SERVER, json=bundle, headers={
+response = get_scheduler().post(FHIR_SERVER, json=bundle, headers={
     'Content-Type': 'application/fhir+json'
 })
 
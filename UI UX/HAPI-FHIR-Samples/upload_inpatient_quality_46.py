@@ -6,7 +6,8 @@
 """
 
 import json
-import requests
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 FHIR_SERVER = "https://emr-smart.appx.com.tw/v/r4/fhir"
 BUNDLE_FILE = "inpatient_quality_46_bundle.json"
@@ -27,7 +28,7 @@ def main():
     
     # 上傳bundle
     print("\n開始上傳...")
-    response = requests.post(
+    response = get_scheduler().post(
         FHIR_SERVER,
         json=bundle,
         headers={"Content-Type": "application/json"}
@@ -3,6 +3,8 @@
 """
 import json
 import requests
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 FHIR_SERVER = "https://emr-smart.appx.com.tw/v/r4/fhir"
 BUNDLE_FILE = "outcome_quality_12_bundle.json"
@@ -21,7 +23,7 @@ def upload_bundle():
     print(f"\n🚀 開始上傳到: {FHIR_SERVER}")
     
     try:
-        response = requests.post(
+        response = get_scheduler().post(
             FHIR_SERVER,
             json=bundle,
             headers={"Content-Type": "application/fhir+json"},
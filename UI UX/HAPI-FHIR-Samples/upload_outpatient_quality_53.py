@@ -7,6 +7,8 @@
 
 import json
 import requests
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 # FHIR伺服器設定
 FHIR_SERVER = "https://emr-smart.appx.com.tw/v/r4/fhir"
@@ -37,7 +39,7 @@ def upload_bundle(bundle_file):
     # 上傳Bundle
     print("開始上傳...")
     try:
-        response = requests.post(
+        response = get_scheduler().post(
             FHIR_SERVER,
             json=bundle,
             headers={
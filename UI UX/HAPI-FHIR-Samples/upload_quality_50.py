@@ -3,7 +3,8 @@
 """
 
 import json
-import requests
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 def upload_bundle(bundle_file):
     """上傳 Bundle 到 FHIR 伺服器"""
@@ -22,7 +23,7 @@ def upload_bundle(bundle_file):
         print(f"  {rt}: {count}")
     
     print("\n開始上傳...")
-    response = requests.post(url, json=bundle, headers={'Content-Type': 'application/fhir+json'})
+    response = get_scheduler().post(url, json=bundle, headers={'Content-Type': 'application/fhir+json'})
     
     if response.status_code in [200, 201]:
         print(f"上傳成功! 狀態碼: {response.status_code}")
@@ -4,7 +4,8 @@
 """
 
 import json
-import requests
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 # FHIR伺服器設定
 FHIR_SERVER = "https://emr-smart.appx.com.tw/v/r4/fhir"
@@ -33,7 +34,7 @@ def upload_bundle(bundle_file):
     # 上傳Bundle
     print("正在上傳資料到FHIR伺服器...")
     try:
-        response = requests.post(
+        response = get_scheduler().post(
             FHIR_SERVER,
             json=bundle,
             headers={
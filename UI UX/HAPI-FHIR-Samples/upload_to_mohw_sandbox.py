@@ -11,6 +11,8 @@ import json
 import requests
 import time
 import os
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 # 台灣衛福部 FHIR SAND-BOX 伺服器
 FHIR_SERVER = "https://thas.mohw.gov.tw/v/r4/fhir"
@@ -144,7 +146,7 @@ def upload_bundle(bundle_info):
     try:
         print(f"⏳ 正在上傳到 {FHIR_SERVER} ...")
         
-        response = requests.post(
+        response = get_scheduler().post(
             FHIR_SERVER,
             json=bundle,
             headers=headers,
@@ -210,11 +212,7 @@ def main():
         else:
             fail_count += 1
             print(f"❌ 失敗 ({fail_count}/{i})")
-        
-        # 每次上傳後等待2秒，避免伺服器負載過大
-        if i < len(BUNDLES):
-            print("⏳ 等待 2 秒...")
-            time.sleep(2)
+        # 上傳間隔由共用排程器控制，避免伺服器負載過大（429/503 依 Retry-After 重試）
     
     # 上傳完成統計
     elapsed_time = time.time() - start_time
@@ -225,6 +223,7 @@ def main():
     print(f"✅ 成功: {success_count}/{len(BUNDLES)}")
     print(f"❌ 失敗: {fail_count}/{len(BUNDLES)}")
     print(f"⏱️  總耗時: {elapsed_time:.1f} 秒")
+    print(f"📶 請求排程: {get_scheduler().format_stats()}")
     print("="*70)
     
     if success_count == len(BUNDLES):
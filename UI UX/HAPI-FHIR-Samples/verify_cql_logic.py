@@ -4,6 +4,9 @@
 """
 import requests
 
+import shared_path  # noqa: F401
+from fhir_shared.code_sets import value_set
+
 base_url = "https://emr-smart.appx.com.tw/v/r4/fhir"
 
 print("\n" + "="*70)
@@ -45,7 +48,7 @@ print(f"✅ 過濾後: {len(filtered_encounters)} 筆 AMI病人的 Encounters")
 ami_patients_set = set()
 ami_deaths_set = set()
 
-ami_icd_codes = ['I21.0', 'I21.1', 'I21.2', 'I21.9', 'I21', 'I22']
+ami_icd_codes = value_set('ami')  # I21、I22 開頭，含 I21.0 ~ I21.9
 
 for entry in filtered_encounters:
     encounter = entry['resource']
@@ -67,7 +70,7 @@ for entry in filtered_encounters:
             codings = condition.get('code', {}).get('coding', [])
             for coding in codings:
                 code = coding.get('code', '')
-                if any(code.startswith(ami_code) for ami_code in ami_icd_codes):
+                if ami_icd_codes.matches(code):
                     has_ami = True
                     print(f"  ✅ {patient_id} - Encounter/{encounter_id}: 診斷 {code}")
                     break
@@ -124,7 +127,7 @@ print(f"✅ 過濾後: {len(filtered_encounters)} 筆失智症病人的 Encounte
 dementia_patients_set = set()
 hospice_patients_set = set()
 
-dementia_icd_codes = ['F00', 'F01', 'F02', 'F03', 'G30']
+dementia_icd_codes = value_set('dementia')
 hospice_codes = ['05023C', '05024C', '05025C']
 
 for entry in filtered_encounters:
@@ -147,7 +150,7 @@ for entry in filtered_encounters:
             codings = condition.get('code', {}).get('coding', [])
             for coding in codings:
                 code = coding.get('code', '')
-                if any(code.startswith(dem_code) for dem_code in dementia_icd_codes):
+                if dementia_icd_codes.matches(code):
                     has_dementia = True
                     print(f"  ✅ {patient_id} - Encounter/{encounter_id}: 診斷 {code}")
                     break
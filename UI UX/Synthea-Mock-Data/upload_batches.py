@@ -3,8 +3,9 @@
 """
 
 import json
-import requests
 from datetime import datetime
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 # FHIR 伺服器設定
 FHIR_SERVER = "https://emr-smart.appx.com.tw/v/r4/fhir"
@@ -68,7 +69,7 @@ def upload_in_batches(bundle_file):
             batch_bundle['entry'].append(new_entry)
         
         try:
-            response = requests.post(
+            response = get_scheduler().post(
                 FHIR_SERVER,
                 json=batch_bundle,
                 headers={'Content-Type': 'application/fhir+json'},
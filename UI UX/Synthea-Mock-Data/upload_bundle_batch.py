@@ -3,7 +3,8 @@
 """
 
 import json
-import requests
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 # FHIR 伺服器設定
 FHIR_SERVER = "https://emr-smart.appx.com.tw/v/r4/fhir"
@@ -45,7 +46,7 @@ def upload_bundle_batch(bundle_file):
     try:
         # 發送 transaction Bundle
         print("開始批次上傳...")
-        response = requests.post(
+        response = get_scheduler().post(
             FHIR_SERVER,
             json=bundle,
             headers={'Content-Type': 'application/fhir+json'},
@@ -3,8 +3,9 @@
 """
 
 import json
-import requests
 from datetime import datetime
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import get_scheduler
 
 # FHIR 伺服器設定
 FHIR_SERVER = "https://emr-smart.appx.com.tw/v/r4/fhir"
@@ -36,11 +37,11 @@ def upload_bundle(bundle_file):
             # 使用 PUT 方法上傳（如果資源有 ID）
             if 'id' in resource:
                 url = f"{FHIR_SERVER}/{resource_type}/{resource_id}"
-                response = requests.put(url, json=resource, headers={'Content-Type': 'application/fhir+json'})
+                response = get_scheduler().put(url, json=resource, headers={'Content-Type': 'application/fhir+json'})
             else:
                 # 使用 POST 方法建立新資源
                 url = f"{FHIR_SERVER}/{resource_type}"
-                response = requests.post(url, json=resource, headers={'Content-Type': 'application/fhir+json'})
+                response = get_scheduler().post(url, json=resource, headers={'Content-Type': 'application/fhir+json'})
             
             if response.status_code in [200, 201]:
                 success_count += 1
@@ -0,0 +1,287 @@
+"""
+Async FHIR Client Module
+以 asyncio + httpx 連線池（HTTP/2、keep-alive）連接 SMART FHIR 伺服器
+介面與 fhir_client.FHIRClient 相同，但所有擷取方法皆為 coroutine
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional
+import logging
+
+from fhir_client import MultiServerFHIRClient
+import shared_path  # noqa: F401
+from fhir_shared.json_decoder import get_decoder
+from fhir_shared.fhir_scheduler import RequestScheduler, FHIRRequestError, get_scheduler, configure_scheduler
+
+try:
+    import httpx
+except ImportError:  # 選用套件：僅在 fetch.transport = async 時需要
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+
+def _http2_available() -> bool:
+    """HTTP/2 需要額外安裝 h2 套件 (pip install httpx[http2])"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class AsyncFHIRClient:
+    """非同步 FHIR 客戶端類別，多個請求共用同一個連線池"""
+    
+    def __init__(self, base_url: str, name: str = "FHIR Server", max_connections: int = 4,
+                 timeout: float = 30.0, max_pages: int = 3, http2: bool = True,
+                 json_decoder: str = 'auto', scheduler: Optional[RequestScheduler] = None):
+        """
+        初始化非同步 FHIR 客戶端
+        
+        Args:
+            base_url: FHIR 伺服器基礎 URL
+            name: 伺服器名稱
+            max_connections: 連線池最大連線數（同時請求上限）
+            timeout: 每個請求的逾時秒數
+            max_pages: 每次搜尋最多擷取頁數（與同步版相同，預設 3 頁）
+            http2: 是否啟用 HTTP/2（未安裝 h2 時自動退回 HTTP/1.1）
+            json_decoder: Bundle 解碼後端 (auto / orjson / json)；stream 在此以整頁解碼處理
+            scheduler: 請求排程器（與同步客戶端共用速率限制與重試），None = 行程共用排程器
+        """
+        if httpx is None:
+            raise ImportError("AsyncFHIRClient 需要 httpx 套件，請執行: pip install httpx[http2]")
+        
+        self.base_url = base_url.rstrip('/')
+        self.name = name
+        self.max_pages = max_pages
+        self.decoder = get_decoder(json_decoder)
+        self.scheduler = scheduler or get_scheduler()
+        
+        if http2 and not _http2_available():
+            logger.warning(f"{name}: 未安裝 h2 套件，改用 HTTP/1.1 keep-alive 連線")
+            http2 = False
+        
+        self.client = httpx.AsyncClient(
+            headers={
+                'Accept': 'application/fhir+json',
+                'Content-Type': 'application/fhir+json'
+            },
+            http2=http2,
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections)
+        )
+    
+    async def aclose(self):
+        """關閉連線池"""
+        await self.client.aclose()
+    
+    async def get_capability_statement(self) -> Optional[Dict]:
+        """獲取伺服器能力聲明"""
+        try:
+            response = await self.scheduler.arequest(self.client, 'GET', f"{self.base_url}/metadata", timeout=10)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as e:
+            logger.error(f"無法獲取 {self.name} 能力聲明: {e}")
+            return None
+    
+    async def search_resource(self, resource_type: str, params: Dict[str, Any] = None,
+                              timeout: Optional[float] = None) -> List[Dict]:
+        """
+        搜尋 FHIR 資源
+        
+        Args:
+            resource_type: 資源類型 (Patient, Immunization, Condition, Observation, etc.)
+            params: 搜尋參數
+            timeout: 此次請求的逾時秒數（None = 使用客戶端預設）
+        
+        Returns:
+            資源列表
+            
+        Raises:
+            FHIRRequestError: 排程器重試用盡後仍失敗（與同步版相同）
+        """
+        request_timeout = timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+        url = f"{self.base_url}/{resource_type}"
+        
+        default_params = {'_count': 100}
+        if params:
+            default_params.update(params)
+        
+        try:
+            response = await self.scheduler.arequest(self.client, 'GET', url, params=default_params,
+                                                     timeout=request_timeout)
+            response.raise_for_status()
+            bundle = self.decoder.loads(response.content)
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error(f"搜尋 {resource_type} 時發生錯誤 ({self.name}): {e}")
+            raise FHIRRequestError(f"搜尋 {resource_type} 時發生錯誤 ({self.name}): {e}") from e
+        
+        if bundle.get('resourceType') != 'Bundle':
+            return []
+        
+        resources = [entry['resource'] for entry in bundle.get('entry', []) if 'resource' in entry]
+        logger.info(f"從 {self.name} 獲取了 {len(resources)} 筆 {resource_type} 資料")
+        
+        # 處理分頁
+        page_count = 1
+        while page_count < self.max_pages:
+            next_link = self._get_next_link(bundle)
+            if not next_link:
+                break
+            
+            try:
+                response = await self.scheduler.arequest(self.client, 'GET', next_link, timeout=request_timeout)
+                response.raise_for_status()
+                bundle = self.decoder.loads(response.content)
+            except (httpx.HTTPError, ValueError) as e:
+                logger.error(f"獲取下一頁時發生錯誤 ({self.name}): {e}")
+                raise FHIRRequestError(f"獲取 {resource_type} 下一頁時發生錯誤 ({self.name}): {e}") from e
+            
+            page_resources = [entry['resource'] for entry in bundle.get('entry', []) if 'resource' in entry]
+            resources.extend(page_resources)
+            logger.info(f"獲取第 {page_count + 1} 頁: {len(page_resources)} 筆資料")
+            page_count += 1
+        
+        return resources
+    
+    def _get_next_link(self, bundle: Dict) -> Optional[str]:
+        """從 Bundle 中提取下一頁連結"""
+        for link in bundle.get('link', []):
+            if link.get('relation') == 'next':
+                return link.get('url')
+        return None
+    
+    async def get_patients(self, time_period_years: int = 2) -> List[Dict]:
+        """獲取病人資料"""
+        return await self.search_resource('Patient', {})
+    
+    async def get_immunizations(self, time_period_years: int = 2) -> List[Dict]:
+        """獲取疫苗接種紀錄（過去 N 年內）"""
+        start_date = datetime.now() - timedelta(days=365 * time_period_years)
+        params = {
+            'date': f'ge{start_date.strftime("%Y-%m-%d")}',
+            'status': 'completed'
+        }
+        return await self.search_resource('Immunization', params)
+    
+    async def get_conditions(self, time_period_years: int = 2) -> List[Dict]:
+        """獲取診斷紀錄"""
+        return await self.search_resource('Condition', {'clinical-status': 'active'})
+    
+    async def get_observations(self, code: str = None, time_period_years: int = 2) -> List[Dict]:
+        """獲取觀察值紀錄"""
+        start_date = datetime.now() - timedelta(days=365 * time_period_years)
+        params = {
+            'date': f'ge{start_date.strftime("%Y-%m-%d")}',
+            'status': 'final,amended,corrected'
+        }
+        if code:
+            params['code'] = code
+        return await self.search_resource('Observation', params)
+
+
+class AsyncMultiServerFHIRClient(MultiServerFHIRClient):
+    """多伺服器非同步 FHIR 客戶端（儲存邏輯沿用 MultiServerFHIRClient）"""
+    
+    def __init__(self, server_configs: List[Dict], fetch_config: Optional[Dict] = None):
+        """
+        初始化多伺服器非同步客戶端
+        
+        Args:
+            server_configs: 伺服器配置列表
+            fetch_config: 擷取設定 (config.json 的 fetch)
+                max_connections_per_server: 每個伺服器的連線池大小
+                request_timeout: 每個請求的逾時秒數
+                total_timeout: 整體擷取逾時秒數，逾時即取消所有請求 (null = 不限制)
+                http2: 是否啟用 HTTP/2
+        """
+        fetch_config = fetch_config or {}
+        self.server_configs = server_configs
+        self.max_connections = fetch_config.get('max_connections_per_server', 4)
+        self.request_timeout = fetch_config.get('request_timeout', 30.0)
+        self.total_timeout = fetch_config.get('total_timeout')
+        self.http2 = fetch_config.get('http2', True)
+        self.json_decoder = fetch_config.get('json_decoder', 'auto')
+        rate_config = fetch_config.get('rate_limit')
+        self.scheduler = configure_scheduler(rate_config) if rate_config is not None else get_scheduler()
+    
+    async def _fetch_server(self, client: AsyncFHIRClient, time_period_years: int) -> Optional[Dict[str, List[Dict]]]:
+        """從單一伺服器同時擷取四種資源"""
+        logger.info(f"正在連接伺服器: {client.name} ({client.base_url})")
+        
+        capability = await client.get_capability_statement()
+        if not capability:
+            logger.warning(f"✗ {client.name} 連接失敗，跳過此伺服器")
+            return None
+        logger.info(f"✓ {client.name} 連接成功")
+        
+        patients, immunizations, conditions, observations = await asyncio.gather(
+            client.get_patients(time_period_years),
+            client.get_immunizations(time_period_years),
+            client.get_conditions(time_period_years),
+            client.get_observations(time_period_years=time_period_years)
+        )
+        return {
+            'Patient': patients,
+            'Immunization': immunizations,
+            'Condition': conditions,
+            'Observation': observations
+        }
+    
+    async def fetch_all_data_async(self, time_period_years: int = 2) -> Dict[str, List[Dict]]:
+        """
+        同時從所有伺服器擷取資料；超過 total_timeout 時取消所有進行中的請求
+        
+        Returns:
+            包含所有資源類型的字典（依伺服器設定順序合併，與同步版相同）
+        """
+        clients = [
+            AsyncFHIRClient(
+                base_url=config['base_url'],
+                name=config.get('name', 'FHIR Server'),
+                max_connections=self.max_connections,
+                timeout=self.request_timeout,
+                http2=self.http2,
+                json_decoder=self.json_decoder,
+                scheduler=self.scheduler
+            )
+            for config in self.server_configs
+        ]
+        
+        logger.info(f"開始從 {len(clients)} 個伺服器非同步擷取資料...")
+        
+        try:
+            server_results = await asyncio.wait_for(
+                asyncio.gather(*(self._fetch_server(client, time_period_years) for client in clients)),
+                timeout=self.total_timeout
+            )
+        finally:
+            await asyncio.gather(*(client.aclose() for client in clients))
+        
+        all_data = {
+            'Patient': [],
+            'Immunization': [],
+            'Condition': [],
+            'Observation': []
+        }
+        for result in server_results:
+            if result:
+                for resource_type, resources in result.items():
+                    all_data[resource_type].extend(resources)
+        
+        logger.info("\n" + "="*60)
+        logger.info("資料擷取完成統計:")
+        for resource_type, resources in all_data.items():
+            logger.info(f"  {resource_type}: {len(resources)} 筆")
+        logger.info(f"  請求排程: {self.scheduler.format_stats()}")
+        logger.info("="*60 + "\n")
+        
+        return all_data
+    
+    def fetch_all_data(self, time_period_years: int = 2) -> Dict[str, List[Dict]]:
+        """同步呼叫介面，供 main.py 以相同流程使用"""
+        return asyncio.run(self.fetch_all_data_async(time_period_years))
@@ -33,6 +33,14 @@ class ReportDisplay:
         spaces = " " * indent
         print(f"{spaces}{key}: {value}")
     
+    def print_estimate(self, key: str, data: Dict, field: str, indent: int = 2):
+        """列印數值；近似統計時（有 {field}_error_bounds）附上 95% 信賴區間"""
+        bounds = data.get(f'{field}_error_bounds')
+        if bounds:
+            self.print_key_value(key, f"≈{data[field]}（95% 信賴區間 {bounds['lower']}–{bounds['upper']}）", indent)
+        else:
+            self.print_key_value(key, data[field], indent)
+    
     def print_dict(self, data: Dict, indent: int = 4):
         """列印字典資料"""
         spaces = " " * indent
@@ -72,7 +80,7 @@ class ReportDisplay:
         self.print_section("💉 COVID-19 疫苗接種統計")
         
         self.print_key_value("總接種劑數", covid_data['total_doses'])
-        self.print_key_value("已接種人數", covid_data['vaccinated_patients'])
+        self.print_estimate("已接種人數", covid_data, 'vaccinated_patients')
         
         if total_patients > 0:
             coverage = (covid_data['vaccinated_patients'] / total_patients * 100)
@@ -108,7 +116,7 @@ class ReportDisplay:
         self.print_section("💉 流感疫苗接種統計")
         
         self.print_key_value("總接種劑數", flu_data['total_doses'])
-        self.print_key_value("已接種人數", flu_data['vaccinated_patients'])
+        self.print_estimate("已接種人數", flu_data, 'vaccinated_patients')
         
         if total_patients > 0:
             coverage = (flu_data['vaccinated_patients'] / total_patients * 100)
@@ -138,7 +146,7 @@ class ReportDisplay:
         """顯示高血壓診斷統計"""
         self.print_section("🩺 高血壓診斷統計")
         
-        self.print_key_value("高血壓病人數", htn_data['total_patients'])
+        self.print_estimate("高血壓病人數", htn_data, 'total_patients')
         self.print_key_value("診斷紀錄總數", htn_data['total_conditions'])
         
         if total_patients > 0:
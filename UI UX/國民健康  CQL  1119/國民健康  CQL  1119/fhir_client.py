@@ -9,6 +9,10 @@ from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 import logging
 
+import shared_path  # noqa: F401
+from fhir_shared.json_decoder import get_decoder
+from fhir_shared.fhir_scheduler import RequestScheduler, FHIRRequestError, get_scheduler, configure_scheduler
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -16,16 +20,21 @@ logger = logging.getLogger(__name__)
 class FHIRClient:
     """FHIR 客戶端類別，用於與 SMART FHIR 伺服器互動"""
     
-    def __init__(self, base_url: str, name: str = "FHIR Server"):
+    def __init__(self, base_url: str, name: str = "FHIR Server", json_decoder: str = 'auto',
+                 scheduler: Optional[RequestScheduler] = None):
         """
         初始化 FHIR 客戶端
         
         Args:
             base_url: FHIR 伺服器基礎 URL
             name: 伺服器名稱
+            json_decoder: Bundle 解碼後端 (auto / orjson / json / stream)
+            scheduler: 請求排程器（速率限制、重試、退避），None = 行程共用排程器
         """
         self.base_url = base_url.rstrip('/')
         self.name = name
+        self.decoder = get_decoder(json_decoder)
+        self.scheduler = scheduler or get_scheduler()
         self.session = requests.Session()
         self.session.headers.update({
             'Accept': 'application/fhir+json',
@@ -36,7 +45,7 @@ class FHIRClient:
         """獲取伺服器能力聲明"""
         try:
             url = f"{self.base_url}/metadata"
-            response = self.session.get(url, timeout=10)
+            response = self.scheduler.get(url, session=self.session, timeout=10)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -53,6 +62,9 @@ class FHIRClient:
             
         Returns:
             資源列表
+            
+        Raises:
+            FHIRRequestError: 排程器重試用盡後仍失敗（不回傳空列表，避免統計被默默算成 0）
         """
         try:
             url = f"{self.base_url}/{resource_type}"
@@ -62,17 +74,14 @@ class FHIRClient:
             if params:
                 default_params.update(params)
             
-            response = self.session.get(url, params=default_params, timeout=30)
+            response = self.scheduler.get(url, session=self.session, params=default_params, timeout=30,
+                                          stream=self.decoder.incremental)
             response.raise_for_status()
             
-            bundle = response.json()
-            resources = []
+            resources, bundle = self._decode_page(response)
             
             # 提取資源
             if bundle.get('resourceType') == 'Bundle':
-                entries = bundle.get('entry', [])
-                resources = [entry['resource'] for entry in entries if 'resource' in entry]
-                
                 logger.info(f"從 {self.name} 獲取了 {len(resources)} 筆 {resource_type} 資料")
                 
                 # 處理分頁 (最多獲取 3 頁)
@@ -82,26 +91,40 @@ class FHIRClient:
                     if not next_link:
                         break
                     
-                    try:
-                        response = self.session.get(next_link, timeout=30)
-                        response.raise_for_status()
-                        bundle = response.json()
-                        
-                        entries = bundle.get('entry', [])
-                        page_resources = [entry['resource'] for entry in entries if 'resource' in entry]
-                        resources.extend(page_resources)
-                        
-                        logger.info(f"獲取第 {page_count + 1} 頁: {len(page_resources)} 筆資料")
-                        page_count += 1
-                    except Exception as e:
-                        logger.warning(f"獲取下一頁時發生錯誤: {e}")
-                        break
+                    response = self.scheduler.get(next_link, session=self.session, timeout=30,
+                                                  stream=self.decoder.incremental)
+                    response.raise_for_status()
+                    
+                    page_resources, bundle = self._decode_page(response)
+                    resources.extend(page_resources)
+                    
+                    logger.info(f"獲取第 {page_count + 1} 頁: {len(page_resources)} 筆資料")
+                    page_count += 1
             
             return resources
             
-        except Exception as e:
+        except (requests.exceptions.RequestException, ValueError) as e:
             logger.error(f"搜尋 {resource_type} 時發生錯誤 ({self.name}): {e}")
-            return []
+            raise FHIRRequestError(f"搜尋 {resource_type} 時發生錯誤 ({self.name}): {e}") from e
+    
+    def _decode_page(self, response: requests.Response) -> tuple:
+        """
+        解碼一頁搜尋結果
+        
+        Returns:
+            (entry 中的資源列表, Bundle)；增量解碼時 Bundle 不含 entry
+        """
+        if self.decoder.incremental:
+            parser = self.decoder.iter_entries(response.iter_content(chunk_size=65536))
+            resources = [entry['resource'] for entry in parser if 'resource' in entry]
+            bundle = parser.bundle
+        else:
+            bundle = self.decoder.loads(response.content)
+            resources = [entry['resource'] for entry in bundle.get('entry', []) if 'resource' in entry]
+        
+        if bundle.get('resourceType') != 'Bundle':
+            return [], bundle
+        return resources, bundle
     
     def _get_next_link(self, bundle: Dict) -> Optional[str]:
         """從 Bundle 中提取下一頁連結"""
@@ -189,18 +212,25 @@ class FHIRClient:
 class MultiServerFHIRClient:
     """多伺服器 FHIR 客戶端"""
     
-    def __init__(self, server_configs: List[Dict]):
+    def __init__(self, server_configs: List[Dict], fetch_config: Optional[Dict] = None):
         """
         初始化多伺服器客戶端
         
         Args:
             server_configs: 伺服器配置列表
+            fetch_config: 擷取設定 (config.json 的 fetch)，json_decoder 指定解碼後端，
+                          rate_limit 設定請求排程器（速率、重試、同時請求上限）
         """
+        fetch_config = fetch_config or {}
+        rate_config = fetch_config.get('rate_limit')
+        self.scheduler = configure_scheduler(rate_config) if rate_config is not None else get_scheduler()
         self.clients = []
         for config in server_configs:
             client = FHIRClient(
                 base_url=config['base_url'],
-                name=config.get('name', 'FHIR Server')
+                name=config.get('name', 'FHIR Server'),
+                json_decoder=fetch_config.get('json_decoder', 'auto'),
+                scheduler=self.scheduler
             )
             self.clients.append(client)
     
@@ -253,6 +283,7 @@ class MultiServerFHIRClient:
         logger.info(f"  Immunization: {len(all_data['Immunization'])} 筆")
         logger.info(f"  Condition: {len(all_data['Condition'])} 筆")
         logger.info(f"  Observation: {len(all_data['Observation'])} 筆")
+        logger.info(f"  請求排程: {self.scheduler.format_stats()}")
         logger.info("="*60 + "\n")
         
         return all_data
@@ -11,6 +11,8 @@ from datetime import datetime
 from fhir_client import MultiServerFHIRClient
 from data_processor import FHIRDataProcessor
 from display import ReportDisplay
+import shared_path  # noqa: F401
+from fhir_shared.sketches import sketch_options
 
 # 設定日誌
 logging.basicConfig(
@@ -63,7 +65,13 @@ def main():
     print("\n正在連接外部 SMART FHIR 伺服器...")
     
     try:
-        multi_client = MultiServerFHIRClient(config['fhir_servers'])
+        fetch_config = config.get('fetch', {})
+        if fetch_config.get('transport', 'sync') == 'async':
+            # 選用：asyncio + httpx 連線池（需安裝 httpx[http2]）
+            from async_fhir_client import AsyncMultiServerFHIRClient
+            multi_client = AsyncMultiServerFHIRClient(config['fhir_servers'], fetch_config)
+        else:
+            multi_client = MultiServerFHIRClient(config['fhir_servers'], fetch_config)
         time_period = config['filters']['time_period_years']
         
         fhir_data = multi_client.fetch_all_data(time_period_years=time_period)
@@ -79,7 +87,7 @@ def main():
     print("\n正在處理資料...")
     
     try:
-        processor = FHIRDataProcessor(fhir_data)
+        processor = FHIRDataProcessor(fhir_data, sketch_options(config.get('approximate_statistics')))
         report = processor.generate_full_report(time_period_years=time_period)
         
         print("✓ 資料處理完成")
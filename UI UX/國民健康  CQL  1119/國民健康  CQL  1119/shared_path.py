@@ -0,0 +1,16 @@
+"""
+將專案根目錄（含 fhir_shared 套件的上層目錄）加入 sys.path，供此目錄的腳本匯入共用模組
+
+    import shared_path  # noqa: F401
+    from fhir_shared.fhir_scheduler import get_scheduler
+"""
+
+import sys
+from pathlib import Path
+
+PROJECT_ROOT = next(parent for parent in Path(__file__).resolve().parents
+                    if (parent / 'fhir_shared' / '__init__.py').is_file())
+
+# 加在最後：此目錄的模組仍優先於專案根目錄的同名腳本
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.append(str(PROJECT_ROOT))
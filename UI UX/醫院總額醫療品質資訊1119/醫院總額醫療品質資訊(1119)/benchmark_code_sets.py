@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代碼集合效能測試 - 降血壓藥品 (指標 1710) 的 ATC 代碼判斷
+
+比較原本逐一前綴掃描 + 排除清單、startswith(tuple) 與編譯後的 CodeSet
+(逐筆 matches 及向量化 mask)，確認結果一致後輸出每百萬筆的耗時
+
+用法:
+    python benchmark_code_sets.py              # 預設 1、2、4 百萬筆 coding
+    python benchmark_code_sets.py 10000000     # 指定筆數
+"""
+
+import sys
+import time
+import random
+
+import pandas as pd
+
+import shared_path  # noqa: F401
+from fhir_shared.code_sets import VALUE_SETS, value_set
+
+DEFAULT_SIZES = [1_000_000, 2_000_000, 4_000_000]
+DISTINCT_CODES = 5000
+REPEAT = 3
+
+PREFIXES = VALUE_SETS['antihypertensive']['prefixes']
+EXCLUDED = VALUE_SETS['antihypertensive']['excluded']
+
+
+def build_codes(size: int) -> list:
+    """產生測試代碼：約三成為降血壓藥品，其餘為其他 ATC 代碼，含排除代碼與缺值"""
+    rng = random.Random(size)
+    letters = 'ABCDGHJLMNPRSV'
+    pool = [f"{(rng.choice(PREFIXES) + 'AB')[:5]}{rng.randrange(100):02d}"
+            for _ in range(DISTINCT_CODES * 3 // 10)]
+    pool += [f"{rng.choice(letters)}{rng.randrange(100):02d}AA{rng.randrange(100):02d}"
+             for _ in range(DISTINCT_CODES - len(pool))]
+    pool += EXCLUDED + [None]
+    return [rng.choice(pool) for _ in range(size)]
+
+
+def prefix_loop(codes: list) -> int:
+    """原本的寫法：逐一前綴 startswith，命中後檢查排除清單"""
+    count = 0
+    for code in codes:
+        if not code:
+            continue
+        for prefix in PREFIXES:
+            if code.startswith(prefix):
+                if code not in EXCLUDED:
+                    count += 1
+                break
+    return count
+
+
+def startswith_tuple(codes: list) -> int:
+    """startswith(tuple(...)) + 排除清單"""
+    prefixes = tuple(PREFIXES)
+    return sum(1 for code in codes if code and code.startswith(prefixes) and code not in EXCLUDED)
+
+
+def code_set_matches(codes: list) -> int:
+    """CodeSet.matches 逐筆判斷"""
+    matches = value_set('antihypertensive').matches
+    return sum(1 for code in codes if matches(code))
+
+
+def code_set_mask(codes: pd.Series) -> int:
+    """CodeSet.mask 向量化判斷"""
+    return int(value_set('antihypertensive').mask(codes).sum())
+
+
+def best_of(func, repeat=REPEAT):
+    """重複執行取最短時間（秒）"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    
+    print(f"降血壓藥品代碼判斷效能測試 ({len(PREFIXES)} 個前綴, {len(EXCLUDED)} 個排除代碼, "
+          f"約 {DISTINCT_CODES} 種代碼, 每項取 {REPEAT} 次最短時間)")
+    print(f"{'coding 筆數':>12} {'命中':>9} {'前綴迴圈':>10} {'startswith':>11} {'matches':>10} {'mask':>10} {'倍數':>7}")
+    for size in sizes:
+        codes = build_codes(size)
+        series = pd.Series(codes, dtype=object)
+        expected = prefix_loop(codes)
+        assert expected == startswith_tuple(codes) == code_set_matches(codes) == code_set_mask(series)
+        
+        loop = best_of(lambda: prefix_loop(codes))
+        tuple_ = best_of(lambda: startswith_tuple(codes))
+        matches = best_of(lambda: code_set_matches(codes))
+        mask = best_of(lambda: code_set_mask(series))
+        print(f"{size:>12,} {expected:>9,} {loop * 1000:>8.0f}ms {tuple_ * 1000:>9.0f}ms "
+              f"{matches * 1000:>8.0f}ms {mask * 1000:>8.0f}ms {loop / mask:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
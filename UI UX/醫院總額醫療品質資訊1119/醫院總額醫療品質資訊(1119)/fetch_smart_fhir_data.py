@@ -12,6 +12,9 @@ from datetime import datetime, date
 from collections import defaultdict
 import csv
 
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import FHIRRequestError, get_scheduler
+
 # FHIR Server 配置
 FHIR_SERVERS = {
     'server1': {
@@ -77,7 +80,7 @@ def get_headers(server_config):
 def test_fhir_connection(base_url, server_name):
     """測試FHIR伺服器連接"""
     try:
-        response = requests.get(
+        response = get_scheduler().get(
             f"{base_url}/metadata",
             headers={'Accept': 'application/fhir+json'},
             timeout=10
@@ -109,11 +112,8 @@ def fetch_medication_requests(base_url, headers, start_date, end_date):
     }
     
     try:
-        response = requests.get(url, headers=headers, params=params, timeout=30)
-        if response.status_code != 200:
-            print(f"  ⚠️  MedicationRequest查詢失敗 (HTTP {response.status_code})")
-            return []
-        
+        response = get_scheduler().get(url, headers=headers, params=params, timeout=30)
+        response.raise_for_status()
         bundle = response.json()
         entries = bundle.get('entry', [])
         
@@ -141,7 +141,7 @@ def fetch_medication_requests(base_url, headers, start_date, end_date):
     
     except requests.exceptions.RequestException as e:
         print(f"  ⚠️  MedicationRequest查詢錯誤: {str(e)}")
-        return []
+        raise FHIRRequestError(f"MedicationRequest 查詢失敗: {e}") from e
 
 
 def fetch_encounters(base_url, headers, start_date, end_date):
@@ -158,11 +158,8 @@ def fetch_encounters(base_url, headers, start_date, end_date):
     }
     
     try:
-        response = requests.get(url, headers=headers, params=params, timeout=30)
-        if response.status_code != 200:
-            print(f"  ⚠️  Encounter查詢失敗 (HTTP {response.status_code})")
-            return []
-        
+        response = get_scheduler().get(url, headers=headers, params=params, timeout=30)
+        response.raise_for_status()
         bundle = response.json()
         entries = bundle.get('entry', [])
         
@@ -183,7 +180,7 @@ def fetch_encounters(base_url, headers, start_date, end_date):
     
     except requests.exceptions.RequestException as e:
         print(f"  ⚠️  Encounter查詢錯誤: {str(e)}")
-        return []
+        raise FHIRRequestError(f"Encounter 查詢失敗: {e}") from e
 
 
 def analyze_by_quarter(medications, encounters):
@@ -14,6 +14,10 @@ import sqlite3
 import os
 from collections import defaultdict
 
+import shared_path  # noqa: F401
+from fhir_shared.code_sets import value_set
+from fhir_shared.fhir_scheduler import FHIRRequestError, get_scheduler
+
 # FHIR伺服器配置 - 使用公開測試伺服器
 FHIR_SERVER_1 = "https://r4.smarthealthit.org"  # SMART Health IT 測試伺服器
 FHIR_SERVER_2 = "https://hapi.fhir.org/baseR4"  # HAPI FHIR 測試伺服器
@@ -22,6 +26,9 @@ FHIR_SERVER_2 = "https://hapi.fhir.org/baseR4"  # HAPI FHIR 測試伺服器
 START_DATE = "2020-01-01"  # 使用測試伺服器有資料的時間範圍
 END_DATE = "2024-12-31"
 
+# 抗生素 ATC 代碼 (前3碼為 J01)
+ANTIBIOTIC = value_set('antibiotic')
+
 print("=" * 80)
 print("門診抗生素使用率 - SMART on FHIR 資料查詢")
 print("=" * 80)
@@ -55,59 +62,57 @@ try:
     print(f"    查詢參數: {params}")
     print("    正在撈取 MedicationRequest 資料...")
     
-    response = requests.get(
+    response = get_scheduler().get(
         f"{FHIR_SERVER_1}/MedicationRequest",
         params=params,
         headers=headers,
         timeout=30
     )
     
-    if response.status_code == 200:
-        bundle = response.json()
-        
-        if 'entry' in bundle:
-            for entry in bundle['entry']:
-                resource = entry.get('resource', {})
-                
-                # 提取藥品資訊
-                med_data = {
-                    'id': resource.get('id'),
-                    'patient': resource.get('subject', {}).get('reference', ''),
-                    'status': resource.get('status'),
-                    'intent': resource.get('intent'),
-                    'authored_on': resource.get('authoredOn', ''),
-                    'medication_code': None,
-                    'medication_display': None,
-                    'atc_code': None
-                }
-                
-                # 提取藥品代碼
-                med_codeable = resource.get('medicationCodeableConcept', {})
-                if med_codeable:
-                    codings = med_codeable.get('coding', [])
-                    for coding in codings:
-                        system = coding.get('system', '')
-                        code = coding.get('code', '')
-                        display = coding.get('display', '')
-                        
-                        med_data['medication_code'] = code
-                        med_data['medication_display'] = display
-                        
-                        # 檢查是否為 ATC 代碼
-                        if 'atc' in system.lower() or (code and code.startswith('J01')):
-                            med_data['atc_code'] = code
-                
-                all_medications.append(med_data)
+    response.raise_for_status()
+    bundle = response.json()
+    
+    if 'entry' in bundle:
+        for entry in bundle['entry']:
+            resource = entry.get('resource', {})
             
-            print(f"    ✓ 成功撈取 {len(all_medications)} 筆 MedicationRequest")
-        else:
-            print("    ⚠️  Bundle 中無 entry 資料")
+            # 提取藥品資訊
+            med_data = {
+                'id': resource.get('id'),
+                'patient': resource.get('subject', {}).get('reference', ''),
+                'status': resource.get('status'),
+                'intent': resource.get('intent'),
+                'authored_on': resource.get('authoredOn', ''),
+                'medication_code': None,
+                'medication_display': None,
+                'atc_code': None
+            }
+            
+            # 提取藥品代碼
+            med_codeable = resource.get('medicationCodeableConcept', {})
+            if med_codeable:
+                codings = med_codeable.get('coding', [])
+                for coding in codings:
+                    system = coding.get('system', '')
+                    code = coding.get('code', '')
+                    display = coding.get('display', '')
+                    
+                    med_data['medication_code'] = code
+                    med_data['medication_display'] = display
+                    
+                    # 檢查是否為 ATC 代碼
+                    if 'atc' in system.lower() or ANTIBIOTIC.matches(code):
+                        med_data['atc_code'] = code
+            
+            all_medications.append(med_data)
+        
+        print(f"    ✓ 成功撈取 {len(all_medications)} 筆 MedicationRequest")
     else:
-        print(f"    ✗ HTTP 錯誤: {response.status_code}")
-        print(f"    回應: {response.text[:200]}")
-    
-except Exception as e:
+        print("    ⚠️  Bundle 中無 entry 資料")
+
+except requests.exceptions.RequestException as e:
     print(f"    ✗ 錯誤: {str(e)}")
+    raise FHIRRequestError(f"FHIR Server 1 MedicationRequest 查詢失敗: {e}") from e
 
 # ============================================
 # 2. 從FHIR Server 2 撈取 MedicationRequest
@@ -125,58 +130,57 @@ try:
     print(f"    查詢參數: {params}")
     print("    正在撈取 MedicationRequest 資料...")
     
-    response = requests.get(
+    response = get_scheduler().get(
         f"{FHIR_SERVER_2}/MedicationRequest",
         params=params,
         headers=headers,
         timeout=30
     )
     
-    if response.status_code == 200:
-        bundle = response.json()
+    response.raise_for_status()
+    bundle = response.json()
+    
+    if 'entry' in bundle:
+        initial_count = len(all_medications)
         
-        if 'entry' in bundle:
-            initial_count = len(all_medications)
+        for entry in bundle['entry']:
+            resource = entry.get('resource', {})
             
-            for entry in bundle['entry']:
-                resource = entry.get('resource', {})
-                
-                med_data = {
-                    'id': resource.get('id'),
-                    'patient': resource.get('subject', {}).get('reference', ''),
-                    'status': resource.get('status'),
-                    'intent': resource.get('intent'),
-                    'authored_on': resource.get('authoredOn', ''),
-                    'medication_code': None,
-                    'medication_display': None,
-                    'atc_code': None
-                }
-                
-                med_codeable = resource.get('medicationCodeableConcept', {})
-                if med_codeable:
-                    codings = med_codeable.get('coding', [])
-                    for coding in codings:
-                        system = coding.get('system', '')
-                        code = coding.get('code', '')
-                        display = coding.get('display', '')
-                        
-                        med_data['medication_code'] = code
-                        med_data['medication_display'] = display
-                        
-                        if 'atc' in system.lower() or (code and code.startswith('J01')):
-                            med_data['atc_code'] = code
-                
-                all_medications.append(med_data)
+            med_data = {
+                'id': resource.get('id'),
+                'patient': resource.get('subject', {}).get('reference', ''),
+                'status': resource.get('status'),
+                'intent': resource.get('intent'),
+                'authored_on': resource.get('authoredOn', ''),
+                'medication_code': None,
+                'medication_display': None,
+                'atc_code': None
+            }
             
-            new_count = len(all_medications) - initial_count
-            print(f"    ✓ 成功撈取 {new_count} 筆 MedicationRequest")
-        else:
-            print("    ⚠️  Bundle 中無 entry 資料")
-    else:
-        print(f"    ✗ HTTP 錯誤: {response.status_code}")
+            med_codeable = resource.get('medicationCodeableConcept', {})
+            if med_codeable:
+                codings = med_codeable.get('coding', [])
+                for coding in codings:
+                    system = coding.get('system', '')
+                    code = coding.get('code', '')
+                    display = coding.get('display', '')
+                    
+                    med_data['medication_code'] = code
+                    med_data['medication_display'] = display
+                    
+                    if 'atc' in system.lower() or ANTIBIOTIC.matches(code):
+                        med_data['atc_code'] = code
+            
+            all_medications.append(med_data)
         
-except Exception as e:
+        new_count = len(all_medications) - initial_count
+        print(f"    ✓ 成功撈取 {new_count} 筆 MedicationRequest")
+    else:
+        print("    ⚠️  Bundle 中無 entry 資料")
+
+except requests.exceptions.RequestException as e:
     print(f"    ✗ 錯誤: {str(e)}")
+    raise FHIRRequestError(f"FHIR Server 2 MedicationRequest 查詢失敗: {e}") from e
 
 
 # ============================================
@@ -199,7 +203,7 @@ for i, med in enumerate(all_medications):
         else:
             med['atc_code'] = f'N02BA{i:02d}'  # 非抗生素
             med['medication_display'] = f'Other Medication {i+1}'
-    elif med['atc_code'] and med['atc_code'].startswith('J01'):
+    elif ANTIBIOTIC.matches(med['atc_code']):
         antibiotic_count += 1
 
 print(f"    ✓ 總處方數: {total_medication_count}")
@@ -212,7 +216,7 @@ print(f"    ✓ 非抗生素處方數: {total_medication_count - antibiotic_coun
 print("\n[4/5] 計算門診抗生素使用率...")
 
 # 篩選抗生素 (ATC碼前3碼為J01)
-antibiotics = [med for med in all_medications if med.get('atc_code', '').startswith('J01')]
+antibiotics = [med for med in all_medications if ANTIBIOTIC.matches(med.get('atc_code'))]
 
 # 計算統計
 antibiotic_claims = len(antibiotics)
@@ -259,7 +263,7 @@ if not df_all.empty:
     # 解析日期並分季度
     df_all['date'] = pd.to_datetime(df_all['authored_on'], errors='coerce')
     df_all['quarter'] = df_all['date'].dt.to_period('Q').astype(str)
-    df_all['is_antibiotic'] = df_all['atc_code'].str.startswith('J01', na=False)
+    df_all['is_antibiotic'] = ANTIBIOTIC.mask(df_all['atc_code'])
     
     # 季度統計
     quarterly_stats = df_all.groupby('quarter').agg({
@@ -9,6 +9,9 @@ import pandas as pd
 from datetime import datetime
 import os
 
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import FHIRRequestError, get_scheduler
+
 # FHIR伺服器配置
 FHIR_SERVER = "https://r4.smarthealthit.org"
 
@@ -38,7 +41,7 @@ try:
     
     print(f"    查詢 MedicationRequest 資源...")
     
-    response = requests.get(
+    response = get_scheduler().get(
         f"{FHIR_SERVER}/MedicationRequest",
         params=params,
         headers=headers,
@@ -47,48 +50,44 @@ try:
     
     print(f"    HTTP 狀態碼: {response.status_code}")
     
-    if response.status_code == 200:
-        bundle = response.json()
-        
-        print(f"    Bundle 類型: {bundle.get('type')}")
-        print(f"    總筆數: {bundle.get('total', 'N/A')}")
-        
-        if 'entry' in bundle:
-            for entry in bundle['entry']:
-                resource = entry.get('resource', {})
-                
-                med_data = {
-                    'id': resource.get('id'),
-                    'status': resource.get('status'),
-                    'authored_on': resource.get('authoredOn', ''),
-                    'medication_display': '',
-                    'atc_code': ''
-                }
-                
-                # 提取藥品名稱
-                med_codeable = resource.get('medicationCodeableConcept', {})
-                if med_codeable:
-                    med_data['medication_display'] = med_codeable.get('text', '')
-                    codings = med_codeable.get('coding', [])
-                    for coding in codings:
-                        code = coding.get('code', '')
-                        if code:
-                            med_data['atc_code'] = code
-                            break
-                
-                all_medications.append(med_data)
+    response.raise_for_status()
+    bundle = response.json()
+    
+    print(f"    Bundle 類型: {bundle.get('type')}")
+    print(f"    總筆數: {bundle.get('total', 'N/A')}")
+    
+    if 'entry' in bundle:
+        for entry in bundle['entry']:
+            resource = entry.get('resource', {})
             
-            print(f"    ✓ 成功撈取 {len(all_medications)} 筆處方資料")
-        else:
-            print("    ⚠️  Bundle 中無資料")
+            med_data = {
+                'id': resource.get('id'),
+                'status': resource.get('status'),
+                'authored_on': resource.get('authoredOn', ''),
+                'medication_display': '',
+                'atc_code': ''
+            }
+            
+            # 提取藥品名稱
+            med_codeable = resource.get('medicationCodeableConcept', {})
+            if med_codeable:
+                med_data['medication_display'] = med_codeable.get('text', '')
+                codings = med_codeable.get('coding', [])
+                for coding in codings:
+                    code = coding.get('code', '')
+                    if code:
+                        med_data['atc_code'] = code
+                        break
+            
+            all_medications.append(med_data)
+        
+        print(f"    ✓ 成功撈取 {len(all_medications)} 筆處方資料")
     else:
-        print(f"    ✗ 錯誤: {response.status_code}")
-        print(f"    {response.text[:300]}")
-    
-except requests.Timeout:
-    print(f"    ✗ 連線逾時")
-except Exception as e:
+        print("    ⚠️  Bundle 中無資料")
+
+except requests.exceptions.RequestException as e:
     print(f"    ✗ 錯誤: {str(e)}")
+    raise FHIRRequestError(f"MedicationRequest 查詢失敗: {e}") from e
 
 # ============================================
 # 2. 模擬 ATC 碼並計算使用率
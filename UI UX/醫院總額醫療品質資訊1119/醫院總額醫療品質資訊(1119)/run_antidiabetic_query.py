@@ -13,9 +13,16 @@ from datetime import datetime, timedelta
 from collections import defaultdict
 import csv
 
+import shared_path  # noqa: F401
+from fhir_shared.code_sets import value_set
+from fhir_shared.fhir_scheduler import FHIRRequestError, get_scheduler
+
 # SMART on FHIR 測試伺服器
 FHIR_SERVER = "https://r4.smarthealthit.org"
 
+# 降血糖藥品 ATC 代碼 (A10 開頭)
+ANTIDIABETIC = value_set('antidiabetic')
+
 def get_antidiabetic_medications():
     """
     查詢降血糖藥品的 MedicationRequest
@@ -36,7 +43,7 @@ def get_antidiabetic_medications():
     }
     
     try:
-        response = requests.get(url, params=params, timeout=30)
+        response = get_scheduler().get(url, params=params, timeout=30)
         response.raise_for_status()
         bundle = response.json()
         
@@ -62,7 +69,7 @@ def get_antidiabetic_medications():
                         for coding in codings:
                             code = coding.get("code", "")
                             # 檢查是否為降血糖藥品 (A10開頭)
-                            if code.startswith("A10"):
+                            if ANTIDIABETIC.matches(code):
                                 med_code = code
                                 med_display = coding.get("display", "Unknown Antidiabetic Drug")
                                 break
@@ -121,9 +128,9 @@ def get_antidiabetic_medications():
         
         return medications, patients
     
-    except Exception as e:
+    except requests.exceptions.RequestException as e:
         print(f"錯誤: {e}")
-        return [], {}
+        raise FHIRRequestError(f"MedicationRequest 查詢失敗: {e}") from e
 
 def calculate_overlap(med1, med2):
     """
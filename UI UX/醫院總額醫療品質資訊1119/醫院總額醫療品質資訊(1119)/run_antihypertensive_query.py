@@ -12,32 +12,18 @@ from datetime import datetime, timedelta
 from collections import defaultdict
 import json
 
+import shared_path  # noqa: F401
+from fhir_shared.code_sets import value_set
+from fhir_shared.fhir_scheduler import FHIRRequestError, get_scheduler
+
 # SMART on FHIR 伺服器配置
 FHIR_SERVERS = {
     'SMART_Health_IT': 'https://r4.smarthealthit.org',
     'HAPI_FHIR_Test': 'https://hapi.fhir.org/baseR4'
 }
 
-# 降血壓藥品 ATC 代碼 (依健保指標 1710)
-ANTIHYPERTENSIVE_ATC_CODES = [
-    'C07',     # BETA BLOCKING AGENTS (排除 C07AA05)
-    'C02CA',   # Alpha-adrenoreceptor antagonists
-    'C02DB',   # Hydrazinophthalazine derivatives
-    'C02DC',   # Pyrimidine derivatives
-    'C02DD',   # Nitroferricyanide derivatives
-    'C03AA',   # Thiazides, plain
-    'C03BA',   # Sulfonamides, plain
-    'C03CA',   # Sulfonamides, plain
-    'C03DA',   # Aldosterone antagonists
-    'C08CA',   # Dihydropyridine derivatives (排除 C08CA06)
-    'C08DA',   # Phenylalkylamine derivatives
-    'C08DB',   # Benzothiazepine derivatives
-    'C09AA',   # ACE inhibitors
-    'C09CA',   # Angiotensin II antagonists
-]
-
-# 排除的 ATC 代碼
-EXCLUDED_ATC_CODES = ['C07AA05', 'C08CA06']
+# 降血壓藥品 ATC 代碼 (依健保指標 1710，含排除代碼 C07AA05、C08CA06)
+ANTIHYPERTENSIVE = value_set('antihypertensive')
 
 def fetch_medication_requests(server_name, server_url, start_date='2024-01-01'):
     """
@@ -61,7 +47,7 @@ def fetch_medication_requests(server_name, server_url, start_date='2024-01-01'):
         print(f"查詢 MedicationRequest...")
         print(f"參數: {params}\n")
         
-        response = requests.get(url, params=params, timeout=30)
+        response = get_scheduler().get(url, params=params, timeout=30)
         response.raise_for_status()
         bundle = response.json()
         
@@ -83,13 +69,10 @@ def fetch_medication_requests(server_name, server_url, start_date='2024-01-01'):
         
         print(f"✓ 成功解析 {len(all_medications)} 筆降血壓藥品處方\n")
         return all_medications
-        
+    
     except requests.exceptions.RequestException as e:
         print(f"❌ 連接錯誤: {e}")
-        return []
-    except Exception as e:
-        print(f"❌ 處理錯誤: {e}")
-        return []
+        raise FHIRRequestError(f"{server_name} MedicationRequest 查詢失敗: {e}") from e
 
 def parse_medication_request(resource, server_name):
     """
@@ -109,7 +92,7 @@ def parse_medication_request(resource, server_name):
             code = coding.get('code', '')
             display = coding.get('display', '')
             
-            if 'atc' in system.lower() or code.startswith(tuple(ANTIHYPERTENSIVE_ATC_CODES)):
+            if 'atc' in system.lower() or ANTIHYPERTENSIVE.prefix_of(code):
                 atc_code = code
                 if display:
                     drug_name = display
@@ -139,14 +122,7 @@ def parse_medication_request(resource, server_name):
         if not atc_code:
             return None
         
-        is_antihypertensive = False
-        for prefix in ANTIHYPERTENSIVE_ATC_CODES:
-            if atc_code.startswith(prefix):
-                if atc_code not in EXCLUDED_ATC_CODES:
-                    is_antihypertensive = True
-                break
-        
-        if not is_antihypertensive:
+        if not ANTIHYPERTENSIVE.matches(atc_code):
             return None
         
         # 取得處方日期
@@ -195,7 +171,7 @@ def parse_medication_request(resource, server_name):
             'drug_name': drug_name,
             'atc_code': atc_code,
         }
-        
+    
     except Exception as e:
         print(f"⚠ 解析處方時發生錯誤: {e}")
         return None
@@ -12,6 +12,9 @@ from datetime import datetime
 import sqlite3
 import os
 
+import shared_path  # noqa: F401
+from fhir_shared.fhir_scheduler import FHIRRequestError, get_scheduler
+
 # FHIR伺服器配置
 FHIR_SERVER_1 = "https://fhir.nhi.gov.tw/fhir"  # 健保署FHIR伺服器
 FHIR_SERVER_2 = "https://fhir.hospitals.tw/fhir"  # 醫院總額FHIR伺服器
@@ -49,7 +52,8 @@ try:
     }
     
     print(f"    查詢參數: {params}")
-    # response = requests.get(f"{FHIR_SERVER_1}/MedicationRequest", params=params, headers=headers)
+    # response = get_scheduler().get(f"{FHIR_SERVER_1}/MedicationRequest", params=params, headers=headers)
+    # response.raise_for_status()
     
     # 模擬資料（實際環境需要真實API調用）
     print("    ⚠️  使用模擬資料 (實際環境需要OAuth2認證)")
@@ -76,10 +80,10 @@ try:
     ]
     
     print(f"    ✓ 撈取到 {len(fhir_medications)} 筆 MedicationRequest 資料")
-    
-except Exception as e:
+
+except requests.exceptions.RequestException as e:
     print(f"    ✗ 錯誤: {str(e)}")
-    fhir_medications = []
+    raise FHIRRequestError(f"FHIR Server 1 MedicationRequest 查詢失敗: {e}") from e
 
 # ============================================
 # 2. 從FHIR Server 2 撈取 Encounter
@@ -96,7 +100,8 @@ try:
     }
     
     print(f"    查詢參數: {params}")
-    # response = requests.get(f"{FHIR_SERVER_2}/Encounter", params=params, headers=headers)
+    # response = get_scheduler().get(f"{FHIR_SERVER_2}/Encounter", params=params, headers=headers)
+    # response.raise_for_status()
     
     print("    ⚠️  使用模擬資料")
     
@@ -124,10 +129,10 @@ try:
     ]
     
     print(f"    ✓ 撈取到 {len(fhir_encounters)} 筆 Encounter 資料")
-    
-except Exception as e:
+
+except requests.exceptions.RequestException as e:
     print(f"    ✗ 錯誤: {str(e)}")
-    fhir_encounters = []
+    raise FHIRRequestError(f"FHIR Server 2 Encounter 查詢失敗: {e}") from e
 
 # ============================================
 # 3. 整合FHIR資料
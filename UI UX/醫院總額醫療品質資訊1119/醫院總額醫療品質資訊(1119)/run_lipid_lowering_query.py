@@ -12,6 +12,10 @@ from datetime import datetime, timedelta
 from collections import defaultdict
 import json
 
+import shared_path  # noqa: F401
+from fhir_shared.code_sets import value_set
+from fhir_shared.fhir_scheduler import FHIRRequestError, get_scheduler
+
 # SMART on FHIR 伺服器配置
 FHIR_SERVERS = {
     'SMART_Health_IT': 'https://r4.smarthealthit.org',
@@ -19,13 +23,7 @@ FHIR_SERVERS = {
 }
 
 # 降血脂藥品 ATC 代碼 (依健保指標 1711)
-LIPID_LOWERING_ATC_CODES = [
-    'C10AA',   # HMG CoA reductase inhibitors - Statins
-    'C10AB',   # Fibrates
-    'C10AC',   # Bile acid sequestrants
-    'C10AD',   # Nicotinic acid and derivatives
-    'C10AX',   # Other lipid modifying agents
-]
+LIPID_LOWERING = value_set('lipid_lowering')
 
 def fetch_medication_requests(server_name, server_url, start_date='2024-01-01'):
     """
@@ -49,7 +47,7 @@ def fetch_medication_requests(server_name, server_url, start_date='2024-01-01'):
         print(f"查詢 MedicationRequest...")
         print(f"參數: {params}\n")
         
-        response = requests.get(url, params=params, timeout=30)
+        response = get_scheduler().get(url, params=params, timeout=30)
         response.raise_for_status()
         bundle = response.json()
         
@@ -71,13 +69,10 @@ def fetch_medication_requests(server_name, server_url, start_date='2024-01-01'):
         
         print(f"✓ 成功解析 {len(all_medications)} 筆降血脂藥品處方\n")
         return all_medications
-        
+    
     except requests.exceptions.RequestException as e:
         print(f"❌ 連接錯誤: {e}")
-        return []
-    except Exception as e:
-        print(f"❌ 處理錯誤: {e}")
-        return []
+        raise FHIRRequestError(f"{server_name} MedicationRequest 查詢失敗: {e}") from e
 
 def parse_medication_request(resource, server_name):
     """
@@ -97,7 +92,7 @@ def parse_medication_request(resource, server_name):
             code = coding.get('code', '')
             display = coding.get('display', '')
             
-            if 'atc' in system.lower() or code.startswith(tuple(LIPID_LOWERING_ATC_CODES)):
+            if 'atc' in system.lower() or LIPID_LOWERING.prefix_of(code):
                 atc_code = code
                 if display:
                     drug_name = display
@@ -136,13 +131,7 @@ def parse_medication_request(resource, server_name):
         if not atc_code:
             return None
         
-        is_lipid_lowering = False
-        for prefix in LIPID_LOWERING_ATC_CODES:
-            if atc_code.startswith(prefix):
-                is_lipid_lowering = True
-                break
-        
-        if not is_lipid_lowering:
+        if not LIPID_LOWERING.matches(atc_code):
             return None
         
         # 取得處方日期
@@ -191,7 +180,7 @@ def parse_medication_request(resource, server_name):
             'drug_name': drug_name,
             'atc_code': atc_code,
         }
-        
+    
     except Exception as e:
         print(f"⚠ 解析處方時發生錯誤: {e}")
         return None
@@ -0,0 +1,15 @@
+"""
+FHIR Shared Package
+各工具目錄共用的模組（只保留這一份）：
+
+    fhir_scheduler   FHIR 請求排程器（速率限制、重試、in-flight 上限）
+    json_decoder     FHIR JSON 解碼器（orjson / 增量解碼 Bundle）
+    fhir_frames      FHIR 資源攤平為欄式 DataFrame
+    sketches         近似統計用的 HyperLogLog / QuantileSketch
+    code_sets        各指標共用的 ATC / ICD / 醫令代碼集合
+
+專案根目錄的腳本可直接匯入；子目錄的腳本先匯入該目錄的 shared_path，將專案根目錄加入 sys.path：
+
+    import shared_path  # noqa: F401
+    from fhir_shared.fhir_scheduler import get_scheduler
+"""
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+編譯後的代碼集合 (Code Set)
+各指標共用的 ATC / ICD / 醫令代碼判斷：前綴 + 完整代碼 + 排除代碼，
+每個代碼集合只編譯一次並快取，取代逐一 startswith / in list 掃描
+
+    from fhir_shared.code_sets import value_set
+    ANTIHYPERTENSIVE = value_set('antihypertensive')
+    ANTIHYPERTENSIVE.matches('C07AB02')     # True
+    ANTIHYPERTENSIVE.matches('C07AA05')     # False (排除)
+    df['is_target'] = ANTIHYPERTENSIVE.mask(df['atc_code'])
+"""
+
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# 單一代碼集合最多記住的判斷結果筆數（超過即清空重來）
+MAX_MEMO = 1 << 16
+
+# 各指標的代碼集合（依健保指標規範）
+VALUE_SETS = {
+    # 指標 1710 / 1713: 降血壓藥品(口服)
+    'antihypertensive': {
+        'prefixes': [
+            'C07',     # BETA BLOCKING AGENTS (排除 C07AA05)
+            'C02CA',   # Alpha-adrenoreceptor antagonists
+            'C02DB',   # Hydrazinophthalazine derivatives
+            'C02DC',   # Pyrimidine derivatives
+            'C02DD',   # Nitroferricyanide derivatives
+            'C03AA',   # Thiazides, plain
+            'C03BA',   # Sulfonamides, plain
+            'C03CA',   # Sulfonamides, plain
+            'C03DA',   # Aldosterone antagonists
+            'C08CA',   # Dihydropyridine derivatives (排除 C08CA06)
+            'C08DA',   # Phenylalkylamine derivatives
+            'C08DB',   # Benzothiazepine derivatives
+            'C09AA',   # ACE inhibitors
+            'C09CA',   # Angiotensin II antagonists
+        ],
+        'excluded': ['C07AA05', 'C08CA06'],
+    },
+    # 指標 1711 / 1714: 降血脂藥品
+    'lipid_lowering': {
+        'prefixes': [
+            'C10AA',   # HMG CoA reductase inhibitors - Statins
+            'C10AB',   # Fibrates
+            'C10AC',   # Bile acid sequestrants
+            'C10AD',   # Nicotinic acid and derivatives
+            'C10AX',   # Other lipid modifying agents
+        ],
+    },
+    # 指標 1712 / 1715: 降血糖藥品(口服及注射)
+    'antidiabetic': {
+        'prefixes': ['A10'],
+    },
+    # 指標 1140.01: 門診抗生素 (ATC 前 3 碼 J01)
+    'antibiotic': {
+        'prefixes': ['J01'],
+    },
+    # 指標 1136.01 ~ 1138.01: 剖腹產醫令
+    'cesarean': {
+        'codes': ['81004C', '81005C', '81028C', '81029C', '97009C', '97014C'],
+    },
+    # 指標 1662Q / 1668Y: 急性心肌梗塞
+    'ami': {
+        'prefixes': ['I21', 'I22'],
+    },
+    # 指標 2795Q / 2796Y: 失智症
+    'dementia': {
+        'prefixes': ['F00', 'F01', 'F02', 'F03', 'G30'],
+    },
+    # 指標 20.01Q / 1804Y: 體外震波碎石術 (ESWL，SNOMED / ICD-10-PCS)
+    'eswl': {
+        'codes': ['80146002', '0TF00ZZ', '0TF10ZZ', '0TF20ZZ'],
+    },
+}
+
+
+class CodeSet:
+    """
+    編譯後的代碼集合
+    
+    prefixes: 前綴（依長度分桶，每個長度一次 set 查詢）
+    codes:    完整代碼（精確比對）
+    excluded: 排除代碼（精確比對，優先於 prefixes / codes）
+    """
+    
+    def __init__(self, prefixes: Iterable[str] = (), codes: Iterable[str] = (),
+                 excluded: Iterable[str] = ()):
+        self.prefixes = tuple(sorted(set(prefixes)))
+        self.codes = frozenset(codes)
+        self.excluded = frozenset(excluded)
+        
+        buckets: Dict[int, set] = {}
+        for prefix in self.prefixes:
+            buckets.setdefault(len(prefix), set()).add(prefix)
+        # 短前綴在前：命中最短前綴即可停止
+        self._buckets: List[Tuple[int, frozenset]] = [
+            (length, frozenset(buckets[length])) for length in sorted(buckets)]
+        self._memo: Dict[str, bool] = {}
+    
+    def __contains__(self, code: Optional[str]) -> bool:
+        return self.matches(code)
+    
+    def __len__(self) -> int:
+        return len(self.prefixes) + len(self.codes)
+    
+    def __repr__(self) -> str:
+        return (f"CodeSet(prefixes={len(self.prefixes)}, codes={len(self.codes)}, "
+                f"excluded={len(self.excluded)})")
+    
+    def prefix_of(self, code: Optional[str]) -> Optional[str]:
+        """code 命中的前綴（不考慮排除代碼；未命中回傳 None）"""
+        if not code:
+            return None
+        for length, prefixes in self._buckets:
+            if length > len(code):
+                break
+            head = code[:length]
+            if head in prefixes:
+                return head
+        return None
+    
+    def matches(self, code: Optional[str]) -> bool:
+        """code 是否屬於此代碼集合"""
+        result = self._memo.get(code)
+        if result is None:
+            if not code or code in self.excluded:
+                result = False
+            else:
+                result = code in self.codes or self.prefix_of(code) is not None
+            if len(self._memo) >= MAX_MEMO:
+                self._memo.clear()
+            self._memo[code] = result
+        return result
+    
+    def any(self, codes: Iterable[Optional[str]]) -> bool:
+        """任一代碼屬於此代碼集合"""
+        return any(self.matches(code) for code in codes)
+    
+    def mask(self, codes) -> np.ndarray:
+        """
+        向量化判斷（list / Series / ndarray → bool ndarray）
+        相同代碼只判斷一次，缺值為 False
+        """
+        positions, uniques = pd.factorize(pd.Series(codes, dtype=object), use_na_sentinel=True)
+        hits = np.fromiter((self.matches(code) for code in uniques), dtype=bool, count=len(uniques))
+        # 缺值的位置為 -1，對應附加在最後的 False
+        return np.append(hits, False)[positions]
+
+
+@lru_cache(maxsize=None)
+def compile_code_set(prefixes: Tuple[str, ...] = (), codes: Tuple[str, ...] = (),
+                     excluded: Tuple[str, ...] = ()) -> CodeSet:
+    """編譯代碼集合（相同內容只編譯一次）"""
+    return CodeSet(prefixes, codes, excluded)
+
+
+def value_set(name: str) -> CodeSet:
+    """依名稱取得 VALUE_SETS 中的代碼集合（已編譯並快取）"""
+    if name not in VALUE_SETS:
+        raise KeyError(f"未定義的代碼集合: {name}")
+    definition = VALUE_SETS[name]
+    return compile_code_set(tuple(definition.get('prefixes', ())), tuple(definition.get('codes', ())),
+                            tuple(definition.get('excluded', ())))
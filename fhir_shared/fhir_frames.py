@@ -0,0 +1,196 @@
+"""
+FHIR Frames Module
+將 FHIR 資源攤平為欄式 DataFrame（每種資源類型一張表），指標的計數、期間過濾、
+group-by 可直接以 pandas / NumPy 向量化計算，不必逐筆走訪 dict
+
+每張表的欄位:
+    id, patient_id, encounter_id        字串（參照只保留 id）
+    start, end                          datetime64（時區直接捨去，保留當地時間；無日期為 NaT）
+    system, code, display, text         主要代碼（該類型代碼欄位的第一個 coding）
+    coding_text                         所有 coding 的 code / display（小寫，以換行分隔，供關鍵字搜尋）
+    class, status, clinical_status, category    categorical（category 為第一個 coding）
+    is_laboratory                       bool（任一 category coding 為 laboratory）
+Patient 另有 gender（categorical）、birth_date（datetime64）、city、state
+"""
+
+import logging
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# 各資源類型的代碼欄位（預設 code）
+CODE_FIELDS = {
+    'Encounter': 'type',
+    'Immunization': 'vaccineCode',
+    'MedicationRequest': 'medicationCodeableConcept',
+    'MedicationAdministration': 'medicationCodeableConcept',
+    'MedicationDispense': 'medicationCodeableConcept',
+    'MedicationStatement': 'medicationCodeableConcept',
+    'DocumentReference': 'type',
+}
+
+# 各資源類型的時間欄位（依序取第一個有值的欄位；Period 拆為 start / end）
+TIME_FIELDS = {
+    'Encounter': ('period',),
+    'Condition': ('onsetDateTime', 'onsetPeriod', 'recordedDate'),
+    'Observation': ('effectiveDateTime', 'effectivePeriod', 'effectiveInstant', 'issued'),
+    'Procedure': ('performedDateTime', 'performedPeriod'),
+    'Immunization': ('occurrenceDateTime',),
+    'MedicationRequest': ('authoredOn',),
+    'MedicationAdministration': ('effectiveDateTime', 'effectivePeriod'),
+    'MedicationDispense': ('whenHandedOver', 'whenPrepared'),
+    'DocumentReference': ('date',),
+}
+
+PATIENT_REFERENCE_FIELDS = ('subject', 'patient', 'beneficiary', 'individual')
+
+COLUMNS = ['id', 'patient_id', 'encounter_id', 'start', 'end', 'system', 'code', 'display', 'text',
+           'coding_text', 'class', 'status', 'clinical_status', 'category', 'is_laboratory']
+PATIENT_COLUMNS = ['id', 'gender', 'birth_date', 'city', 'state']
+CATEGORICAL_COLUMNS = ('class', 'status', 'clinical_status', 'category')
+
+_TIMEZONE_RE = r'(?:Z|[+-]\d{2}:?\d{2})$'
+
+
+class FHIRFrames:
+    """各資源類型的 DataFrame（第一次存取時攤平，之後重複使用）"""
+    
+    def __init__(self, fhir_data: Dict[str, List[Dict]]):
+        self.fhir_data = fhir_data
+        self._frames: Dict[str, pd.DataFrame] = {}
+    
+    def __getitem__(self, resource_type: str) -> pd.DataFrame:
+        frame = self._frames.get(resource_type)
+        if frame is None:
+            resources = self.fhir_data.get(resource_type) or []
+            frame = flatten_patients(resources) if resource_type == 'Patient' else flatten(resource_type, resources)
+            self._frames[resource_type] = frame
+            logger.debug(f"已攤平 {resource_type}: {len(frame)} 筆")
+        return frame
+
+
+def flatten(resource_type: str, resources: List[Dict]) -> pd.DataFrame:
+    """將同一類型的資源攤平為 DataFrame（欄位見模組說明）"""
+    code_field = CODE_FIELDS.get(resource_type, 'code')
+    time_fields = TIME_FIELDS.get(resource_type, ())
+    rows = []
+    for resource in resources:
+        concept = resource.get(code_field)
+        codings = _codings(concept)
+        system, code, display = codings[0] if codings else (None, None, None)
+        categories = _codings(resource['category']) if 'category' in resource else []
+        start, end = _time_range(resource, time_fields)
+        rows.append((
+            resource.get('id'),
+            _patient_id(resource),
+            _encounter_id(resource) if 'encounter' in resource or 'context' in resource else None,
+            start,
+            end,
+            system,
+            code,
+            display,
+            concept.get('text') if isinstance(concept, dict) else None,
+            '\n'.join(f"{coding_code or ''}\n{coding_display or ''}"
+                      for _, coding_code, coding_display in codings).lower(),
+            _first_code(resource['class']) if 'class' in resource else None,
+            resource.get('status'),
+            _first_code(resource['clinicalStatus']) if 'clinicalStatus' in resource else None,
+            categories[0][1] if categories else None,
+            any(category_code == 'laboratory' for _, category_code, _ in categories),
+        ))
+    
+    frame = pd.DataFrame.from_records(rows, columns=COLUMNS)
+    frame['start'] = parse_datetimes(frame['start'])
+    frame['end'] = parse_datetimes(frame['end'])
+    for column in CATEGORICAL_COLUMNS:
+        frame[column] = frame[column].astype('category')
+    return frame
+
+
+def flatten_patients(patients: List[Dict]) -> pd.DataFrame:
+    """Patient 攤平為 DataFrame（地址取第一筆）"""
+    rows = []
+    for patient in patients:
+        address = (patient.get('address') or [{}])[0]
+        rows.append((patient.get('id'), patient.get('gender'), patient.get('birthDate'),
+                     address.get('city'), address.get('state')))
+    
+    frame = pd.DataFrame.from_records(rows, columns=PATIENT_COLUMNS)
+    frame['gender'] = frame['gender'].astype('category')
+    frame['birth_date'] = pd.to_datetime(frame['birth_date'].str[:10], format='%Y-%m-%d', errors='coerce')
+    return frame
+
+
+def parse_datetimes(values: pd.Series) -> pd.Series:
+    """FHIR 日期時間字串 → datetime64（捨去時區；無法解析為 NaT）"""
+    values = values.astype(object).where(values.notna(), None)
+    stripped = values.str.replace(_TIMEZONE_RE, '', regex=True)
+    return pd.to_datetime(stripped, format='ISO8601', errors='coerce')
+
+
+def age_in_years(birth_dates: pd.Series, reference: datetime) -> pd.Series:
+    """依 reference 日期計算足歲年齡（生日未知為 NaN）"""
+    before_birthday = (birth_dates.dt.month > reference.month) | \
+        ((birth_dates.dt.month == reference.month) & (birth_dates.dt.day > reference.day))
+    return reference.year - birth_dates.dt.year - before_birthday.astype(int)
+
+
+def reference_id(reference: Optional[str]) -> Optional[str]:
+    """Patient/123 → 123"""
+    if not reference:
+        return None
+    return reference.split('/_history/')[0].rstrip('/').split('/')[-1]
+
+
+def _patient_id(resource: Dict) -> Optional[str]:
+    for field in PATIENT_REFERENCE_FIELDS:
+        value = resource.get(field)
+        if isinstance(value, dict) and value.get('reference'):
+            return reference_id(value['reference'])
+    return None
+
+
+def _encounter_id(resource: Dict) -> Optional[str]:
+    """encounter、context（STU3）或 context.encounter（R4 DocumentReference）參照的就醫 id"""
+    for field in ('encounter', 'context'):
+        value = resource.get(field)
+        if not isinstance(value, dict):
+            continue
+        encounters = value.get('encounter')
+        for item in [value] + (encounters if isinstance(encounters, list) else [encounters]):
+            reference = item.get('reference') if isinstance(item, dict) else None
+            if reference and 'Encounter/' in reference:
+                return reference_id(reference)
+    return None
+
+
+def _codings(concept: Any) -> List[Tuple[Optional[str], Optional[str], Optional[str]]]:
+    """CodeableConcept / Coding → [(system, code, display)]"""
+    if isinstance(concept, list):
+        return [coding for item in concept for coding in _codings(item)]
+    if not isinstance(concept, dict):
+        return []
+    if 'coding' in concept:
+        return [(coding.get('system'), coding.get('code'), coding.get('display'))
+                for coding in concept['coding'] if isinstance(coding, dict)]
+    if 'code' in concept:
+        return [(concept.get('system'), concept['code'], concept.get('display'))]
+    return []
+
+
+def _first_code(concept: Any) -> Optional[str]:
+    codings = _codings(concept)
+    return codings[0][1] if codings else None
+
+
+def _time_range(resource: Dict, fields: Tuple[str, ...]) -> Tuple[Optional[str], Optional[str]]:
+    for field in fields:
+        value = resource.get(field)
+        if isinstance(value, dict):
+            return value.get('start'), value.get('end')
+        if value:
+            return value, value
+    return None, None
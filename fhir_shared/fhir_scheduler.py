@@ -0,0 +1,400 @@
+"""
+FHIR Request Scheduler Module
+所有 FHIR 請求共用的排程器：
+- 每個伺服器一個 token bucket 限制請求速率
+- 429 / 503 依 Retry-After 暫停該伺服器
+- 暫時性錯誤以指數退避 + 隨機抖動 (jitter) 重試
+- 全域同時進行中請求上限 (in-flight cap)
+- 統計重試次數與被限流等待的時間
+
+同步 (requests) 與非同步 (httpx) 客戶端共用相同的 token bucket 與統計。
+"""
+
+import time
+import random
+import asyncio
+import logging
+import threading
+import weakref
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Dict, Optional, Any
+from urllib.parse import urlsplit
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# 伺服器未處理請求的狀態碼：任何 HTTP 方法都可以安全重試
+THROTTLE_STATUSES = {429, 503}
+# 其他暫時性錯誤：只重試冪等方法（POST transaction 可能已部分處理）
+TRANSIENT_STATUSES = {500, 502, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+
+
+class FHIRRequestError(Exception):
+    """重試後仍失敗的 FHIR 請求（不再回傳空 Bundle 掩蓋錯誤）"""
+
+
+class TokenBucket:
+    """Token bucket：平均 rate 次/秒，最多累積 burst 次"""
+    
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        # Retry-After 指定的暫停期限（monotonic 時間）
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+    
+    def reserve(self) -> float:
+        """預約一個 token，回傳呼叫端需等待的秒數（0 = 立即送出）"""
+        with self._lock:
+            now = time.monotonic()
+            if self.rate > 0:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            
+            wait = max(0.0, self.paused_until - now)
+            if self.rate <= 0:
+                return wait
+            self.tokens -= 1
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+            return wait
+    
+    def pause(self, seconds: float):
+        """Retry-After：暫停此伺服器 seconds 秒（取較晚的期限）"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RequestScheduler:
+    """FHIR 請求排程器（執行緒安全，可在多個客戶端間共用）"""
+    
+    def __init__(self, requests_per_second: float = 10.0, burst: Optional[float] = None,
+                 max_in_flight: int = 16, max_retries: int = 5,
+                 backoff_base: float = 0.5, backoff_max: float = 30.0, max_retry_after: float = 120.0):
+        """
+        初始化排程器
+        
+        Args:
+            requests_per_second: 每個伺服器預設的平均請求速率（0 = 不限制）
+            burst: token bucket 容量（預設同 requests_per_second）
+            max_in_flight: 所有伺服器合計同時進行中的請求上限
+            max_retries: 暫時性錯誤的最多重試次數
+            backoff_base: 指數退避的基礎秒數（第 n 次重試約等待 base × 2^n）
+            backoff_max: 單次退避等待上限秒數
+            max_retry_after: Retry-After 接受的最長等待秒數
+        """
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._buckets_lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        # asyncio.Semaphore 綁定 event loop，依 loop 分別建立
+        self._async_in_flight: Dict[int, asyncio.Semaphore] = {}
+        self._session = None
+        
+        self._stats_lock = threading.Lock()
+        self.stats = self._empty_stats()
+    
+    def _empty_stats(self) -> Dict[str, Any]:
+        return {
+            'requests': 0,
+            'retries': 0,
+            'failures': 0,
+            'throttled_responses': 0,
+            'throttled_seconds': 0.0,
+            'backoff_seconds': 0.0,
+            'status_counts': {}
+        }
+    
+    @staticmethod
+    def server_key(url: str) -> str:
+        """以 scheme://host:port 區分伺服器"""
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+    
+    def set_rate(self, url: str, requests_per_second: float, burst: Optional[float] = None):
+        """覆寫某伺服器的請求速率"""
+        with self._buckets_lock:
+            self._buckets[self.server_key(url)] = TokenBucket(requests_per_second, burst)
+    
+    def _bucket(self, url: str) -> TokenBucket:
+        key = self.server_key(url)
+        with self._buckets_lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.requests_per_second, self.burst)
+            return bucket
+    
+    @property
+    def session(self) -> requests.Session:
+        """未指定 session 時共用的連線（上傳腳本使用）"""
+        if self._session is None:
+            self._session = requests.Session()
+        return self._session
+    
+    def _should_retry(self, method: str, status: Optional[int]) -> bool:
+        """status 為 None 表示連線錯誤或逾時"""
+        if status in THROTTLE_STATUSES:
+            return True
+        if method.upper() not in IDEMPOTENT_METHODS:
+            return False
+        return status is None or status in TRANSIENT_STATUSES
+    
+    def _retry_after(self, headers) -> Optional[float]:
+        """解析 Retry-After（秒數或 HTTP 日期）"""
+        value = headers.get('Retry-After') if headers is not None else None
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return None
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        return min(max(0.0, seconds), self.max_retry_after)
+    
+    def _backoff(self, attempt: int) -> float:
+        """指數退避 + full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+    
+    def _next_wait(self, url: str, method: str, attempt: int, status: Optional[int], headers) -> Optional[float]:
+        """
+        判斷是否重試並回傳等待秒數；不重試時回傳 None
+        """
+        if status is not None:
+            self._count_status(status)
+        if attempt >= self.max_retries or not self._should_retry(method, status):
+            return None
+        
+        wait = self._retry_after(headers) if status in THROTTLE_STATUSES else None
+        if wait is not None:
+            # 同一伺服器的其他請求也一起暫停
+            self._bucket(url).pause(wait)
+            with self._stats_lock:
+                self.stats['throttled_responses'] += 1
+        else:
+            wait = self._backoff(attempt)
+            with self._stats_lock:
+                self.stats['backoff_seconds'] += wait
+        
+        with self._stats_lock:
+            self.stats['retries'] += 1
+        logger.warning(f"{method} {url} 失敗 ({status or '連線錯誤'})，{wait:.1f} 秒後重試 "
+                       f"({attempt + 1}/{self.max_retries})")
+        return wait
+    
+    def _count_status(self, status: int):
+        with self._stats_lock:
+            counts = self.stats['status_counts']
+            counts[status] = counts.get(status, 0) + 1
+    
+    def _record_throttle(self, seconds: float):
+        if seconds > 0:
+            with self._stats_lock:
+                self.stats['throttled_seconds'] += seconds
+    
+    def _record_request(self):
+        with self._stats_lock:
+            self.stats['requests'] += 1
+    
+    def _record_failure(self):
+        with self._stats_lock:
+            self.stats['failures'] += 1
+    
+    def request(self, method: str, url: str, session: Optional[requests.Session] = None,
+                **kwargs) -> requests.Response:
+        """
+        經排程器送出請求
+        
+        可重試的錯誤會自動重試；重試用盡後回傳最後一個回應（由呼叫端
+        raise_for_status），連線錯誤則重新拋出最後一個例外。
+        stream=True 時回應本文在回傳後才下載，in-flight 名額保留到回應關閉
+        （呼叫端以 with response: 讀取）才釋放。
+        
+        Args:
+            method: HTTP 方法
+            url: 請求 URL
+            session: 使用的 requests.Session（None = 排程器共用連線）
+            **kwargs: 傳給 session.request 的參數（params、json、timeout、stream...）
+        """
+        session = session or self.session
+        bucket = self._bucket(url)
+        attempt = 0
+        
+        while True:
+            wait = bucket.reserve()
+            if wait > 0:
+                self._record_throttle(wait)
+                time.sleep(wait)
+            
+            self._record_request()
+            self._in_flight.acquire()
+            held = False
+            try:
+                response = session.request(method, url, **kwargs)
+                retry_wait = self._next_wait(url, method, attempt, response.status_code, response.headers)
+                if retry_wait is None:
+                    if response.status_code >= 400:
+                        self._record_failure()
+                    if kwargs.get('stream'):
+                        self._release_on_close(response)
+                        held = True
+                    return response
+                response.close()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                retry_wait = self._next_wait(url, method, attempt, None, None)
+                if retry_wait is None:
+                    self._record_failure()
+                    raise
+            finally:
+                if not held:
+                    self._in_flight.release()
+            
+            time.sleep(retry_wait)
+            attempt += 1
+    
+    def _release_on_close(self, response: requests.Response):
+        """串流回應關閉（或未關閉即被回收）時才釋放 in-flight 名額，只釋放一次"""
+        semaphore = self._in_flight
+        once = threading.Lock()
+        
+        def release():
+            if once.acquire(blocking=False):
+                semaphore.release()
+        
+        close = response.close
+        
+        def close_and_release():
+            try:
+                close()
+            finally:
+                release()
+        
+        response.close = close_and_release
+        weakref.finalize(response, release)
+    
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+    
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request('PUT', url, **kwargs)
+    
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, **kwargs)
+    
+    def _async_semaphore(self) -> asyncio.Semaphore:
+        loop_id = id(asyncio.get_running_loop())
+        semaphore = self._async_in_flight.get(loop_id)
+        if semaphore is None:
+            semaphore = self._async_in_flight[loop_id] = asyncio.Semaphore(self.max_in_flight)
+        return semaphore
+    
+    async def arequest(self, client, method: str, url: str, **kwargs):
+        """
+        非同步版 request（client 為 httpx.AsyncClient）
+        
+        asyncio.CancelledError 不會被攔截，取消時立即中止。
+        """
+        import httpx
+        
+        bucket = self._bucket(url)
+        attempt = 0
+        
+        while True:
+            wait = bucket.reserve()
+            if wait > 0:
+                self._record_throttle(wait)
+                await asyncio.sleep(wait)
+            
+            self._record_request()
+            try:
+                async with self._async_semaphore():
+                    response = await client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                retry_wait = self._next_wait(url, method, attempt, None, None)
+                if retry_wait is None:
+                    self._record_failure()
+                    raise
+            else:
+                retry_wait = self._next_wait(url, method, attempt, response.status_code, response.headers)
+                if retry_wait is None:
+                    if response.status_code >= 400:
+                        self._record_failure()
+                    return response
+                await response.aclose()
+            
+            await asyncio.sleep(retry_wait)
+            attempt += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """統計快照（重試次數、被限流等待秒數等）"""
+        with self._stats_lock:
+            stats = dict(self.stats)
+            stats['status_counts'] = dict(self.stats['status_counts'])
+        stats['throttled_seconds'] = round(stats['throttled_seconds'], 3)
+        stats['backoff_seconds'] = round(stats['backoff_seconds'], 3)
+        return stats
+    
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats = self._empty_stats()
+    
+    def format_stats(self) -> str:
+        stats = self.get_stats()
+        return (f"請求 {stats['requests']} 次、重試 {stats['retries']} 次、失敗 {stats['failures']} 次、"
+                f"限流等待 {stats['throttled_seconds']:.1f} 秒、退避等待 {stats['backoff_seconds']:.1f} 秒")
+
+
+_default_scheduler: Optional[RequestScheduler] = None
+_default_lock = threading.Lock()
+
+
+def get_scheduler() -> RequestScheduler:
+    """取得行程共用的排程器（首次呼叫時以預設值建立）"""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RequestScheduler()
+        return _default_scheduler
+
+
+def configure_scheduler(config: Optional[Dict] = None) -> RequestScheduler:
+    """
+    依設定重新建立共用排程器
+    
+    Args:
+        config: {requests_per_second, burst, max_in_flight, max_retries,
+                 backoff_base, backoff_max, max_retry_after}
+    """
+    global _default_scheduler
+    config = config or {}
+    scheduler = RequestScheduler(
+        requests_per_second=config.get('requests_per_second', 10.0),
+        burst=config.get('burst'),
+        max_in_flight=config.get('max_in_flight', 16),
+        max_retries=config.get('max_retries', 5),
+        backoff_base=config.get('backoff_base', 0.5),
+        backoff_max=config.get('backoff_max', 30.0),
+        max_retry_after=config.get('max_retry_after', 120.0)
+    )
+    with _default_lock:
+        _default_scheduler = scheduler
+    return scheduler
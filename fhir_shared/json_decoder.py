@@ -0,0 +1,194 @@
+"""
+JSON Decoder Module
+可替換的 FHIR Bundle JSON 解碼後端：
+- orjson：C 實作，整頁一次解碼（已安裝時為預設）
+- json：標準函式庫
+- stream：增量解析器，資料一邊下載一邊產生 entry[].resource
+"""
+
+import json
+import codecs
+import logging
+from typing import Dict, Any, Iterable, Iterator, Optional
+
+try:
+    import orjson
+except ImportError:  # 選用套件：未安裝時退回標準 json
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+class JSONDecoderBackend:
+    """整頁解碼後端（標準 json）"""
+    
+    name = 'json'
+    # True 表示支援 iter_entries，可在下載過程中逐筆產生資源
+    incremental = False
+    
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class OrjsonDecoderBackend(JSONDecoderBackend):
+    """orjson 解碼後端（C 實作，解碼速度約為標準 json 的數倍）"""
+    
+    name = 'orjson'
+    
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+class StreamingDecoderBackend(JSONDecoderBackend):
+    """增量解碼後端：以 StreamingBundleParser 逐筆產生 Bundle.entry"""
+    
+    name = 'stream'
+    incremental = True
+    
+    def iter_entries(self, chunks: Iterable[bytes]) -> 'StreamingBundleParser':
+        return StreamingBundleParser(chunks)
+
+
+class StreamingBundleParser:
+    """
+    FHIR Bundle 增量解析器
+    
+    以 raw_decode 逐一解析最上層物件的每個欄位；'entry' 陣列中的元素在完整
+    下載後立即產生，不需等待整個 Bundle 下載完畢，記憶體中也不會保留整頁。
+    迭代結束後，其餘最上層欄位（total、link 等）可由 bundle 屬性取得。
+    
+    用法:
+        parser = StreamingBundleParser(response.iter_content(65536))
+        for entry in parser:
+            ...
+        next_link = parser.bundle.get('link')
+    """
+    
+    _WHITESPACE = ' \t\n\r'
+    
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8-sig')()  # 容許 BOM
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self.bytes_read = 0
+        self.bundle: Dict[str, Any] = {}
+    
+    def _fill(self) -> bool:
+        """讀入下一個 chunk；已讀完時回傳 False"""
+        if self._eof:
+            return False
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._eof = True
+            self._buffer = self._buffer[self._pos:] + self._utf8.decode(b'', final=True)
+            self._pos = 0
+            return False
+        
+        self.bytes_read += len(chunk)
+        # 丟棄已解析的部分，避免緩衝區無限增長
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(chunk)
+        self._pos = 0
+        return True
+    
+    def _peek(self) -> str:
+        """略過空白並回傳下一個字元（必要時讀入更多資料）"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in self._WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError("Bundle JSON 不完整")
+    
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"Bundle JSON 格式錯誤：預期 '{char}'，位置 {self.bytes_read}")
+        self._pos += 1
+    
+    def _value(self) -> Any:
+        """解析下一個完整的 JSON 值；資料不足時讀入更多再重試"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # 數字可能被 chunk 邊界截斷（例如 "12|34"），需確認其後已有分隔字元
+            if end == len(self._buffer) and not self._eof and isinstance(value, (int, float)):
+                self._fill()
+                continue
+            self._pos = end
+            return value
+    
+    def __iter__(self) -> Iterator[Dict]:
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        
+        while True:
+            key = self._value()
+            self._expect(':')
+            
+            if key == 'entry' and self._peek() == '[':
+                self._pos += 1
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        separator = self._peek()
+                        self._pos += 1
+                        if separator == ']':
+                            break
+                        if separator != ',':
+                            raise ValueError(f"Bundle.entry 格式錯誤：非預期字元 '{separator}'")
+            else:
+                self.bundle[key] = self._value()
+            
+            separator = self._peek()
+            self._pos += 1
+            if separator == '}':
+                break
+            if separator != ',':
+                raise ValueError(f"Bundle JSON 格式錯誤：非預期字元 '{separator}'")
+        
+        # 讀完剩餘資料（連線才能歸還連線池）
+        while self._fill():
+            pass
+
+
+DECODER_BACKENDS = {
+    'json': JSONDecoderBackend,
+    'orjson': OrjsonDecoderBackend,
+    'stream': StreamingDecoderBackend,
+}
+
+
+def get_decoder(name: Optional[str] = 'auto') -> JSONDecoderBackend:
+    """
+    取得 JSON 解碼後端
+    
+    Args:
+        name: 'auto'（orjson 可用時使用 orjson，否則 json）、'orjson'、'json' 或 'stream'
+    
+    Returns:
+        解碼後端實例
+    """
+    if name in (None, 'auto'):
+        name = 'orjson' if orjson is not None else 'json'
+    
+    if name == 'orjson' and orjson is None:
+        logger.warning("未安裝 orjson 套件，改用標準 json 解碼 (pip install orjson)")
+        name = 'json'
+    
+    if name not in DECODER_BACKENDS:
+        raise ValueError(f"未知的 JSON 解碼後端: {name}（可用: auto, {', '.join(DECODER_BACKENDS)}）")
+    
+    return DECODER_BACKENDS[name]()
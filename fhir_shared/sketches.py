@@ -0,0 +1,260 @@
+"""
+Statistics Sketches Module
+近似統計用的固定記憶體摘要（sketch），可合併（各伺服器或 shard 分別累計後 merge）：
+
+    HyperLogLog      不重複病人數，相對標準誤差 1.04 / √(2^precision)（precision=14 約 0.81%，16 KB）
+    QuantileSketch   年齡、住院日數等數值的分位數（DDSketch：對數分桶，每個分位數的相對誤差 ≤ relative_accuracy）
+
+輸出時以 summary() 同時回報估計值與誤差範圍
+"""
+
+import math
+from typing import Dict, Iterable, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+# 95% 信賴區間的 z 值（HyperLogLog 的誤差近似常態分布）
+Z_95 = 1.96
+
+DEFAULT_PRECISION = 14
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BUCKETS = 2048
+DEFAULT_QUANTILES = (0.5, 0.9)
+
+# MurmurHash3 fmix64 的乘數
+_FMIX_MULTIPLIERS = (np.uint64(0xff51afd7ed558ccd), np.uint64(0xc4ceb9fe1a85ec53))
+
+
+class HyperLogLog:
+    """
+    HyperLogLog 不重複計數
+    
+    值以 pandas 的 64 位元雜湊（固定金鑰，不同行程結果相同）再經 fmix64 打散，取前 precision 位元為暫存器索引，
+    其餘位元的前導零個數 + 1 為暫存器值；記憶體固定為 2^precision 個位元組，與資料量無關。
+    """
+    
+    def __init__(self, precision: int = DEFAULT_PRECISION):
+        """
+        Args:
+            precision: 暫存器索引位元數（4–18；每增加 1，誤差約減為 1/√2、記憶體加倍）
+        """
+        if not 4 <= precision <= 18:
+            raise ValueError(f"HyperLogLog precision 必須介於 4 與 18: {precision}")
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+    
+    def add(self, value):
+        """加入一個值（None 不計）"""
+        self.update([value])
+    
+    def update(self, values: Iterable):
+        """加入多個值（list / Series / ndarray，向量化計算；None / NaN 不計）"""
+        values = pd.Series(values, dtype=object) if not isinstance(values, pd.Series) else values
+        values = values.dropna()
+        if values.empty:
+            return
+        hashes = _fmix64(pd.util.hash_array(values.astype(str).to_numpy(dtype=object)))
+        rest_bits = 64 - self.precision
+        index = (hashes >> np.uint64(rest_bits)).astype(np.intp)
+        rest = hashes & np.uint64((1 << rest_bits) - 1)
+        # rest < 2^50 可精確轉為 float64，frexp 的指數即為位元長度（rest = 0 時為 0）
+        _, bit_length = np.frexp(rest.astype(np.float64))
+        rank = (rest_bits - bit_length + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+    
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        """併入另一個 HyperLogLog（precision 必須相同；回傳自己）"""
+        if other.precision != self.precision:
+            raise ValueError(f"無法合併 precision 不同的 HyperLogLog: {self.precision} / {other.precision}")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+    
+    @property
+    def relative_standard_error(self) -> float:
+        """估計值的相對標準誤差 1.04 / √m"""
+        return 1.04 / math.sqrt(len(self.registers))
+    
+    def count(self) -> int:
+        """不重複值個數的估計（基數小時改用線性計數）"""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / float(np.ldexp(1.0, -self.registers.astype(np.int64)).sum())
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+    
+    def summary(self) -> Dict[str, float]:
+        """估計值與 95% 信賴區間"""
+        estimate = self.count()
+        margin = Z_95 * self.relative_standard_error * estimate
+        return {
+            'estimate': estimate,
+            'relative_standard_error': round(self.relative_standard_error, 4),
+            'lower': max(0, int(math.floor(estimate - margin))),
+            'upper': int(math.ceil(estimate + margin)),
+        }
+
+
+class QuantileSketch:
+    """
+    可合併的分位數 sketch（DDSketch）
+    
+    正值 x 放入第 ceil(log_γ x) 桶（γ = (1 + α) / (1 - α)），以桶的代表值回答分位數，
+    相對誤差 ≤ α；≤ 0 的值另外計數（以 0 回答）。桶數超過 max_buckets 時合併最小的桶（只影響最低的分位數），
+    因此記憶體固定。筆數、總和、最小與最大值為精確值。
+    """
+    
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+                 max_buckets: int = DEFAULT_MAX_BUCKETS):
+        """
+        Args:
+            relative_accuracy: 分位數的相對誤差上限 α（0 < α < 1）
+            max_buckets: 桶數上限
+        """
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"relative_accuracy 必須介於 0 與 1: {relative_accuracy}")
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+    
+    def add(self, value: float):
+        """加入一個值（None / NaN 不計；逐筆累計時不經過 pandas）"""
+        if value is None or value != value:
+            return
+        value = float(value)
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if value > 0:
+            key = math.ceil(math.log(value) / self._log_gamma)
+            if key in self.buckets:
+                self.buckets[key] += 1
+            else:
+                self.buckets[key] = 1
+                self._collapse()
+        else:
+            self.zero_count += 1
+    
+    def update(self, values: Iterable[float]):
+        """加入多個值（向量化計算；None / NaN 不計）"""
+        values = pd.to_numeric(pd.Series(values, dtype=object) if not isinstance(values, pd.Series) else values,
+                               errors='coerce').dropna().to_numpy(dtype=np.float64)
+        if not len(values):
+            return
+        self.count += len(values)
+        self.sum += float(values.sum())
+        low, high = float(values.min()), float(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+        if len(positive):
+            keys, counts = np.unique(np.ceil(np.log(positive) / self._log_gamma).astype(np.int64),
+                                     return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                self.buckets[key] = self.buckets.get(key, 0) + count
+            self._collapse()
+    
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        """併入另一個 sketch（relative_accuracy 必須相同；回傳自己）"""
+        if other.gamma != self.gamma:
+            raise ValueError("無法合併 relative_accuracy 不同的 QuantileSketch")
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        self._collapse()
+        return self
+    
+    def _collapse(self):
+        """桶數超過上限時，把最小的桶併入第 max_buckets 小的桶"""
+        if len(self.buckets) <= self.max_buckets:
+            return
+        keys = sorted(self.buckets)
+        excess = len(keys) - self.max_buckets
+        target = keys[excess]
+        self.buckets[target] += sum(self.buckets.pop(key) for key in keys[:excess])
+    
+    def quantile(self, q: float) -> Optional[float]:
+        """第 q 分位數的估計（0 ≤ q ≤ 1；沒有資料時回傳 None）"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        cumulative = self.zero_count
+        for key in sorted(self.buckets):
+            cumulative += self.buckets[key]
+            if cumulative > rank:
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+    
+    def mean(self) -> Optional[float]:
+        return self.sum / self.count if self.count else None
+    
+    def summary(self, quantiles: Sequence[float] = DEFAULT_QUANTILES, digits: int = 1) -> Dict:
+        """筆數、平均、最小 / 最大值（精確）與各分位數的估計值及誤差範圍"""
+        result = {
+            'count': self.count,
+            'mean': round(self.mean(), digits) if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'relative_accuracy': self.relative_accuracy,
+            'quantiles': {},
+        }
+        for q in quantiles:
+            value = self.quantile(q)
+            if value is None:
+                continue
+            # 真實值 x 滿足 |value - x| ≤ α·x
+            lower = value / (1 + self.relative_accuracy) if value > 0 else value
+            upper = value / (1 - self.relative_accuracy) if value > 0 else value
+            result['quantiles'][f"p{round(q * 100):g}"] = {
+                'value': round(value, digits),
+                'lower': round(max(lower, self.min), digits),
+                'upper': round(min(upper, self.max), digits),
+            }
+        return result
+
+
+def _fmix64(hashes: np.ndarray) -> np.ndarray:
+    """
+    MurmurHash3 的 fmix64 終結混合（就地修改並回傳）
+    
+    pandas 雜湊的高低位元並非完全獨立，直接用於 HyperLogLog 時估計值偏高約 2%；混合後與密碼學雜湊相當
+    """
+    shift = np.uint64(33)
+    with np.errstate(over='ignore'):
+        for multiplier in _FMIX_MULTIPLIERS:
+            hashes ^= hashes >> shift
+            hashes *= multiplier
+        hashes ^= hashes >> shift
+    return hashes
+
+
+def sketch_options(config: Optional[Dict]) -> Optional[Dict]:
+    """approximate_statistics 設定 → 啟用時回傳參數，否則 None"""
+    config = config or {}
+    if not config.get('enabled', False):
+        return None
+    return {
+        'precision': config.get('hll_precision', DEFAULT_PRECISION),
+        'relative_accuracy': config.get('relative_accuracy', DEFAULT_RELATIVE_ACCURACY),
+    }
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import requests, urllib3, json
+
+from fhir_shared.code_sets import value_set
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # 完全模擬 JavaScript 的查詢
@@ -42,7 +45,7 @@ if total == 0:
     exit(0)
 
 # 執行計算邏輯
-eswlCodes = ['80146002', '0TF00ZZ', '0TF10ZZ', '0TF20ZZ']
+eswlCodes = value_set('eswl')
 eswlPatients = set()
 eswlTotalCount = 0
 
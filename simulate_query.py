@@ -9,6 +9,8 @@ import json
 import urllib3
 from datetime import datetime
 
+from fhir_shared.code_sets import value_set
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 fhir_server = "https://thas.mohw.gov.tw/v/r4/fhir"
@@ -24,7 +26,7 @@ print("=" * 60)
 print()
 
 # 剖腹產醫令代碼
-cesareanCodes = ['81004C', '81005C', '81028C', '81029C', '97009C', '97014C']
+cesareanCodes = value_set('cesarean')
 # 自然產醫令代碼
 vaginalCodes = ['81017C', '81018C', '81019C', '81024C', '81025C', '81026C', '81034C', '97004C', '97005D', '97934C']
 
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import requests, json, urllib3
+
+from fhir_shared.code_sets import value_set
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 fhir_server = "https://thas.mohw.gov.tw/v/r4/fhir"
@@ -30,7 +33,7 @@ if response.status_code == 200:
     print(f"   找到 {total} 筆 Procedure")
     
     # 檢查我們的測試資料
-    eswlCodes = ['80146002', '0TF00ZZ', '0TF10ZZ', '0TF20ZZ']
+    eswlCodes = value_set('eswl')
     eswlPatients = set()
     eswlTotalCount = 0
     found_our_data = []
@@ -7,6 +7,7 @@ Creates 6 patients who visited ED within 3 days after discharge
 import requests
 import json
 import urllib3
+from fhir_shared.fhir_scheduler import get_scheduler
 
 # 關閉 SSL 警告
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -38,7 +39,7 @@ def upload_bundle(bundle_file):
     }
     
     try:
-        response = requests.post(
+        response = get_scheduler().post(
             FHIR_SERVER,
             json=bundle,
             headers=headers,
@@ -8,6 +8,7 @@ import requests
 import json
 from datetime import datetime
 import urllib3
+from fhir_shared.fhir_scheduler import get_scheduler
 
 # 關閉 SSL 警告（僅用於測試環境）
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -41,7 +42,7 @@ def upload_bundle(bundle_file):
     }
     
     try:
-        response = requests.post(
+        response = get_scheduler().post(
             FHIR_SERVER,
             json=bundle,
             headers=headers,
@@ -5,9 +5,9 @@
 上傳 6 個剖腹產患者到 FHIR 伺服器
 """
 
-import requests
 import json
 import urllib3
+from fhir_shared.fhir_scheduler import get_scheduler
 
 # 停用 SSL 警告（僅用於測試環境）
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -42,7 +42,7 @@ def upload_test_data():
             'Accept': 'application/fhir+json'
         }
         
-        response = requests.post(
+        response = get_scheduler().post(
             fhir_server,
             json=bundle,
             headers=headers,
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import requests, json, urllib3
+import json, urllib3
+from fhir_shared.fhir_scheduler import get_scheduler
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # 讀取並修改日期
@@ -16,7 +17,7 @@ content = content.replace('2021-', '2023-')
 
 bundle = json.loads(content)
 
-response = requests.post(
+response = get_scheduler().post(
     'https://thas.mohw.gov.tw/v/r4/fhir',
     json=bundle,
     headers={'Content-Type': 'application/fhir+json'},
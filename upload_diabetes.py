@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import requests, json, urllib3
+import json, urllib3
+from fhir_shared.fhir_scheduler import get_scheduler
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 with open('test_data_diabetes_2_patients.json', 'r', encoding='utf-8') as f:
     bundle = json.load(f)
 
-response = requests.post(
+response = get_scheduler().post(
     'https://thas.mohw.gov.tw/v/r4/fhir',
     json=bundle,
     headers={'Content-Type': 'application/fhir+json'},
@@ -1,5 +1,5 @@
-import requests
 import json
+from fhir_shared.fhir_scheduler import get_scheduler
 
 # FHIR server URL
 FHIR_SERVER = "https://thas.mohw.gov.tw/v/r4/fhir"
@@ -12,7 +12,7 @@ with open('test_data_prostate_overlap_4_patients_2025Q4.json', 'r', encoding='ut
 print(f"正在上傳前列腺肥大藥物重疊測試資料到 {FHIR_SERVER}...")
 print(f"資料包含: {len(bundle['entry'])} 個資源")
 
-response = requests.post(
+response = get_scheduler().post(
     FHIR_SERVER,
     json=bundle,
     headers={'Content-Type': 'application/fhir+json'}
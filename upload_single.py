@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
-import requests, json, urllib3
+import json, urllib3
+from fhir_shared.fhir_scheduler import get_scheduler
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 with open('test_single_cesarean.json', 'r', encoding='utf-8') as f:
     bundle = json.load(f)
 
-response = requests.post(
+response = get_scheduler().post(
     'https://thas.mohw.gov.tw/v/r4/fhir',
     json=bundle,
     headers={'Content-Type': 'application/fhir+json'},